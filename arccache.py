@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+
+On-disk cache of ARC wavelength solutions.
+
+Each solved ARC is stored under a key made from its spectral setup (the
+GRATING, GR-ANGLE, CAMANG, CCDSUM and LAMPID headers) and a hash of the
+raw file content. For each key the cache holds the calibrated ARC mosaic
+(ARC_m_*.fits, including WAVELENGTH, WL_MODEL_2D and SIMULATION extensions),
+which is all later reduction steps need from an ARC; a cached ARC is
+therefore not solved again.
+
+As the key depends on the file content, the cache directory can be shared
+between nights: re-reducing a night, or another night re-using the same
+calibration frames, does not have to solve any ARC again.
+
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import logging
+from astropy.io import fits
+
+import pysalt.mp_logging
+
+
+setup_headers = [
+    'GRATING',
+    'GR-ANGLE',
+    'CAMANG',
+    'CCDSUM',
+    'LAMPID',
+]
+
+
+def file_hash(filename, blocksize=2**20):
+    """
+
+    Compute the SHA1 checksum of the content of a file.
+
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while (True):
+            block = f.read(blocksize)
+            if (not block):
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def setup_string(header, keys=None):
+    """
+
+    Convert the spectral setup of a frame (by default the setup_headers) into
+    a string that is safe to use as part of a filename, e.g.
+    PG0900_13.625_27.250_2x2_Ar
+
+    """
+    parts = []
+    for key in (setup_headers if keys is None else keys):
+        value = header[key] if key in header else "none"
+        if (type(value) == float):
+            value = "%.3f" % (value)
+        elif (key == 'CCDSUM'):
+            value = "x".join(str(value).split())
+        parts.append(str(value).strip().replace(" ", ""))
+    return "_".join(parts).replace(os.sep, "-")
+
+
+def cache_key(filename, header=None):
+    """
+
+    Return the cache key for the raw ARC frame filename.
+
+    """
+    if (header is None):
+        header = fits.getheader(filename, 0)
+    return "%s__%s" % (setup_string(header), file_hash(filename)[:16])
+
+
+def cache_filename(cachedir, key):
+    return os.path.join(cachedir, "%s.fits" % (key))
+
+
+def lookup(cachedir, key):
+    """
+
+    Return the filename of the cached ARC mosaic for key, or None if this
+    ARC has not been solved before.
+
+    """
+    if (cachedir is None):
+        return None
+    fn = cache_filename(cachedir, key)
+    return fn if os.path.isfile(fn) else None
+
+
+def _atomic_copy(src, dest):
+    # write to a temporary file first, so a concurrent reader (or a crash)
+    # never sees a partially written file
+    tmp = "%s.%d.tmp" % (dest, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.rename(tmp, dest)
+
+
+def store(cachedir, key, arc_mosaic_filename):
+    """
+
+    Add a solved ARC to the cache.
+
+    """
+    logger = logging.getLogger("ArcCache")
+    if (cachedir is None):
+        return
+
+    if (not os.path.isdir(cachedir)):
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            # most likely created by another process in the meantime
+            pass
+
+    _atomic_copy(arc_mosaic_filename, cache_filename(cachedir, key))
+
+    logger.info("Added %s to ARC cache (%s)" % (arc_mosaic_filename, key))
+
+
+def restore(cachedir, key, arc_mosaic_filename):
+    """
+
+    Copy the cached ARC mosaic for key to arc_mosaic_filename. Returns True
+    if the ARC was found in the cache.
+
+    """
+    cached_fn = lookup(cachedir, key)
+    if (cached_fn is None):
+        return False
+    pysalt.clobberfile(arc_mosaic_filename)
+    shutil.copyfile(cached_fn, arc_mosaic_filename)
+    return True
+
+
+if __name__ == "__main__":
+
+    logger_setup = pysalt.mp_logging.setup_logging()
+    logger = logging.getLogger("ArcCache")
+
+    cachedir = sys.argv[1]
+    for filename in sys.argv[2:]:
+        key = cache_key(filename)
+        logger.info("%s: %s (%s)" % (
+            filename, key,
+            "cached" if lookup(cachedir, key) is not None else "not cached"))
+
+    pysalt.mp_logging.shutdown_logging(logger_setup)
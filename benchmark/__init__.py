@@ -0,0 +1,16 @@
+"""
+
+Synthetic inputs and per-stage benchmarks for the RSS longslit pipeline.
+
+    synthetic   generator for 6-amplifier RSS frames and mosaics (ARC and
+                OBJECT frames) with known wavelength solution, sky, sources
+                and cosmics
+    runner      times and memory-profiles each pipeline stage in isolation
+                and writes a JSON report that can be compared across commits
+
+Run from the top-level directory of the pipeline, e.g.
+
+    python -m benchmark.runner --binning=2x2,4x4 --output=bench.json
+    python -m benchmark.runner --compare old.json new.json
+
+"""
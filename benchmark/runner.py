@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+
+"""
+
+Time and memory-profile the main stages of the pipeline on synthetic
+frames (see benchmark.synthetic).
+
+Each stage runs in isolation: all of its inputs (e.g. the wavelength
+solution the 2-d tracing starts from) are prepared first, and only the stage
+itself is measured. Every repetition runs in a separate forked process, in a
+scratch directory (stages write some files into the current directory), so
+the memory measurement of one stage is not affected by memory left over
+from other stages.
+
+For each stage the report contains wall-clock and CPU time (user + system,
+summed over all threads) of each repetition, the peak resident memory
+during the stage, and the increase of the peak over the memory in use when
+the stage started. Stages that can not be imported (e.g. because pysalt is
+not installed) are reported as skipped.
+
+The JSON report also records git commit, host and software versions, so
+reports from different commits can be compared with --compare.
+
+Usage:
+
+    python -m benchmark.runner --binning=2x2,4x4 --repeat=3 --output=bench.json
+    python -m benchmark.runner --compare before.json after.json
+
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import platform
+import tempfile
+import resource
+import traceback
+import subprocess
+import multiprocessing
+import logging
+import gc
+from optparse import OptionParser
+
+import numpy
+import scipy
+
+# stages run in scratch directories, so make sure the pipeline modules can
+# still be imported from there
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from benchmark import synthetic
+
+
+report_version = 1
+
+
+#
+# Setup for each stage: prepare all inputs, and return the function that
+# runs the stage.
+#
+
+def setup_find_wavelength_solution(frames, params):
+    import wlcal
+    arc = frames['arc']
+    line = arc['SCI'].data.shape[0] / 2
+    return lambda: wlcal.find_wavelength_solution(arc, line)
+
+
+def setup_compute_2d_wavelength_solution(frames, params):
+    import wlcal
+    import traceline
+    arc = frames['arc']
+    wls_data = wlcal.find_wavelength_solution(
+        arc, arc['SCI'].data.shape[0] / 2)
+    if (wls_data is None):
+        raise RuntimeError("No wavelength solution for the ARC frame")
+    return lambda: traceline.compute_2d_wavelength_solution(
+        arc_filename=arc,
+        n_lines_to_trace=-15,
+        fit_order=[2, 2],
+        trace_every=0.05,
+        wls_data=wls_data,
+        return_traces=True,
+    )
+
+
+def setup_optimal_sky_subtraction(frames, params):
+    import optimal_spline_basepoints
+    obj = frames['object']
+    return lambda: optimal_spline_basepoints.optimal_sky_subtraction(
+        obj,
+        sky_regions=None,
+        N_points=600,
+        iterate=False,
+        skiplength=5,
+        image_data=obj['SCI'].data,
+        obj_wl=obj['WAVELENGTH'].data,
+    )
+
+
+def setup_create_2d_flatfield_from_sky(frames, params):
+    import fiddle_slitflat2
+    obj = frames['object']
+    return lambda: fiddle_slitflat2.create_2d_flatfield_from_sky(
+        wl=obj['WAVELENGTH'].data,
+        img=obj['SCI'].data,
+        bad_rows=None,
+    )
+
+
+def setup_lacosmics(frames, params):
+    import podi_cython
+    amplifiers = frames['amplifiers']
+    jobs = [(numpy.ascontiguousarray(ext.data, dtype=numpy.float64),
+             ext.header['GAIN'], ext.header['RDNOISE'])
+            for ext in amplifiers if ext.name == 'SCI']
+
+    def run():
+        return [podi_cython.lacosmics(
+            data, gain=gain, readnoise=readnoise,
+            sigclip=5.0, sigfrac=0.6, objlim=5.0, niter=3,
+            saturation_limit=65000, verbose=False)
+            for data, gain, readnoise in jobs]
+    return run
+
+
+def _skysub_inputs(frames):
+    obj = frames['object']
+    return (obj['SCI'].data - obj['SKY.TRUE'].data, obj['VAR'].data,
+            obj['WAVELENGTH'].data, obj['TRACEOFFSET'].data,
+            obj['SOURCES'].data)
+
+
+def setup_optimal_extract(frames, params):
+    import optimal_extraction
+    data, var, wl, trace_offset, sources = _skysub_inputs(frames)
+    source = sources[0]
+    center_x = data.shape[1] / 2
+    width = 2 * (source[3] - source[2])
+    source_profile_2d = optimal_extraction.generate_source_profile(
+        data=data, variance=var, wavelength=wl, trace_offset=trace_offset,
+        position=[center_x, source[0]], width=width)
+    optimal_weight = optimal_extraction.integrate_source_profile(
+        width=width, supersample=2, profile2d=source_profile_2d,
+        wl_resolution=-5)
+    mean_dispersion = (numpy.nanmax(wl) - numpy.nanmin(wl)) / wl.shape[1]
+    return lambda: optimal_extraction.optimal_extract(
+        img_data=data,
+        wl_data=wl,
+        variance_data=var,
+        trace_offset=trace_offset,
+        optimal_weight=optimal_weight,
+        opt_weight_center_y=source[0],
+        reference_x=center_x,
+        reference_y=source[0],
+        y_ranges=[source[2:4] - source[0]],
+        dwl=0.5 * mean_dispersion,
+    )
+
+
+def setup_rectify_full_spec(frames, params):
+    import rectify_fullspec
+    data, var, wl, trace_offset, _ = _skysub_inputs(frames)
+    return lambda: rectify_fullspec.rectify_full_spec(
+        data=data, var=var, wavelength=wl, traceoffset=trace_offset,
+        n_threads=params['threads'])
+
+
+stages = [
+    ('find_wavelength_solution', setup_find_wavelength_solution),
+    ('compute_2d_wavelength_solution', setup_compute_2d_wavelength_solution),
+    ('optimal_sky_subtraction', setup_optimal_sky_subtraction),
+    ('create_2d_flatfield_from_sky', setup_create_2d_flatfield_from_sky),
+    ('lacosmics', setup_lacosmics),
+    ('optimal_extract', setup_optimal_extract),
+    ('rectify_full_spec', setup_rectify_full_spec),
+]
+
+
+#
+# Measurements
+#
+
+def _proc_status():
+    # current and peak resident memory (in MB) from /proc, if available
+    status = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if (key in ('VmRSS', 'VmHWM')):
+                    status[key] = int(value.split()[0]) / 1024.
+    except IOError:
+        pass
+    return status
+
+
+def _reset_peak_memory():
+    # Linux (>= 4.0) allows resetting the peak resident memory of a process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except IOError:
+        return False
+
+
+def _current_memory():
+    status = _proc_status()
+    return status.get('VmRSS', numpy.NaN)
+
+
+def _peak_memory():
+    status = _proc_status()
+    if ('VmHWM' in status):
+        return status['VmHWM']
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _measure_stage(setup, frames, params, workdir, conn):
+    # runs in the forked process
+    try:
+        os.chdir(workdir)
+        try:
+            run = setup(frames, params)
+        except ImportError as e:
+            conn.send({'status': 'skipped', 'error': str(e)})
+            return
+
+        gc.collect()
+        peak_reset = _reset_peak_memory()
+        memory_before = _current_memory()
+        if (not peak_reset):
+            memory_before = _peak_memory()
+
+        cpu_start = _cpu_time()
+        wall_start = time.time()
+        result = run()
+        wall_time = time.time() - wall_start
+        cpu_time = _cpu_time() - cpu_start
+        peak_memory = _peak_memory()
+
+        conn.send({
+            'status': 'ok' if result is not None else 'failed',
+            'error': None if result is not None else "stage returned no result",
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'memory_before_mb': memory_before,
+            'peak_memory_mb': peak_memory,
+            'memory_increase_mb': peak_memory - memory_before,
+            'peak_memory_reset': peak_reset,
+        })
+    except Exception as e:
+        conn.send({'status': 'failed',
+                   'error': "%s: %s" % (e.__class__.__name__, str(e)),
+                   'traceback': traceback.format_exc()})
+    finally:
+        conn.close()
+
+
+def benchmark_stage(name, setup, frames, params, repeat=3, keep_files=False):
+    """
+
+    Run stage repeat times, each time in a new process, and summarize time
+    and memory usage.
+
+    """
+    logger = logging.getLogger("Benchmark")
+
+    runs = []
+    for i in range(repeat):
+        workdir = tempfile.mkdtemp(prefix="rssbench_%s_" % (name))
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_measure_stage,
+            args=(setup, frames, params, workdir, child_conn))
+        process.start()
+        child_conn.close()
+        try:
+            run = parent_conn.recv()
+        except EOFError:
+            run = None
+        process.join()
+        if (not keep_files):
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if (run is None):
+            run = {'status': 'failed',
+                   'error': "process died with exit code %s" % (
+                       process.exitcode)}
+        runs.append(run)
+        if (run['status'] != 'ok'):
+            logger.warning("%s: %s (%s)" % (name, run['status'], run['error']))
+            break
+        logger.info("%s: run %d of %d: %.3f s (cpu: %.3f s), peak memory "
+                    "%.1f MB (+%.1f MB)" % (
+                        name, i + 1, repeat, run['wall_time'], run['cpu_time'],
+                        run['peak_memory_mb'], run['memory_increase_mb']))
+
+    if (runs[-1]['status'] != 'ok'):
+        return runs[-1]
+
+    wall_times = [run['wall_time'] for run in runs]
+    return {
+        'status': 'ok',
+        'repeat': repeat,
+        'wall_time': wall_times,
+        'cpu_time': [run['cpu_time'] for run in runs],
+        'wall_time_min': numpy.min(wall_times),
+        'wall_time_median': numpy.median(wall_times),
+        'peak_memory_mb': numpy.max([run['peak_memory_mb'] for run in runs]),
+        'memory_increase_mb': numpy.max(
+            [run['memory_increase_mb'] for run in runs]),
+        'peak_memory_reset': runs[0]['peak_memory_reset'],
+    }
+
+
+def create_frames(binning, seed=1):
+    """
+
+    All synthetic frames the stages need: ARC and OBJECT mosaic, and the
+    OBJECT frame as separate amplifiers.
+
+    """
+    frames = {}
+    frames['arc'] = synthetic.create_frame(
+        binning=binning, obstype='ARC', seed=seed)
+    frames['object'] = synthetic.create_frame(
+        binning=binning, obstype='OBJECT', seed=seed + 1)
+    frames['amplifiers'] = synthetic.split_amplifiers(frames['object'])
+    return frames
+
+
+def _git_info():
+    info = {'commit': None, 'dirty': None}
+    try:
+        info['commit'] = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=repo_dir).strip()
+        info['dirty'] = len(subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=repo_dir).strip()) > 0
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def _host_info():
+    return {
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'scipy': scipy.__version__,
+    }
+
+
+def run_benchmarks(binnings, stage_names=None, repeat=3, seed=1, threads=None,
+                   keep_files=False):
+    """
+
+    Benchmark all stages (or only those in stage_names) for each binning,
+    and return the report.
+
+    """
+    logger = logging.getLogger("Benchmark")
+
+    params = {'threads': threads}
+    report = {
+        'version': report_version,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'git': _git_info(),
+        'host': _host_info(),
+        'settings': {'repeat': repeat, 'seed': seed, 'threads': threads},
+        'results': {},
+    }
+
+    for binning in binnings:
+        logger.info("Creating synthetic frames with binning %s" % (binning))
+        start = time.time()
+        frames = create_frames(binning, seed=seed)
+        results = {
+            'frame_shape': list(frames['object']['SCI'].data.shape),
+            'generate_time': time.time() - start,
+            'stages': {},
+        }
+        for name, setup in stages:
+            if (stage_names is not None and name not in stage_names):
+                continue
+            logger.info("Benchmarking %s (binning %s)" % (name, binning))
+            results['stages'][name] = benchmark_stage(
+                name, setup, frames, params, repeat=repeat,
+                keep_files=keep_files)
+        report['results'][binning] = results
+        del frames
+
+    return report
+
+
+def _json_default(obj):
+    # numpy scalars
+    if (isinstance(obj, numpy.generic)):
+        return obj.item()
+    raise TypeError("%s is not JSON serializable" % (repr(obj)))
+
+
+def write_report(report, filename):
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True, default=_json_default)
+
+
+def compare_reports(old, new):
+    """
+
+    Compare two reports, returning one row (binning, stage, old and new
+    minimum wall time, their ratio, old and new peak memory increase) for
+    each stage measured in both.
+
+    """
+    rows = []
+    for binning in sorted(set(old['results']) & set(new['results'])):
+        old_stages = old['results'][binning]['stages']
+        new_stages = new['results'][binning]['stages']
+        for name, _ in stages:
+            if (name not in old_stages or name not in new_stages):
+                continue
+            o, n = old_stages[name], new_stages[name]
+            if (o['status'] != 'ok' or n['status'] != 'ok'):
+                rows.append((binning, name, o['status'], n['status']))
+                continue
+            rows.append((binning, name,
+                         o['wall_time_min'], n['wall_time_min'],
+                         n['wall_time_min'] / o['wall_time_min'],
+                         o['memory_increase_mb'], n['memory_increase_mb']))
+    return rows
+
+
+def print_comparison(old, new):
+    print "old: %s (%s)" % (old['git']['commit'], old['created'])
+    print "new: %s (%s)" % (new['git']['commit'], new['created'])
+    print "%-6s %-32s %10s %10s %7s %10s %10s" % (
+        "bin", "stage", "old [s]", "new [s]", "ratio", "old [MB]", "new [MB]")
+    for row in compare_reports(old, new):
+        if (len(row) == 4):
+            print "%-6s %-32s %10s %10s" % row
+        else:
+            print "%-6s %-32s %10.3f %10.3f %7.2f %10.1f %10.1f" % row
+
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("", "--binning", dest="binning",
+                      help="comma-separated list of binnings, or 'all'",
+                      default="2x2", type=str)
+    parser.add_option("", "--stages", dest="stages",
+                      help="comma-separated list of stages (default: all)",
+                      default=None, type=str)
+    parser.add_option("", "--repeat", dest="repeat",
+                      help="number of runs of each stage",
+                      default=3, type=int)
+    parser.add_option("", "--seed", dest="seed",
+                      help="random seed for the synthetic frames",
+                      default=1, type=int)
+    parser.add_option("", "--threads", dest="threads",
+                      help="number of threads for multi-threaded stages",
+                      default=None, type=int)
+    parser.add_option("", "--output", dest="output",
+                      help="filename of JSON report",
+                      default=None, type=str)
+    parser.add_option("", "--keep", dest="keep_files",
+                      help="keep the working directory of each stage",
+                      default=False, action="store_true")
+    parser.add_option("", "--compare", dest="compare",
+                      help="compare two reports (given as arguments)",
+                      default=False, action="store_true")
+    parser.add_option("", "--loglevel", dest="loglevel",
+                      help="log level (DEBUG, INFO, WARNING)",
+                      default="INFO", type=str)
+    (options, cmdline_args) = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, options.loglevel.upper()))
+
+    if (options.compare):
+        reports = [json.load(open(fn)) for fn in cmdline_args[:2]]
+        print_comparison(reports[0], reports[1])
+        sys.exit(0)
+
+    binnings = synthetic.binnings if options.binning == 'all' else \
+        options.binning.split(",")
+    stage_names = None if options.stages is None else \
+        options.stages.split(",")
+
+    report = run_benchmarks(binnings, stage_names=stage_names,
+                            repeat=options.repeat, seed=options.seed,
+                            threads=options.threads,
+                            keep_files=options.keep_files)
+
+    output = options.output
+    if (output is None):
+        output = "benchmark_%s.json" % (
+            (report['git']['commit'] or "unknown")[:10])
+    write_report(report, output)
+    logging.getLogger("Benchmark").info("Report written to %s" % (output))
@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+
+"""
+
+Generator for synthetic SALT RSS longslit frames.
+
+Frames look like prepared (bias-subtracted and trimmed) RSS data, either as
+6 separate amplifiers (SCI, VAR and BPM extension for each amplifier, as
+after salt_prepdata) or as mosaic (as returned by tiledata). Wavelengths,
+including the curvature of lines along the slit, follow the RSS model in
+wlmodel.rssmodelwave, so the same headers (GRATING, GR-ANGLE, CAMANG,
+CCDSUM) the pipeline uses for real data describe the synthetic frames.
+
+ARC frames contain the emission lines of the calibration lamp; OBJECT frames
+the night-sky continuum and lines, plus point sources with a slightly curved
+trace. Both include the slit illumination (edges, vignetting and small-scale
+slit-width variations), the throughput of grating and detector, photon and
+read noise, hot columns and cosmic rays.
+
+Each mosaic also carries the truth it was created from:
+
+    WAVELENGTH   wavelength map of each pixel
+    SKY.TRUE     noise-free sky model (OBJECT frames)
+    CRJ.TRUE     pixels hit by cosmic rays
+    TRACEOFFSET  offset of the source trace from its position at the center
+                 column, per column (OBJECT frames)
+    SOURCES      one row per source, columns as in
+                 find_sources.identify_sources (center, peak flux, lower and
+                 upper edge of the source)
+
+All frames are fully determined by their parameters and the random seed.
+
+Usage:
+
+    python -m benchmark.synthetic --binning=2x2 --type=arc arc.fits
+
+"""
+
+import os
+import sys
+import numpy
+import logging
+from optparse import OptionParser
+
+from astropy.io import fits
+
+import pysalt
+import wlmodel
+
+
+#
+# Detector geometry, in unbinned pixels
+#
+n_amplifiers = 6
+amp_width = 1024
+amp_height = 4102
+chip_gap = 100
+pixel_scale = 0.1267  # arcsec/pixel
+
+# range of rows covered by the longslit
+slit_edges = [155, 3945]
+
+# all binnings commonly used for longslit spectroscopy (spectral x spatial)
+binnings = ['1x1', '2x2', '2x4', '4x4']
+
+#
+# Strong night-sky emission lines: wavelength in A, intensity relative to
+# the 5577 [OI] line
+#
+sky_lines = numpy.array([
+    [4358.34, 0.15],  # Hg (light pollution)
+    [5460.74, 0.20],  # Hg (light pollution)
+    [5577.34, 1.00],  # [OI]
+    [5889.95, 0.45],  # NaD
+    [5895.92, 0.35],  # NaD
+    [6300.30, 0.60],  # [OI]
+    [6363.78, 0.20],  # [OI]
+    [6498.73, 0.08],  # OH
+    [6533.04, 0.12],
+    [6553.62, 0.10],
+    [6863.96, 0.25],
+    [6923.22, 0.15],
+    [7316.28, 0.30],
+    [7340.89, 0.30],
+    [7369.25, 0.20],
+    [7401.69, 0.15],
+    [7750.64, 0.35],
+    [7794.11, 0.35],
+    [7821.50, 0.25],
+    [7913.71, 0.40],
+    [7993.33, 0.45],
+    [8344.60, 0.60],
+    [8399.17, 0.55],
+    [8430.17, 0.45],
+    [8465.21, 0.45],
+    [8827.10, 0.70],
+    [8885.85, 0.65],
+    [8919.53, 0.40],
+    [8958.08, 0.70],
+])
+
+#
+# Lines of the calibration lamps (wavelength in A, relative intensity). Only
+# used if the lamp line lists of pysalt can not be found.
+#
+lamp_lines = {
+    'Ar': numpy.array([
+        [4158.59, 0.15], [4200.67, 0.12], [4259.36, 0.08], [4300.10, 0.06],
+        [4333.56, 0.06], [4348.06, 0.10], [4510.73, 0.05], [4545.05, 0.07],
+        [4609.57, 0.08], [4657.90, 0.06], [4726.87, 0.06], [4764.87, 0.08],
+        [4806.02, 0.07], [4879.86, 0.09], [5162.29, 0.05], [5495.87, 0.06],
+        [5606.73, 0.05], [5650.70, 0.04], [5912.09, 0.06], [6032.13, 0.08],
+        [6043.22, 0.06], [6059.37, 0.04], [6416.31, 0.10], [6677.28, 0.15],
+        [6752.83, 0.12], [6871.29, 0.20], [6965.43, 1.00], [7067.22, 0.90],
+        [7147.04, 0.30], [7272.94, 0.40], [7383.98, 0.80], [7503.87, 1.00],
+        [7514.65, 0.60], [7635.11, 0.90], [7723.76, 0.50], [7948.18, 0.80],
+        [8006.16, 0.60], [8014.79, 0.70], [8103.69, 0.80], [8115.31, 1.00],
+        [8264.52, 0.80], [8408.21, 0.70], [8424.65, 0.80], [8521.44, 0.60],
+        [9122.97, 0.90], [9224.50, 0.50], [9657.78, 0.70],
+    ]),
+}
+
+
+def parse_binning(binning):
+    """
+
+    Return binx, biny from binning given as string ("2x4") or pair.
+
+    """
+    if (isinstance(binning, str)):
+        binning = binning.lower().split("x")
+    binx, biny = [int(b) for b in binning]
+    return binx, biny
+
+
+def mosaic_geometry(binx, biny):
+    """
+
+    Size of the binned mosaic and the column range of each amplifier in it,
+    using the same layout as tiledata.
+
+    """
+    width = amp_width // binx
+    height = amp_height // biny
+    columns = []
+    for i in range(n_amplifiers):
+        startx = i * width + int(chip_gap * int(i / 2) / binx)
+        columns.append((startx, startx + width))
+    mosaic_width = n_amplifiers * width + 2 * chip_gap / binx
+    return (height, mosaic_width), columns
+
+
+def rss_header(binning='2x2', obstype='OBJECT', grating='PG0900',
+               grating_angle=15.875, camera_angle=31.75, lamp='Ar',
+               exptime=None):
+    """
+
+    Primary header with all keywords the pipeline uses to select and
+    calibrate a RSS longslit frame.
+
+    """
+    binx, biny = parse_binning(binning)
+    is_arc = (obstype == 'ARC')
+
+    hdr = fits.Header()
+    hdr['INSTRUME'] = 'RSS'
+    hdr['OBJECT'] = 'ARC' if is_arc else 'SYNTHETIC'
+    hdr['OBSTYPE'] = obstype
+    hdr['CCDTYPE'] = obstype
+    hdr['OBSMODE'] = 'SPECTROSCOPY'
+    hdr['PROPID'] = 'BENCHMARK'
+    hdr['DATE-OBS'] = '2016-01-01'
+    hdr['JD'] = 2457388.5
+    hdr['AIRMASS'] = 1.2
+    hdr['EXPTIME'] = (30. if is_arc else 900.) if exptime is None else exptime
+    hdr['CCDSUM'] = "%d %d" % (binx, biny)
+    hdr['MASKID'] = 'PL0150N001'
+    hdr['LAMPID'] = lamp if is_arc else 'NONE'
+    hdr['GRATING'] = grating
+    hdr['GR-ANGLE'] = grating_angle
+    hdr['GRTILT'] = grating_angle
+    hdr['CAMANG'] = camera_angle
+    hdr['AR-ANGLE'] = camera_angle
+    for key, value in [('WP-STATE', 'S1 - Waveplate Inactive'),
+                       ('ET-STATE', 'S1 - Etalon Inactive'),
+                       ('GR-STATE', 'S4 - Grating At Station'),
+                       ('GR-STA', 'S3'),
+                       ('BS-STATE', 'S1 - Beamsplitter Inactive'),
+                       ('FI-STATE', 'S2 - Filter At Station'),
+                       ('AR-STATE', 'S3 - Articulation At Station'),
+                       ('AR-STA', 'S3'),
+                       ('POLCONF', 'OPEN')]:
+        hdr[key] = value
+    hdr['SYNTHETI'] = (True, "synthetic frame for benchmarking")
+    return hdr
+
+
+def wavelength_map(header, shape, binx, biny):
+    return wlmodel.rssmodelwave(
+        header=header,
+        img=numpy.empty(shape, dtype=numpy.uint8),
+        xbin=binx, ybin=biny)
+
+
+def load_lamp_lines(lamp):
+    """
+
+    Line list (wavelength, relative intensity) of the calibration lamp; uses
+    the same lamp line lists as wlcal, if available.
+
+    """
+    logger = logging.getLogger("SynthArc")
+    try:
+        lampfile = pysalt.get_data_filename(
+            "pysalt$data/linelists/%s.txt" % (lamp))
+        lines = numpy.loadtxt(lampfile, ndmin=2)
+    except Exception:
+        lines = None
+    if (lines is None or lines.shape[0] == 0):
+        logger.debug("Using built-in line list for lamp %s" % (lamp))
+        return lamp_lines[lamp]
+    if (lines.shape[1] < 2):
+        lines = numpy.append(lines[:, :1], numpy.ones((lines.shape[0], 1)),
+                             axis=1)
+    lines = numpy.array(lines[:, :2])
+    lines[:, 1] /= numpy.max(lines[:, 1])
+    return lines
+
+
+def line_spectrum(wl_grid, lines, sigma):
+    """
+
+    Sum of gaussian emission lines with peak intensities lines[:,1] on an
+    equidistant wavelength grid.
+
+    """
+    spec = numpy.zeros_like(wl_grid)
+    step = wl_grid[1] - wl_grid[0]
+    half_width = int(numpy.ceil(5 * sigma / step))
+    for center, peak in lines:
+        i = int((center - wl_grid[0]) / step)
+        i1, i2 = max(i - half_width, 0), min(i + half_width + 1, spec.shape[0])
+        if (i2 <= i1):
+            continue
+        spec[i1:i2] += peak * numpy.exp(
+            -0.5 * ((wl_grid[i1:i2] - center) / sigma) ** 2)
+    return spec
+
+
+def throughput(wl, wl_center, wl_range):
+    # combined efficiency of VPH grating and detector, peaking at the
+    # central wavelength
+    return 0.3 + 0.7 * numpy.exp(-0.5 * ((wl - wl_center) / (0.6 * wl_range)) ** 2)
+
+
+def slit_illumination(y):
+    """
+
+    Relative illumination along the slit at (unbinned) row y: sharp slit
+    edges, vignetting towards the ends of the slit, and small-scale
+    variations of the slit width.
+
+    """
+    edge_width = 5.
+    edges = 0.25 * (1 + numpy.tanh((y - slit_edges[0]) / edge_width)) * \
+        (1 + numpy.tanh((slit_edges[1] - y) / edge_width))
+    center = 0.5 * (slit_edges[0] + slit_edges[1])
+    half_length = 0.5 * (slit_edges[1] - slit_edges[0])
+    vignetting = 1. - 0.1 * ((y - center) / half_length) ** 2
+    ripple = 1. + 0.02 * numpy.sin(2 * numpy.pi * y / 700.) + \
+        0.01 * numpy.sin(2 * numpy.pi * y / 93.)
+    return edges * vignetting * ripple
+
+
+def add_cosmics(data, mask, rng, n_cosmics, binx, biny):
+    """
+
+    Add n_cosmics cosmic-ray tracks (random length up to 15 unbinned pixels
+    and direction) to data, marking all affected pixels in mask.
+
+    """
+    if (n_cosmics <= 0):
+        return
+    ny, nx = data.shape
+    y0 = rng.uniform(0, ny, n_cosmics)
+    x0 = rng.uniform(0, nx, n_cosmics)
+    length = rng.uniform(1, 15, n_cosmics)
+    angle = rng.uniform(0, numpy.pi, n_cosmics)
+    charge = rng.uniform(2000, 30000, n_cosmics)
+
+    # sample each track every half (binned) pixel
+    n_steps = numpy.maximum(
+        2 * length / min(binx, biny), 1).astype(numpy.int) + 1
+    track = numpy.repeat(numpy.arange(n_cosmics), n_steps)
+    step = numpy.arange(track.shape[0]) - \
+        numpy.repeat(numpy.cumsum(n_steps) - n_steps, n_steps)
+    frac = step / numpy.maximum(n_steps[track] - 1., 1.)
+    yy = numpy.round(y0[track] + frac * length[track] *
+                     numpy.sin(angle[track]) / biny).astype(numpy.int)
+    xx = numpy.round(x0[track] + frac * length[track] *
+                     numpy.cos(angle[track]) / binx).astype(numpy.int)
+    inside = (yy >= 0) & (yy < ny) & (xx >= 0) & (xx < nx)
+    numpy.add.at(data, (yy[inside], xx[inside]),
+                 (charge / n_steps)[track[inside]])
+    mask[yy[inside], xx[inside]] = 1
+
+
+def create_mosaic(binning='2x2', obstype='OBJECT', seed=1,
+                  grating='PG0900', grating_angle=15.875, camera_angle=31.75,
+                  lamp='Ar',
+                  sky_continuum=30., sky_line_peak=1500., arc_line_peak=3000.,
+                  line_fwhm=4.,
+                  n_sources=2, source_peak=300., seeing=1.5,
+                  cosmics_density=1e-5, n_hot_columns=6,
+                  gain=1.5, readnoise=3., saturation=65535.,
+                  truth=True):
+    """
+
+    Create a mosaiced RSS frame (ARC or OBJECT).
+
+    Fluxes (in ADU per unbinned pixel) are: sky_continuum and sky_line_peak
+    (for the 5577 line), arc_line_peak (brightest lamp line) and source_peak
+    (at the center of the trace, near the central wavelength); line_fwhm is
+    the FWHM of all lines in unbinned pixels, seeing the FWHM (in arcsec) of
+    the spatial profile of sources. cosmics_density is the number of cosmics
+    per unbinned pixel. Pixels are clipped at the saturation level.
+
+    Set truth=False to leave out the SKY.TRUE and CRJ.TRUE extensions.
+
+    """
+    logger = logging.getLogger("SynthRSS")
+
+    binx, biny = parse_binning(binning)
+    rng = numpy.random.RandomState(seed)
+    is_arc = (obstype == 'ARC')
+
+    hdr = rss_header(binning=binning, obstype=obstype, grating=grating,
+                     grating_angle=grating_angle, camera_angle=camera_angle,
+                     lamp=lamp)
+    hdr['SEED'] = (seed, "random seed of synthetic frame")
+
+    shape, columns = mosaic_geometry(binx, biny)
+    logger.info("Creating synthetic %s frame, binning %dx%d, %d x %d pixels" % (
+        obstype, binx, biny, shape[1], shape[0]))
+
+    wl = wavelength_map(hdr, shape, binx, biny)
+    wl_min, wl_max = numpy.min(wl), numpy.max(wl)
+    wl_center = 0.5 * (wl_min + wl_max)
+    dispersion = (wl_max - wl_min) / (shape[1] * binx)  # A per unbinned px
+    sigma = line_fwhm * dispersion / 2.355
+
+    # all spectra are computed on a fine 1-d wavelength grid first, and then
+    # interpolated to the wavelength of each pixel
+    wl_grid = numpy.arange(wl_min - 10 * sigma, wl_max + 10 * sigma,
+                           0.1 * dispersion)
+    if (is_arc):
+        spec_grid = arc_line_peak * line_spectrum(
+            wl_grid, load_lamp_lines(lamp), sigma)
+    else:
+        spec_grid = sky_continuum * (wl_grid / 5500.) ** -1 + \
+            sky_line_peak * line_spectrum(wl_grid, sky_lines, sigma)
+    spec_grid *= throughput(wl_grid, wl_center, wl_max - wl_min)
+
+    y_unbinned = (numpy.arange(shape[0]) + 0.5) * biny
+    illumination = slit_illumination(y_unbinned).reshape((-1, 1))
+    model = numpy.interp(wl, wl_grid, spec_grid)
+    model *= illumination
+    model *= binx * biny
+    hdus_truth = []
+    if (not is_arc and truth):
+        hdus_truth.append(fits.ImageHDU(data=model.copy(), name="SKY.TRUE"))
+
+    #
+    # Add point sources along a slightly curved trace
+    #
+    sources = numpy.zeros((0, 4))
+    trace_offset = None
+    if (not is_arc and n_sources > 0):
+        x_rel = (numpy.arange(shape[1]) - 0.5 * shape[1]) / (0.5 * shape[1])
+        trace_offset = (8. * x_rel ** 2 - 3. * x_rel) / biny
+        sigma_y = seeing / pixel_scale / 2.355 / biny
+        src_spec = throughput(wl, wl_center, wl_max - wl_min) * \
+            (wl / wl_center) ** -1.5
+        margin = 20 * sigma_y
+        centers = rng.uniform(slit_edges[0] / biny + margin,
+                              slit_edges[1] / biny - margin, n_sources)
+        peaks = source_peak * rng.uniform(0.2, 1., n_sources) * binx * biny
+        sources = numpy.empty((n_sources, 4))
+        for i_src, (y_src, peak) in enumerate(zip(centers, peaks)):
+            y1 = max(int(y_src - 6 * sigma_y - numpy.max(numpy.fabs(trace_offset))), 0)
+            y2 = min(int(y_src + 6 * sigma_y + numpy.max(numpy.fabs(trace_offset))) + 2,
+                     shape[0])
+            dy = numpy.arange(y1, y2).reshape((-1, 1)) - y_src - \
+                trace_offset.reshape((1, -1))
+            model[y1:y2] += peak * src_spec[y1:y2] * \
+                numpy.exp(-0.5 * (dy / sigma_y) ** 2)
+            sources[i_src] = [y_src, peak, y_src - 3 * sigma_y,
+                              y_src + 3 * sigma_y]
+            hdr['SRC%d_Y' % (i_src + 1)] = (y_src, "source center [binned px]")
+        del src_spec
+
+    #
+    # Photon and read noise
+    #
+    data = rng.poisson(numpy.maximum(model, 0) * gain).astype(numpy.float64)
+    data /= gain
+    data += rng.normal(0, readnoise / gain, shape)
+    del model
+
+    bpm = numpy.zeros(shape, dtype=numpy.int)
+    hot_columns = rng.randint(0, shape[1], n_hot_columns)
+    data[:, hot_columns] += 5000.
+    bpm[:, hot_columns] = 1
+
+    cosmics = numpy.zeros(shape, dtype=numpy.uint8)
+    n_cosmics = int(cosmics_density * shape[0] * shape[1] * binx * biny)
+    add_cosmics(data, cosmics, rng, n_cosmics, binx, biny)
+    logger.debug("Added %d cosmics, %d hot columns" % (n_cosmics, n_hot_columns))
+
+    numpy.minimum(data, saturation, out=data)
+    var = numpy.maximum(data, 0) / gain + (readnoise / gain) ** 2
+
+    # the chip gaps contain no data
+    in_gap = numpy.ones((shape[1]), dtype=numpy.bool)
+    for startx, endx in columns:
+        in_gap[startx:endx] = False
+    data[:, in_gap] = numpy.NaN
+    var[:, in_gap] = numpy.NaN
+    bpm[:, in_gap] = 1
+
+    sci_hdu = fits.ImageHDU(data=data, name="SCI")
+    sci_hdu.header['GAIN'] = gain
+    sci_hdu.header['RDNOISE'] = readnoise
+    hdus = [fits.PrimaryHDU(header=hdr),
+            sci_hdu,
+            fits.ImageHDU(data=bpm, name="BPM"),
+            fits.ImageHDU(data=var, name="VAR"),
+            fits.ImageHDU(data=wl, name="WAVELENGTH"),
+            ]
+    if (truth):
+        hdus_truth.append(fits.ImageHDU(data=cosmics, name="CRJ.TRUE"))
+    if (trace_offset is not None):
+        hdus_truth.append(fits.ImageHDU(data=trace_offset, name="TRACEOFFSET"))
+        hdus_truth.append(fits.ImageHDU(data=sources, name="SOURCES"))
+
+    return fits.HDUList(hdus + hdus_truth)
+
+
+def split_amplifiers(mosaic):
+    """
+
+    Cut a mosaic into the 6 amplifiers of the raw frame, with SCI, VAR and
+    BPM extension for each amplifier, in the layout tiledata expects.
+
+    """
+    binx, biny = parse_binning(mosaic[0].header['CCDSUM'].split())
+    _, columns = mosaic_geometry(binx, biny)
+
+    sci_hdus, var_hdus, bpm_hdus = [], [], []
+    for i, (startx, endx) in enumerate(columns):
+        detsec = "[%d:%d,1:%d]" % (
+            i * amp_width + 1, (i + 1) * amp_width, amp_height)
+        for name, hdus in [('SCI', sci_hdus), ('VAR', var_hdus),
+                           ('BPM', bpm_hdus)]:
+            hdu = fits.ImageHDU(
+                data=numpy.array(mosaic[name].data[:, startx:endx]))
+            hdu.header['EXTNAME'] = name
+            hdu.header['EXTVER'] = i + 1
+            hdu.header['CCDSUM'] = mosaic[0].header['CCDSUM']
+            hdu.header['DETSEC'] = detsec
+            hdus.append(hdu)
+        sci_hdus[-1].header['GAIN'] = mosaic['SCI'].header['GAIN']
+        sci_hdus[-1].header['RDNOISE'] = mosaic['SCI'].header['RDNOISE']
+        sci_hdus[-1].header['VAREXT'] = 1 + n_amplifiers + i
+        sci_hdus[-1].header['BPMEXT'] = 1 + 2 * n_amplifiers + i
+
+    return fits.HDUList([fits.PrimaryHDU(header=mosaic[0].header.copy())] +
+                        sci_hdus + var_hdus + bpm_hdus)
+
+
+def create_frame(binning='2x2', obstype='OBJECT', mosaic=True, **kwargs):
+    """
+
+    Create a synthetic frame, either mosaiced or as 6 amplifiers. All other
+    parameters are passed on to create_mosaic.
+
+    """
+    hdulist = create_mosaic(binning=binning, obstype=obstype, **kwargs)
+    if (mosaic):
+        return hdulist
+    return split_amplifiers(hdulist)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = OptionParser(usage="%prog [options] output.fits")
+    parser.add_option("", "--binning", dest="binning",
+                      help="binning (spectral x spatial), e.g. 2x2",
+                      default="2x2", type=str)
+    parser.add_option("", "--type", dest="obstype",
+                      help="type of frame (arc, object)",
+                      default="object", type=str)
+    parser.add_option("", "--seed", dest="seed",
+                      help="random seed",
+                      default=1, type=int)
+    parser.add_option("", "--amplifiers", dest="mosaic",
+                      help="write the 6 amplifiers instead of a mosaic",
+                      default=True, action="store_false")
+    parser.add_option("", "--grating", dest="grating",
+                      help="grating name",
+                      default="PG0900", type=str)
+    parser.add_option("", "--grating-angle", dest="grating_angle",
+                      help="grating angle",
+                      default=15.875, type=float)
+    parser.add_option("", "--camera-angle", dest="camera_angle",
+                      help="camera articulation angle",
+                      default=31.75, type=float)
+    (options, cmdline_args) = parser.parse_args()
+
+    hdulist = create_frame(binning=options.binning,
+                           obstype=options.obstype.upper(),
+                           mosaic=options.mosaic,
+                           seed=options.seed,
+                           grating=options.grating,
+                           grating_angle=options.grating_angle,
+                           camera_angle=options.camera_angle)
+    hdulist.writeto(cmdline_args[0], clobber=True)
@@ -0,0 +1,95 @@
+/**
+ *
+ * (c) Ralf Kotulla, kotulla@uwm.edu
+ *
+ * This module implements a flux-conserving drizzle of input pixels, each
+ * covering a range in wavelength and along the slit, onto a regular output
+ * grid in wavelength and position along the slit.
+ *
+ */
+
+#include <math.h>
+
+
+/*
+ * For each input pixel px, the flux (and variance) is distributed across all
+ * output pixels it overlaps with, in proportion of the overlapping area to the
+ * total area of the input pixel, and multiplied by the pixel weight. Pixels
+ * with non-positive or NaN weight are ignored.
+ *
+ * out_coverage receives the weighted overlap area in units of output pixels,
+ * i.e. 1.0 means the output pixel is fully covered by input pixels.
+ *
+ * All output buffers are of dimension n_y x n_wl (wavelength varying
+ * fastest), and are not reset, so multiple calls can accumulate into the
+ * same output.
+ */
+void drizzle__cy(double* wl_from, double* wl_to,
+                 double* y_from, double* y_to,
+                 double* flux, double* var, double* weight,
+                 int n_pixels,
+                 double out_wl0, double out_dwl, int n_wl,
+                 double out_y0, double out_dy, int n_y,
+                 double* out_flux, double* out_var, double* out_coverage)
+{
+    int px, iwl, iy, iwl_start, iwl_end, iy_start, iy_end, idx;
+    double first_wl, last_wl, first_y, last_y, width_wl, width_y;
+    double overlap_wl, overlap_y, fraction, w;
+
+    for (px=0; px<n_pixels; px++) {
+
+        w = weight[px];
+        if (!(w > 0)) {
+            continue;
+        }
+
+        // find first and last pixel in output array to receive some of
+        // the flux of this input pixel
+        first_wl = (wl_from[px] - out_wl0) / out_dwl;
+        last_wl = (wl_to[px] - out_wl0) / out_dwl;
+        first_y = (y_from[px] - out_y0) / out_dy;
+        last_y = (y_to[px] - out_y0) / out_dy;
+
+        width_wl = last_wl - first_wl;
+        width_y = last_y - first_y;
+        if (!(width_wl > 0) || !(width_y > 0)) {
+            // this also catches NaNs in any of the pixel edges
+            continue;
+        }
+
+        iwl_start = (int)floor(first_wl);
+        iwl_end = (int)ceil(last_wl);
+        iy_start = (int)floor(first_y);
+        iy_end = (int)ceil(last_y);
+
+        if (iwl_start < 0) iwl_start = 0;
+        if (iwl_end > n_wl) iwl_end = n_wl;
+        if (iy_start < 0) iy_start = 0;
+        if (iy_end > n_y) iy_end = n_y;
+
+        for (iy=iy_start; iy<iy_end; iy++) {
+
+            overlap_y = fmin(last_y, iy+1.) - fmax(first_y, (double)iy);
+            if (overlap_y <= 0) {
+                continue;
+            }
+
+            for (iwl=iwl_start; iwl<iwl_end; iwl++) {
+
+                overlap_wl = fmin(last_wl, iwl+1.) - fmax(first_wl, (double)iwl);
+                if (overlap_wl <= 0) {
+                    continue;
+                }
+
+                fraction = (overlap_wl / width_wl) * (overlap_y / width_y);
+
+                idx = iy*n_wl + iwl;
+                out_flux[idx] += w * fraction * flux[px];
+                out_var[idx] += w * fraction * var[px];
+                out_coverage[idx] += w * overlap_wl * overlap_y;
+            }
+        }
+    }
+
+    return;
+}
@@ -5,16 +5,30 @@ import numpy
 cimport numpy
 
 cdef extern void sigma_clip_mean__cy (double* pixels, int n_pixels, int n_images, double* output,
-                                      double nsigma, int max_repeat)
+                                      double nsigma, int max_repeat) nogil
 cdef extern void sigma_clip_median__cy (double* pixels, int n_pixels, int n_images, double* output,
-                                      double nsigma, int max_repeat)
+                                      double nsigma, int max_repeat) nogil
 cdef extern void lacosmics__cy(double* data,
                                double* out_cleaned, int* out_mask, int* out_saturated,
                                int sx, int sy,
                                double gain, double readnoise,
                                double sigclip, double sigfrac, double objlim,
                                double saturation_limit, int verbose,
-                               int niter)
+                               int niter) nogil
+cdef extern void drizzle__cy(double* wl_from, double* wl_to,
+                             double* y_from, double* y_to,
+                             double* flux, double* var, double* weight,
+                             int n_pixels,
+                             double out_wl0, double out_dwl, int n_wl,
+                             double out_y0, double out_dy, int n_y,
+                             double* out_flux, double* out_var,
+                             double* out_coverage) nogil
+cdef extern void trace_arcs__cy(double* data, int nx, int ny,
+                                int stride_x, int stride_y,
+                                int* start_x, int* start_y, int* direction,
+                                int n_traces,
+                                int max_window_x, double max_corner_angle,
+                                double* arc_center)
 
 
 @cython.boundscheck(False)
@@ -32,7 +46,12 @@ def sigma_clip_mean(
     x, n = pixels.shape[0], pixels.shape[1]
     # print "n_pixels=",x,"    n_images=",n
 
-    sigma_clip_mean__cy(&pixels[0,0], x, n, &returned[0], nsigma, max_repeat)
+    # release the GIL, so several blocks of pixels can be combined in
+    # parallel threads
+    cdef double* p_pixels = &pixels[0,0]
+    cdef double* p_returned = &returned[0]
+    with nogil:
+        sigma_clip_mean__cy(p_pixels, x, n, p_returned, nsigma, max_repeat)
                                   
     return
 
@@ -54,7 +73,12 @@ def sigma_clip_median(
     x, n = pixels.shape[0], pixels.shape[1]
     # print "n_pixels=",x,"    n_images=",n
 
-    sigma_clip_median__cy(&pixels[0,0], x, n, &returned[0], nsigma, max_repeat)
+    # release the GIL, so several blocks of pixels can be combined in
+    # parallel threads
+    cdef double* p_pixels = &pixels[0,0]
+    cdef double* p_returned = &returned[0]
+    with nogil:
+        sigma_clip_median__cy(p_pixels, x, n, p_returned, nsigma, max_repeat)
                                   
     return
 
@@ -90,14 +114,160 @@ def lacosmics(
     if (saturated == None):
         saturated = numpy.ndarray(shape=(data_in.shape[0], data_in.shape[1]), dtype=numpy.int32)
 
-    lacosmics__cy(&data_in[0,0], 
-                  &cleaned[0,0], &mask[0,0], &saturated[0,0],
-                  data_in.shape[0], data_in.shape[1],
-                  gain, readnoise,
-                  sigclip, sigfrac, objlim,
-                  saturation_limit,
-                  verbose,
-                  niter)
+    # get all pointers while still holding the GIL, then release it so
+    # several frames (e.g. all amplifiers) can be cleaned in parallel threads
+    cdef double* p_data = &data_in[0,0]
+    cdef double* p_cleaned = &cleaned[0,0]
+    cdef int* p_mask = &mask[0,0]
+    cdef int* p_saturated = &saturated[0,0]
+    cdef int sx = data_in.shape[0], sy = data_in.shape[1]
+
+    with nogil:
+        lacosmics__cy(p_data,
+                      p_cleaned, p_mask, p_saturated,
+                      sx, sy,
+                      gain, readnoise,
+                      sigclip, sigfrac, objlim,
+                      saturation_limit,
+                      verbose,
+                      niter)
                                   
     return cleaned, mask, saturated
 
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def drizzle(
+        numpy.ndarray[double, ndim=1, mode="c"] wl_from not None,
+        numpy.ndarray[double, ndim=1, mode="c"] wl_to not None,
+        numpy.ndarray[double, ndim=1, mode="c"] flux not None,
+        numpy.ndarray[double, ndim=1, mode="c"] var not None,
+        double out_wl0,
+        double out_dwl,
+        int n_wl,
+        numpy.ndarray[double, ndim=1, mode="c"] weight = None,
+        numpy.ndarray[double, ndim=1, mode="c"] y_from = None,
+        numpy.ndarray[double, ndim=1, mode="c"] y_to = None,
+        double out_y0 = 0.,
+        double out_dy = 1.,
+        int n_y = 1,
+        numpy.ndarray[double, ndim=2, mode="c"] out_flux = None,
+        numpy.ndarray[double, ndim=2, mode="c"] out_var = None,
+        numpy.ndarray[double, ndim=2, mode="c"] out_coverage = None,
+):
+
+    # Drizzle input pixels covering wl_from..wl_to (and y_from..y_to along
+    # the slit, by default all pixels go into a single output row) onto a
+    # regular output grid. Returns flux, variance and coverage, each of
+    # shape (n_y, n_wl). If given, the results are added to the out_*
+    # buffers instead, e.g. to drizzle tiles of a larger output frame.
+    # The GIL is released while drizzling, so several threads can work on
+    # different output tiles at the same time.
+
+    cdef int n_pixels
+    n_pixels = wl_from.shape[0]
+
+    if (weight is None):
+        weight = numpy.ones(shape=(n_pixels), dtype=numpy.float64)
+    if (y_from is None):
+        y_from = numpy.zeros(shape=(n_pixels), dtype=numpy.float64)
+    if (y_to is None):
+        y_to = y_from + 1.
+
+    # the kernel reads all input arrays in lockstep
+    for name, values in [('wl_to', wl_to), ('flux', flux), ('var', var),
+                         ('weight', weight), ('y_from', y_from),
+                         ('y_to', y_to)]:
+        if (values.shape[0] != n_pixels):
+            raise ValueError("%s has %d values, but wl_from has %d" % (
+                name, values.shape[0], n_pixels))
+
+    if (out_flux is None):
+        out_flux = numpy.zeros(shape=(n_y, n_wl), dtype=numpy.float64)
+    if (out_var is None):
+        out_var = numpy.zeros(shape=(n_y, n_wl), dtype=numpy.float64)
+    if (out_coverage is None):
+        out_coverage = numpy.zeros(shape=(n_y, n_wl), dtype=numpy.float64)
+    if (out_flux.shape[0] != n_y or out_flux.shape[1] != n_wl or
+            out_var.shape[0] != n_y or out_var.shape[1] != n_wl or
+            out_coverage.shape[0] != n_y or out_coverage.shape[1] != n_wl):
+        raise ValueError("output buffers need to be of shape (n_y, n_wl)")
+
+    if (n_pixels <= 0):
+        return out_flux, out_var, out_coverage
+
+    cdef double* p_wl_from = &wl_from[0]
+    cdef double* p_wl_to = &wl_to[0]
+    cdef double* p_y_from = &y_from[0]
+    cdef double* p_y_to = &y_to[0]
+    cdef double* p_flux = &flux[0]
+    cdef double* p_var = &var[0]
+    cdef double* p_weight = &weight[0]
+    cdef double* p_out_flux = &out_flux[0,0]
+    cdef double* p_out_var = &out_var[0,0]
+    cdef double* p_out_coverage = &out_coverage[0,0]
+
+    with nogil:
+        drizzle__cy(p_wl_from, p_wl_to,
+                    p_y_from, p_y_to,
+                    p_flux, p_var, p_weight,
+                    n_pixels,
+                    out_wl0, out_dwl, n_wl,
+                    out_y0, out_dy, n_y,
+                    p_out_flux, p_out_var, p_out_coverage)
+
+    return out_flux, out_var, out_coverage
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def trace_arcs(
+        data not None,
+        start_x not None,
+        start_y not None,
+        direction not None,
+        int max_window_x = 5,
+        double max_corner_angle = 60.,
+):
+
+    # Trace many lines in data (indexed as data[x,y], lines are traced along
+    # y) in one go, each starting at (start_x, start_y) and going up or down
+    # depending on direction. Returns the traced positions as array of shape
+    # (n_traces, data.shape[0], 3), in the same layout as the arc_center
+    # array in traceline.trace_arc.
+
+    cdef int nx, ny, stride_x, stride_y, n_traces
+    cdef numpy.ndarray[double, ndim=2, mode="c"] _data
+
+    nx, ny = data.shape[0], data.shape[1]
+    if (data.flags.f_contiguous and not data.flags.c_contiguous):
+        # typically a transposed image, use it without making a copy
+        _data = numpy.ascontiguousarray(data.T, dtype=numpy.float64)
+        stride_x, stride_y = 1, nx
+    else:
+        _data = numpy.ascontiguousarray(data, dtype=numpy.float64)
+        stride_x, stride_y = ny, 1
+
+    cdef numpy.ndarray[int, ndim=1, mode="c"] _start_x = \
+        numpy.ascontiguousarray(start_x, dtype=numpy.int32)
+    cdef numpy.ndarray[int, ndim=1, mode="c"] _start_y = \
+        numpy.ascontiguousarray(start_y, dtype=numpy.int32)
+    cdef numpy.ndarray[int, ndim=1, mode="c"] _direction = \
+        numpy.ascontiguousarray(direction, dtype=numpy.int32)
+    n_traces = _start_x.shape[0]
+
+    cdef numpy.ndarray[double, ndim=3, mode="c"] arc_center = \
+        numpy.empty(shape=(n_traces, nx, 3), dtype=numpy.float64)
+    arc_center[:,:,:] = numpy.NaN
+
+    if (n_traces <= 0):
+        return arc_center
+
+    trace_arcs__cy(&_data[0,0], nx, ny, stride_x, stride_y,
+                   &_start_x[0], &_start_y[0], &_direction[0], n_traces,
+                   max_window_x, max_corner_angle,
+                   &arc_center[0,0,0])
+
+    return arc_center
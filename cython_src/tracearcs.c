@@ -0,0 +1,130 @@
+/**
+ *
+ * (c) Ralf Kotulla, kotulla@uwm.edu
+ *
+ * This module implements the row-by-row tracing of arc- and sky-lines, as
+ * done in traceline.trace_arc, for many lines (and both directions) in a
+ * single call.
+ *
+ */
+
+#include <math.h>
+#include <stdlib.h>
+
+#define N_PIXELS_FOR_CORNER 5
+#define CORNER_MIN 3
+#define MAX_TRACE_LENGTH 5000
+
+
+/*
+ * data is indexed as data[x*stride_x + y*stride_y], with x (0..nx-1) being
+ * the column and y (0..ny-1) the row along which lines are traced.
+ *
+ * Each trace t starts at (start_x[t], start_y[t]) and moves in steps of
+ * direction[t] rows. In each row, the trace moves to the brightest pixel
+ * within +/- max_window_x of the current position. Tracing stops at the
+ * image edge, at NaN pixels, or at corners, i.e. where the direction of the
+ * trace across the last N_PIXELS_FOR_CORNER rows differs from the direction
+ * in the N_PIXELS_FOR_CORNER rows before by more than max_corner_angle
+ * degrees for more than CORNER_MIN consecutive rows.
+ *
+ * arc_center has to be of dimension n_traces x nx x 3 and initialized to
+ * NaN; for each traced row y, arc_center[t,y,0] receives the center
+ * position, and [t,y,1] and [t,y,2] the shift in x over the last and the
+ * previous N_PIXELS_FOR_CORNER rows.
+ */
+void trace_arcs__cy(double* data, int nx, int ny, int stride_x, int stride_y,
+                    int* start_x, int* start_y, int* direction, int n_traces,
+                    int max_window_x, double max_corner_angle,
+                    double* arc_center)
+{
+    int t, k, i, row, next_row, cur_col, next_col, max_idx, corner_count;
+    int d, n = N_PIXELS_FOR_CORNER;
+    double value, max_value, y_stepsize, dx_past, dx_now;
+    double angle_past, angle_now;
+    double *ac;
+
+    for (t=0; t<n_traces; t++) {
+
+        d = direction[t];
+        if (d == 0) {
+            continue;
+        }
+        if (start_y[t] < 0 || start_y[t] >= nx) {
+            continue;
+        }
+
+        ac = &arc_center[t*nx*3];
+        y_stepsize = fabs((double)d);
+
+        cur_col = start_x[t];
+        ac[start_y[t]*3 + 0] = start_x[t];
+        corner_count = 0;
+
+        for (k=0; ; k++) {
+
+            next_row = start_y[t] + d*(k+1);
+            if (next_row < 0 || next_row >= ny || next_row >= nx) {
+                break;
+            }
+
+            if (cur_col-max_window_x < 0 || cur_col+max_window_x+1 >= nx) {
+                // We have reached the edge
+                break;
+            }
+
+            // find the brightest pixel in the next row, stopping at NaNs
+            max_idx = -1;
+            max_value = 0;
+            for (i=0; i<2*max_window_x+1; i++) {
+                value = data[(cur_col-max_window_x+i)*stride_x + next_row*stride_y];
+                if (isnan(value)) {
+                    max_idx = -2;
+                    break;
+                }
+                value /= y_stepsize;
+                if (max_idx < 0 || value > max_value) {
+                    max_value = value;
+                    max_idx = i;
+                }
+            }
+            if (max_idx < 0) {
+                break;
+            }
+            next_col = cur_col + max_idx - max_window_x;
+
+            //
+            // Corner detection
+            //
+            if (k > 2*n) {
+                row = start_y[t] + d*(k-2*n+1);
+                dx_past = ac[row*3] - ac[(row+d*n)*3];
+                dx_now = ac[(row+d*n)*3] - ac[(start_y[t]+d*k)*3];
+
+                angle_past = atan2(dx_past, n) * 180. / M_PI;
+                angle_now = atan2(dx_now, n) * 180. / M_PI;
+
+                ac[next_row*3 + 1] = dx_now;
+                ac[next_row*3 + 2] = dx_past;
+
+                if (fabs(angle_past - angle_now) > max_corner_angle) {
+                    corner_count++;
+                } else {
+                    corner_count = 0;
+                }
+                if (corner_count > CORNER_MIN) {
+                    break;
+                }
+            }
+
+            if (abs(next_row - start_y[t]) > MAX_TRACE_LENGTH) {
+                break;
+            }
+
+            ac[next_row*3 + 0] = cur_col;
+            cur_col = next_col;
+        }
+    }
+
+    return;
+}
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+
+Registry for debug output (intermediate images, tables, line traces, ...).
+
+Debug artifacts are only written if they are enabled, either for a whole
+processing stage (e.g. "wlcal"), for a single artifact ("wlcal.diffs" or
+just "diffs"), or for everything ("all"). By default nothing is written.
+Artifacts can be enabled with enable(), or via the environment variable
+RSS_DEBUG_ARTIFACTS (comma-separated, same syntax).
+
+Data is always written in binary form, images and tables as FITS and plain
+arrays as .npy files. All writes are handed to a background thread, so the
+reduction itself never waits for debug output; call flush() before moving
+or deleting the output directory.
+
+Usage:
+
+    debugartifacts.save_fits("zeroback", img_data, stage="zeroback")
+    debugartifacts.save_array("diffs", lambda: differences.flatten(),
+                              stage="wlcal")
+
+Passing a function instead of the data delays computing it until we know the
+artifact is actually needed.
+
+"""
+
+import os
+import threading
+import Queue
+import atexit
+import logging
+import numpy
+from astropy.io import fits
+
+
+_enabled = set()
+
+_queue = None
+_writer = None
+_writer_pid = None
+_lock = threading.Lock()
+
+
+def enable(names):
+    """
+
+    Enable debug output for all stages or artifacts in names, given as list
+    or comma-separated string.
+
+    """
+    if (names is None):
+        return
+    if (not isinstance(names, (list, tuple, set))):
+        names = str(names).split(",")
+    for name in names:
+        if (name.strip() != ""):
+            _enabled.add(name.strip())
+
+
+def disable():
+    _enabled.clear()
+
+
+def any_enabled():
+    return len(_enabled) > 0
+
+
+def is_enabled(name, stage=None):
+    if (not _enabled):
+        return False
+    if ('all' in _enabled or name in _enabled):
+        return True
+    if (stage is not None and
+            (stage in _enabled or "%s.%s" % (stage, name) in _enabled)):
+        return True
+    return False
+
+
+def _write(kind, filename, data, header):
+    if (kind == 'fits'):
+        fits.PrimaryHDU(data=data, header=header).writeto(
+            filename, clobber=True)
+    elif (kind == 'hdulist'):
+        data.writeto(filename, clobber=True)
+    elif (kind == 'npy'):
+        numpy.save(filename, data)
+
+
+def _writer_loop(queue):
+    logger = logging.getLogger("DebugArtifacts")
+    while (True):
+        item = queue.get()
+        try:
+            if (item is None):
+                break
+            _write(*item)
+        except Exception as e:
+            logger.warning("Unable to write debug artifact %s: %s" % (
+                item[1], str(e)))
+        finally:
+            queue.task_done()
+
+
+def _submit(kind, filename, data, header=None):
+    global _queue, _writer, _writer_pid
+
+    # the writer thread does not survive a fork, so each process (e.g. the
+    # workers reducing frames in parallel) starts its own
+    with _lock:
+        if (_writer is None or _writer_pid != os.getpid()):
+            _queue = Queue.Queue()
+            _writer = threading.Thread(target=_writer_loop, args=(_queue,))
+            _writer.daemon = True
+            _writer.start()
+            _writer_pid = os.getpid()
+
+    # resolve the filename now, in case we change directories before the
+    # file gets written
+    _queue.put((kind, os.path.abspath(filename), data, header))
+
+
+def flush():
+    """
+
+    Wait until all pending debug artifacts are written.
+
+    """
+    if (_queue is not None and _writer_pid == os.getpid()):
+        _queue.join()
+
+atexit.register(flush)
+
+
+def _get_data(data):
+    return data() if callable(data) else data
+
+
+def save_fits(name, data, stage=None, header=None, filename=None):
+    """
+
+    Write data as FITS image to filename (default: <name>.fits), if the
+    artifact is enabled. The data is copied, so it can be changed right
+    after this call.
+
+    """
+    if (not is_enabled(name, stage)):
+        return
+    data = numpy.array(_get_data(data))
+    if (header is not None):
+        header = header.copy()
+    _submit('fits', name+".fits" if filename is None else filename,
+            data, header)
+
+
+def save_hdulist(name, hdulist, stage=None, filename=None):
+    """
+
+    Write a HDUList (e.g. a full intermediate frame) to filename (default:
+    <name>.fits), if the artifact is enabled.
+
+    """
+    if (not is_enabled(name, stage)):
+        return
+    hdulist = _get_data(hdulist)
+    hdulist = fits.HDUList([
+        hdu.__class__(data=None if hdu.data is None else numpy.array(hdu.data),
+                      header=hdu.header.copy())
+        for hdu in hdulist])
+    _submit('hdulist', name+".fits" if filename is None else filename,
+            hdulist)
+
+
+def save_array(name, data, stage=None, filename=None):
+    """
+
+    Write an array to filename (default: <name>.npy), if the artifact is
+    enabled. Use numpy.load() to read it back.
+
+    """
+    if (not is_enabled(name, stage)):
+        return
+    data = numpy.array(_get_data(data))
+    _submit('npy', name+".npy" if filename is None else filename, data)
+
+
+enable(os.environ.get("RSS_DEBUG_ARTIFACTS", None))
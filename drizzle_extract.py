@@ -9,6 +9,7 @@ from optparse import OptionParser
 import pysalt.mp_logging
 import logging
 
+import podi_cython
 
 
 def drizzle_spec(img_data, wl, var_data, out_wl):
@@ -39,56 +40,25 @@ def drizzle_spec(img_data, wl, var_data, out_wl):
     wl_to = 0.5*(wl_data_padded[:, 1:-1] + wl_data_padded[:,2:])
     #print wl_width.shape, wl_from.shape, wl_to.shape
 
-    # compute the flux density array (i.e. flux per wavelength) by dividing the
-    # flux image (which is flux integrated over the width of a pixel) by the width of each pixel
-    img_data_per_wl = img_data / wl_width
-    var_data_per_wl = var_data / wl_width
-
-
     #
-    # now drizzle the data into the output container
+    # now drizzle the data into the output container. The drizzle kernel
+    # distributes the flux of each pixel across all output pixels in
+    # proportion to the overlap, so dividing by the output dispersion yields
+    # the flux per wavelength.
     #
-    wl_width_1d = wl_width.ravel()
-    wl_from_1d = wl_from.ravel()
-    wl_to_1d = wl_to.ravel()
-    wl_data_1d = wl.ravel()
-    img_data_per_wl_1d = img_data_per_wl.ravel()
-    var_data_1d = var_data.ravel()
-    var_data_per_wl_1d = var_data_per_wl.ravel()
-    wl_width_1d = wl_width.ravel()
-
     wl0 = out_wl[0]
     dwl = out_wl[1] - out_wl[0]
 
-    for px in range(wl_width_1d.shape[0]):
-
-        # find first and last pixel in output array to receive some of the flux of this input pixel
-        first_px = (wl_from_1d[px] - wl0) / dwl
-        last_px = (wl_to_1d[px] - wl0) / dwl
-
-        pixels = range(int(math.floor(first_px)), int(math.ceil(last_px)))  # , dtype=numpy.int)
-        # print wl_data_1d[px], wl_width_1d[px], first_px, last_px, pixels
-        for i, tp in enumerate(pixels):
-
-            if (i == 0 and i == len(pixels) - 1):
-                # all flux in a single output pixel
-                fraction = last_px - first_px
-            elif (i == 0):
-                # first pixel, with more to come
-                fraction = (tp + 1.) - first_px
-            elif (i == len(pixels) - 1):
-                # last of many pixels
-                fraction = last_px - tp
-            else:
-                # some pixel in the middle
-                fraction = 1.
-
-            if (numpy.isnan(out_flux[tp])):
-                out_flux[tp] = 0.
-                out_var[tp] = 0.
-            out_flux[tp] += fraction * img_data_per_wl_1d[px]  # * (dwl / wl_width_1d[px])
-            out_var[tp] += fraction * var_data_per_wl_1d[px]  # * (dwl / wl_width_1d[px])
-            # print "     ", tp, fraction
+    drz_flux, drz_var, drz_coverage = podi_cython.drizzle(
+        wl_from=numpy.ascontiguousarray(wl_from.ravel(), dtype=numpy.float64),
+        wl_to=numpy.ascontiguousarray(wl_to.ravel(), dtype=numpy.float64),
+        flux=numpy.ascontiguousarray(img_data.ravel(), dtype=numpy.float64),
+        var=numpy.ascontiguousarray(var_data.ravel(), dtype=numpy.float64),
+        out_wl0=wl0, out_dwl=dwl, n_wl=out_wl.shape[0],
+    )
+    touched = drz_coverage[0] > 0
+    out_flux[touched] = drz_flux[0][touched] / dwl
+    out_var[touched] = drz_var[0][touched] / dwl
 
     return out_flux, out_var
 
@@ -179,52 +149,19 @@ def drizzle_extract_spectrum(fits_fn, out_fn,
         wl_to = 0.5*(wl_data_padded[:, 1:-1] + wl_data_padded[:,2:])
         #print wl_width.shape, wl_from.shape, wl_to.shape
 
-        # compute the flux density array (i.e. flux per wavelength) by dividing the
-        # flux image (which is flux integrated over the width of a pixel) by the width of each pixel
-        img_data_per_wl = img_data / wl_width
-        var_data_per_wl = var_data / wl_width
-
         #
         # now drizzle the data into the output container
         #
-        wl_width_1d = wl_width.ravel()
-        wl_from_1d = wl_from.ravel()
-        wl_to_1d = wl_to.ravel()
-        wl_data_1d = wl_data.ravel()
-        img_data_per_wl_1d = img_data_per_wl.ravel()
-        var_data_1d = var_data.ravel()
-        var_data_per_wl_1d = var_data_per_wl.ravel()
-        wl_width_1d = wl_width.ravel()
-
-        for px in range(wl_width_1d.shape[0]):
-
-            # find first and last pixel in output array to receive some of the flux of this input pixel
-            first_px = (wl_from_1d[px] - wl0) / dwl
-            last_px = (wl_to_1d[px] - wl0) / dwl
-
-            pixels = range(int(math.floor(first_px)), int(math.ceil(last_px))) #, dtype=numpy.int)
-            #print wl_data_1d[px], wl_width_1d[px], first_px, last_px, pixels
-            for i, tp in enumerate(pixels):
-
-                if (i == 0 and i == len(pixels)-1):
-                    # all flux in a single output pixel
-                    fraction = last_px - first_px
-                elif (i == 0):
-                    # first pixel, with more to come
-                    fraction = (tp + 1.) - first_px
-                elif (i == len(pixels)-1):
-                    # last of many pixels
-                    fraction = last_px - tp
-                else:
-                    # some pixel in the middle
-                    fraction = 1.
-
-                if (numpy.isnan(out_flux[tp])):
-                    out_flux[tp] = 0.
-                    out_var[tp] = 0.
-                out_flux[tp] += fraction * img_data_per_wl_1d[px] #* (dwl / wl_width_1d[px])
-                out_var[tp] += fraction * var_data_per_wl_1d[px] #* (dwl / wl_width_1d[px])
-                #print "     ", tp, fraction
+        drz_flux, drz_var, drz_coverage = podi_cython.drizzle(
+            wl_from=numpy.ascontiguousarray(wl_from.ravel(), dtype=numpy.float64),
+            wl_to=numpy.ascontiguousarray(wl_to.ravel(), dtype=numpy.float64),
+            flux=numpy.ascontiguousarray(img_data.ravel(), dtype=numpy.float64),
+            var=numpy.ascontiguousarray(var_data.ravel(), dtype=numpy.float64),
+            out_wl0=wl0, out_dwl=dwl, n_wl=out_wl_count,
+        )
+        touched = drz_coverage[0] > 0
+        out_flux[touched] = drz_flux[0][touched] / dwl
+        out_var[touched] = drz_var[0][touched] / dwl
 
 
         #
@@ -8,13 +8,57 @@ import time
 
 import pysalt
 import logging
+import debugartifacts
+import movingstats
+
+
+def stack_line_profiles(wl, flux, line_centers, bins,
+                        pixelsize=0.5, n_subpixels=10):
+    """
+
+    Stack the sky samples (wl, flux; sorted by wavelength) around all lines
+    in line_centers into histograms of flux and sample count, with bins
+    given as wavelength offsets relative to the line center.
+
+    Each sample counts at n_subpixels positions spread evenly across
+    [wl, wl+pixelsize), to account for the finite width of a pixel. Only the
+    samples within the bins of each line are used, and all lines are binned
+    together in one pass.
+
+    """
+    bin_width = bins[1] - bins[0]
+    n_bins = bins.shape[0] - 1
+
+    # range of samples that may fall into the bins of each line
+    start = numpy.searchsorted(wl, line_centers + bins[0] - pixelsize,
+                               side='left')
+    end = numpy.searchsorted(wl, line_centers + bins[-1], side='right')
+    n_samples = end - start
+
+    # indices of all samples within the windows of all lines, and their
+    # offset from the line center
+    first = numpy.cumsum(n_samples) - n_samples
+    idx = numpy.arange(numpy.sum(n_samples)) + numpy.repeat(start - first,
+                                                            n_samples)
+    offset = wl[idx] - numpy.repeat(line_centers, n_samples) - bins[0]
+    sample_flux = flux[idx]
+
+    hist_sum = numpy.zeros((n_bins))
+    hist_count = numpy.zeros((n_bins))
+    for dl in numpy.linspace(0, pixelsize, n_subpixels, endpoint=False):
+        b = numpy.floor((offset + dl) / bin_width).astype(numpy.int)
+        valid = (b >= 0) & (b < n_bins)
+        hist_sum += numpy.bincount(b[valid], weights=sample_flux[valid],
+                                   minlength=n_bins)
+        hist_count += numpy.bincount(b[valid], minlength=n_bins)
+    return hist_sum, hist_count
 
 
 def find_line_edges(allskies, line_sigma=None):
 
     logger = logging.getLogger("FastFindEdges")
 
-    print allskies.shape
+    logger.debug("Input: %s" % (str(allskies.shape)))
 
     min_l, max_l = math.floor(numpy.min(allskies[:,0])), math.ceil(numpy.max(allskies[:,0]))
     range_l = max_l - min_l
@@ -169,13 +213,9 @@ def find_line_edges(allskies, line_sigma=None):
 
     gain, readnoise = 1.3, 3
 
-    # add some padding to avoid querying non-existant data
+    # running median across +/- 50 bins, ignoring missing data
     fw = 50
-    padded = numpy.empty((avg_spec.shape[0]+2*fw))
-    padded[:] = numpy.NaN
-    padded[fw:-fw] = avg_spec
-    continuum = numpy.array([
-        bottleneck.nanmedian(padded[i-fw:i+fw]) for i in range(fw, avg_spec.shape[0]+fw)])
+    continuum = movingstats.move_median(avg_spec, fw, fw-1)
     continuum[numpy.isnan(continuum)] = 0.
 
     if (line_sigma == None):
@@ -206,92 +246,51 @@ def find_line_edges(allskies, line_sigma=None):
         linecomb[:,4] = avg_spec
         linecomb[:,4][~real_peak] = 0.
 
-        numpy.savetxt("linecomb.xxx", linecomb)
+        debugartifacts.save_array("linecomb.xxx", linecomb, stage="skysub")
 
 
         # now compute a line profile, stacking the data in the vicinity of each line
         hi_res = 0.1 * resolution
 
-        superskies = allskies.reshape((1,-1,2)).repeat(10,axis=0)
-        pixelsize=0.5
-        dl = numpy.linspace(0,pixelsize,10,endpoint=False).reshape((-1,1)).repeat(allskies.shape[0], axis=1)
-        print dl.shape
-
-        print superskies[:,0,:]
-
-        #print dl
-        print allskies.shape, superskies.shape
-        superskies[:,:,0] += dl
-        print superskies[:,0,:]
-
-        #superskies = superskies.reshape((-1,2))
-        #print superskies[:15,:]
-
-        print superskies.shape
-        superskies = superskies.reshape((-1,2))
-
         good_lines = real_peak & (bin_center > min_l+0.1*range_l) & (bin_center < max_l-0.2*range_l)
-        line_centers = (bins[:-1]+0.5*resolution)[real_peak]
+        line_centers = bin_center[good_lines]
         s2n = ((spec-continuum)/spec_noise)[good_lines]
-        print s2n
         s2n_sort = numpy.argsort(s2n)[::-1]
-        print s2n[s2n_sort]
         good_line_centers = line_centers[s2n_sort]
 
-        full_count, full_sum = None, None
         line_profile_width = 20.
-        n_hires_bins = (2*line_profile_width) / hi_res + 1.
+        n_hires_bins = int(round((2*line_profile_width) / hi_res)) + 1
         hires_bins = numpy.arange(n_hires_bins+1)*hi_res - line_profile_width
-        print hires_bins
-
-        for line in good_line_centers: #[6466.625]: #line_centers:
-
-            #print (superskies[:10,0]-line)
-            l = superskies[:,0]-line
-            good_l = (l>-20) & (l<20)
-            print line, numpy.sum(good_l)
-            print l
-
-            _hist_sum, edges_sum = numpy.histogram(
-                l, 
-                bins=hires_bins,
-                weights=superskies[:,1]
-            )
-            _hist_count, edges_count = numpy.histogram(
-                l, 
-                bins=hires_bins,
-            )
-            print line, numpy.sum(hist_count)
-
-            if (full_count == None):
-                full_count = _hist_count
-            else:
-                full_count += _hist_count
-
-            if (full_sum == None):
-                full_sum = _hist_sum
-            else:
-                full_sum += _hist_sum
-
-            #print line
-            pass
-
-        print full_sum.shape, full_count.shape
+
+        wl, flux = allskies[:,0], allskies[:,1]
+        if (numpy.any(numpy.diff(wl) < 0)):
+            si = numpy.argsort(wl)
+            wl, flux = wl[si], flux[si]
+
+        a = time.time()
+        full_sum, full_count = stack_line_profiles(
+            wl, flux, good_line_centers, hires_bins,
+            pixelsize=0.5, n_subpixels=10)
+        logger.info("Stacking %d lines took %f seconds" % (
+            good_line_centers.shape[0], time.time()-a))
+
         hires_spec = full_sum / full_count
         hires_center = hires_bins[:-1]+0.5*hi_res
-        print hires_spec.shape, hires_center.shape
-        numpy.savetxt("lineprofile", 
-                      numpy.append(hires_center.reshape((-1,1)), 
-                                   hires_spec.reshape((-1,1)), axis=1)
-        )
-
-        min_i = numpy.min(hires_spec)
-        max_i = numpy.max(hires_spec)
+        logger.debug("Line profile: %s" % (str(hires_spec.shape)))
+        debugartifacts.save_array(
+            "lineprofile",
+            lambda: numpy.append(hires_center.reshape((-1,1)),
+                                 hires_spec.reshape((-1,1)), axis=1),
+            stage="skysub")
+
+        min_i = numpy.nanmin(hires_spec)
+        max_i = numpy.nanmax(hires_spec)
         halfmax = min_i + 0.5*(max_i-min_i)
-        print halfmax
+        logger.debug("Half maximum: %f" % (halfmax))
         left_fwhm = numpy.min(hires_center[hires_spec > halfmax])
         right_fwhm = numpy.max(hires_center[hires_spec > halfmax])
-        print left_fwhm, right_fwhm, right_fwhm-left_fwhm
+        logger.debug("FWHM: %f -- %f (%f)" % (
+            left_fwhm, right_fwhm, right_fwhm-left_fwhm))
 
 
         # Now we have a FWHM measurement for the line profile
@@ -333,7 +332,7 @@ def find_line_edges(allskies, line_sigma=None):
         bin_center[real_peak]+line_hwhm,
         )
 
-    numpy.savetxt("linecomb.yyy", linecomb)
+    debugartifacts.save_array("linecomb.yyy", linecomb, stage="skysub")
 
     return edges
 
@@ -5,6 +5,7 @@ import sys, numpy, scipy
 from astropy.io import fits
 import scipy.ndimage
 import logging
+import warnings
 
 def compute_profile(wl, img, line_wl, line_width=5, n_iter=15, polyorder=5,
                     bad_rows=None, debug=False,
@@ -156,6 +157,173 @@ def compute_profile(wl, img, line_wl, line_width=5, n_iter=15, polyorder=5,
     return fit, poly
 
 
+# measurement operations supported by compute_profiles; as chunks with
+# NaN pixels are skipped, the nan-aware versions give the same results
+binned_ops = {
+    numpy.sum: 'sum',
+    numpy.nansum: 'sum',
+    numpy.mean: 'mean',
+    numpy.nanmean: 'mean',
+}
+
+
+def compute_profiles(wl, img, line_wls, line_width=5, n_iter=15, polyorder=5,
+                     bad_rows=None, op=numpy.sum, eval_y=None):
+    """
+
+    Same as compute_profile, but for many wavelength chunks (line_wls, in
+    ascending order) at once: all pixels are assigned to the chunks they
+    fall into (with a wavelength within line_width of the chunk center) in
+    one pass, and the per-row sums/means of all chunks are accumulated with
+    numpy.bincount instead of looping over all rows of each chunk. The
+    iterative, outlier-rejecting polynomial fits along the slit are then
+    done for all chunks simultaneously.
+
+    Returns the best-fit profiles for all rows (except bad_rows), with one
+    column per chunk, and the same profiles evaluated at rows eval_y (or
+    None). Chunks without valid data (e.g. containing NaN pixels) are NaN.
+
+    """
+
+    logger = logging.getLogger("ComputeProfiles")
+
+    if (op not in binned_ops):
+        raise ValueError("Unsupported operation for binned profiles: %s" % (
+            str(op)))
+    mode = binned_ops[op]
+
+    line_wls = numpy.asarray(line_wls, dtype=numpy.float)
+    n_chunks = line_wls.shape[0]
+
+    rows = numpy.arange(wl.shape[0])
+    if (bad_rows is not None):
+        wl = wl[~bad_rows, :]
+        img = img[~bad_rows, :]
+        rows = rows[~bad_rows]
+    n_rows = rows.shape[0]
+
+    #
+    # Each pixel belongs to chunks first ... last-1, i.e. all chunks with
+    # line_wl-line_width <= wl <= line_wl+line_width
+    #
+    _wl = wl.ravel()
+    _img = img.ravel()
+    _row = numpy.repeat(numpy.arange(n_rows), wl.shape[1])
+    first = numpy.searchsorted(line_wls + line_width, _wl, side='left')
+    last = numpy.searchsorted(line_wls - line_width, _wl, side='right')
+    _isnan = numpy.isnan(_img)
+
+    sums = numpy.zeros((n_rows * n_chunks))
+    counts = numpy.zeros((n_rows * n_chunks))
+    nan_count = numpy.zeros((n_chunks))
+    n_max = numpy.max(last - first) if _wl.shape[0] > 0 else 0
+    for k in range(max(0, n_max)):
+        chunk = first + k
+        in_chunk = chunk < last
+        idx = _row[in_chunk] * n_chunks + chunk[in_chunk]
+        sums += numpy.bincount(idx, weights=_img[in_chunk],
+                               minlength=n_rows * n_chunks)
+        counts += numpy.bincount(idx, minlength=n_rows * n_chunks)
+        nan_count += numpy.bincount(chunk[in_chunk & _isnan],
+                                    minlength=n_chunks)
+
+    sums = sums.reshape((n_rows, n_chunks))
+    counts = counts.reshape((n_rows, n_chunks))
+    if (mode == 'mean'):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            values = sums / counts
+    else:
+        values = sums
+
+    # there are invalid pixels in these chunks - be safe and not use them
+    has_nan = nan_count > 0
+    logger.debug("Skipping %d chunks with NaN pixels" % (numpy.sum(has_nan)))
+    values[:, has_nan] = numpy.NaN
+
+    #
+    # run a median filter to get rid of individual hot pixels
+    #
+    fm = scipy.ndimage.median_filter(values, size=(25,1),
+                                     mode='constant', cval=0)
+    valid = numpy.isfinite(fm)
+    fm[~valid] = -1e99
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median_intensity = numpy.nanmedian(
+            numpy.where(valid, fm, numpy.NaN), axis=0)
+    valid &= (fm > 0.3*median_intensity)
+    valid[:, has_nan] = False
+
+    #
+    # Iteratively fit polynomials to all chunks, rejecting outliers. To keep
+    # the normal equations well-conditioned, fit in rows scaled to [-1,1]
+    #
+    y_center = 0.5 * (rows[0] + rows[-1]) if n_rows > 0 else 0.
+    y_scale = max(0.5 * (rows[-1] - rows[0]), 1.) if n_rows > 0 else 1.
+    vander = numpy.vander((rows - y_center) / y_scale, polyorder+1)
+    vander_products = (vander[:, :, None] * vander[:, None, :]).reshape(
+        (n_rows, -1))
+    fm_valid = numpy.where(valid, fm, 0.)
+
+    coeffs = numpy.empty((polyorder+1, n_chunks))
+    coeffs[:,:] = numpy.NaN
+    active = numpy.ones((n_chunks), dtype=numpy.bool)
+    fit = numpy.empty((n_rows, n_chunks))
+    fit[:,:] = numpy.NaN
+    sparse_polys = {}
+    for iteration in range(n_iter):
+
+        # stop fitting chunks once they run out of data
+        n_valid = numpy.sum(valid, axis=0)
+        active &= n_valid > 0
+        if (not numpy.any(active)):
+            break
+
+        # chunks with too few rows for the normal equations are fit one by
+        # one with numpy.polyfit (least-norm solution), as in compute_profile
+        sparse = active & (n_valid <= polyorder)
+        dense = active & ~sparse
+
+        if (numpy.any(dense)):
+            weights = valid[:, dense].astype(numpy.float)
+            normal = vander_products.T.dot(weights).T.reshape(
+                (-1, polyorder+1, polyorder+1))
+            rhs = vander.T.dot(weights * fm_valid[:, dense]).T
+            coeffs[:, dense] = numpy.linalg.solve(
+                normal, rhs[:, :, None])[:, :, 0].T
+            fit[:, dense] = vander.dot(coeffs[:, dense])
+
+        for chunk in numpy.nonzero(sparse)[0]:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", numpy.RankWarning)
+                poly = numpy.polyfit(x=rows[valid[:, chunk]],
+                                     y=fm[valid[:, chunk], chunk],
+                                     deg=polyorder)
+            sparse_polys[chunk] = poly
+            fit[:, chunk] = numpy.polyval(poly, rows)
+
+        residual = fm - fit
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            _perc = numpy.nanpercentile(
+                numpy.where(valid, residual, numpy.NaN), [16,84,50], axis=0)
+        _sigma = 0.5*(_perc[1] - _perc[0])
+
+        bad = (residual > 3*_sigma) | (residual < -3*_sigma)
+        valid[bad & active] = False
+        fm_valid[~valid] = 0.
+
+    eval_fit = None
+    if (eval_y is not None):
+        eval_fit = numpy.vander(
+            (numpy.asarray(eval_y) - y_center) / y_scale,
+            polyorder+1).dot(coeffs)
+        for chunk, poly in sparse_polys.items():
+            eval_fit[..., chunk] = numpy.polyval(poly, eval_y)
+
+    return fit, eval_fit
+
+
 if __name__ == "__main__":
 
     fn = sys.argv[1]
@@ -4,10 +4,12 @@
 import sys, numpy, scipy
 from astropy.io import fits
 import scipy.ndimage
-from fiddle_slitflat import compute_profile
+from fiddle_slitflat import compute_profile, compute_profiles, binned_ops
 import pickle
 import logging
 import pysalt.mp_logging
+import stagetiming
+import surface
 
 import itertools
 def polyfit2dx(x, y, z, order=[3,3], ):
@@ -45,12 +47,19 @@ def polyval2dx(x, y, m, order=[3,3]):
 from optscale import polyfit2d, polyval2d
 
 
+@stagetiming.timed()
 def create_2d_flatfield_from_sky(wl, img, reuse_profile=None, bad_rows=None,
                                  debug=False,
-                                 op=numpy.nanmean):
+                                 op=numpy.nanmean,
+                                 engine='binned'):
 
     logger = logging.getLogger("Create2dVPHFlat")
 
+    if (engine == 'binned' and op not in binned_ops):
+        logger.warning("Binned profiles do not support %s, using per-row "
+                       "profiles instead" % (str(op)))
+        engine = 'rows'
+
     logger.info("Input size::  img:%s wl:%s" % (str(img.shape), str(wl.shape)))
 
     n_wl_chunks = 60
@@ -83,6 +92,23 @@ def create_2d_flatfield_from_sky(wl, img, reuse_profile=None, bad_rows=None,
         with open(reuse_profile, "rb") as pf:
             (profiles, profiles_sparse) = pickle.load(pf)
 
+    elif (engine == 'binned'):
+        logger.debug("Extracting all %d profiles in one pass" % (
+            wl_centers.shape[0]))
+        good_rows = numpy.ones((wl.shape[0]), dtype=numpy.bool) \
+            if bad_rows is None else ~bad_rows
+        profiles[good_rows, :], profiles_sparse[:, :] = compute_profiles(
+            wl=wl,
+            img=img,
+            line_wls=wl_centers,
+            line_width=wl_steps,
+            n_iter=15,
+            polyorder=5,
+            bad_rows=bad_rows,
+            op=op,
+            eval_y=sparse_y,
+        )
+
     else:
         for i_wl, cwl in enumerate(wl_centers):
             logger.debug("Extracting profile %d for wl %f +/- %f" % (
@@ -209,9 +235,11 @@ def create_2d_flatfield_from_sky(wl, img, reuse_profile=None, bad_rows=None,
     # Now compute the full resolution 2-d frame from the best-fit polynomial
     #
     logger.info("computing full-resolution scaling frame")
-    full_y, _ = numpy.indices(img.shape)
     # fullres2d = polyval2dx(x=wl, y=full_y, m=poly2d, order=order)
-    fullres2d = interpol(x=wl, y=full_y, grid=False)
+    def flatfield(rows, cols):
+        _wl, _y = numpy.broadcast_arrays(wl[rows, cols], rows)
+        return interpol(x=_wl, y=_y, grid=False)
+    fullres2d = surface.evaluate(flatfield, img.shape, tolerance=1e-4)
 
     if (debug):
         fits.PrimaryHDU(data=fullres2d).writeto(
@@ -3,6 +3,7 @@
 
 import os, sys, numpy, scipy.ndimage, scipy.signal
 import logging
+import debugartifacts
 from astropy.io import fits
 
 import pysalt.mp_logging
@@ -15,20 +16,26 @@ def find_edges_of_skylines(allskies, fn):
     logger.debug("median filter")
     #order0 = scipy.ndimage.filters.median_filter(allskies[:,1].reshape((-1,1)), size=49, mode='mirror')[:,0]
     order0 = scipy.ndimage.filters.gaussian_filter(input=allskies[:,1], order=0, sigma=15)
-    numpy.savetxt(fn+".diff0", 
-                  numpy.append(allskies[:,0].reshape((-1,1)),
-                               order0.reshape((-1,1)), axis=1))
+    debugartifacts.save_array(
+        fn+".diff0",
+        lambda: numpy.append(allskies[:,0].reshape((-1,1)),
+                             order0.reshape((-1,1)), axis=1),
+        stage="skysub")
 
     logger.debug("1st order")
     order1 = numpy.diff(order0)
-    numpy.savetxt(fn+".diff1", 
-                  numpy.append(allskies[:-1,0].reshape((-1,1)),
-                               order1.reshape((-1,1)), axis=1))
+    debugartifacts.save_array(
+        fn+".diff1",
+        lambda: numpy.append(allskies[:-1,0].reshape((-1,1)),
+                             order1.reshape((-1,1)), axis=1),
+        stage="skysub")
     #order1s = scipy.ndimage.filters.gaussian_filter(input=order1, order=0, sigma=3)
     order1s = scipy.ndimage.filters.median_filter(order1.reshape((-1,1)), size=15, mode='mirror')[:,0]
-    numpy.savetxt(fn+".diff1s", 
-                  numpy.append(allskies[:-1,0].reshape((-1,1)),
-                               order1s.reshape((-1,1)), axis=1))
+    debugartifacts.save_array(
+        fn+".diff1s",
+        lambda: numpy.append(allskies[:-1,0].reshape((-1,1)),
+                             order1s.reshape((-1,1)), axis=1),
+        stage="skysub")
 
 
     # print "2nd order"
@@ -65,20 +72,19 @@ def find_edges_of_skylines(allskies, fn):
 
     wl_edges = allskies[:,0][_edges]
     # print wl_edges
-    numpy.savetxt("edges_all", wl_edges)
+    debugartifacts.save_array("edges_all", wl_edges, stage="skysub")
 
     s2n = numpy.fabs(order1[_edges]) / _std
     s2n_cutoff = 3.
     is_strong_edge = (s2n > s2n_cutoff)
     strong_edges = allskies[:,0][_edges][is_strong_edge]
 
-    numpy.savetxt("edges_s2n=3", wl_edges)
+    debugartifacts.save_array("edges_s2n=3", wl_edges, stage="skysub")
 
     combined = numpy.append(strong_edges.reshape((-1,1)),
                                (s2n[is_strong_edge]).reshape((-1,1)), axis=1)
 
-    numpy.savetxt("edges_s2n=3.x", combined
-                  )
+    debugartifacts.save_array("edges_s2n=3.x", combined, stage="skysub")
 
     #source = ~good
     logger.info("done, returing list of edges")
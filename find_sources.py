@@ -11,8 +11,12 @@ import pysalt
 
 import logging
 import bottleneck
+import movingstats
+import stagetiming
+import debugartifacts
 
 
+@stagetiming.timed()
 def continuum_slit_profile(hdulist=None, data_ext='SKYSUB.OPT', sky_ext='SKYSUB.IMG', subtract_sky=True,
                            data=None, wl=None, sky=None, var=None):
 
@@ -32,7 +36,7 @@ def continuum_slit_profile(hdulist=None, data_ext='SKYSUB.OPT', sky_ext='SKYSUB.
         logger.critical("Missing data to compute continuum slit profile")
         return None, None
 
-    fits.PrimaryHDU(data=data).writeto("yyy", clobber=True)
+    debugartifacts.save_fits("yyy", data, stage="findsources")
     y = data.shape[0]/2
     #sky1d = sky[y:y+1,:] #.reshape((-1,1))
     sky1d = sky[y,:] #.reshape((-1,1))
@@ -51,8 +55,8 @@ def continuum_slit_profile(hdulist=None, data_ext='SKYSUB.OPT', sky_ext='SKYSUB.
     
     #print mf.shape
 
-    numpy.savetxt("sky", sky1d)
-    numpy.savetxt("sky2", mf)
+    debugartifacts.save_array("sky", sky1d, stage="findsources")
+    debugartifacts.save_array("sky2", mf, stage="findsources")
 
     # pick the intensity of the lowest 10%
     max_intensity = scipy.stats.scoreatpercentile(sky1d, [10,20])
@@ -79,17 +83,15 @@ def continuum_slit_profile(hdulist=None, data_ext='SKYSUB.OPT', sky_ext='SKYSUB.
     N = 15
     buffered = numpy.zeros(line_strength.shape[0]+2*N)
     buffered[N:-N][~no_line] = 1.0
-    numpy.savetxt("lines", buffered)
+    debugartifacts.save_array("lines", buffered, stage="findsources")
 
     W = 15
-    line_blocker = numpy.array(
-        [numpy.sum(buffered[x+N-W:x+N+W]) for x in range(line_strength.shape[0])]
-    )
-    numpy.savetxt("lineblocker", line_blocker)
+    line_blocker = movingstats.move_sum(buffered[N:-N], W, W-1)
+    debugartifacts.save_array("lineblocker", line_blocker, stage="findsources")
 
     line_contaminated = line_blocker >= 1
     line_strength[line_contaminated] = numpy.NaN
-    numpy.savetxt("contsky", line_strength)
+    debugartifacts.save_array("contsky", line_strength, stage="findsources")
     
     #
     # Now we have a very good estimate where skylines contaminate the spectrum
@@ -150,7 +152,7 @@ def continuum_slit_profile(hdulist=None, data_ext='SKYSUB.OPT', sky_ext='SKYSUB.
 
     var[out_of_range] = numpy.NaN
 
-    fits.PrimaryHDU(data=data).writeto("xxx", clobber=True)
+    debugartifacts.save_fits("xxx", data, stage="findsources")
 
     #intensity_profile = bottleneck.nansum(data, axis=1)
     intensity_profile = numpy.nansum(data, axis=1)
@@ -158,8 +160,8 @@ def continuum_slit_profile(hdulist=None, data_ext='SKYSUB.OPT', sky_ext='SKYSUB.
 
     #print data.shape, intensity_profile.shape
 
-    numpy.savetxt("prof", intensity_profile)
-    numpy.savetxt("prof.var", intensity_error)
+    debugartifacts.save_array("prof", intensity_profile, stage="findsources")
+    debugartifacts.save_array("prof.var", intensity_error, stage="findsources")
 
     #
     # Apply wide median filter to subtract continuum slope (if any)
@@ -168,6 +170,7 @@ def continuum_slit_profile(hdulist=None, data_ext='SKYSUB.OPT', sky_ext='SKYSUB.
     return intensity_profile, intensity_error
 
 
+@stagetiming.timed()
 def identify_sources(profile, profile_var=None,
                      min_peak_s2n=4,
                      psf_size=3,
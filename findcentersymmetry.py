@@ -14,6 +14,8 @@ import traceline
 from traceline import linetrace_colidx
 
 import logging
+import stagetiming
+import debugartifacts
 
 
 def mirror_residuals(p, xmin, xmax, linefit, save):
@@ -26,13 +28,13 @@ def mirror_residuals(p, xmin, xmax, linefit, save):
     diff = right - left
     ret = numpy.var(diff)
     if (save):
-        numpy.savetxt("symmetry.residuals%d" % (p[0]), diff)
-        with open("fitlog","a") as fl:
-            fl.write("%f %f\n" % (p[0], ret))
+        debugartifacts.save_array("symmetry.residuals%d" % (p[0]), diff,
+                                  stage="symmetry")
     return ret
 
 
 
+@stagetiming.timed()
 def find_curvature_symmetry_line(hdulist,
                                  data_ext='VAR',
                                  avg_width=10,
@@ -51,7 +53,7 @@ def find_curvature_symmetry_line(hdulist,
     #avg_width = 10
     spec = wlcal.extract_arc_spectrum(hdulist,
                                       avg_width=avg_width)
-    numpy.savetxt("symmetry.spec", spec)
+    debugartifacts.save_array("symmetry.spec", spec, stage="symmetry")
 
     logger.debug("Searching for lines")
     linelist = wlcal.find_list_of_lines(
@@ -61,7 +63,7 @@ def find_curvature_symmetry_line(hdulist,
         avg_width=avg_width,
         pre_smooth=None)
     #print linelist
-    numpy.savetxt("symmetry.lines", linelist)
+    debugartifacts.save_array("symmetry.lines", linelist, stage="symmetry")
 
     #
     # Select the brightest line to determine line width
@@ -74,7 +76,8 @@ def find_curvature_symmetry_line(hdulist,
     # allow for at most 20 pixels linewidth
     maxw=10
     part_of_bright_line = spec[int(brightest[0]-maxw):int(brightest[0]+maxw)]
-    numpy.savetxt("symmetry.partofbrightest", part_of_bright_line)
+    debugartifacts.save_array("symmetry.partofbrightest", part_of_bright_line,
+                              stage="symmetry")
     peak_flux = brightest[1]
     _x = numpy.arange(part_of_bright_line.shape[0])
     left = numpy.min(_x[part_of_bright_line > 0.5*peak_flux])
@@ -92,7 +95,7 @@ def find_curvature_symmetry_line(hdulist,
         avg_width=avg_width,
         pre_smooth=linewidth/2.)
     #print linelist
-    numpy.savetxt("symmetry.lines2", linelist2)
+    debugartifacts.save_array("symmetry.lines2", linelist2, stage="symmetry")
 
     #
     # Now pick some isolated lines
@@ -105,7 +108,7 @@ def find_curvature_symmetry_line(hdulist,
         min_signal_to_noise=10,
     )
     isolated = linelist2[i_isolated.astype(numpy.int)]
-    numpy.savetxt("symmetry.isolated", isolated)
+    debugartifacts.save_array("symmetry.isolated", isolated, stage="symmetry")
     print linelist2.shape, isolated.shape
 
     #
@@ -138,7 +141,8 @@ def find_curvature_symmetry_line(hdulist,
             fine_centroiding=True,
             fine_centroiding_width=2*linewidth,
         )
-        numpy.savetxt("symmetry.lt.%d" % (lines4curvature[line,0]), lt)
+        debugartifacts.save_array("symmetry.lt.%d" % (lines4curvature[line,0]),
+                                  lt, stage="symmetry")
 
         #
         # Require the trace to extend across at leat half the chip
@@ -167,7 +171,7 @@ def find_curvature_symmetry_line(hdulist,
         #print pos_2d.shape
         var = numpy.var(pos_2d, axis=1)
         #print var.shape
-        numpy.savetxt("symmetry.posvar", var)
+        debugartifacts.save_array("symmetry.posvar", var, stage="symmetry")
 
         _var = var.copy()
         n_sigma = 5
@@ -178,7 +182,7 @@ def find_curvature_symmetry_line(hdulist,
             #print _stats, _median, _sigma
             bad = (_var > _median+n_sigma*_sigma) | (_var < _median - n_sigma*_sigma)
             _var[bad] = numpy.NaN
-        numpy.savetxt("symmetry.posvar2", _var)
+        debugartifacts.save_array("symmetry.posvar2", _var, stage="symmetry")
         bad_positions = numpy.isnan(_var) #.reshape((-1,1))
         #print bad_positions.shape
         idx = numpy.arange(-pad_left, lt.shape[0]+pad_right).reshape((-1, blocksize))
@@ -192,8 +196,9 @@ def find_curvature_symmetry_line(hdulist,
         #print bad1d
 
         good_linedata = lt[bad1d[bad1d>=0]]
-        numpy.savetxt("symmetry.good_lt.%d" % (lines4curvature[line,0]),
-                      good_linedata)
+        debugartifacts.save_array(
+            "symmetry.good_lt.%d" % (lines4curvature[line,0]),
+            good_linedata, stage="symmetry")
 
         #
         #
@@ -211,7 +216,6 @@ def find_curvature_symmetry_line(hdulist,
         xmax = numpy.max(good_linedata[:, 0])
 
         # test fitting
-        fl = open("fitlog_%d" %(line),"w")
         t1 = int(0.45*data.shape[0])
         t2 = int(0.55*data.shape[0])
         symmetry_quality = numpy.empty((data.shape[0]))
@@ -222,13 +226,13 @@ def find_curvature_symmetry_line(hdulist,
                 xmin=numpy.min(good_linedata[:, 0]),
                 xmax=numpy.max(good_linedata[:, 0]),
                 linefit=linefit,
-                save=True)
+                save=debug)
             #numpy.savetxt("symmetry.residuals%d" % (p), diff)
             #print p, numpy.mean(diff), numpy.var(diff)
-            print >>fl, p, diff
             symmetry_quality[p] = diff
 
-        numpy.savetxt("symmetry.quality.%d" % (line), symmetry_quality)
+        debugartifacts.save_array("symmetry.quality.%d" % (line),
+                                  symmetry_quality, stage="symmetry")
             #numpy.mean(diff), numpy.var(diff)
 
         midline = numpy.argmin(symmetry_quality)
@@ -257,7 +261,8 @@ def find_curvature_symmetry_line(hdulist,
     best_match = numpy.argmin(good_symmetry[:,2])
     best_midline = good_symmetry[best_match]
 
-    numpy.savetxt("symmetry.summary", symmetry_line)
+    debugartifacts.save_array("symmetry.summary", symmetry_line,
+                              stage="symmetry")
 
     logger.info("Done finding symmetry (row=%d)" % (best_midline[1]))
     return symmetry_line, best_midline, linewidth
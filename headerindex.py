@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""
+
+Index of the primary headers of all raw frames of a night.
+
+The index holds the header keywords the pipeline uses to classify frames
+and to match ARCs and flat-fields to OBJECT frames. It is built once per
+raw directory, reading only the primary header of each file, and stored as
+a small JSON catalog. Entries are re-used as long as size and modification
+time of the file do not change, so later runs (e.g. with --check) do not
+have to open any file again.
+
+Frames are grouped by a hash of their instrument setup (all setup_headers
+except the grating tilt), so finding the ARCs for a frame is a dictionary
+lookup, with an optional fallback to the ARC with the closest GRTILT.
+
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import numpy
+from astropy.io import fits
+
+import pysalt.mp_logging
+
+
+#
+# Headers that need to match between frames taken with the same instrument
+# setup; the grating tilt is handled separately, to allow for closest
+# matches.
+#
+setup_headers = [
+    'CCDSUM',
+    'WP-STATE',  # Waveplate State Machine State
+    'ET-STATE',  # Etalon State Machine State
+    'GR-STATE',  # Grating State Machine State
+    'GR-STA',  # Commanded Grating Station
+    'BS-STATE',  # Beamsplitter State Machine State
+    'FI-STATE',  # Filter State Machine State
+    'AR-STATE',  # Articulation State Machine State
+    'AR-STA',  # Commanded Articulation Station
+    'CAMANG',  # Commanded Articulation Station
+    'POLCONF',  # Polarization configuration
+    'GRATING',  # Commanded grating station
+]
+tilt_header = 'GRTILT'
+
+# all headers stored in the index
+index_headers = ['INSTRUME', 'OBSTYPE', 'CCDTYPE', 'OBJECT', 'JD',
+                 'EXPTIME', 'LAMPID', 'GR-ANGLE', tilt_header] + setup_headers
+
+catalog_version = 1
+
+
+def _header_value(value):
+    # header values as stored in the JSON catalog
+    if (isinstance(value, unicode)):
+        return str(value)
+    if (isinstance(value, (bool, numpy.bool_))):
+        return bool(value)
+    if (isinstance(value, (int, long, float, numpy.number))):
+        return value.item() if isinstance(value, numpy.number) else value
+    return str(value)
+
+
+def read_header(filename):
+    """
+
+    Read all index_headers from the primary header of filename.
+
+    """
+    header = fits.getheader(filename, 0)
+    return dict((key, _header_value(header[key]))
+                for key in index_headers if key in header)
+
+
+def setup_hash(header):
+    """
+
+    Hash of the instrument setup of a frame, or None if any of the
+    setup_headers is missing (such frames never match any other frame).
+
+    """
+    parts = []
+    for key in setup_headers:
+        if (key not in header):
+            return None
+        value = header[key]
+        if (isinstance(value, (int, long, float)) and
+                not isinstance(value, bool)):
+            # so that e.g. 45 and 45.0 are the same setup
+            value = repr(float(value))
+        else:
+            value = str(value)
+        parts.append("%s=%s" % (key, value))
+    return hashlib.sha1("\n".join(parts)).hexdigest()[:16]
+
+
+def frame_type(header):
+    """
+
+    Type of the frame (OBJECT, ARC, FLAT, ...) from the OBSTYPE header, or
+    from CCDTYPE if OBSTYPE is missing or not one of OBJECT/ARC/FLAT.
+
+    """
+    obstype = header.get('OBSTYPE', None)
+    if (obstype not in ['OBJECT', 'ARC', 'FLAT']):
+        obstype = None
+    if (obstype is None or obstype.strip() == ""):
+        obstype = header.get('CCDTYPE', obstype)
+    return obstype
+
+
+class HeaderIndex(object):
+
+    def __init__(self, catalog=None):
+        self.catalog = catalog
+        self.entries = {}
+        self.modified = False
+        if (catalog is not None and os.path.isfile(catalog)):
+            self.load(catalog)
+
+    def load(self, catalog):
+        logger = logging.getLogger("HeaderIndex")
+        try:
+            with open(catalog) as f:
+                data = json.load(f)
+            if (data.get('version', None) == catalog_version):
+                self.entries = data['entries']
+                for entry in self.entries.values():
+                    entry['header'] = dict(
+                        (str(key), _header_value(value))
+                        for key, value in entry['header'].items())
+        except (IOError, ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable header index %s (%s)" % (
+                catalog, str(e)))
+
+    def save(self, catalog=None):
+        catalog = self.catalog if catalog is None else catalog
+        if (catalog is None):
+            return
+        # write to a temporary file first, so parallel readers never see a
+        # partially written catalog
+        tmp = "%s.%d.tmp" % (catalog, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({'version': catalog_version, 'entries': self.entries},
+                      f, indent=1, sort_keys=True)
+        os.rename(tmp, catalog)
+        self.modified = False
+
+    def update(self, filenames):
+        """
+
+        Add all filenames to the index, reading the headers of all files
+        that are new or changed since they were last indexed.
+
+        """
+        logger = logging.getLogger("HeaderIndex")
+        n_read = 0
+        for filename in filenames:
+            key = os.path.abspath(filename)
+            stat = os.stat(filename)
+            entry = self.entries.get(key, None)
+            if (entry is not None and entry['size'] == stat.st_size and
+                    entry['mtime'] == stat.st_mtime):
+                continue
+            header = read_header(filename)
+            self.entries[key] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'header': header,
+                'setup': setup_hash(header),
+            }
+            n_read += 1
+        if (n_read > 0):
+            self.modified = True
+        logger.info("Indexed %d files, %d headers read, %d from catalog" % (
+            len(filenames), n_read, len(filenames) - n_read))
+
+    def header(self, filename):
+        return self.entries[os.path.abspath(filename)]['header']
+
+    def setup(self, filename):
+        return self.entries[os.path.abspath(filename)]['setup']
+
+    def classify(self, filenames, types=('OBJECT', 'ARC', 'FLAT')):
+        """
+
+        Sort all RSS frames in filenames by type. Returns a dictionary of
+        type to the list of frames.
+
+        """
+        logger = logging.getLogger("HeaderIndex")
+        obslog = dict((t, []) for t in types)
+        for filename in filenames:
+            header = self.header(filename)
+            if (header.get('INSTRUME', None) != "RSS"):
+                logger.info("Frame %s is not a valid RSS frame (instrument: %s)" % (
+                    filename, header.get('INSTRUME', None)))
+                continue
+            obstype = frame_type(header)
+            if (obstype in obslog):
+                obslog[obstype].append(filename)
+                logger.debug("Identifying %s as %s" % (filename, obstype))
+            else:
+                logger.info("No idea what to do with frame %s --> %s" % (
+                    filename, obstype))
+        return obslog
+
+
+def build_index(filenames, catalog=None):
+    """
+
+    Return the header index of all filenames, re-using (and updating) the
+    catalog file if given.
+
+    """
+    index = HeaderIndex(catalog)
+    index.update(filenames)
+    if (index.modified):
+        index.save()
+    return index
+
+
+class SetupTable(object):
+    """
+
+    Frames (e.g. the calibrated ARCs) grouped by the hash of their
+    instrument setup, with their grating tilt.
+
+    """
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, header, item, setup=None):
+        setup = setup_hash(header) if setup is None else setup
+        if (setup is None or tilt_header not in header):
+            return
+        if (setup not in self.groups):
+            self.groups[setup] = []
+        self.groups[setup].append((header[tilt_header], item))
+
+    def map(self, fct):
+        """
+
+        Copy of the table, with fct applied to all items (e.g. to make all
+        filenames absolute).
+
+        """
+        table = SetupTable()
+        for setup in self.groups:
+            table.groups[setup] = [(tilt, fct(item))
+                                   for tilt, item in self.groups[setup]]
+        return table
+
+    def find(self, header, accept_closest=False):
+        """
+
+        All items with the same setup and grating tilt as header. With
+        accept_closest, return the item with the closest grating tilt
+        instead. Also returns whether the grating tilt matches exactly.
+
+        """
+        setup = setup_hash(header)
+        group = self.groups.get(setup, []) if setup is not None else []
+        tilt = header[tilt_header] if tilt_header in header else None
+        if (not accept_closest):
+            return [item for t, item in group if t == tilt], True
+        if (len(group) == 0 or tilt is None):
+            return [], False
+        diff = numpy.fabs(numpy.array([t for t, _ in group]) - tilt)
+        closest = numpy.argmin(diff)
+        return [group[closest][1]], diff[closest] == 0
+
+
+if __name__ == "__main__":
+
+    logger_setup = pysalt.mp_logging.setup_logging()
+    logger = logging.getLogger("HeaderIndex")
+
+    catalog = sys.argv[1]
+    filenames = sys.argv[2:]
+    index = build_index(filenames, catalog=catalog)
+    obslog = index.classify(filenames)
+    for obstype in obslog:
+        for filename in obslog[obstype]:
+            logger.info("%-6s %s %s" % (obstype, index.setup(filename),
+                                        filename))
+
+    pysalt.mp_logging.shutdown_logging(logger_setup)
@@ -1,10 +1,143 @@
 #!/usr/bin/env python
 
 import sys
+import time
 import numpy
 import logging
+import bottleneck
 
-def calculate_local_noise(data, basepoints, select=None, dumpdebug=False, operator=numpy.nanstd):
+
+#
+# Reductions we know how to compute for all basepoints at once in the sorted
+# engine. All other operators are still supported, but are called once for
+# each slice of sorted data.
+#
+vectorized_operators = {
+    numpy.nanstd: 'std',
+    numpy.nanvar: 'var',
+    numpy.nanmean: 'mean',
+    numpy.nanmedian: 'median',
+    bottleneck.nanstd: 'std',
+    bottleneck.nanvar: 'var',
+    bottleneck.nanmean: 'mean',
+    bottleneck.nanmedian: 'median',
+}
+
+
+def basepoint_edges(basepoints):
+    """
+
+    Each basepoint is responsible for all datapoints between the mid-points
+    to its two neighbors; the first and last basepoint extend to their own
+    position on the outside.
+
+    """
+    padded = numpy.empty((basepoints.shape[0]+2))
+    padded[1:-1] = basepoints[:]
+    padded[0] = basepoints[0]
+    padded[-1] = basepoints[-1]
+    left_edge = 0.5*(padded[:-2] + padded[1:-1])
+    right_edge = 0.5*(padded[1:-1] + padded[2:])
+
+    return left_edge, right_edge
+
+
+def segmented_stats(values, start, end, mode='std', percentile=None):
+    """
+
+    Compute NaN-aware statistics for many consecutive segments
+    values[start[i]:end[i]] of a 1-d array in one go. Segments have to be
+    non-overlapping and sorted, i.e. start[i+1] >= end[i].
+
+    mode can be one of mean, std, var, median, percentile (requires
+    percentile, in the range 0..100) or mad (median absolute deviation from
+    the median). Empty segments return NaN, matching the numpy nan-functions.
+
+    """
+
+    n_segments = start.shape[0]
+    result = numpy.empty((n_segments))
+    result[:] = numpy.NaN
+
+    length = end - start
+    nonempty = length > 0
+    if (not numpy.any(nonempty)):
+        return result
+
+    # Label each datapoint with the segment it belongs to; as segments are
+    # sorted this is the last segment starting at or before each datapoint
+    first, last = numpy.min(start[nonempty]), numpy.max(end[nonempty])
+    idx = numpy.arange(first, last)
+    segment_id = numpy.searchsorted(start, idx, side='right') - 1
+    inside = (segment_id >= 0) & (idx < end[segment_id])
+
+    v = values[first:last]
+    valid = inside & numpy.isfinite(v)
+    v = v[valid]
+    sid = segment_id[valid]
+    count = numpy.bincount(sid, minlength=n_segments).astype(numpy.float)
+    has_data = count > 0
+
+    if (mode in ['mean', 'std', 'var']):
+        mean = numpy.bincount(sid, weights=v, minlength=n_segments)
+        mean[has_data] /= count[has_data]
+        if (mode == 'mean'):
+            result[has_data] = mean[has_data]
+            return result
+
+        # two-pass variance to avoid loss of precision
+        delta = v - mean[sid]
+        var = numpy.bincount(sid, weights=delta**2, minlength=n_segments)
+        var[has_data] /= count[has_data]
+        result[has_data] = var[has_data] if mode == 'var' else \
+            numpy.sqrt(var[has_data])
+        return result
+
+    if (mode in ['median', 'percentile', 'mad']):
+        q = 50. if mode != 'percentile' else percentile
+
+        def _sorted_percentile(v, sid, q):
+            si = numpy.lexsort((v, sid))
+            v_sorted = v[si]
+            n = numpy.bincount(sid, minlength=n_segments)
+            first = numpy.cumsum(n) - n
+            pos = (q / 100.) * (n - 1)
+            lo = numpy.floor(pos).astype(numpy.int)
+            hi = numpy.ceil(pos).astype(numpy.int)
+            _r = numpy.empty((n_segments))
+            _r[:] = numpy.NaN
+            ok = n > 0
+            v_lo = v_sorted[(first + lo)[ok]]
+            v_hi = v_sorted[(first + hi)[ok]]
+            _r[ok] = v_lo + (v_hi - v_lo) * (pos - lo)[ok]
+            return _r
+
+        stat = _sorted_percentile(v, sid, q)
+        if (mode == 'mad'):
+            stat = _sorted_percentile(numpy.fabs(v - stat[sid]), sid, 50.)
+        result[has_data] = stat[has_data]
+        return result
+
+    raise ValueError("Unknown segmented statistic: %s" % (mode))
+
+
+def calculate_local_noise(data, basepoints, select=None, dumpdebug=False,
+                          operator=numpy.nanstd, mode='sorted'):
+    """
+
+    For each basepoint, compute the statistic operator (nanstd by default)
+    over all datapoints in data whose select-value (typically wavelength) is
+    between the mid-points to the adjacent basepoints.
+
+    mode='mask' builds a full boolean mask over all datapoints for each
+    basepoint. mode='sorted' uses the sort order of select to find the
+    range of datapoints belonging to each basepoint with searchsorted and
+    then reduces all ranges in one pass. Besides the numpy/bottleneck
+    nanstd/nanvar/nanmean/nanmedian functions, operator may also be one of
+    the strings 'std', 'var', 'mean', 'median', 'mad' or 'pNN' (NN-th
+    percentile); other callables are applied to each range in turn.
+
+    """
 
     logger = logging.getLogger("LocalNoise")
     logger.debug("Local noise at %d places for %d datapoints" % (basepoints.shape[0], data.shape[0]))
@@ -17,41 +150,80 @@ def calculate_local_noise(data, basepoints, select=None, dumpdebug=False, operat
     if (dumpdebug):
         numpy.savez("data_for_local_noise", data, basepoints, select)
 
-    #print "padding"
-    padded = numpy.empty((basepoints.shape[0]+2))
-    padded[1:-1] = basepoints[:]
-    padded[0] = basepoints[0]
-    padded[1] = basepoints[1]
-    left_edge = 0.5*(padded[:-2] + padded[1:-1])
-    right_edge = 0.5*(padded[1:-1] + padded[2:])
+    left_edge, right_edge = basepoint_edges(basepoints)
 
     #print "selecting & computing noise"
     noise = numpy.empty((basepoints.shape[0], data.shape[1]))
-    logger.debug("Shapes noise/basepoints/padded/data: %s/%s/%s/%s" % (
-                 str(noise.shape), str(basepoints.shape),
-                 str(padded.shape), str(data.shape)))
+    logger.debug("Shapes noise/basepoints/data: %s/%s/%s" % (
+                 str(noise.shape), str(basepoints.shape), str(data.shape)))
 
     noise[:,:] = numpy.NaN
-    for p in range(basepoints.shape[0]):
-        nearby = (select >= left_edge[p]) & (select < right_edge[p])
-        subset = data[nearby]
-        #print subset.shape
 
-        #_noise = numpy.nanstd(subset,axis=0)
-        _noise = operator(data[nearby],axis=0)
-        #print p, _noise
-        noise[p, :] = _noise
+    if (mode == 'mask'):
+        for p in range(basepoints.shape[0]):
+            nearby = (select >= left_edge[p]) & (select < right_edge[p])
+            noise[p, :] = operator(data[nearby],axis=0)
+
+        logger.debug("all done: %s" % (str(noise.shape)))
+        return noise
+
+    #
+    # sorted mode: the caller typically already sorted all data by
+    # wavelength, so only sort if this is not the case
+    #
+    if (numpy.any(select[1:] < select[:-1])):
+        logger.debug("select is not sorted, sorting data first")
+        si = numpy.argsort(select)
+        select = select[si]
+        data = data[si]
+
+    start = numpy.searchsorted(select, left_edge, side='left')
+    end = numpy.searchsorted(select, right_edge, side='left')
+    end[end < start] = start[end < start]
+
+    op_name = operator if type(operator) == str else \
+        vectorized_operators.get(operator, None)
+
+    if (op_name is None):
+        # unknown operator, fall back to calling it for each range
+        for p in range(basepoints.shape[0]):
+            noise[p, :] = operator(data[start[p]:end[p]], axis=0)
+    else:
+        percentile = None
+        if (op_name.startswith("p")):
+            percentile = float(op_name[1:])
+            op_name = 'percentile'
+        for col in range(data.shape[1]):
+            noise[:, col] = segmented_stats(
+                values=data[:, col], start=start, end=end,
+                mode=op_name, percentile=percentile)
 
     logger.debug("all done: %s" % (str(noise.shape)))
     return noise
 
+
 if __name__ == "__main__":
 
     if (sys.argv[1] == "test"):
+        logging.basicConfig(level=logging.INFO)
+        logger = logging.getLogger("LocalNoiseTest")
+
         data = numpy.random.random((5495808,1))
         basepoints = numpy.linspace(0, 5495808, 600)
         xpos = numpy.arange(5495808)
-        ln = calculate_local_noise(data=data, basepoints=basepoints, select=xpos)
+
+        results = {}
+        for mode in ['mask', 'sorted']:
+            t0 = time.time()
+            results[mode] = calculate_local_noise(
+                data=data, basepoints=basepoints, select=xpos, mode=mode)
+            t1 = time.time()
+            logger.info("mode %-6s: %8.3f seconds" % (mode, t1-t0))
+
+        logger.info("max. difference: %g" % (
+            numpy.nanmax(numpy.fabs(results['mask'] - results['sorted']))))
+
+        ln = results['sorted']
         numpy.savetxt(
             "localnoise.test",
             numpy.append(basepoints.reshape((-1,1)),
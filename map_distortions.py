@@ -10,9 +10,11 @@ import numpy
 import math
 import logging
 import bottleneck
+import stagetiming
 
 from pysalt import mp_logging
 
+@stagetiming.timed()
 def map_distortions(wl_2d, diff_2d, img_2d, y, x_list, badrows=None,
                     debug=False, dwl=3):
 
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+
+Normalization and combination of flat-fields into master flats, and a cache
+of master flats that can be shared between nights.
+
+Flats are normalized one frame at a time, by dividing each amplifier by a
+median-filtered version of itself along the dispersion direction; this
+takes out the spectral slope and leaves the pixel-to-pixel variations. The
+normalized flats are then combined block by block of rows with the
+sigma-clipping kernels in podi_cython, reading only the rows of the current
+block from each frame. Memory use is therefore set by the block size and not
+by the number of flats.
+
+Master flats are cached under a key made up of the instrument setup and the
+checksums of all input flats, so re-reducing a night (or another night using
+the same flats) does not have to create the master flat again.
+
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.pool
+import numpy
+import scipy.ndimage
+from astropy.io import fits
+
+import pysalt.mp_logging
+import podi_cython
+import arccache
+import stagetiming
+
+
+setup_headers = [
+    'GRATING',
+    'GR-ANGLE',
+    'GRTILT',
+    'CAMANG',
+    'CCDSUM',
+]
+
+combine_methods = {
+    'mean': podi_cython.sigma_clip_mean,
+    'median': podi_cython.sigma_clip_median,
+}
+
+
+@stagetiming.timed()
+def normalize_amplifier(data, filter_size=(1, 25)):
+    """
+
+    Divide the amplifier data by its median, filtered along the dispersion
+    direction. Pixels that can not be normalized are set to NaN, so they are
+    ignored when combining.
+
+    """
+    filtered = scipy.ndimage.filters.median_filter(
+        input=data,
+        size=filter_size,
+        footprint=None,
+        output=None,
+        mode='reflect',
+        cval=0.0,
+        origin=0)
+    normalized = data / filtered
+    normalized[~numpy.isfinite(normalized)] = numpy.NaN
+    return normalized
+
+
+def _combine_block(frames, y0, y1, method, nsigma, max_repeat):
+    # stack all frames so that all values of a pixel are adjacent in memory,
+    # as required by the sigma-clipping kernels
+    block = frames[0][y0:y1]
+    stack = numpy.empty((block.size, len(frames)), dtype=numpy.float64)
+    for i, data in enumerate(frames):
+        stack[:, i] = data[y0:y1].ravel()
+    combined = numpy.empty(block.size, dtype=numpy.float64)
+    combine_methods[method](stack, combined, nsigma, max_repeat)
+    return combined.reshape(block.shape)
+
+
+@stagetiming.timed()
+def combine_extension(hdus, extid, method='mean', nsigma=3., max_repeat=3,
+                      block_rows=128, n_threads=None):
+    """
+
+    Combine extension extid of all (memory-mapped) flats in hdus, using
+    sigma-clipped averages (method mean or median). The combination runs in
+    blocks of block_rows rows, in up to n_threads threads (default: one per
+    CPU).
+
+    """
+    # access all data before starting any threads; with memory-mapping this
+    # only maps the files, the rows are read block by block
+    frames = [hdulist[extid].data for hdulist in hdus]
+    ny, nx = frames[0].shape
+    blocks = [(y0, min(y0 + block_rows, ny))
+              for y0 in range(0, ny, block_rows)]
+
+    if (n_threads is None):
+        n_threads = multiprocessing.cpu_count()
+    n_threads = max(1, min(n_threads, len(blocks)))
+
+    combined = numpy.empty((ny, nx), dtype=numpy.float64)
+
+    def _combine(block):
+        y0, y1 = block
+        combined[y0:y1] = _combine_block(frames, y0, y1,
+                                         method, nsigma, max_repeat)
+
+    if (n_threads <= 1):
+        for block in blocks:
+            _combine(block)
+    else:
+        pool = multiprocessing.pool.ThreadPool(processes=n_threads)
+        pool.map(_combine, blocks)
+        pool.close()
+        pool.join()
+
+    return combined
+
+
+@stagetiming.timed()
+def combine(normalized_filenames, template, masterflat_filename,
+            method='mean', nsigma=3., max_repeat=3, block_rows=128,
+            n_threads=None):
+    """
+
+    Combine all SCI extensions of the normalized flats, and write the result
+    to masterflat_filename, using template (the HDUList of one of the raw
+    flats) for all headers.
+
+    """
+    logger = logging.getLogger("MasterFlat")
+
+    hdus = [fits.open(fn, memmap=True) for fn in normalized_filenames]
+    for extid, ext in enumerate(hdus[0]):
+        if (ext.name != "SCI"):
+            continue
+        logger.info("Ext %d: combining %d flats (sigma-clipped %s)" % (
+            extid, len(hdus), method))
+        template[extid].data = combine_extension(
+            hdus, extid, method=method, nsigma=nsigma,
+            max_repeat=max_repeat, block_rows=block_rows,
+            n_threads=n_threads)
+    for hdulist in hdus:
+        hdulist.close()
+
+    template[0].header['NCOMBINE'] = (len(normalized_filenames),
+                                      "number of flats combined")
+    template[0].header['FLATCOMB'] = (method, "flat combination method")
+    pysalt.clobberfile(masterflat_filename)
+    template.writeto(masterflat_filename, clobber=True)
+    logger.info("Wrote master flat-field to %s" % (masterflat_filename))
+
+
+def cache_key(filenames, header=None, method='mean', nsigma=3.,
+              max_repeat=3):
+    """
+
+    Return the cache key for the master flat of the raw flats in filenames,
+    combined with the given method and clipping parameters, e.g.
+    PG0900_13.625_13.625_27.250_2x2__mean_3_3__<checksum>.
+
+    """
+    if (header is None):
+        header = fits.getheader(filenames[0], 0)
+    setup = arccache.setup_string(header, keys=setup_headers)
+    combination = "%s_%g_%d" % (method, nsigma, max_repeat)
+
+    # the order of the flats does not matter for the master flat
+    sha1 = hashlib.sha1()
+    for file_hash in sorted([arccache.file_hash(fn) for fn in filenames]):
+        sha1.update(file_hash)
+    return "%s__%s__%s" % (setup, combination, sha1.hexdigest()[:16])
+
+
+def cache_filename(cachedir, key):
+    return os.path.join(cachedir, "flat__%s.fits" % (key))
+
+
+def lookup(cachedir, key):
+    """
+
+    Return the filename of the cached master flat for key, or None.
+
+    """
+    if (cachedir is None):
+        return None
+    fn = cache_filename(cachedir, key)
+    return fn if os.path.isfile(fn) else None
+
+
+def store(cachedir, key, masterflat_filename):
+    """
+
+    Add a master flat to the cache.
+
+    """
+    logger = logging.getLogger("MasterFlat")
+    if (cachedir is None):
+        return
+
+    if (not os.path.isdir(cachedir)):
+        try:
+            os.makedirs(cachedir)
+        except OSError:
+            # most likely created by another process in the meantime
+            pass
+
+    # write to a temporary file first, so a concurrent reader (or a crash)
+    # never sees a partially written file
+    fn = cache_filename(cachedir, key)
+    tmp = "%s.%d.tmp" % (fn, os.getpid())
+    shutil.copyfile(masterflat_filename, tmp)
+    os.rename(tmp, fn)
+    logger.info("Added %s to flat cache (%s)" % (masterflat_filename, key))
+
+
+def restore(cachedir, key, masterflat_filename):
+    """
+
+    Copy the cached master flat for key to masterflat_filename. Returns True
+    if the master flat was found in the cache.
+
+    """
+    cached_fn = lookup(cachedir, key)
+    if (cached_fn is None):
+        return False
+    pysalt.clobberfile(masterflat_filename)
+    shutil.copyfile(cached_fn, masterflat_filename)
+    return True
+
+
+if __name__ == "__main__":
+
+    logger_setup = pysalt.mp_logging.setup_logging()
+    logger = logging.getLogger("MasterFlat")
+
+    # combine already normalized flats
+    masterflat_filename = sys.argv[1]
+    filenames = sys.argv[2:]
+    combine(filenames, fits.open(filenames[0]), masterflat_filename)
+
+    pysalt.mp_logging.shutdown_logging(logger_setup)
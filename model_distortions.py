@@ -13,7 +13,10 @@ import scipy.ndimage
 import math
 
 import traceline
+import debugartifacts
+import stagetiming
 import wlmodel
+import surface
 import map_distortions
 import pysalt
 
@@ -32,6 +35,7 @@ for idx,name in enumerate(distmap_cols):
     distmap_colidx[name] = idx
 
 
+@stagetiming.timed()
 def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
                                diff_2d=None, badrows=None, s2n_cutoff=5,
                                ref_row=None, linewidth=10,
@@ -92,7 +96,8 @@ def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
         order=0,
         mode='reflect',
     )
-    fits.PrimaryHDU(data=img_prefilter).writeto("dist_prefilter.fits", clobber=True)
+    debugartifacts.save_fits("dist_prefilter", img_prefilter,
+                             stage="distortions")
 
 
     if (distortion_method.lower() == 'trace' or True):
@@ -103,19 +108,33 @@ def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
         # algorithm/method instead
         #
         multi_line_traces = []
-        for line in skyline_list:
+        all_traces = None
+        if (traceline.use_compiled_tracer):
+            # trace all lines, in both directions, in one go
+            all_traces = traceline.trace_arcs(
+                data=img_prefilter.T,
+                starts=[(line[0], int(ref_row))
+                        for line in skyline_list for d in [-1,+1]],
+                directions=[-1,+1] * len(skyline_list),
+                max_window_x=int(round(linewidth)),
+            )
+
+        for i_line, line in enumerate(skyline_list):
 
             logger.info("tracing line, starting at x=%d, y=%d" % (line[0], ref_row))
             # print line[0], ref_row
 
             all_row_data = None
-            for direction_y in [-1,+1]:
-                lt = traceline.trace_arc(
-                    data=img_prefilter.T,
-                    start=(line[0], int(ref_row)),
-                    direction=direction_y,
-                    max_window_x=linewidth,
-                )
+            for i_dir, direction_y in enumerate([-1,+1]):
+                if (all_traces is not None):
+                    lt = all_traces[2*i_line+i_dir]
+                else:
+                    lt = traceline.trace_arc(
+                        data=img_prefilter.T,
+                        start=(line[0], int(ref_row)),
+                        direction=direction_y,
+                        max_window_x=linewidth,
+                    )
 
                 valid = numpy.isfinite(lt[:,1])
                 lt = lt[valid]
@@ -213,8 +232,11 @@ def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
             multi_line_traces.append(linetrace_final)
 
             linetrace_final += [1., 1., 0., 0., 1., 0., 0., 0.]
-            numpy.savetxt("allrowdata.%d" % (line[0]), linetrace_final)
-            numpy.savetxt("allrowdata.dum.%d" % (line[0]), linetrace_final[:, [0,1,4,-2,-1]])
+            debugartifacts.save_array("allrowdata.%d" % (line[0]),
+                                      linetrace_final, stage="distortions")
+            debugartifacts.save_array("allrowdata.dum.%d" % (line[0]),
+                                      linetrace_final[:, [0,1,4,-2,-1]],
+                                      stage="distortions")
 
         #
         # Now we have a full set of line-traces for all identified lines.
@@ -256,8 +278,9 @@ def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
 
             multi_line_traces[i_line] = combined
 
-            numpy.savetxt("allrowdata.dist.%d" % (skyline_list[i_line,0]),
-                          combined)
+            debugartifacts.save_array(
+                "allrowdata.dist.%d" % (skyline_list[i_line,0]),
+                combined, stage="distortions")
 
 
             #
@@ -296,12 +319,11 @@ def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
                           (combined[:,distmap_colidx['FLUX']] < (flux_median+3*flux_1sigma))
             good_trace = combined[good_fluxes]
 
-            if (use_for_map[i_line]):
-                numpy.savetxt("allrowdata.distgood.%d" % (skyline_list[i_line, 0]),
-                              good_trace)
-            else:
-                numpy.savetxt("allrowdata.distbad.%d" % (skyline_list[i_line, 0]),
-                              good_trace)
+            debugartifacts.save_array(
+                "allrowdata.dist%s.%d" % (
+                    "good" if use_for_map[i_line] else "bad",
+                    skyline_list[i_line, 0]),
+                good_trace, stage="distortions")
 
             if (use_for_map[i_line]):
                 logger.debug("merging data")
@@ -343,11 +365,13 @@ def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
         #
         logger.debug("computing 2-d distortion model")
         wlmap = wl_2d #hdulist['WAVELENGTH'].data
-        _y,_x = numpy.indices(wlmap.shape)
-        distortion_2d = interpol(
-            x=wlmap,
-            y=_y,
-            grid=False,)
+
+        def distortion(rows, cols):
+            _wl, _y = numpy.broadcast_arrays(wlmap[rows, cols], rows)
+            return interpol(x=_wl, y=_y, grid=False)
+        # the tolerance is only checked at sample points; 5e-4 A keeps all
+        # pixels within about 1e-3 A of the exact model
+        distortion_2d = surface.evaluate(distortion, wlmap.shape, tolerance=5e-4)
         # print distortion_2d.shape
 
 
@@ -411,17 +435,11 @@ def map_wavelength_distortions(skyline_list, wl_2d, img_2d,
     readnoise = 7
     gain=2
 
-    regfile = open("distortions.reg", "w")
-    print >>regfile, """\
-# Region file format: DS9 version 4.1
-global color=green dashlist=8 3 width=1 font="helvetica 10 normal roman" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1
-physical
-    """
-
+    regions = []
     all_lines = [] #[None] * skyline_list.shape[0]
     for i, line in enumerate(skyline_list):
 
-        print >>regfile, "point(%.2f,%.2f) # point=circle" % (line[0], ref_row)
+        regions.append("point(%.2f,%.2f) # point=circle" % (line[0], ref_row))
 
         #fn = "distortion_%d.bin" % (line[0])
         #linedata = numpy.loadtxt(fn)
@@ -458,11 +476,20 @@ physical
         linedata_mean[:, 9] -= med_dwl
 
         # print "LINEDATA", i, "\n", linedata_mean, "\n\n"
-        numpy.savetxt("linedata_%d" % (i), linedata_mean)
+        debugartifacts.save_array("linedata_%d" % (i), linedata_mean,
+                                  stage="distortions")
 
         #all_lines[i] = linedata_mean
         all_lines.append(linedata_mean)
 
+    if (debugartifacts.is_enabled("distortions.reg", stage="distortions")):
+        with open("distortions.reg", "w") as regfile:
+            print >>regfile, """\
+# Region file format: DS9 version 4.1
+global color=green dashlist=8 3 width=1 font="helvetica 10 normal roman" select=1 highlite=1 dash=0 fixed=0 edit=1 move=1 delete=1 include=1 source=1
+physical"""
+            print >>regfile, "\n".join(regions)
+
     if (len(all_lines) <= 0):
         logger.warning("no lines found, aborting WL distortion modeling")
         return None, None
@@ -507,11 +534,13 @@ physical
     #
     logger.debug("computing 2-d distortion model")
     wlmap = wl_2d #hdulist['WAVELENGTH'].data
-    _y,_x = numpy.indices(wlmap.shape)
-    distortion_2d = interpol(
-        x=wlmap,
-        y=_y,
-        grid=False,)
+
+    def distortion(rows, cols):
+        _wl, _y = numpy.broadcast_arrays(wlmap[rows, cols], rows)
+        return interpol(x=_wl, y=_y, grid=False)
+    # the tolerance is only checked at sample points; 5e-4 A keeps all
+    # pixels within about 1e-3 A of the exact model
+    distortion_2d = surface.evaluate(distortion, wlmap.shape, tolerance=5e-4)
     # print distortion_2d.shape
 
 
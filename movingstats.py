@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+
+NaN-aware sliding-window statistics for 1-D profiles and spectra.
+
+All filters use the same window definition: the value at position i is
+computed from data[i-before : i+after+1], ignoring NaNs. Windows are
+truncated at the edges of the data, i.e. they behave as if the data was
+padded with NaNs on both sides. Positions without any valid data in their
+window are NaN.
+
+Median, mean and sum use the running-window implementations in bottleneck,
+so they only take O(N) (or O(N log window) for the median) time instead of
+one Python-level reduction per position. The running update of the
+standard deviation loses precision once a strong outlier (e.g. a cosmic or
+a masked pixel set to a large value) leaves the window, so move_std instead
+works on a strided view of all windows.
+
+"""
+
+import numpy
+import bottleneck
+from numpy.lib.stride_tricks import as_strided
+
+
+def _move(move_fct, data, before, after):
+    data = numpy.asarray(data, dtype=numpy.float)
+    if (data.shape[0] <= 0):
+        return data.copy()
+    window = before + after + 1
+    # bottleneck computes trailing windows: result[j] uses data[j-window+1:j+1]
+    # so shift by after. Padding both ends with NaNs also keeps the window
+    # from being longer than the data, which bottleneck does not allow.
+    padded = numpy.empty((data.shape[0] + before + after))
+    padded[:] = numpy.NaN
+    padded[before:before+data.shape[0]] = data
+    return move_fct(padded, window=window, min_count=1)[before+after:]
+
+
+def move_median(data, before, after=None):
+    return _move(bottleneck.move_median, data, before,
+                 before if after is None else after)
+
+
+def move_mean(data, before, after=None):
+    return _move(bottleneck.move_mean, data, before,
+                 before if after is None else after)
+
+
+def move_sum(data, before, after=None):
+    return _move(bottleneck.move_sum, data, before,
+                 before if after is None else after)
+
+
+def _windows(data, before, after):
+    # NaN-padded (N, window) view with the full window for each position
+    data = numpy.asarray(data, dtype=numpy.float)
+    padded = numpy.empty((data.shape[0] + before + after))
+    padded[:] = numpy.NaN
+    padded[before:before+data.shape[0]] = data
+    return as_strided(padded, shape=(data.shape[0], before+after+1),
+                      strides=(padded.strides[0], padded.strides[0]))
+
+
+def move_std(data, before, after=None):
+    after = before if after is None else after
+    return bottleneck.nanstd(_windows(data, before, after), axis=1)
+
+
+def move_percentile(data, percentile, before, after=None):
+    """
+
+    Sliding-window percentile(s), as numpy.nanpercentile. If percentile is a
+    list, the result has one row per percentile.
+
+    """
+    after = before if after is None else after
+    return numpy.nanpercentile(_windows(data, before, after), percentile,
+                               axis=1)
+
+
+#
+# Reductions with a running-window implementation; all others are applied
+# to each window in turn.
+#
+moving_operators = {
+    numpy.nanmedian: move_median,
+    numpy.nanmean: move_mean,
+    numpy.nanstd: move_std,
+    numpy.nansum: move_sum,
+    bottleneck.nanmedian: move_median,
+    bottleneck.nanmean: move_mean,
+    bottleneck.nanstd: move_std,
+    bottleneck.nansum: move_sum,
+}
+
+
+def move_filter(data, before, after, fct):
+    """
+
+    Apply the reduction fct to the window around each position in data.
+
+    """
+    if (fct in moving_operators):
+        return moving_operators[fct](data, before, after)
+    windows = _windows(data, before, after)
+    return numpy.array([fct(w) for w in windows])
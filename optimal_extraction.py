@@ -13,6 +13,8 @@ import logging
 
 import find_sources
 import tracespec
+import podi_cython
+import stagetiming
 
 class OptimalWeight(object):
 
@@ -83,6 +85,7 @@ class OptimalWeight(object):
 
 
 
+@stagetiming.timed()
 def generate_source_profile(data, variance, wavelength, trace_offset,
                             position, width=50, debug=False):
 
@@ -131,6 +134,7 @@ def generate_source_profile(data, variance, wavelength, trace_offset,
     return combined
 
 
+@stagetiming.timed()
 def integrate_source_profile(width=25, supersample=10, wl_resolution=5,
                              profile2d=None,
                              debug=False):
@@ -192,104 +196,32 @@ def integrate_source_profile(width=25, supersample=10, wl_resolution=5,
     n_spec_bins = int(math.ceil((wl_max - wl_min) / spec_resolution))
     logger.debug("using a total of %d spectral bins" % (n_spec_bins))
 
-    out_drizzle = numpy.zeros((n_samples, n_spec_bins))
-    #print out_drizzle.shape
-
     wl_start = numpy.arange(n_spec_bins, dtype=numpy.float) * spec_resolution + wl_min
     wl_end = wl_start + spec_resolution
-    for _XXX, px in enumerate(profile2d):
-        # px = [ pixel / var / x / wavelength / y / wl1 / wl2]
-        [flux, var, x, wl, y, wl1, wl2] = px
-
-        y1 = y - 0.5
-        y2 = y + 0.5
-
-        first_y = (y1 - y_min) / y_width #* supersample
-        last_y = (y2 - y_min) / y_width #* supersample
-
-        _y1 = int(math.floor(first_y))
-        _y2 = int(math.ceil(last_y))
-        _wl1 = int(math.floor((wl1 - wl_min)/spec_resolution))
-        _wl2 = int(math.ceil((wl2 - wl_min)/spec_resolution))
-
-        #print px
-        #print y1, y2, wl1, wl2, "-->", _y1, _y2, _wl1, _wl2, "(", y_min, wl_min, supersample, wl_resolution,")"
-
-        # Determine drizzle=-factors along the spatial axis
-        pixels_y = range(_y1, _y2)
-        pixel_fraction_y = numpy.zeros((_y2-_y1,1))
-        for i, tp in enumerate(pixels_y):
-            #print "drizzle pixel",i,tp
-            if (i == 0 and i == len(pixels_y) - 1):
-                # all flux in a single output pixel
-                fraction = 1.0
-            elif (i == 0):
-                # right-edge of this pixel is
-                right_edge = (tp+1)*y_width + y_min
-                #print "right-edge:", right_edge
-                f = right_edge - y1
-                # first pixel, with more to come
-                fraction = f/(y2-y1)
-            elif (i == len(pixels_y) - 1):
-                # last of many pixels
-                left_edge = tp*y_width + y_min
-                #print "left edge", left_edge
-                f = y2-left_edge
-                fraction = f/(y2-y1)
-            else:
-                # some pixel in the middle
-                fraction = y_width / (y2-y1)
-            #print fraction
-            pixel_fraction_y[i,0] = fraction
-
-
-
-        #print pixel_fraction_y, numpy.sum(pixel_fraction_y)
 
-        # Now also figure out the drizzle-factor along the wavelength axis
-        pixels_wl = range(_wl1, _wl2)
-        pixel_fraction_wl = numpy.zeros((1, _wl2-_wl1))
-        for i, tp in enumerate(pixels_wl):
-            #print "drizzle pixel",i,tp
-            if (i == 0 and i == len(pixels_wl) - 1):
-                # all flux in a single output pixel
-                fraction = 1.0
-            elif (i == 0):
-                # right-edge of this pixel is
-                right_edge = (tp + 1) * spec_resolution + wl_min
-                #print "right-edge:", right_edge
-                f = right_edge - wl1
-                # first pixel, with more to come
-                fraction = f / (wl2 - wl1)
-            elif (i == len(pixels_wl) - 1):
-                # last of many pixels
-                left_edge = tp * spec_resolution + wl_min
-                #print "left edge", left_edge
-                f = wl2 - left_edge
-                fraction = f / (wl2 - wl1)
-            else:
-                # some pixel in the middle
-                fraction = spec_resolution / (wl2 - wl1)
-
-            #print fraction
-            pixel_fraction_wl[0, i] = fraction
-
-        #print pixel_fraction_wl, numpy.sum(pixel_fraction_wl)
-
-        full_weight_matrix = pixel_fraction_wl * pixel_fraction_y
-        #print full_weight_matrix.shape
-        #print full_weight_matrix
-        #print numpy.sum(full_weight_matrix)
-
-        flux_distribution = full_weight_matrix * flux
-
-        try:
-            out_drizzle[_y1:_y2, _wl1:_wl2] += flux_distribution
-        except ValueError:
-            pass
-
-        #if (_XXX > 20):
-        #    break
+    # px = [ pixel / var / x / wavelength / y / wl1 / wl2]
+    # Each pixel extends +/- 0.5 pixels along the slit, and from wl1 to wl2
+    # in wavelength; distribute its flux across the drizzle buffer in
+    # proportion to the overlap. Only use pixels that are fully contained in
+    # the drizzle buffer, along the slit and in wavelength; partially
+    # covered pixels would bias the outermost rows and columns.
+    fully_contained = \
+        (numpy.floor((profile2d[:,4] - 0.5 - y_min) / y_width) >= 0) & \
+        (numpy.ceil((profile2d[:,4] + 0.5 - y_min) / y_width) <= n_samples) & \
+        (numpy.floor((profile2d[:,5] - wl_min) / spec_resolution) >= 0) & \
+        (numpy.ceil((profile2d[:,6] - wl_min) / spec_resolution) <= n_spec_bins)
+    profile2d = profile2d[fully_contained]
+
+    out_drizzle, _, _ = podi_cython.drizzle(
+        wl_from=numpy.ascontiguousarray(profile2d[:,5], dtype=numpy.float64),
+        wl_to=numpy.ascontiguousarray(profile2d[:,6], dtype=numpy.float64),
+        flux=numpy.ascontiguousarray(profile2d[:,0], dtype=numpy.float64),
+        var=numpy.ascontiguousarray(profile2d[:,1], dtype=numpy.float64),
+        y_from=numpy.ascontiguousarray(profile2d[:,4] - 0.5, dtype=numpy.float64),
+        y_to=numpy.ascontiguousarray(profile2d[:,4] + 0.5, dtype=numpy.float64),
+        out_wl0=wl_min, out_dwl=spec_resolution, n_wl=n_spec_bins,
+        out_y0=y_min, out_dy=y_width, n_y=n_samples,
+    )
 
     #
     # truncate negative pixels to 0
@@ -376,6 +308,7 @@ def integrate_source_profile(width=25, supersample=10, wl_resolution=5,
 
 
 
+@stagetiming.timed()
 def optimal_extract(img_data, wl_data, variance_data,
                     trace_offset,
                     opt_weight_center_y=None,
@@ -514,68 +447,34 @@ def optimal_extract(img_data, wl_data, variance_data,
         #
         # print wl_width.shape, wl_from.shape, wl_to.shape
 
-        # compute the flux density array (i.e. flux per wavelength) by dividing the
-        # flux image (which is flux integrated over the width of a pixel) by the width of each pixel
-        img_data_per_wl = spec_img_data / spec_wl_width
-        var_data_per_wl = spec_var_data / spec_wl_width
-
         #
-        # now drizzle the data into the output container
+        # now drizzle the data into the output container, using one output
+        # column for each pixel row along the slit. Pixels with zero or
+        # negative weights do not contribute. Dividing by the output
+        # dispersion converts the drizzled flux into flux per wavelength,
+        # the coverage counts the number of (fractional) output pixels.
         #
-        wl_width_1d = spec_wl_width.ravel()
-        wl_from_1d = spec_wl_from.ravel()
-        wl_to_1d = spec_wl_to.ravel()
-        wl_data_1d = spec_wl_data.ravel()
-        img_data_per_wl_1d = img_data_per_wl.ravel()
-        var_data_1d = spec_var_data.ravel()
-        var_data_per_wl_1d = var_data_per_wl.ravel()
-        wl_width_1d = spec_wl_width.ravel()
-        y_data_1d = spec_y_data.ravel()
-        opt_weight_1d = weight_data.ravel()
-
         n_out_y = int(y2 - y1 + 4)
         y_min = y1 - 2.
-        drizzled_flux = numpy.zeros((out_wl_count, n_out_y))
-        drizzled_var = numpy.zeros((out_wl_count, n_out_y))
-        drizzled_npix = numpy.zeros((out_wl_count, n_out_y))
-
-        for px in range(wl_width_1d.shape[0]):
-
-            # find first and last pixel in output array to receive some of the flux of this input pixel
-            first_px = (wl_from_1d[px] - wl0) / dwl
-            last_px = (wl_to_1d[px] - wl0) / dwl
-
-            opt_weight = 1.0
-            if (optimal_weight is not None):
-                opt_weight = opt_weight_1d[px]
-            if (opt_weight <= 0):
-                continue
-
-            #    opt_weight = optimal_weight.get_weight(wl=wl_data_1d[px], y=y_data_1d[px])
-            #    #print "optimal weight @", wl_data_1d[px], y_data_1d[px], " == ", opt_weight
-
-            pixels = range(int(math.floor(first_px)), int(math.ceil(last_px)))  # , dtype=numpy.int)
-            # print wl_data_1d[px], wl_width_1d[px], first_px, last_px, pixels
-            for i, tp in enumerate(pixels):
-
-                if (i == 0 and i == len(pixels) - 1):
-                    # all flux in a single output pixel
-                    fraction = last_px - first_px
-                elif (i == 0):
-                    # first pixel, with more to come
-                    fraction = (tp + 1.) - first_px
-                elif (i == len(pixels) - 1):
-                    # last of many pixels
-                    fraction = last_px - tp
-                else:
-                    # some pixel in the middle
-                    fraction = 1.
-
-                iy = int(math.floor(y_data_1d[px] - y_min))
-
-                drizzled_flux[tp,iy] += fraction * img_data_per_wl_1d[px]
-                drizzled_var[tp,iy] += fraction * var_data_per_wl_1d[px]
-                drizzled_npix[tp,iy] += fraction
+        iy = numpy.floor(spec_y_data.ravel() - y_min)
+        use_pixel = numpy.ones(iy.shape, dtype=numpy.float64)
+        if (optimal_weight is not None):
+            use_pixel[weight_data.ravel() <= 0] = 0.
+
+        drz_flux, drz_var, drz_npix = podi_cython.drizzle(
+            wl_from=numpy.ascontiguousarray(spec_wl_from.ravel(), dtype=numpy.float64),
+            wl_to=numpy.ascontiguousarray(spec_wl_to.ravel(), dtype=numpy.float64),
+            flux=numpy.ascontiguousarray(spec_img_data.ravel(), dtype=numpy.float64),
+            var=numpy.ascontiguousarray(spec_var_data.ravel(), dtype=numpy.float64),
+            weight=use_pixel,
+            y_from=numpy.ascontiguousarray(iy, dtype=numpy.float64),
+            y_to=numpy.ascontiguousarray(iy+1., dtype=numpy.float64),
+            out_wl0=wl0, out_dwl=dwl, n_wl=out_wl_count,
+            out_y0=0., out_dy=1., n_y=n_out_y,
+        )
+        drizzled_flux = drz_flux.T / dwl
+        drizzled_var = drz_var.T / dwl
+        drizzled_npix = drz_npix.T
 
         _x,_y = numpy.indices((drizzled_flux.shape), dtype=numpy.float)
         _y += y_min
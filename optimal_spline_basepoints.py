@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import os, sys, numpy, time
-import scipy, scipy.interpolate, scipy.spatial, scipy.ndimage
+import scipy, scipy.interpolate, scipy.spatial, scipy.ndimage, scipy.linalg
 
 from astropy.io import fits
 
@@ -20,6 +20,9 @@ import localnoise
 import plot_high_res_sky_spec
 import math
 import quickwlmodel
+import debugartifacts
+import stagetiming
+import skysamples
 
 lots_of_debug = True
 
@@ -41,7 +44,8 @@ def satisfy_schoenberg_whitney(data, basepoints, k=3):
         a=data,
         bins=basepoints,
     )
-    delete[count == 0] = True
+    # count has one entry per interval, i.e. one less than basepoints
+    delete[:-1][count == 0] = True
     # logger.debug("done with histogram method, continuing old-fashioned way")
 
     # for idx in range(basepoints.shape[0]-1):
@@ -196,6 +200,205 @@ def find_center_row(data):
 
     return fit_all[0][0]
 
+
+@stagetiming.timed()
+def integrate_sky_spline(spline, from_wl, to_wl, mode='batch'):
+    """
+
+    Integrate the sky spline across each pixel, i.e. from from_wl to to_wl.
+    Returns an array with the same shape as from_wl.
+
+    mode='pixel' calls spline.integral() once per pixel (slow, the original
+    approach); mode='batch' evaluates the antiderivative of the spline on all
+    pixel edges at once and takes the difference. Just like splint, the
+    spline is assumed to be zero outside the interval covered by its knots,
+    so both edge arrays are clipped to this range first.
+
+    """
+
+    if (mode == 'pixel'):
+        return numpy.array([
+            spline.integral(a, b) for a, b in zip(
+                from_wl.ravel(), to_wl.ravel())]
+            ).reshape(from_wl.shape)
+
+    t, c, k = spline._eval_args
+    antiderivative = scipy.interpolate.splantider((t, c, k))
+    t_min, t_max = t[k], t[-k-1]
+
+    f_from = scipy.interpolate.splev(
+        numpy.clip(from_wl.ravel(), t_min, t_max), antiderivative)
+    f_to = scipy.interpolate.splev(
+        numpy.clip(to_wl.ravel(), t_min, t_max), antiderivative)
+
+    return (f_to - f_from).reshape(from_wl.shape)
+
+
+def bspline_basis(t, k, x):
+    """
+
+    Evaluate the k+1 non-zero B-splines of the full knot vector t at all
+    positions x (Cox-de Boor recursion, vectorized across x).
+
+    Returns the index of the first non-zero B-spline and the array of
+    basis values, of shape (x.shape[0], k+1), for each position.
+
+    """
+    n = t.shape[0] - k - 1
+    l = numpy.clip(numpy.searchsorted(t, x, side='right') - 1, k, n-1)
+
+    basis = numpy.zeros((x.shape[0], k+1))
+    basis[:, 0] = 1.
+    left = numpy.empty((x.shape[0], k+1))
+    right = numpy.empty((x.shape[0], k+1))
+    for j in range(1, k+1):
+        left[:, j] = x - t[l+1-j]
+        right[:, j] = t[l+j] - x
+        saved = numpy.zeros(x.shape[0])
+        for r in range(j):
+            temp = basis[:, r] / (right[:, r+1] + left[:, j-r])
+            basis[:, r] = saved + right[:, r+1] * temp
+            saved = left[:, j-r] * temp
+        basis[:, j] = saved
+
+    return l - k, basis
+
+
+def spline_normal_equations(t, k, x, y, w=None, mask=None, chunksize=500000):
+    """
+
+    Compute the normal equations of the least-squares spline fit with full
+    knot vector t to the data x,y (with optional weights w, applied to the
+    residuals as in LSQUnivariateSpline). If mask is given, only datapoints
+    with mask == True are used.
+
+    Returns the normal matrix in upper banded form, as expected by
+    scipy.linalg.solveh_banded, and the right-hand side. Data is streamed
+    in chunks of chunksize points, so memory demands do not depend on the
+    number of datapoints; the normal equations only need (k+2) x n_knots
+    values.
+
+    """
+    n = t.shape[0] - k - 1
+    ab = numpy.zeros(((k+1)*n))
+    rhs = numpy.zeros((n))
+
+    for start in range(0, x.shape[0], chunksize):
+        _x = x[start:start+chunksize]
+        _y = y[start:start+chunksize]
+        _w = None if w is None else w[start:start+chunksize]
+        if (mask is not None):
+            _mask = mask[start:start+chunksize]
+            _x, _y = _x[_mask], _y[_mask]
+            _w = None if _w is None else _w[_mask]
+        if (_x.shape[0] <= 0):
+            continue
+
+        first, basis = bspline_basis(t, k, _x)
+        if (_w is not None):
+            basis *= _w.reshape((-1,1))
+            _y = _y * _w
+
+        for a in range(k+1):
+            rhs += numpy.bincount(first+a, weights=basis[:, a]*_y,
+                                  minlength=n)
+            for b in range(a, k+1):
+                # A[first+a, first+b] is stored in ab[k+a-b, first+b]
+                ab += numpy.bincount(
+                    (k+a-b)*n + first + b,
+                    weights=basis[:, a]*basis[:, b],
+                    minlength=(k+1)*n)
+
+    return ab.reshape((k+1, n)), rhs
+
+
+def solve_spline_normal_equations(t, k, ab, rhs, regularize=False):
+    """
+
+    Solve the banded normal equations (using a banded Cholesky
+    decomposition) and return the resulting spline as UnivariateSpline, so
+    it can be used just like the LSQUnivariateSpline fitted to the same
+    data.
+
+    Raises numpy.linalg.LinAlgError if the system is singular, e.g. because
+    some knot intervals do not contain any data. With regularize=True, a
+    small damping term is added to the diagonal instead, which pulls the
+    coefficients of spline functions without data towards zero but leaves
+    all others unaffected.
+
+    """
+    if (regularize):
+        ab = ab.copy()
+        diag = ab[-1]
+        damping = 1e-10 * numpy.max(diag)
+        ab[-1] = diag + damping
+    c = scipy.linalg.solveh_banded(ab, rhs, lower=False)
+    # like FITPACK, pad the coefficients to the length of the knot vector
+    c = numpy.append(c, numpy.zeros((k+1)))
+    return scipy.interpolate.UnivariateSpline._from_tck((t, c, k))
+
+
+def full_knot_vector(interior_knots, xb, xe, k=3):
+    return numpy.concatenate([[xb]*(k+1), interior_knots, [xe]*(k+1)])
+
+
+def banded_spline_fit(x, y, knots, bbox, w=None, mask=None, k=3,
+                      state=None, chunksize=500000):
+    """
+
+    Least-squares spline fit to x, y (sorted by x; optionally only points
+    where mask is True, and with weights w) with the given interior knots.
+    The banded normal equations of the B-spline basis are accumulated while
+    streaming through the data in chunks, and solved with a banded
+    Cholesky decomposition. This needs far less memory than FITPACK and
+    scales to many millions of datapoints and 10k+ knots. If some knots do
+    not have enough data, the system is regularized instead of thinning
+    out the knots.
+
+    state is the second return value of an earlier call. If the knots and
+    weights did not change since then, and mask only excludes additional
+    points, only the contributions of the newly excluded points are removed
+    from the normal equations instead of re-computing them from all data.
+
+    Returns the spline and the new state.
+
+    """
+    logger = logging.getLogger("BandedSpline")
+
+    if (mask is None):
+        mask = numpy.ones(x.shape, dtype=numpy.bool)
+
+    t = full_knot_vector(knots, bbox[0], bbox[1], k=k)
+    if (state is not None and
+            numpy.array_equal(state['t'], t) and
+            state['w'] is w and
+            not numpy.any(mask & ~state['mask'])):
+        removed = state['mask'] & ~mask
+        logger.debug("Updating spline fit for %d removed datapoints" % (
+            numpy.sum(removed)))
+        ab_removed, rhs_removed = spline_normal_equations(
+            t, k, x, y, w=w, mask=removed, chunksize=chunksize)
+        ab = state['ab'] - ab_removed
+        rhs = state['rhs'] - rhs_removed
+    else:
+        logger.debug("Computing spline fit from all %d datapoints" % (
+            numpy.sum(mask)))
+        ab, rhs = spline_normal_equations(
+            t, k, x, y, w=w, mask=mask, chunksize=chunksize)
+
+    try:
+        spline = solve_spline_normal_equations(t, k, ab, rhs)
+    except numpy.linalg.LinAlgError:
+        logger.warning("Spline normal equations are singular (%d knots), "
+                       "regularizing" % (knots.shape[0]))
+        spline = solve_spline_normal_equations(t, k, ab, rhs,
+                                               regularize=True)
+
+    state = {'t': t, 'w': w, 'ab': ab, 'rhs': rhs, 'mask': mask.copy()}
+    return spline, state
+
+
+@stagetiming.timed()
 def optimal_sky_subtraction(obj_hdulist,
                             image_data=None,
                             sky_regions=None,
@@ -213,6 +416,10 @@ def optimal_sky_subtraction(obj_hdulist,
                             debug_prefix="",
                             obj_wl=None,
                             noise_mode='global',
+                            integration_mode='batch',
+                            iteration_mode='full',
+                            spline_engine='fitpack',
+                            spline_weights=None,
                             debug=False):
 
     logger = logging.getLogger("OptSplineKs")
@@ -233,7 +440,7 @@ def optimal_sky_subtraction(obj_hdulist,
         #print "obj_data:", obj_data.shape
         logger.debug("Using obj_data from SCI.RAW extension")
     else:
-        obj_data = image_data.copy()
+        obj_data = image_data
         logger.debug("Using obj_data from passed image data")
 
     #obj_wl   = wlmap_model #wl_map #obj_hdulist['WAVELENGTH'].data
@@ -292,43 +499,40 @@ def optimal_sky_subtraction(obj_hdulist,
         logger.warning("Could not find spatial map, using plain x/y coordinates instead")
         obj_spatial, _ = numpy.indices(obj_data.shape)
 
-    # now merge all data frames into a single 3-d numpy array
+    #
+    # now collect all data required for the sky fit in a single sample store,
+    # sorted by wavelength
+    #
     logger.info("Combining all data required for 2-D sky estimation")
-    obj_cube = numpy.empty((obj_data.shape[0], obj_data.shape[1], 4))
-    obj_cube[:,:,0] = obj_wl[:,:]
-    obj_cube[:,:,1] = (obj_data*1.0)[:,:] 
-    obj_cube[:,:,2] = obj_rms[:,:]
-    obj_cube[:,:,3] = obj_spatial[:,:]
-
-    good_sky_data = numpy.isfinite(obj_data)
-
-    #print good_sky_data
-    #print "\n\n #1: --\n", good_sky_data.shape, obj_cube.shape, "\n\n"
     if (lots_of_debug):
         pysalt.clobberfile(debug_prefix+"data_preflat.fits")
-        fits.PrimaryHDU(data=obj_cube[:,:,1]).writeto(debug_prefix+"data_preflat.fits", clobber=True)
+        fits.PrimaryHDU(data=obj_data).writeto(debug_prefix+"data_preflat.fits", clobber=True)
 
+    obj_flux = obj_data
     if (skyline_flat is not None):
         # We also received a skyline flatfield for field flattening
-        obj_cube[:,:,1] /= skyline_flat.reshape((-1,1))
+        obj_flux = obj_data / skyline_flat.reshape((-1,1))
         logger.info("Applying skyline flatfield to data before sky-subtraction")
-        #return 1,2
-        pass
 
     if (lots_of_debug):
         pysalt.clobberfile(debug_prefix+"data_postflat.fits")
-        fits.PrimaryHDU(data=obj_cube[:,:,1]).writeto(debug_prefix+"data_postflat.fits", clobber=True)
+        fits.PrimaryHDU(data=obj_flux).writeto(debug_prefix+"data_postflat.fits", clobber=True)
+
+    samples = skysamples.SkySamples(
+        wl=obj_wl, flux=obj_flux, var=obj_rms, spatial=obj_spatial)
+    del obj_flux, obj_rms
+
+    samples.flag_detector(skysamples.INVALID, ~numpy.isfinite(obj_data))
 
-    
     # mask_objects = False
     if (not mask_objects and select_region is None):
-        obj_bpm  = numpy.array(obj_hdulist['BPM'].data).flatten()
-        good_sky_data &= (obj_hdulist['BPM'].data == 0)
+        samples.flag_detector(skysamples.INVALID,
+                              obj_hdulist['BPM'].data != 0)
         logger.info("Using full-frame (no masking) for sky estimation")
 
     else:
         
-        use4sky = numpy.ones((obj_cube.shape[0]), dtype=numpy.bool)
+        use4sky = numpy.ones((obj_data.shape[0]), dtype=numpy.bool)
         # by default, use entire frame for sky
  
         if (mask_objects):
@@ -341,7 +545,7 @@ def optimal_sky_subtraction(obj_hdulist,
 
         if (select_region is not None):
             logger.debug("limiting sky to selected regions")
-            sky = numpy.zeros((obj_cube.shape[0]), dtype=numpy.bool)
+            sky = numpy.zeros((obj_data.shape[0]), dtype=numpy.bool)
             for y12 in select_region:
                 #print "@@@@@@@@@@",y12, numpy.sum(use4sky), use4sky.shape
                 logger.debug("Selecting sky-region: y =%d--%d (total: %d)" % (
@@ -357,8 +561,8 @@ def optimal_sky_subtraction(obj_hdulist,
         # mark all excluded regions as such and exclude them from the sky
         # dataset
         #
-        good_sky_data[~use4sky] = False
-        # obj_cube = obj_cube[use4sky]
+        samples.flag_detector(skysamples.MASKED, numpy.broadcast_to(
+            ~use4sky.reshape((-1,1)), obj_data.shape))
 
         if (lots_of_debug):
             _x = numpy.array(obj_data)
@@ -369,30 +573,17 @@ def optimal_sky_subtraction(obj_hdulist,
                 fits.ImageHDU(data=obj_data),
                 fits.ImageHDU(data=_x)]).writeto(debug_prefix+"obj_mask.fits")
 
-        obj_bpm  = numpy.array(obj_hdulist['BPM'].data)[use4sky].flatten()
-        #print obj_bpm.shape, obj_cube.shape
-    #print "\n\n #2: --\n", good_sky_data.shape, obj_cube.shape, "\n\n"
-
-    # convert dataset from 3-d to 2-d
-    # obj_cube = obj_cube.reshape((-1, obj_cube.shape[2]))
-
-    fits.PrimaryHDU(data=good_sky_data.astype(numpy.int)).writeto(
-        "good_sky_data_x0.fits", clobber=True)
-
-    # Now exclude all pixels marked as bad
-    #valid_pixels = (obj_bpm == 0) & numpy.isfinite(obj_cube[:, 1])
-    #obj_cube = obj_cube[valid_pixels]
+    debugartifacts.save_fits(
+        "good_sky_data_x0",
+        lambda: samples.to_detector(samples.good()).astype(numpy.int),
+        stage="skysub")
 
-    if (lots_of_debug):
-        fits.PrimaryHDU(data=good_sky_data.astype(numpy.int)).writeto(
-            "goodskydata.0.fits", clobber=True)
-
-    n_good_pixels = numpy.sum(good_sky_data)
+    n_good_pixels = numpy.sum(samples.good())
 
     logger.info("%d pixels (of %d, ~%.1f%%) left after eliminating bad "
                 "pixels!" % (
-        n_good_pixels,good_sky_data.size,
-        100.*n_good_pixels/good_sky_data.size))
+        n_good_pixels, samples.size,
+        100.*n_good_pixels/samples.size))
 
     #
     # Now also exclude all points that are marked as non-sky regions 
@@ -403,50 +594,23 @@ def optimal_sky_subtraction(obj_hdulist,
 
         logger.info("Selecting sky-pixels from user-defined regions")
         logger.debug("Sky-regions: %s" % (str(sky_regions)))
-        is_sky = numpy.zeros((obj_cube.shape[0]), dtype=numpy.bool)
+        is_sky = numpy.zeros((samples.size), dtype=numpy.bool)
         for idx, sky_region in enumerate(sky_regions):
             logger.debug("Good region: %d ... %d" % (sky_region[0], sky_region[1]))
-            in_region = (obj_cube[:,3] > sky_region[0]) & \
-                        (obj_cube[:,3] < sky_region[1]) & \
-                        (numpy.isfinite(obj_cube[:,1]))
+            in_region = (samples.spatial > sky_region[0]) & \
+                        (samples.spatial < sky_region[1]) & \
+                        (numpy.isfinite(samples.flux))
             is_sky[in_region] = True
 
-        # obj_cube = obj_cube[is_sky]
+        # samples.flag(skysamples.MASKED, ~is_sky)
     else:
         logger.info("No user-selected sky-regions, using full available frame")
 
-    #print "\n\n #3: --\n", good_sky_data.shape, obj_cube.shape, "\n\n"
-
-    allskies = obj_cube #[::skiplength]
-    if (lots_of_debug):
-        # numpy.savetxt(debug_prefix+"xxx1", allskies)
-        # print obj_cube.shape
-        # print good_sky_data.shape
-
-        _x = obj_cube[good_sky_data]
-        # print _x.shape
-        logger.debug("Saving debug output")
-        numpy.savetxt(debug_prefix+"xxx1",
-                      obj_cube[good_sky_data].reshape((-1, obj_cube.shape[2])))
-        logger.debug("done with debug output")
-
-    # _x = fits.ImageHDU(data=obj_hdulist['SCI.RAW'].data,
-    #                      header=obj_hdulist['SCI.RAW'].header)
-    # _x.name = "STEP1"
-    # obj_hdulist.append(_x)
-
-
-
-    # #
-    # # Load and prepare data
-    # #
-    # allskies = numpy.loadtxt(allskies_filename)
-
-    # just to be on the safe side, sort allskies by wavelength
-    logger.debug("Sorting input data by wavelength")
-    allskies = obj_cube[good_sky_data].reshape((-1, obj_cube.shape[2]))
-    sky_sort_wl = numpy.argsort(allskies[:,0])
-    allskies = allskies[sky_sort_wl]
+    #
+    # All good sky samples, in order of wavelength
+    #
+    good = samples.good()
+    allskies = numpy.array([samples.wl[good], samples.flux[good]]).T
     if (lots_of_debug):
         logger.debug("writing debug output")
         numpy.savetxt(debug_prefix+"xxx2", allskies[::skiplength])
@@ -454,7 +618,6 @@ def optimal_sky_subtraction(obj_hdulist,
 
     logger.debug("Working on %7d data points to estimate sky" % (allskies.shape[0]))
 
-
     #
     # Compute cumulative distribution
     #
@@ -630,7 +793,7 @@ def optimal_sky_subtraction(obj_hdulist,
                                              spline_opt(k_wl).reshape((-1,1)),
                                              axis=1)
         #numpy.savetxt(debug_prefix+"spline_opt", spec_simple)
-        fits.PrimaryHDU(data=good_sky_data.astype(numpy.int)).writeto(
+        fits.PrimaryHDU(data=samples.to_detector(samples.good()).astype(numpy.int)).writeto(
             "good_sky_data_x1.fits", clobber=True)
 
     #
@@ -673,217 +836,173 @@ def optimal_sky_subtraction(obj_hdulist,
     logger.info("Starting iteratively (%dx) computing best sky-spectrum, "
                 "using noise-mode %s" % (n_iterations, noise_mode))
 
-    strong_gradient_basepoints_added = False
 
-    wl_sort = numpy.argsort(obj_wl.flatten())
-    wl_unsort = numpy.argsort(wl_sort)
-    # print "wort/unsort:", wl_sort.shape, wl_unsort.shape
+    #
+    # In incremental mode, the spline fit is only updated for datapoints
+    # rejected since the last iteration. This is only supported by the
+    # banded spline engine.
+    #
+    if (iteration_mode == 'incremental' and spline_engine != 'banded'):
+        logger.warning("Incremental sky iterations require the banded "
+                       "spline engine, using full iterations")
+        iteration_mode = 'full'
+    logger.info("Using %s sky iterations" % (iteration_mode))
+    spline_state = None
 
-    obj_cube_sorted = obj_cube.reshape((-1, obj_cube.shape[2]))[wl_sort]
-    good_sky_data_sorted = good_sky_data.reshape((-1,1))[wl_sort]
-    # print "obj-cube-sorted:", obj_cube_sorted.shape, good_sky_data_sorted.shape
+    #
+    # Optionally weight all pixels by their uncertainty from the VAR
+    # extension; pixels without valid variance do not contribute to the fit
+    #
+    sky_weights = None
+    if (spline_weights == 'variance'):
+        logger.info("Weighting sky pixels by 1/sigma from VAR extension")
+        sky_weights = numpy.zeros(samples.var.shape)
+        valid_var = numpy.isfinite(samples.var) & (samples.var > 0)
+        sky_weights[valid_var] = 1. / numpy.sqrt(samples.var[valid_var])
 
-    for iteration in range(n_iterations):
+    #
+    # Search for regions of large scatter - these indicate something is
+    # not yet well described by the fit and thus could benefit from
+    # another spline basepoint in that region.
+    #
+    # The noise estimate is done on blocks of neighboring pixels (in
+    # wavelength), using all data irrespective of any masks, so it does not
+    # change between iterations and only needs to be done once.
+    #
+    logger.info("Searching for additional spline basepoints")
+    binned_flux = samples.blocks(samples.flux).copy()
+    binned_wl = numpy.median(samples.blocks(samples.wl), axis=1)
+    noisy = numpy.zeros(binned_flux.shape, dtype=numpy.bool)
+    for i in range(3):
 
-        logger.info("Starting sky-spectrum iteration %d of %d" % (
-            iteration+1, n_iterations)
+        logger.debug("starting iteration %d on binned data" % (i+1))
+        noise_stats = numpy.nanpercentile(
+            binned_flux, [16,50,84], axis=1
         )
-        # compute spline
-        # k_iter_good = satisfy_schoenberg_whitney(good_data[:,0], k_wl, k=3)
-        good_data = obj_cube_sorted[good_sky_data_sorted]
-        logger.info("good data: %s" % (str(good_data.shape)))
-        # print "***\n"*5,good_data.shape,"\n***"*5
 
-        # we now need to sort the data by wavelength
-        # logger.debug("Sorting input data for iteration %d" % (iteration+1))
-        #si = numpy.argsort(good_data[:,0])
-        #good_data = good_data[si]
+        binned_one_sigma = 0.5*(noise_stats[2, :] - noise_stats[0, :])
+        binned_median = noise_stats[1, :]
+
+        shape_1d = (binned_one_sigma.shape[0], 1)
+        _good_max = (binned_median + 3 * binned_one_sigma)
+        _good_min = (binned_median - 3 * binned_one_sigma)
+        bad_data = (binned_flux > _good_max.reshape(shape_1d)) | \
+                   (binned_flux < _good_min.reshape(shape_1d))
+        binned_flux[bad_data] = numpy.NaN
+        noisy |= bad_data
+        if (not debug):
+            logger.debug("done computing noise spectrum")
+        else:
+            logger.debug("done computing noise spectrum, saving debug")
+            debug_fn = "noisespec_%d" % (i+1)
+            numpy.savetxt(debug_fn,
+                          numpy.array([binned_wl,
+                                       binned_one_sigma,
+                                       binned_median,
+                                       ]).T)
+            logger.info("done writing debug %s" % (debug_fn))
+    del binned_flux
+
+    samples.flag(skysamples.NOISY, samples.unblock(noisy))
+    del noisy
+    debugartifacts.save_fits(
+        "unprepped_mask",
+        lambda: samples.to_detector(samples.good()).astype(numpy.int),
+        stage="skysub")
+
+    logger.info("Searching for the edges of sky-lines")
+    data = numpy.array([binned_wl,
+                        binned_one_sigma,
+                        binned_median,
+                        ]).T
+    basepoints_to_add = quickwlmodel.find_additional_basepoints(
+        data=data,
+    )
+    logger.info("Adding %d spline basepoints in places of strong "
+                "flux-gradients" % (basepoints_to_add.shape[0]))
+    k_wl = numpy.sort(numpy.append(k_wl, basepoints_to_add))
 
-        #
-        # Search for regions of large scatter - these indicate something is
-        # not yet well described by the fit and thus could benefit from
-        # another spline basepoint in that region.
-        #
-        logger.info("Searching for additional spline basepoints")
-        noiseblocksize = 250
-        # print good_data.shape
-
-        # os._exit(-2)
-
-        obj_cube_1d = obj_cube_sorted
-        # obj_cube.copy().reshape((-1, obj_cube.shape[2]))[wl_sort]
-        good_sky_data_1d = good_sky_data_sorted # good_sky_data.reshape((-1,1))[wl_sort]
-        # print
-        n_noise_blocks = math.ceil(obj_cube_1d.shape[0] / float(noiseblocksize))
-        n_to_add = int(n_noise_blocks*noiseblocksize-obj_cube_1d.shape[0])
-        # print n_to_add
-        n_add_front = int(n_to_add/2)
-        n_add_back = int(n_to_add - n_add_front)
-        pad_width = ((int(n_add_front),int(n_add_back)),(0,0))
-        # print pad_width, obj_cube_1d.shape
-
-        prep4noise = numpy.pad(
-            obj_cube_1d,
-            pad_width=pad_width,
-            mode='constant',
-            constant_values=(numpy.NaN,),
-        )
-        prep4noise_flag = numpy.pad(
-            good_sky_data_1d,
-            pad_width=pad_width,
-            mode='constant', constant_values=(False,)
-        )
-        # print "prep4noise:", prep4noise.shape, prep4noise_flag.shape
-        prep4noise_reshape = numpy.reshape(prep4noise,
-            (-1, noiseblocksize, obj_cube_1d.shape[1]))
-        # print prep4noise.shape, prep4noise_reshape.shape
-        prep4noise_reshape_flag = numpy.reshape(prep4noise_flag,
-            (-1, noiseblocksize, prep4noise_flag.shape[1]))
-        # print "prepnoise flags/flux:", prep4noise_reshape_flag.shape, \
-        #       prep4noise_reshape.shape
-        for i in range(3):
-
-            logger.debug("starting iteration %d on binned data" % (i+1))
-            noise_stats = numpy.nanpercentile(
-                prep4noise_reshape[:,:,1], [16,50,84], axis=1
-            )
-            binned_wl = numpy.median(prep4noise_reshape[:,:,0], axis=1)
-            # print noise_stats.shape
-
-            binned_one_sigma = 0.5*(noise_stats[2, :] - noise_stats[0, :])
-            binned_median = noise_stats[1, :]
-            # print binned_median.shape, binned_one_sigma.shape
-
-            shape_1d = (binned_one_sigma.shape[0], 1)
-            _good_max = (binned_median + 3 * binned_one_sigma)
-            _good_min = (binned_median - 3 * binned_one_sigma)
-            bad_data = (prep4noise_reshape[:,:,1] >
-                        _good_max.reshape(shape_1d)) | \
-                       (prep4noise_reshape[:,:,1]
-                        < _good_min.reshape(shape_1d))
-            # print "bad data:", i, bad_data.shape
-            prep4noise_reshape[bad_data,1] = numpy.NaN
-            prep4noise_reshape_flag[bad_data] = False
-            # print noise_stats.shape
-            if (not debug):
-                logger.debug("done computing noise spectrum")
-            else:
-                logger.debug("done computing noise spectrum, saving debug")
-                debug_fn = "noisespec_%d.%d" % (iteration+1,i+1)
-                numpy.savetxt(debug_fn,
-                              numpy.array([binned_wl,
-                                           binned_one_sigma,
-                                           binned_median,
-                                           ]).T)
-                # numpy.savetxt("noisedata_%d.%d" % (iteration+1,i+1),
-                #               prep4noise_reshape.reshape(
-                #                   (-1, prep4noise_reshape.shape[2]))
-                #               )
-                logger.info("done writing debug %s" % (debug_fn))
+    for iteration in range(n_iterations):
 
-        #
-        # Re-convert the 3-d array to 2-d
-        #
-        unprep = prep4noise_reshape.reshape(
-            (-1, prep4noise_reshape.shape[2]))[
-                 n_add_front:-n_add_back] #[wl_unsort].reshape(obj_cube.shape)
-        unprep_mask = prep4noise_reshape_flag.reshape((-1,1))[n_add_front:-n_add_back] #[wl_unsort].reshape(
-            #good_sky_data.shape)
-        # print unprep.shape, unprep_mask.shape, obj_cube.shape, good_sky_data.shape
-
-        obj_cube_1d = unprep
-        good_sky_data_sorted = unprep_mask
-        fits.PrimaryHDU(
-            data=good_sky_data_sorted[wl_unsort].reshape(obj_data.shape).astype(numpy.int)).writeto(
-            "unprepped_mask.fits", clobber=True
+        logger.info("Starting sky-spectrum iteration %d of %d" % (
+            iteration+1, n_iterations)
         )
-        # print "Un-prepped:", obj_cube_1d.shape, good_sky_data_sorted.shape
-
-
-        #fits.PrimaryHDU(data=good_sky_data.astype(numpy.int)).writeto(
-        #    "mask_%d.fits" % (iteration), clobber=True)
-
-        if (not strong_gradient_basepoints_added):
-            logger.info("Searching for the edges of sky-lines")
-            data = numpy.array([binned_wl,
-                                binned_one_sigma,
-                                binned_median,
-                                ]).T
-            basepoints_to_add = quickwlmodel.find_additional_basepoints(
-                data=data,
-            )
-            logger.info("Adding %d spline basepoints in places of strong "
-                        "flux-gradients" % (basepoints_to_add.shape[0]))
-            k_wl = numpy.sort(numpy.append(k_wl, basepoints_to_add))
-            strong_gradient_basepoints_added = True
 
         #
         # Select only data points not previously masked out
         #
-        good_data = obj_cube_sorted[good_sky_data_sorted[:,0]]
+        good = samples.good()
+        good_wl = samples.wl[good]
+        logger.info("good data: %d" % (good_wl.shape[0]))
         logger.debug("Dumping debug output")
         if (debug):
-            numpy.savetxt("xxx.allskies", obj_cube_sorted)
-            numpy.savetxt("xxx.allskies.good", good_data)
-        # print good_data.shape
-
+            numpy.savetxt("xxx.allskies", numpy.array(
+                [samples.wl, samples.flux, samples.var, samples.spatial]).T)
+            numpy.savetxt("xxx.allskies.good", numpy.array(
+                [good_wl, samples.flux[good], samples.var[good],
+                 samples.spatial[good]]).T)
 
         logger.debug("Ensuring Schoenberg/Whitney is satisfied")
         k_iter_good = satisfy_schoenberg_whitney(
-            good_data[:,0],
+            good_wl,
             k_wl, k=3)
 
         logger.info("Computing spline, measuring noise and rejecting "
                     "outliers ...")
 
         logger.info("Computing spline ...")
-        try:
-            # spline_iter = scipy.interpolate.LSQUnivariateSpline(
-            #     x=good_data[:,0], #allskies[:,0],#[good_point],
-            #     y=good_data[:,1], #allskies[:,1],#[good_point],
-            #     t=k_iter_good, #k_wl,
-            #     w=None, # no weights (for now)
-            #     bbox=[wl_min, wl_max],
-            #     k=3, # use a cubic spline fit
-            # )
-            # print obj_cube_sorted.shape
-            spline_iter = scipy.interpolate.LSQUnivariateSpline(
-                x=good_data[:,0], #allskies[:,0],# #[good_point],
-                y=good_data[:,1], #allskies[:,1],
-                #  #[good_point],
-                t=k_iter_good, #k_wl,
-                w=None, # no weights (for now)
-                bbox=[wl_min, wl_max],
-                k=3, # use a cubic spline fit
-            )
-            # spline_pickle_test.write_pickle(debug_prefix+"splinein",
-            #     fct=scipy.interpolate.LSQUnivariateSpline,
-            #     x=good_data[:,0], #allskies[:,0],#[good_point],
-            #     y=good_data[:,1], #allskies[:,1],#[good_point],
-            #     t=k_iter_good, #k_wl,
-            #     w=None, # no weights (for now)
-            #     bbox=[wl_min, wl_max],
-            #     k=3,
-            #     )
-
-        except ValueError as e:
-            # this is most likely 
-            # ValueError: Interior knots t must satisfy Schoenberg-Whitney conditions
-            # print e
-            if (iteration > 100):
-                break
-            else:
-                logger.warning("unable to compute LSQ spline, skipping 80% of basepoints")
+        spline_iter = None
+        if (spline_engine == 'banded'):
+            if (iteration_mode != 'incremental'):
+                spline_state = None
+            try:
+                spline_iter, spline_state = banded_spline_fit(
+                    x=samples.wl,
+                    y=samples.flux,
+                    w=sky_weights,
+                    mask=good,
+                    knots=k_iter_good,
+                    bbox=[wl_min, wl_max],
+                    state=spline_state,
+                )
+            except numpy.linalg.LinAlgError:
+                logger.warning("Unable to solve spline normal equations, "
+                               "reverting to FITPACK spline fit")
+                spline_iter, spline_state = None, None
+
+        good_weights = None
+        if (spline_iter is None and sky_weights is not None):
+            good_weights = sky_weights[good]
+
+        if (spline_iter is None):
+            try:
                 spline_iter = scipy.interpolate.LSQUnivariateSpline(
-                    x=good_data[:,0], #allskies[:,0],#[good_point], 
-                    y=good_data[:,1], #allskies[:,1],#[good_point], 
-                    t=k_iter_good[5:-5][::5], #k_wl,
-                    w=None, # no weights (for now)
-                    bbox=[wl_min, wl_max], 
+                    x=good_wl,
+                    y=samples.flux[good],
+                    t=k_iter_good, #k_wl,
+                    w=good_weights,
+                    bbox=[wl_min, wl_max],
                     k=3, # use a cubic spline fit
                 )
-            #print("Critical error!")
-            #os._exit(0)
+
+            except ValueError as e:
+                # this is most likely 
+                # ValueError: Interior knots t must satisfy Schoenberg-Whitney conditions
+                # print e
+                if (iteration > 100):
+                    break
+                else:
+                    logger.warning("unable to compute LSQ spline, skipping 80% of basepoints")
+                    spline_iter = scipy.interpolate.LSQUnivariateSpline(
+                        x=good_wl,
+                        y=samples.flux[good],
+                        t=k_iter_good[5:-5][::5], #k_wl,
+                        w=good_weights,
+                        bbox=[wl_min, wl_max], 
+                        k=3, # use a cubic spline fit
+                    )
+                #print("Critical error!")
+                #os._exit(0)
 
         if (lots_of_debug):
             logger.debug("Saving debug data for this iteration")
@@ -894,10 +1013,9 @@ def optimal_sky_subtraction(obj_hdulist,
                   )
 
         # compute spline fit for each wavelength data point
-        # dflux = good_data[:,1] - spline_iter(good_data[:,0])
         logger.debug("computing residuals for outlier rejection")
-        modelflux = spline_iter(obj_cube_sorted[:,0])
-        dflux = obj_cube_sorted[:,1] - modelflux
+        modelflux = spline_iter(samples.wl)
+        dflux = samples.flux - modelflux
 
         if (lots_of_debug):
             logger.debug("writing dflux.fits")
@@ -907,12 +1025,6 @@ def optimal_sky_subtraction(obj_hdulist,
             )
             logger.debug("dflux shape: %s" % (str(dflux.shape)))
 
-        # there's only 1 iteration, no need to prep for #2
-        # break
-
-
-        # print dflux
-
         #
         # Add here: work out the scatter of the distribution of pixels in the 
         #           vicinity of this basepoint. This is what determined outlier 
@@ -923,40 +1035,12 @@ def optimal_sky_subtraction(obj_hdulist,
         if (noise_mode == 'local1'):
 
             local_noise = localnoise.calculate_local_noise(
-                data=dflux[good_sky_data_sorted],
+                data=dflux[good],
                 basepoints=k_iter_good,
-                select=good_data[:,0],
-                dumpdebug=True
+                select=good_wl,
+                dumpdebug=debug
             )
             var = local_noise[:, 0]
-            # print var.shape
-
-            # subset_selector = good_data.shape[0] / (100*k_wl.shape[0])
-            # subset = good_data[::subset_selector]
-            # logger.debug("Searching for points close to each basepoint")
-            #
-            # # Create a KD-tree with all data points
-            # wl_tree = scipy.spatial.cKDTree(subset[:,0].reshape((-1,1)))
-            #
-            # # Now search this tree for points near each of the spline base points
-            # d, i = wl_tree.query(k_wl.reshape((-1,1)),
-            #                      k=100, # use 100 neighbors
-            #                      distance_upper_bound=avg_sample_width)
-            #
-            # # make sure to flag outliers
-            # bad = (i >= dflux.shape[0])
-            # i[bad] = 0
-            #
-            # # Now we have all indices of a bunch of nearby datapoints, so we can
-            # # extract how far off each of the data points is
-            # delta_flux_2d = dflux[i]
-            # delta_flux_2d[bad] = numpy.NaN
-            # #print "dflux_2d = ", delta_flux_2d.shape
-            #
-            # # With this we can estimate the scatter around each spline fit basepoint
-            # logger.debug("Estimating local scatter")
-            # var = bottleneck.nanstd(delta_flux_2d, axis=1)
-            #print "variance:", var.shape
             if (lots_of_debug):
                 numpy.savetxt(debug_prefix+"fit_variance.iter_%d" % (iteration+1),
                           numpy.append(k_iter_good.reshape((-1,1)),
@@ -979,13 +1063,12 @@ def optimal_sky_subtraction(obj_hdulist,
                 bounds_error=False,
                 #assume_sorted=True
                 )
-            # var_at_pixel = std_interpol(good_data[:,0])
-            var_at_pixel = std_interpol(obj_cube[:,:,0])
+            var_at_pixel = std_interpol(samples.wl)
 
             logger.debug("Marking outliers for rejection in next iteration")
             if (lots_of_debug):
                 numpy.savetxt(debug_prefix+"pixelvar.%d" % (iteration+1),
-                          numpy.append(obj_cube[:,:,0].reshape((-1,1)),
+                          numpy.append(samples.wl.reshape((-1,1)),
                                        var_at_pixel.reshape((-1,1)), axis=1))
 
             # Now mark all pixels exceeding the noise threshold as outliers
@@ -1000,8 +1083,7 @@ def optimal_sky_subtraction(obj_hdulist,
             # Assume a global noise level everywhere
             # this ignores larger noise around bright emission lines
             #
-            # print dflux.shape, good_sky_data_sorted.shape
-            sigma = numpy.percentile(dflux[good_sky_data_sorted[:,0]], [16, 84])
+            sigma = numpy.percentile(dflux[good], [16, 84])
             one_sigma = 0.5 * (sigma[1] - sigma[0])
             logger.debug("Found global 1-sigma noise level of %f" % (
                 one_sigma))
@@ -1014,10 +1096,10 @@ def optimal_sky_subtraction(obj_hdulist,
             # This is a variation of the global noise model
             #
 
-            sigma = numpy.percentile(dflux[good_sky_data_sorted[:,0]], [16, 84])
+            sigma = numpy.percentile(dflux[good], [16, 84])
             # print sigma
             one_sigma = 0.5 * (sigma[1] - sigma[0])
-            median = numpy.median(good_data[:,1])
+            median = numpy.median(samples.flux[good])
             simple_gain = one_sigma**2 / median
 
             if (simple_gain < 1 or simple_gain > 3):
@@ -1035,35 +1117,30 @@ def optimal_sky_subtraction(obj_hdulist,
 
         else:
 
-            outlier = numpy.zeros((good_sky_data_sorted.shape), dtype=numpy.bool)
+            outlier = numpy.zeros((samples.size), dtype=numpy.bool)
             keep_iterating = False
 
         #
         # Exclude all outliers from contributing to the next refinement
         # iteration
         #
-        good_sky_data_sorted[outlier] = False
+        samples.flag(skysamples.OUTLIER, outlier)
 
-        #good_data = good_data[not_outlier]
         if (lots_of_debug):
-            df = good_data[:,1] - spline_iter(good_data[:,0])
+            good_flux = samples.flux[good]
+            df = good_flux - spline_iter(good_wl)
             if (noise_mode == 'local1'):
-                _not_outlier = numpy.fabs(df) < std_interpol(good_data[:,0])
+                _not_outlier = numpy.fabs(df) < std_interpol(good_wl)
             else:
                 _not_outlier = numpy.fabs(df) < 3*one_sigma
 
-            # print df.shape, good_data.shape
             debug_fn = debug_prefix+"good_after.%d" % (iteration+1)
             logger.debug("saving debug output to %s" % (debug_fn))
             numpy.savetxt(debug_fn,
-                          numpy.array([good_data[:,0][_not_outlier],
-                                       good_data[:,1][_not_outlier],
+                          numpy.array([good_wl[_not_outlier],
+                                       good_flux[_not_outlier],
                                        df[_not_outlier]]).T)
-                      #
-                      #         not_outlier] )
-                      # numpy.append(good_data[:,0].reshape((-1,1)),
-                      #              dflux[not_outlier].reshape((-1,1)), axis=1))
-            fits.PrimaryHDU(data=good_sky_data.astype(numpy.int)).writeto(
+            fits.PrimaryHDU(data=samples.to_detector(samples.good()).astype(numpy.int)).writeto(
                 "good_sky_data_after_%d.fits" % (iteration+1), clobber=True)
             logger.debug("done!")
 
@@ -1073,7 +1150,7 @@ def optimal_sky_subtraction(obj_hdulist,
             plot_high_res_sky_spec.plot_sky_spectrum(
                 wl=obj_wl,
                 flux=obj_data,
-                good_sky_data=good_sky_data,
+                good_sky_data=samples.to_detector(samples.good()),
                 bad_rows=None,
                 output_filebase="skyspec.iteration_%d" % (iteration+1),
                 sky_spline=spline_iter,
@@ -1081,10 +1158,8 @@ def optimal_sky_subtraction(obj_hdulist,
                 basepoints=k_iter_good,
             )
 
-        # logger.info("Done with iteration %d (%d pixels left)" % (
-        # iteration+1, good_data.shape[0]))
         logger.info("Done with iteration %d (%d pixels left)" % (
-            iteration+1, numpy.sum(good_sky_data)))
+            iteration+1, numpy.sum(samples.good())))
 
         if (not keep_iterating):
             break
@@ -1119,7 +1194,7 @@ def optimal_sky_subtraction(obj_hdulist,
     # Convert the sorted mask array back into the original unsorted shape
     #
     logger.info("Computing full-resolution sky spectrum from sky-spline")
-    good_sky_data = good_sky_data_sorted[wl_unsort].reshape((obj_data.shape))
+    good_sky_data = samples.to_detector(samples.good())
 
     if (debug):
         # compute high-res sky-spectrum
@@ -1128,8 +1203,8 @@ def optimal_sky_subtraction(obj_hdulist,
         numpy.savetxt(debug_prefix+"sky_highres", numpy.append(wl_highres.reshape((-1,1)),
                                                   sky_highres.reshape((-1,1)), axis=1))
 
-        # print "good-sky/obj-cube:", good_sky_data.shape, obj_cube.shape
-        allskies = obj_cube[good_sky_data]
+        good = samples.good()
+        allskies = numpy.array([samples.wl[good], samples.flux[good]]).T
         allskies_synth = spline_iter(allskies[:,0])
         ascombined = numpy.zeros((allskies_synth.shape[0],4))
         ascombined[:,0] = allskies[:,0]
@@ -1149,15 +1224,13 @@ def optimal_sky_subtraction(obj_hdulist,
         to_wl = 0.5*(padded[:, 1:-1] + padded[:, 2:])
         # print "n\nXXXXX",from_wl.shape, to_wl.shape, obj_wl.shape, padded, "\nXXXXX\n"
 
-        # this would be a nice call, but xxx.integral does not support multiple values
-        # sky2d_x = spline_iter.integral(from_wl.ravel(), to_wl.ravel()).reshape(from_wl.shape)
-        #
-        # therefore we need to do the integration for each pixel by hand
+        # xxx.integral does not support multiple values, so either integrate
+        # each pixel by hand, or evaluate the antiderivative on all pixel
+        # edges at once (see integrate_sky_spline)
         t0 = time.time()
-        sky2d = numpy.array([
-            spline_iter.integral(a,b) for a,b in zip(
-                from_wl.ravel(),to_wl.ravel())]
-            ).reshape(obj_wl.shape)
+        sky2d = integrate_sky_spline(
+            spline=spline_iter, from_wl=from_wl, to_wl=to_wl,
+            mode=integration_mode)
 
         #
         # Important !!!
@@ -1170,7 +1243,8 @@ def optimal_sky_subtraction(obj_hdulist,
         sky2d /= wl_width
 
         t1 = time.time()
-        logger.debug("Integration took %.3f seconds" % (t1-t0))
+        logger.debug("Integration took %.3f seconds (mode: %s)" % (
+            t1-t0, integration_mode))
 
         # print "integration took %f seconds" % (t1-t0)
         if (lots_of_debug):
@@ -1219,7 +1293,7 @@ def estimate_slit_intensity_variations(hdulist, spline, sky_2d):
 
     skyline_list = wlcal.find_list_of_lines(skyspec, readnoise=1, avg_width=1)
     print skyline_list
-    numpy.savetxt("skyline_list", skyline_list)
+    debugartifacts.save_array("skyline_list", skyline_list, stage="skysub")
 
     #
     # Select a couple of the strong lines
@@ -1238,11 +1312,56 @@ def estimate_slit_intensity_variations(hdulist, spline, sky_2d):
 
 
 
+def benchmark_sky_integration(shape=(500, 3170), n_knots=3000):
+    """
+
+    Compare timing and results of the per-pixel and batched sky-spline
+    integration, using a synthetic sky spectrum and wavelength map.
+
+    """
+
+    logger = logging.getLogger("BenchSkyInteg")
+
+    wl_1d = numpy.linspace(4000, 7000, shape[1])
+    curvature = numpy.linspace(-1, 1, shape[0]).reshape((-1,1))**2
+    obj_wl = wl_1d.reshape((1,-1)) + 2.5*curvature
+
+    sample_wl = numpy.sort(numpy.random.uniform(4000, 7000, 50*n_knots))
+    sample_flux = 100. + 1000.*numpy.exp(
+        -(numpy.fmod(sample_wl, 75.)-37.5)**2/8.) + \
+        numpy.random.normal(0, 10, sample_wl.shape[0])
+    knots = numpy.linspace(4001, 6999, n_knots)
+    spline = scipy.interpolate.LSQUnivariateSpline(
+        x=sample_wl, y=sample_flux, t=knots, k=3)
+
+    padded = numpy.pad(obj_wl, ((0,0),(1,1)), mode='edge')
+    from_wl = 0.5*(padded[:, 0:-2] + padded[:, 1:-1])
+    to_wl = 0.5*(padded[:, 1:-1] + padded[:, 2:])
+
+    results = {}
+    for mode in ['pixel', 'batch']:
+        t0 = time.time()
+        results[mode] = integrate_sky_spline(spline, from_wl, to_wl, mode=mode)
+        t1 = time.time()
+        logger.info("%-5s integration of %d pixels: %8.3f seconds" % (
+            mode, obj_wl.size, t1-t0))
+
+    max_diff = numpy.max(numpy.fabs(results['pixel'] - results['batch']))
+    logger.info("Max. absolute difference: %g (max. pixel integral: %g)" % (
+        max_diff, numpy.max(numpy.fabs(results['pixel']))))
+
+    return max_diff
+
+
 if __name__ == "__main__":
 
 
     logger_setup = pysalt.mp_logging.setup_logging()
 
+    if (sys.argv[1] == "benchintegral"):
+        benchmark_sky_integration()
+        pysalt.mp_logging.shutdown_logging(logger_setup)
+        sys.exit(0)
 
     obj_fitsfile = sys.argv[1]
     obj_hdulist = fits.open(obj_fitsfile)
@@ -13,6 +13,9 @@ import bottleneck
 import pysalt
 
 import prep_science
+import debugartifacts
+import stagetiming
+import surface
 
 def scaled_sky(p, skyslice):
     return skyslice * p[0]
@@ -39,13 +42,206 @@ def sky_wl_residuals(p, imgslice, skyslice):
 
 
 
-def minimize_sky_residuals2_spline(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=True, dl=-10):
+def block_ranges(min_wl, dl, n_wl_blocks, vert_size, n_spatial_blocks, ny):
+    """
+
+    Return the wavelength limits and row ranges of all blocks. Wavelength
+    blocks include both limits, so pixels right on the boundary between two
+    blocks are used in both.
+
+    """
+    wl_lower = numpy.arange(n_wl_blocks) * dl + min_wl
+    wl_upper = wl_lower + dl
+    row_ranges = [(int(i * vert_size), int(min(i * vert_size + vert_size, ny)))
+                  for i in range(n_spatial_blocks)]
+    return wl_lower, wl_upper, row_ranges
+
+
+def _block_sky_scaling_leastsq(img, sky, sky_lines, sky_continuum, wl,
+                               wl_lower, wl_upper, row_ranges):
+
+    # Reference implementation, fitting one block after the other
+    scaling = []
+    for i_wl, i_spatial in itertools.product(range(wl_lower.shape[0]),
+                                             range(len(row_ranges))):
+
+        y_min, y_max = row_ranges[i_spatial]
+        strip_wl = wl[y_min:y_max]
+        in_wl_range = (strip_wl >= wl_lower[i_wl]) & \
+                      (strip_wl <= wl_upper[i_wl])
+
+        sel_img = img[y_min:y_max][in_wl_range]
+        sel_sky = sky[y_min:y_max][in_wl_range]
+        sel_lines = sky_lines[y_min:y_max][in_wl_range]
+        sel_continuum = sky_continuum[y_min:y_max][in_wl_range]
+
+        p_init = [1.0, 0.0, numpy.median(sel_continuum)]
+
+        try:
+            fit_args = (sel_img, sel_lines)
+            _fit = scipy.optimize.leastsq(
+                sky_wl_residuals,
+                p_init,
+                args=fit_args,
+                maxfev=500,
+                full_output=1)
+            best_fit = _fit[0]
+        except:
+            best_fit = [numpy.NaN]*3
+
+        simple_median = bottleneck.nanmedian(sel_img/sel_sky)
+        simple_mean = bottleneck.nanmean(sel_img/sel_sky)
+        weight_mean = bottleneck.nansum(sel_img) / bottleneck.nansum(sel_sky)
+        scaling.append([simple_mean, simple_median, weight_mean,
+                        best_fit[0], best_fit[2]])
+
+    return numpy.array(scaling)
+
+
+def block_sky_scaling(img, sky, sky_lines, wl, wl_lower, wl_upper, row_ranges,
+                      n_clip_iterations=0, clip_sigma=3.):
+    """
+
+    Compute the sky scaling statistics for all blocks at once.
+
+    Each pixel is assigned to its block(s) once; all statistics are then
+    accumulated per block with numpy.bincount. The line-fit img = p0*lines +
+    p2 (weighted with lines**2, as in sky_wl_residuals) is linear in its
+    parameters, so instead of running leastsq for each block we solve the
+    normal equations of all blocks in closed form.
+
+    If n_clip_iterations > 0, pixels deviating by more than clip_sigma times
+    the rms from the line-fit of their block are rejected, and all
+    statistics are re-computed without them.
+
+    Returns an array of shape (n_wl_blocks*n_spatial_blocks, 5) with the
+    mean, median and weighted mean of img/sky, and the line scaling p0 and
+    offset p2 for each block, in the same order as
+    itertools.product(range(n_wl_blocks), range(n_spatial_blocks)).
+
+    """
+
+    n_wl_blocks = wl_lower.shape[0]
+    n_spatial_blocks = len(row_ranges)
+    n_blocks = n_wl_blocks * n_spatial_blocks
+
+    #
+    # Assign all pixels to their block(s)
+    #
+    row_block = numpy.empty((img.shape[0]), dtype=numpy.int)
+    row_block[:] = -1
+    for i_spatial, (y_min, y_max) in enumerate(row_ranges):
+        row_block[y_min:y_max] = i_spatial
+    row_block = numpy.repeat(row_block, img.shape[1])
+
+    _wl = wl.ravel()
+    valid = numpy.isfinite(_wl) & (row_block >= 0)
+    valid_pixels = numpy.arange(_wl.shape[0])[valid]
+    _wl = _wl[valid]
+    # first block with wl <= upper limit, last block with wl >= lower limit
+    first = numpy.searchsorted(wl_upper, _wl, side='left')
+    last = numpy.searchsorted(wl_lower, _wl, side='right') - 1
+    first[first < 0] = 0
+    last[last >= n_wl_blocks] = n_wl_blocks - 1
+
+    pixel, block = [], []
+    for offset in range(numpy.max(last - first) + 1 if _wl.shape[0] > 0 else 0):
+        in_block = (first + offset) <= last
+        pixel.append(valid_pixels[in_block])
+        block.append((first[in_block] + offset) * n_spatial_blocks +
+                     row_block[valid_pixels[in_block]])
+    pixel = numpy.concatenate(pixel) if pixel else numpy.zeros((0), dtype=numpy.int)
+    block = numpy.concatenate(block) if block else numpy.zeros((0), dtype=numpy.int)
+
+    _img = img.ravel()[pixel]
+    _sky = sky.ravel()[pixel]
+    _lines = sky_lines.ravel()[pixel]
+
+    def block_sum(weights, select=None):
+        if (select is None):
+            return numpy.bincount(block, weights=weights, minlength=n_blocks)
+        return numpy.bincount(block[select], weights=weights[select],
+                              minlength=n_blocks)
+
+    use = numpy.ones(pixel.shape, dtype=numpy.bool)
+    fittable = numpy.isfinite(_img) & numpy.isfinite(_lines)
+    for iteration in range(n_clip_iterations+1):
+
+        #
+        # Weighted linear fit img = p0*lines + p2, using centered moments
+        # to avoid loss of precision for bright lines
+        #
+        sel = use & fittable
+        w = _lines**2
+        n_fit = block_sum(numpy.ones(pixel.shape), sel)
+        sum_w = block_sum(w, sel)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean_lines = block_sum(w*_lines, sel) / sum_w
+            mean_img = block_sum(w*_img, sel) / sum_w
+            d_lines = _lines - mean_lines[block]
+            d_img = _img - mean_img[block]
+            s_ll = block_sum(w*d_lines*d_lines, sel)
+            s_li = block_sum(w*d_lines*d_img, sel)
+            p0 = s_li / s_ll
+            p2 = mean_img - p0 * mean_lines
+        # leastsq needs at least as many data points as parameters
+        bad_fit = (n_fit < 3) | ~(s_ll > 0)
+        p0[bad_fit] = numpy.NaN
+        p2[bad_fit] = numpy.NaN
+
+        if (iteration >= n_clip_iterations):
+            break
+
+        residual = _img - (p0[block]*_lines + p2[block])
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            rms = numpy.sqrt(block_sum(residual**2, sel) / n_fit)
+            outlier = numpy.fabs(residual) > clip_sigma * rms[block]
+        outlier[~numpy.isfinite(residual)] = False
+        if (numpy.sum(outlier & use) <= 0):
+            break
+        use &= ~outlier
+
+    #
+    # Simple statistics of the ratio between image and sky
+    #
+    ratio = _img / _sky
+    good_ratio = use & ~numpy.isnan(ratio)
+    ratio_blocks = block[good_ratio]
+    ratio = ratio[good_ratio]
+    n_ratio = numpy.bincount(ratio_blocks, minlength=n_blocks)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        simple_mean = numpy.bincount(ratio_blocks, weights=ratio,
+                                     minlength=n_blocks) / n_ratio
+        weight_mean = block_sum(numpy.where(numpy.isnan(_img), 0, _img), use) / \
+                      block_sum(numpy.where(numpy.isnan(_sky), 0, _sky), use)
+
+    # median: sort by block, then by ratio, and pick the central value(s)
+    order = numpy.lexsort((ratio, ratio_blocks))
+    sorted_ratio = ratio[order]
+    start = numpy.cumsum(n_ratio) - n_ratio
+    simple_median = numpy.empty((n_blocks))
+    simple_median[:] = numpy.NaN
+    has_data = n_ratio > 0
+    lo = (start + (n_ratio-1)//2)[has_data]
+    hi = (start + n_ratio//2)[has_data]
+    simple_median[has_data] = 0.5 * (sorted_ratio[lo] + sorted_ratio[hi])
+
+    return numpy.array([simple_mean, simple_median, weight_mean, p0, p2]).T
+
+
+@stagetiming.timed()
+def minimize_sky_residuals2_spline(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=True, dl=-10,
+                                   solver='batch', n_clip_iterations=0, clip_sigma=3.):
 
     logger = logging.getLogger("SkyScaling2")
 
-    poly2d, data_raw, pf2, data = minimize_sky_residuals2_spline(
+    ret = minimize_sky_residuals2(
         img=img, sky=sky, wl=wl, bpm=bpm, vert_size=vert_size, 
-        smooth=smooth, debug_out=debug_out, dl=dl)
+        smooth=smooth, debug_out=debug_out, dl=dl, solver=solver,
+        n_clip_iterations=n_clip_iterations, clip_sigma=clip_sigma)
+    if (ret is None):
+        return None
+    poly2d, data_raw, pf2, data = ret
     
     minx = numpy.min(data[:,0])
     maxx = numpy.max(data[:,0])
@@ -80,9 +276,11 @@ def minimize_sky_residuals2_spline(img, sky, wl, bpm, vert_size=5, smooth=3, deb
         diff = data[:,5] - fit
 
         data_out[:,5] = fit
-        numpy.savetxt("optscale.data.splinefit_%d" % (iteration), data_out)
+        debugartifacts.save_array("optscale.data.splinefit_%d" % (iteration),
+                                  data_out, stage="skyscaling")
         data_out[:,5] = diff
-        numpy.savetxt("optscale.data.splinediff_%d" % (iteration), data_out)
+        debugartifacts.save_array("optscale.data.splinediff_%d" % (iteration),
+                                  data_out, stage="skyscaling")
 
         # find noise level
         for it in range(3):
@@ -95,14 +293,33 @@ def minimize_sky_residuals2_spline(img, sky, wl, bpm, vert_size=5, smooth=3, deb
         data[:,5][outlier] = numpy.NaN
 
     # Now compute the entire full-field scaling frame
+    y,_ = numpy.indices(img.shape)
     spline2d = spline(
         x=wl.ravel(),
         y=y.ravel(),
         grid=False
-    )
+    ).reshape(img.shape)
     return poly2d, data_raw, pf2, data, spline2d
 
-def minimize_sky_residuals2(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=True, dl=-10):
+@stagetiming.timed()
+def minimize_sky_residuals2(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=True, dl=-10,
+                            solver='batch', n_clip_iterations=0, clip_sigma=3.):
+    """
+
+    Find the scaling of the sky-lines that minimizes the sky-subtraction
+    residuals, in blocks of vert_size rows and dl angstroems (negative
+    values give the number of blocks instead), and fit a smooth 2-d
+    polynomial to the block scalings.
+
+    solver selects how the block scalings are computed: 'batch' solves all
+    blocks at once (see block_sky_scaling), 'leastsq' fits one block after
+    the other. Both give the same result, except for blocks without any
+    sky-line signal: leastsq returns its initial guess for those, the batch
+    solver NaN, so they are ignored in the polynomial fit. Iterative outlier
+    rejection (n_clip_iterations, clip_sigma) is only supported by the batch
+    solver.
+
+    """
 
     logger = logging.getLogger("SkyScaling2")
 
@@ -112,8 +329,6 @@ def minimize_sky_residuals2(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=
     sky_lines, sky_continuum= prep_science.filter_isolate_skylines(sky)
 
     # find block size in wavelength and spatial direction
-    print type(wl)
-    print wl
     valid_wl = numpy.isfinite(wl)
     if (numpy.sum(valid_wl) <= 1):
         logger.error("Something went wrong, no valid WL data")
@@ -136,71 +351,34 @@ def minimize_sky_residuals2(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=
     n_spatial_blocks = int(math.ceil(img.shape[0]/vert_size))
     logger.info("Using %d spatial and %d wavelength blocks" % (n_spatial_blocks, n_wl_blocks))
 
-    print "OptScaling2"+"\n"*10
-
-    data = []
-    scaling = numpy.zeros((n_wl_blocks, n_spatial_blocks,5))
-    for i_wl, i_spatial in itertools.product(range(n_wl_blocks), range(n_spatial_blocks)):
-        
-        #
-        # Cut out strips in spatial direction
-        #
-        y_min = i_spatial * vert_size
-        y_max = numpy.min([y_min+vert_size, img.shape[0]])
-        
-        strip_img = img[y_min:y_max]
-        strip_sky = sky[y_min:y_max]
-        strip_wl = wl[y_min:y_max]
-        strip_sky_lines = sky_lines[y_min:y_max]
-        strip_sky_continuum = sky_continuum[y_min:y_max]
+    wl_lower, wl_upper, row_ranges = block_ranges(
+        min_wl, dl, n_wl_blocks, vert_size, n_spatial_blocks, img.shape[0])
 
-        #
-        # Now select wavelength interval
-        #
-        wl_min = i_wl*dl + min_wl
-        wl_max = wl_min + dl
-        in_wl_range = (strip_wl >= wl_min) & (strip_wl <= wl_max)
-
-        sel_img = strip_img[in_wl_range]
-        sel_sky = strip_sky[in_wl_range]
-        sel_lines = strip_sky_lines[in_wl_range]
-        sel_continuum = strip_sky_continuum[in_wl_range]
-
-        p_init = [1.0, 0.0, numpy.median(sel_continuum)]
-
-        try:
-            fit_args = (sel_img, sel_lines)
-            _fit = scipy.optimize.leastsq(
-                sky_wl_residuals,
-                p_init, 
-                args=fit_args,
-                maxfev=500,
-                full_output=1)
-            best_fit = _fit[0]
-        except:
-            best_fit = [numpy.NaN]*3
-
-        simple_median = bottleneck.nanmedian(sel_img/sel_sky)
-        simple_mean = bottleneck.nanmean(sel_img/sel_sky)
-        weight_mean = bottleneck.nansum(sel_img) / bottleneck.nansum(sel_sky)
-        # weighted mean = sum(img/sky * sky)/sum(sky) where sky=weight
-        data.append([i_wl, i_spatial, simple_mean, simple_median, weight_mean, best_fit[0], best_fit[2]])
+    if (solver == 'leastsq'):
+        block_scaling = _block_sky_scaling_leastsq(
+            img, sky, sky_lines, sky_continuum, wl,
+            wl_lower, wl_upper, row_ranges)
+    else:
+        block_scaling = block_sky_scaling(
+            img, sky, sky_lines, wl, wl_lower, wl_upper, row_ranges,
+            n_clip_iterations=n_clip_iterations, clip_sigma=clip_sigma)
 
-        scaling[i_wl, i_spatial,:] = [simple_mean, simple_median, weight_mean, best_fit[0], best_fit[2]]
+    scaling = block_scaling.reshape((n_wl_blocks, n_spatial_blocks, 5))
+    i_wl, i_spatial = numpy.indices((n_wl_blocks, n_spatial_blocks))
+    data = numpy.append(
+        numpy.array([i_wl.ravel(), i_spatial.ravel()]).T,
+        block_scaling, axis=1)
 
-    data = numpy.array(data)
     data2 = numpy.array(data)
     data2[:,0] = (data[:,0] + 0.5)*dl + min_wl
     data2[:,1] = (data[:,1] + 0.5)*vert_size
-    numpy.savetxt("optscale.data", data)
-    numpy.savetxt("optscale.data2", data2)
-
-    fits.PrimaryHDU(data=scaling).writeto("optscale.data.fits", clobber=True)
+    debugartifacts.save_array("optscale.data", data, stage="skyscaling")
+    debugartifacts.save_array("optscale.data2", data2, stage="skyscaling")
+    debugartifacts.save_fits("optscale.data", scaling, stage="skyscaling")
 
     #
     # Do a low-order polynomial fit
     #
-    print data2.shape
     data_scaling = data2[:,5]
     data_wl = data2[:,0]
     data_y = data2[:,1]
@@ -228,14 +406,16 @@ def minimize_sky_residuals2(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=
         combined[:,1] = data_y
         combined[:,2] = fit
         combined[:,3] = diff
-        numpy.savetxt("fit_%d" % (iteration+1), combined) #.reshape((-1,combined.shape[2])))
+        debugartifacts.save_array("fit_%d" % (iteration+1), combined,
+                                  stage="skyscaling")
 
     #
     # Use the 2-d fit to compute a full-resolution scaling image
     #
-    y,_ = numpy.indices(img.shape)
-    
-    fullscale = polyval2d(x=wl, y=y, m=pf2)
+    def sky_scaling(rows, cols):
+        _wl, _y = numpy.broadcast_arrays(wl[rows, cols], rows.astype(numpy.float))
+        return polyval2d(x=_wl, y=_y, m=pf2)
+    fullscale = surface.evaluate(sky_scaling, img.shape, tolerance=1e-4)
 
     return fullscale, data, pf2, data2
 
@@ -276,6 +456,7 @@ def minimize_sky_residuals2(img, sky, wl, bpm, vert_size=5, smooth=3, debug_out=
     # return data, filtered, full2d
 
 
+@stagetiming.timed()
 def minimize_sky_residuals(img, sky, vert_size=5, smooth=20, debug_out=True):
 
     print img.shape, sky.shape
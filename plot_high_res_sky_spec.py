@@ -15,6 +15,7 @@ from astropy.io import fits
 import optimal_spline_basepoints
 import bottleneck
 import logging
+import debugartifacts
 
 warnings.simplefilter('ignore', UserWarning)
 
@@ -127,10 +128,13 @@ def plot_sky_spectrum(wl, flux,
             #print highres_wl
             highres_flux = sky_spline(highres_wl)
             ax.plot(highres_wl, highres_flux, 'r-')
-            numpy.savetxt("specblock.%d" % (row+1),
-                          numpy.array([this_wl, this_flux]).T)
-            numpy.savetxt("specblock_fit.%d" % (row+1),
-                          numpy.array([highres_wl, highres_flux]).T)
+            debugartifacts.save_array(
+                "specblock.%d" % (row+1),
+                lambda: numpy.array([this_wl, this_flux]).T, stage="skysub")
+            debugartifacts.save_array(
+                "specblock_fit.%d" % (row+1),
+                lambda: numpy.array([highres_wl, highres_flux]).T,
+                stage="skysub")
             max_spline_flux = numpy.max(highres_flux)
             y_max = 1.1*max_spline_flux
 
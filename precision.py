@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+
+Storage precision of image planes.
+
+By default all image planes are kept in double precision. In float32 mode,
+image planes (SCI, VAR, sky models, sky-subtracted frames, ...) are stored
+as float32 and pixel masks (BPM, CRJMASK, GOOD_SKY_DATA) as uint8, which
+cuts the memory needed per frame by about half. Wavelength maps, and all
+reductions that accumulate many pixels (sky-spline fits, drizzling and
+extraction), still work in float64.
+
+The mode is selected with set_mode(), or via the environment variable
+RSS_PRECISION (float64 or float32).
+
+"""
+
+import os
+import resource
+import numpy
+
+
+modes = {
+    # mode: (image dtype, mask dtype)
+    'float64': (numpy.float64, None),
+    'float32': (numpy.float32, numpy.uint8),
+}
+
+mode = 'float64'
+image_dtype = numpy.float64
+mask_dtype = None
+
+
+def set_mode(new_mode):
+    global mode, image_dtype, mask_dtype
+    if (new_mode not in modes):
+        raise ValueError("Unknown precision mode %s (valid: %s)" % (
+            new_mode, ", ".join(sorted(modes.keys()))))
+    mode = new_mode
+    image_dtype, mask_dtype = modes[new_mode]
+
+
+def image(data):
+    """
+
+    Return data in the storage precision for image planes; no copy is made
+    if data already has the right type.
+
+    """
+    return numpy.asarray(data, dtype=image_dtype)
+
+
+def mask(data, dtype=None):
+    """
+
+    Return the pixel mask data in the storage precision for masks. In
+    double-precision mode, masks are converted to dtype (if given) and kept
+    unchanged otherwise. Non-finite mask values count as bad pixels.
+
+    """
+    out_dtype = dtype if mask_dtype is None else mask_dtype
+    if (out_dtype is None):
+        return data
+    data = numpy.asarray(data)
+    if (data.dtype == out_dtype):
+        return data
+    if (data.dtype.kind == 'f' and numpy.dtype(out_dtype).kind != 'f'):
+        data = numpy.where(numpy.isfinite(data), data, 1)
+    return data.astype(out_dtype)
+
+
+def empty_image(shape, is_mask=False):
+    """
+
+    Allocate an image plane (or a mask plane if is_mask is set) filled with
+    NaN, or 1 (i.e. bad) for integer masks.
+
+    """
+    dtype = image_dtype
+    if (is_mask and mask_dtype is not None):
+        dtype = mask_dtype
+    data = numpy.empty(shape, dtype=dtype)
+    data[...] = numpy.NaN if numpy.dtype(dtype).kind == 'f' else 1
+    return data
+
+
+def peak_memory():
+    """
+
+    Peak resident memory (in MB) of this process so far.
+
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+set_mode(os.environ.get("RSS_PRECISION", "float64"))
@@ -14,6 +14,10 @@ from astropy.io import fits
 import optimal_spline_basepoints
 import bottleneck
 import logging
+import math
+import movingstats
+import stagetiming
+import debugartifacts
 
 warnings.simplefilter('ignore', UserWarning)
 
@@ -44,40 +48,75 @@ def compute_smoothed_profile(data_x, data_y,
 
     weights = numpy.ones(data_x.shape)
 
+    #
+    # For regularly spaced data (e.g. pixel positions), the neighbors closer
+    # than avg_sample_width form a fixed window around each point, so we can
+    # use sliding-window statistics instead of a KD-tree query
+    #
+    dx = numpy.diff(data_x)
+    regular_grid = data_x.shape[0] > 1 and dx[0] > 0 and numpy.all(dx == dx[0])
+    if (regular_grid):
+        n_within_width = int(math.ceil(avg_sample_width / dx[0])) - 1
+        half_width = min(n_within_width, (n_max_neighbors - 1) / 2)
+        logger.debug("Using sliding window of +/- %d points" % (half_width))
+
+        # If the number of neighbors, and not their distance, limits the
+        # window, points close to the edges use the first/last
+        # n_max_neighbors points
+        n_edge = 0
+        if (n_within_width > half_width and
+                data_x.shape[0] >= n_max_neighbors):
+            n_edge = n_max_neighbors - half_width - 1
 
     for iteration in range(n_iterations):
 
-        # Create a KD-tree with all data points
-        wl_tree = scipy.spatial.cKDTree(data_x.reshape((-1,1)))
-
-        # Now search this tree for points near each of the spline base points
-        d, i = wl_tree.query(data_x.reshape((-1,1)),
-                             k=100, # use 100 neighbors
-                             distance_upper_bound=avg_sample_width)
-
-        #
-        # Compute standard deviation around every pixel
-        #
-        bad = (i >= data_x.shape[0])
-        i[bad] = 0
+        if (regular_grid):
+            local_var = movingstats.move_std(data_y, half_width)
+            local_median = movingstats.move_median(data_y, half_width)
+            if (n_edge > 0):
+                for edge, neighbors in [
+                        (slice(0, n_edge), data_y[:n_max_neighbors]),
+                        (slice(-n_edge, None), data_y[-n_max_neighbors:])]:
+                    local_var[edge] = bottleneck.nanstd(neighbors)
+                    local_median[edge] = bottleneck.nanmedian(neighbors)
+
+        else:
+            # Create a KD-tree with all data points
+            wl_tree = scipy.spatial.cKDTree(data_x.reshape((-1,1)))
+
+            # Now search this tree for points near each of the spline base points
+            d, i = wl_tree.query(data_x.reshape((-1,1)),
+                                 k=n_max_neighbors,
+                                 distance_upper_bound=avg_sample_width)
+
+            #
+            # Compute standard deviation around every pixel
+            #
+            bad = (i >= data_x.shape[0])
+            i[bad] = 0
+
+            # Now we have all indices of a bunch of nearby datapoints, so we can
+            # extract how far off each of the data points is
+            neighbors = data_y[i] #dflux[i]
+            neighbors[bad] = numpy.NaN
+            #print "dflux_2d = ", delta_flux_2d.shape
+
+            # With this we can estimate the scatter around each spline fit basepoint
+            local_var = bottleneck.nanstd(neighbors, axis=1)
+            local_median = bottleneck.nanmedian(neighbors, axis=1)
 
-        # Now we have all indices of a bunch of nearby datapoints, so we can 
-        # extract how far off each of the data points is
-        neighbors = data_y[i] #dflux[i]
-        neighbors[bad] = numpy.NaN
-        #print "dflux_2d = ", delta_flux_2d.shape
-
-        # With this we can estimate the scatter around each spline fit basepoint
-        local_var = bottleneck.nanstd(neighbors, axis=1)
         # print "variance:", local_var.shape
-        numpy.savetxt("fit_variance.iter_%d" % (iteration+1),
-                      numpy.append(data_x.reshape((-1,1)),
-                                   local_var.reshape((-1,1)), axis=1))
-
-        local_median = bottleneck.nanmedian(neighbors, axis=1)
-        numpy.savetxt("fit_median.iter_%d" % (iteration+1),
-                      numpy.append(data_x.reshape((-1,1)),
-                                   local_median.reshape((-1,1)), axis=1))
+        debugartifacts.save_array(
+            "fit_variance.iter_%d" % (iteration+1),
+            lambda: numpy.append(data_x.reshape((-1,1)),
+                                 local_var.reshape((-1,1)), axis=1),
+            stage="prepscience")
+
+        debugartifacts.save_array(
+            "fit_median.iter_%d" % (iteration+1),
+            lambda: numpy.append(data_x.reshape((-1,1)),
+                                 local_median.reshape((-1,1)), axis=1),
+            stage="prepscience")
 
         #
         # Now reject all pixels outside the 2-3 sigma range of the local scatter
@@ -236,6 +275,7 @@ def exclude_lines_close_to_chipgaps(
 
 
 
+@stagetiming.timed()
 def find_nightsky_lines(
         data, y_range=None, write_debug_data=False,
         linewidth=2,):
@@ -254,7 +294,8 @@ def find_nightsky_lines(
     # nightsky_spec_1d = numpy.average(skylines[600:620,:], axis=0)
     nightsky_spec_1d = numpy.average(data[y_range[0]:y_range[1], :], axis=0)
     # print nightsky_spec_1d.shape
-    numpy.savetxt("nightsky", nightsky_spec_1d)
+    debugartifacts.save_array("nightsky", nightsky_spec_1d,
+                              stage="prepscience")
     # wlcal.extract_arc_spectrum(fake_hdu, line=600,avg_width=30)
 
 
@@ -284,6 +325,7 @@ def add_skylines_as_tbhdu(skyline_list):
     return tbhdu
 
 
+@stagetiming.timed()
 def extract_skyline_intensity_profile(
         hdulist, data, wls=None, 
         plot_filename=None,
@@ -13,6 +13,7 @@ import time
 
 import find_sources
 import tracespec
+import debugartifacts
 
 import pysalt.mp_logging
 
@@ -84,8 +85,9 @@ def find_additional_basepoints_old(data, bs=5):
     for i in range(data.shape[0]):
         local_var[i] = numpy.var(data[i-bs:i+bs+1, 1])
 
-    numpy.savetxt("quickspec.localvar",
-                  numpy.array([data[:,0], local_var]).T)
+    debugartifacts.save_array("quickspec.localvar",
+                              lambda: numpy.array([data[:,0], local_var]).T,
+                              stage="skysub")
 
     _var = local_var.copy()
     for iter in range(3):
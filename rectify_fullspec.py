@@ -9,11 +9,14 @@ import itertools
 import scipy
 import scipy.interpolate
 import logging
-import time
+import multiprocessing
+import multiprocessing.pool
 
 import find_sources
 import tracespec
 import optimal_extraction
+import podi_cython
+import stagetiming
 
 
 import pysalt.mp_logging
@@ -23,11 +26,79 @@ from optparse import OptionParser
 
 
 
+def _drizzle_tile(args):
+
+    (tile_start, tile_end, data, var, wavelength, trace, row_min, row_max,
+     y_min, y_width, n_samples, wl_min, spec_resolution, n_spec_bins,
+     out_drizzle, out_drizzle_var, out_coverage) = args
+
+    #
+    # Find all input rows that could contribute to this tile
+    #
+    tile_y0 = tile_start * y_width + y_min
+    tile_y1 = tile_end * y_width + y_min
+    contributing = numpy.nonzero((row_max + 0.5 > tile_y0) &
+                                 (row_min - 0.5 < tile_y1))[0]
+    if (contributing.shape[0] <= 0):
+        return
+    r0, r1 = contributing[0], contributing[-1]+1
+
+    #
+    # Determine the position of each input pixel, accounting for the offsets
+    # determined from the slit/source trace, and its extent in wavelength
+    #
+    pos_y = numpy.arange(r0, r1, dtype=numpy.float).reshape((-1,1)) - \
+            trace[r0:r1]
+    y_from = pos_y - 0.5
+    y_to = pos_y + 0.5
+
+    wl_pad = numpy.pad(wavelength[r0:r1], ((0,0),(1,1)), mode='edge')
+    wl_start = 0.5*(wl_pad[:, 0:-2] + wl_pad[:, 1:-1])
+    wl_end = 0.5*(wl_pad[:, 1:-1] + wl_pad[:, 2:])
+
+    #
+    # select only good & valid data; pixels that are not fully contained in
+    # the output grid are ignored
+    #
+    good_and_valid = numpy.isfinite(data[r0:r1]) & \
+        (numpy.floor((y_from - y_min) / y_width) >= 0) & \
+        (numpy.ceil((y_to - y_min) / y_width) <= n_samples)
+
+    podi_cython.drizzle(
+        wl_from=numpy.ascontiguousarray(wl_start.ravel(), dtype=numpy.float64),
+        wl_to=numpy.ascontiguousarray(wl_end.ravel(), dtype=numpy.float64),
+        flux=numpy.ascontiguousarray(data[r0:r1].ravel(), dtype=numpy.float64),
+        var=numpy.ascontiguousarray(var[r0:r1].ravel(), dtype=numpy.float64),
+        weight=good_and_valid.ravel().astype(numpy.float64),
+        y_from=numpy.ascontiguousarray(y_from.ravel(), dtype=numpy.float64),
+        y_to=numpy.ascontiguousarray(y_to.ravel(), dtype=numpy.float64),
+        out_wl0=wl_min, out_dwl=spec_resolution, n_wl=n_spec_bins,
+        out_y0=tile_y0, out_dy=y_width, n_y=tile_end-tile_start,
+        out_flux=out_drizzle[tile_start:tile_end],
+        out_var=out_drizzle_var[tile_start:tile_end],
+        out_coverage=out_coverage[tile_start:tile_end],
+    )
+
+
+@stagetiming.timed()
 def rectify_full_spec(
         data, var, wavelength,
         traceoffset=None,
         biny=1, spec_resolution=None,
-        debug=False):
+        debug=False,
+        n_threads=None, tile_size=128):
+    """
+
+    Drizzle all valid pixels of data (and var) into a rectified grid of
+    position along the slit (in bins of biny pixels, after correcting for
+    traceoffset) and wavelength (in steps of spec_resolution, by default
+    the mean dispersion). Output pixels without any data are NaN.
+
+    The output grid is split into tiles of tile_size rows, and tiles are
+    drizzled in n_threads parallel threads (default: one per CPU), each
+    writing directly into its part of the shared output frame.
+
+    """
 
     logger = logging.getLogger("RectifyFullSpec")
 
@@ -42,200 +113,61 @@ def rectify_full_spec(
     logger.debug("using spectral resolution of %f" % (spec_resolution))
 
     #
-    # Determine the position input grid, accounting for position offsets
-    # determined from the slit/source trace
+    # Determine the range of positions along the slit covered by each row
+    # of the input grid, accounting for position offsets determined from the
+    # slit/source trace
     #
-    pos_y, pos_x = numpy.indices(data.shape, dtype=numpy.float)
-    if (traceoffset is not None):
-        pos_y -= traceoffset
-
+    trace = numpy.broadcast_to(
+        0. if traceoffset is None else traceoffset, data.shape)
+    rows = numpy.arange(data.shape[0], dtype=numpy.float)
+    row_min = rows - numpy.max(trace, axis=1)
+    row_max = rows - numpy.min(trace, axis=1)
 
     #
     # Compute the coordinates of the output grid
     #
-    y_min = numpy.min(pos_y)
-    y_max = numpy.max(pos_y)
+    y_min = numpy.min(row_min)
+    y_max = numpy.max(row_max)
 
     n_samples = int((y_max - y_min) / biny)
-
-    y_start = (numpy.arange(n_samples, dtype=numpy.float)*biny + y_min)
     y_width = biny
-    y_end = y_start + y_width
-
-    #
-    #
-    #
-    wl_pad = numpy.pad(wavelength, ((0,0),(1,1)), mode='edge')
-    wl_start = 0.5*(wl_pad[:, 0:-2] + wl_pad[:, 1:-1])
-    wl_end = 0.5*(wl_pad[:, 1:-1] + wl_pad[:, 2:])
 
-    #
-    # select only good & valid data
-    #
-    good_and_valid = numpy.isfinite(data)
-
-    use_data = data[good_and_valid]
-    use_var = var[good_and_valid]
-    use_wl = wavelength[good_and_valid]
-    use_wl_start = wl_start[good_and_valid]
-    use_wl_end = wl_end[good_and_valid]
-    use_pos_y = pos_y[good_and_valid]
-    use_pos_x = pos_x[good_and_valid]
-
-    # #
-    # # average dispersion
-    # #
-    # avg_dispersion = numpy.mean(profile2d[:, 6] - profile2d[:, 5])
-    # spec_resolution = wl_resolution if wl_resolution > 0 else avg_dispersion * math.fabs(wl_resolution)
-    # logger.debug("using spectral resolution of %f" %  (spec_resolution))
+    n_spec_bins = int(math.ceil((wl_max - wl_min) / spec_resolution))
+    logger.debug("using a total of %d spectral bins" % (n_spec_bins))
 
     #
     # Now drizzle the data into the 2-d wavelength/y data buffer
     #
-    # wl_min = numpy.min(profile2d[:,5])
-    # wl_max = numpy.max(profile2d[:,6])
-    n_spec_bins = int(math.ceil((wl_max - wl_min) / spec_resolution))
-    logger.debug("using a total of %d spectral bins" % (n_spec_bins))
-
     out_drizzle = numpy.zeros((n_samples, n_spec_bins))
     out_drizzle_var = numpy.zeros((n_samples, n_spec_bins))
-    out_drizzle[:,:] = numpy.NaN
-    out_drizzle_var[:,:] = numpy.NaN
-
-    print out_drizzle.shape
-
-    print use_data.shape
-    #return
-
-
-    wl_start = numpy.arange(n_spec_bins, dtype=numpy.float) * spec_resolution + wl_min
-    wl_end = wl_start + spec_resolution
-
-    start_time = time.time()
-    for px in range(use_data.shape[0]):
-        # px = [ pixel / var / x / wavelength / y / wl1 / wl2]
-        # [flux, var, x, wl, y, wl1, wl2] = px
-
-        if (px > 0 and (px%10000) == 0):
-            used_time = time.time() - start_time
-            time_to_complete = (use_data.shape[0]-px)*used_time/px
-            sys.stdout.write("\r%7d of %7d pixels --> %5.1f%% complete, %5.1fs left" % (
-                px,use_data.shape[0], 100.*float(px)/float(use_data.shape[0]), time_to_complete))
-            sys.stdout.flush()
-
-        flux = use_data[px]
-        var = use_var[px]
-        x = use_pos_x[px]
-        wl = use_wl[px]
-        y = use_pos_y[px]
-        wl1 = use_wl_start[px]
-        wl2 = use_wl_end[px]
-
-
-        y1 = y - 0.5
-        y2 = y + 0.5
-
-        first_y = (y1 - y_min) / y_width #* supersample
-        last_y = (y2 - y_min) / y_width #* supersample
-
-        _y1 = int(math.floor(first_y))
-        _y2 = int(math.ceil(last_y))
-        _wl1 = int(math.floor((wl1 - wl_min)/spec_resolution))
-        _wl2 = int(math.ceil((wl2 - wl_min)/spec_resolution))
-
-        #print px
-        #print y1, y2, wl1, wl2, "-->", _y1, _y2, _wl1, _wl2, "(", y_min, wl_min, supersample, wl_resolution,")"
-
-        # Determine drizzle=-factors along the spatial axis
-        pixels_y = range(_y1, _y2)
-        pixel_fraction_y = numpy.zeros((_y2-_y1,1))
-        for i, tp in enumerate(pixels_y):
-            #print "drizzle pixel",i,tp
-            if (i == 0 and i == len(pixels_y) - 1):
-                # all flux in a single output pixel
-                fraction = 1.0
-            elif (i == 0):
-                # right-edge of this pixel is
-                right_edge = (tp+1)*y_width + y_min
-                #print "right-edge:", right_edge
-                f = right_edge - y1
-                # first pixel, with more to come
-                fraction = f/(y2-y1)
-            elif (i == len(pixels_y) - 1):
-                # last of many pixels
-                left_edge = tp*y_width + y_min
-                #print "left edge", left_edge
-                f = y2-left_edge
-                fraction = f/(y2-y1)
-            else:
-                # some pixel in the middle
-                fraction = y_width / (y2-y1)
-            #print fraction
-            pixel_fraction_y[i,0] = fraction
-
-
-
-        #print pixel_fraction_y, numpy.sum(pixel_fraction_y)
-
-        # Now also figure out the drizzle-factor along the wavelength axis
-        pixels_wl = range(_wl1, _wl2)
-        try:
-            pixel_fraction_wl = numpy.zeros((1, _wl2-_wl1))
-        except ValueError:
-            logger.warning("ValueError: WL-range %d %d --> %d" % (
-                _wl1, _wl2, _wl2-_wl1))
-            continue
-
-        for i, tp in enumerate(pixels_wl):
-            #print "drizzle pixel",i,tp
-            if (i == 0 and i == len(pixels_wl) - 1):
-                # all flux in a single output pixel
-                fraction = 1.0
-            elif (i == 0):
-                # right-edge of this pixel is
-                right_edge = (tp + 1) * spec_resolution + wl_min
-                #print "right-edge:", right_edge
-                f = right_edge - wl1
-                # first pixel, with more to come
-                fraction = f / (wl2 - wl1)
-            elif (i == len(pixels_wl) - 1):
-                # last of many pixels
-                left_edge = tp * spec_resolution + wl_min
-                #print "left edge", left_edge
-                f = wl2 - left_edge
-                fraction = f / (wl2 - wl1)
-            else:
-                # some pixel in the middle
-                fraction = spec_resolution / (wl2 - wl1)
-
-            #print fraction
-            pixel_fraction_wl[0, i] = fraction
-
-        #print pixel_fraction_wl, numpy.sum(pixel_fraction_wl)
-
-        full_weight_matrix = pixel_fraction_wl * pixel_fraction_y
-        #print full_weight_matrix.shape
-        #print full_weight_matrix
-        #print numpy.sum(full_weight_matrix)
-
-        flux_distribution = full_weight_matrix * flux
-        var_distribution = full_weight_matrix * var
-
-        try:
-            _out = out_drizzle[_y1:_y2, _wl1:_wl2]
-            _out_var = out_drizzle_var[_y1:_y2, _wl1:_wl2]
-
-            still_nan = numpy.isnan(_out)
-            _out[still_nan] = 0.
-            _out_var[still_nan] = 0.
-
-            _out += flux_distribution
-            _out_var += var_distribution
-        except ValueError:
-            pass
+    out_coverage = numpy.zeros((n_samples, n_spec_bins))
+
+    jobs = []
+    for tile_start in range(0, n_samples, tile_size):
+        tile_end = min(tile_start + tile_size, n_samples)
+        jobs.append((tile_start, tile_end, data, var, wavelength, trace,
+                     row_min, row_max, y_min, y_width, n_samples,
+                     wl_min, spec_resolution, n_spec_bins,
+                     out_drizzle, out_drizzle_var, out_coverage))
+
+    if (n_threads is None):
+        n_threads = multiprocessing.cpu_count()
+    n_threads = max(1, min(n_threads, len(jobs)))
+
+    logger.debug("Rectifying %d x %d pixels in %d tiles using %d threads" % (
+        n_samples, n_spec_bins, len(jobs), n_threads))
+    if (n_threads > 1):
+        pool = multiprocessing.pool.ThreadPool(processes=n_threads)
+        pool.map(_drizzle_tile, jobs)
+        pool.close()
+        pool.join()
+    else:
+        for job in jobs:
+            _drizzle_tile(job)
 
-        #if (_XXX > 20):
-        #    break
+    no_data = out_coverage <= 0
+    out_drizzle[no_data] = numpy.NaN
+    out_drizzle_var[no_data] = numpy.NaN
 
     #
     # truncate negative pixels to 0
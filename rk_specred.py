@@ -19,6 +19,8 @@ import sys
 import glob
 import shutil
 import time
+import multiprocessing
+import multiprocessing.pool
 
 import matplotlib
 
@@ -102,6 +104,12 @@ import tracespec
 import optimal_extraction
 import plot_high_res_sky_spec
 import findcentersymmetry
+import arccache
+import headerindex
+import masterflat
+import debugartifacts
+import stagetiming
+import precision
 import rectify_fullspec
 
 matplotlib.use('Agg')
@@ -117,124 +125,42 @@ warnings.simplefilter('ignore', UserWarning)
 wlmap_fitorder = [2, 2]
 
 
+@stagetiming.timed()
 def find_appropriate_arc(hdulist, arcfilelist, arcinfos=None,
-                         accept_closest=False):
-    if arcinfos is None:
-        arcinfos = {}
-    hdrs_to_match = [
-        'CCDSUM',
-        'WP-STATE',  # Waveplate State Machine State
-        'ET-STATE',  # Etalon State Machine State
-        'GR-STATE',  # Grating State Machine State
-        'GR-STA',  # Commanded Grating Station
-        'BS-STATE',  # Beamsplitter State Machine State
-        'FI-STATE',  # Filter State Machine State
-        'AR-STATE',  # Articulation State Machine State
-        'AR-STA',  # Commanded Articulation Station
-        'CAMANG',  # Commanded Articulation Station
-        'POLCONF',  # Polarization configuration
-        'GRATING',  # Commanded grating station
-    ]
-    flexmatch_headers = []
-    if (not accept_closest):
-        hdrs_to_match.append(
-            'GRTILT',  # Commanded grating angle
-        )
-    else:
-        flexmatch_headers.append(
-            'GRTILT',  # Commanded grating angle
-        )
-
-    logger = logging.getLogger("FindGoodArc")
-    logger.debug("Checking the following list of ARCs:\n * %s" % ("\n * ".join(arcfilelist)))
-
-    matching_arcs = []
-    for arcfile in arcfilelist:
-        if (arcfile in arcinfos):
-            # use header that we extracted in an earlier run
-            hdr = arcinfos[arcfile]
-        else:
-            # this is a new file we haven't scanned before
-            arc_hdulist = fits.open(arcfile)
-            hdr = arc_hdulist[0].header
-            arcinfos[arcfile] = hdr
-            arc_hdulist.close()
-
-        #
-        # Now search for files with the identical spectral setup
-        #
-        matches = True
-        for hdrname in hdrs_to_match:
-            logger.debug("Comparing header key --> %s <--" % (hdrname))
-
-            # if we can't compare the headers we'll assume they won't match
-            if (not hdrname in hdulist[0].header or not hdrname in hdr):
-                matches = False
-                logger.debug("(%s) Not found in one of the two files" % (hdrname))
-                break
+                         accept_closest=False, arc_table=None):
+    """
 
-            if (not hdulist[0].header[hdrname] == hdr[hdrname]):
-                matches = False
-                logger.debug("(%s) Found in both, but does not match!" % (hdrname))
-                break
+    Find the ARC(s) taken with the same instrument setup as the frame in
+    hdulist. arc_table is a headerindex.SetupTable with all ARCs; without it
+    the table is created from the headers of all files in arcfilelist (using
+    and extending the header cache arcinfos).
 
-        # if all headers exist in both files and all headers match, 
-        # then this ARC file should be usable to calibrate the OBJECT frame
-        if (matches):
-            logger.debug("FOUND GOOD ARC")
-            matching_arcs.append(arcfile)
+    Returns the list of matching ARCs, and whether the grating tilt matches
+    exactly (with accept_closest, the ARC with the closest tilt is returned).
 
-    #
-    # If accepting closest matches as well, check for best match
-    #
-    flex_matches = []
-    if (not accept_closest):
-        return matching_arcs, True
+    """
+    logger = logging.getLogger("FindGoodArc")
 
-    else:
-        logger.info("Selecting the closest matched ARC from list")
-        for arcfile in matching_arcs:
-            if (arcfile in arcinfos):
-                # use header that we extracted in an earlier run
-                hdr = arcinfos[arcfile]
-            else:
+    if (arc_table is None):
+        if arcinfos is None:
+            arcinfos = {}
+        arc_table = headerindex.SetupTable()
+        for arcfile in arcfilelist:
+            if (arcfile is None):
+                continue
+            if (arcfile not in arcinfos):
                 # this is a new file we haven't scanned before
-                arc_hdulist = fits.open(arcfile)
-                hdr = arc_hdulist[0].header
-                arcinfos[arcfile] = hdr
-                arc_hdulist.close()
-
-            fm = []
-            for hdrname in flexmatch_headers:
-                if (hdrname not in hdr):
-                    fm.append(numpy.NaN)
-                else:
-                    fm.append(hdr[hdrname])
-            flex_matches.append(fm)
-        flex_matches = numpy.array(flex_matches)
-
-        # target value
-        target_fm = []
-        for hdrname in flexmatch_headers:
-            if (hdrname not in hdulist[0].header):
-                target_fm.append(numpy.NaN)
-            else:
-                target_fm.append(hdulist[0].header[hdrname])
-        target_fm = numpy.array(target_fm)
-
-        diff = numpy.fabs((flex_matches - target_fm))
-        closest = numpy.argmin(diff)
+                arcinfos[arcfile] = fits.getheader(arcfile, 0)
+            arc_table.add(arcinfos[arcfile], arcfile)
 
-        #print matching_arcs
-        #print closest
-        #print numpy.array(matching_arcs)[closest]
-        matching_arcs = [numpy.array(matching_arcs)[closest]]
-
-        return matching_arcs, diff[closest]==0
+    if (accept_closest):
+        logger.info("Selecting the closest matched ARC from list")
+    return arc_table.find(hdulist[0].header, accept_closest=accept_closest)
     # print "***\n" * 3, matching_arcs, "\n***" * 3
 
 
 
+@stagetiming.timed()
 def tiledata(hdulist, rssgeom):
     logger = logging.getLogger("TileData")
 
@@ -251,7 +177,7 @@ def tiledata(hdulist, rssgeom):
     detsecs = []
 
     exts = {}  # 'SCI': [], 'VAR': [], 'BPM': [] }
-    ext_order = ['SCI', 'BPM', 'VAR']
+    ext_order = ['SCI', 'BPM', 'VAR', 'CRJMASK']
     for e in ext_order:
         exts[e] = []
 
@@ -280,6 +206,9 @@ def tiledata(hdulist, rssgeom):
             exts['VAR'].append(var_ext)
             exts['BPM'].append(bpm_ext)
 
+            if ('CRJEXT' in hdulist[i].header):
+                exts['CRJMASK'].append(hdulist[i].header['CRJEXT'])
+
     # print sci_exts
     # print detsecs
 
@@ -292,6 +221,11 @@ def tiledata(hdulist, rssgeom):
         logger.critical("Could not find all 6 CCD sections!")
         return
 
+    # only tile the cosmic-ray masks if they exist for all amplifiers
+    if (len(exts['CRJMASK']) != len(sci_exts)):
+        ext_order.remove('CRJMASK')
+        del exts['CRJMASK']
+
     # convert to numpy array
     detsecs = numpy.array(detsecs)
     sci_exts = numpy.array(sci_exts)
@@ -334,8 +268,8 @@ def tiledata(hdulist, rssgeom):
         logger.debug("Starting tiling for extension %s !" % (name))
 
         # Now create the mosaics
-        data = numpy.empty((height, width))
-        data[:, :] = numpy.NaN
+        is_mask = name in ['BPM', 'CRJMASK']
+        data = precision.empty_image((height, width), is_mask=is_mask)
 
         for i, ext in enumerate(exts[name]):  # sci_exts):
 
@@ -354,7 +288,8 @@ def tiledata(hdulist, rssgeom):
                 i, name, startx, endx, dx_gaps, dx_shift))
             # logger.info("input size: %d x %d" % (amp_width[i], amp_height[i]))
             # logger.info("output size: %d x %d" % (amp_width[i], height))
-            data[:, startx:endx] = hdulist[ext].data[:, :amp_width[i]]
+            amp_data = hdulist[ext].data[:, :amp_width[i]]
+            data[:, startx:endx] = precision.mask(amp_data) if is_mask else amp_data
 
         imghdu = fits.ImageHDU(data=data)
         imghdu.name = name
@@ -365,10 +300,86 @@ def tiledata(hdulist, rssgeom):
     return fits.HDUList(out_hdus)
 
 
+def _lacosmics_amplifier(args):
+
+    data, gain, readnoise, crj_opts = args
+    return podi_cython.lacosmics(
+        numpy.ascontiguousarray(data, dtype=numpy.float64),
+        gain=gain,
+        readnoise=readnoise,
+        verbose=False,
+        **crj_opts
+    )
+
+
+@stagetiming.timed()
+def lacosmics_amplifiers(hdulist, n_threads=None,
+                         sigclip=5.0, sigfrac=0.6, objlim=5.0, niter=3,
+                         saturation_limit=65000):
+    """
+
+    Remove cosmic rays from all SCI extensions (i.e. all amplifiers, before
+    mosaicing) of hdulist, replacing the data in place.
+
+    podi_cython.lacosmics releases the GIL while cleaning, so amplifiers are
+    processed in parallel threads, without having to copy any data to other
+    processes. With n_threads=None, one thread per amplifier (up to the
+    number of CPUs) is used.
+
+    Returns a dictionary of extension index to cosmic-ray mask.
+
+    """
+    logger = logging.getLogger("LACosmics")
+
+    sci_exts = [i for i, ext in enumerate(hdulist) if ext.name == 'SCI']
+    crj_opts = dict(sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
+                    niter=niter, saturation_limit=saturation_limit)
+
+    jobs = []
+    for i in sci_exts:
+        ext = hdulist[i]
+        gain = 1.5 if (not 'GAIN' in ext.header) else ext.header['GAIN']
+        readnoise = 3 if (not 'RDNOISE' in ext.header) else ext.header['RDNOISE']
+        jobs.append((ext.data, gain, readnoise, crj_opts))
+
+    if (n_threads is None):
+        n_threads = multiprocessing.cpu_count()
+    n_threads = max(1, min(n_threads, len(jobs)))
+
+    logger.debug("Cleaning cosmics in %d amplifiers using %d threads" % (
+        len(jobs), n_threads))
+    if (n_threads > 1):
+        pool = multiprocessing.pool.ThreadPool(processes=n_threads)
+        results = pool.map(_lacosmics_amplifier, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [_lacosmics_amplifier(job) for job in jobs]
+
+    crj_masks = {}
+    for i, (cell_cleaned, cell_mask, cell_saturated) in zip(sci_exts, results):
+        hdulist[i].data = cell_cleaned
+        crj_masks[i] = cell_mask
+
+    return crj_masks
+
+
+@stagetiming.timed(frame_arg='infile')
 def salt_prepdata(infile, badpixelimage=None, create_variance=False,
                   masterbias=None, clean_cosmics=True,
                   flatfield_frame=None, mosaic=False,
+                  crj_threads=None, crj_mask=False,
                   verbose=False, *args):
+    """
+
+    Basic reduction (prepare, overscan/bias, gain, crosstalk, cosmic-ray
+    cleaning, flat-field and optionally mosaicing) of a raw RSS frame.
+
+    With clean_cosmics='both', all steps up to the cosmic-ray cleaning are
+    only done once; the returned HDUList then contains the data without
+    cosmic-ray rejection as SCI, and the cleaned data as SCI.CRJ.
+
+    """
     _, fb = os.path.split(infile)
     logger = logging.getLogger("PrepData(%s)" % (fb))
     logger.info("Working on file %s" % (infile))
@@ -459,10 +470,11 @@ def salt_prepdata(infile, badpixelimage=None, create_variance=False,
     # clean the cosmic rays
     multithread = True
     logger.debug("removing cosmics")
-    if multithread and len(hdulist) > 1:
-        crj_function = pysalt.saltred.saltcrclean.multicrclean
-    else:
-        crj_function = pysalt.saltred.saltcrclean.crclean
+    raw_hdulist = None
+    if (clean_cosmics == 'both'):
+        # keep a copy of the data before cleaning; from here on both
+        # versions are processed separately
+        raw_hdulist = fits.HDUList([hdu.copy() for hdu in hdulist])
     if (clean_cosmics):
         # hdulist = crj_function(hdulist,
         #                        crtype='edge', thresh=5, mbox=11, bthresh=5.0,
@@ -475,30 +487,29 @@ def salt_prepdata(infile, badpixelimage=None, create_variance=False,
         objlim = 5.0
         saturation_limit = 65000
 
-        # This is BEFORE mosaicing, therefore:
-        # Loop over all SCI extensions
-        for ext in hdulist:
-            if (ext.name == 'SCI'):
-                with open("headers", "a") as h:
-                    print >> h, ext.header
-
-                gain = 1.5 if (not 'GAIN' in ext.header) else ext.header['GAIN']
-                readnoise = 3 if (not 'RDNOISE' in ext.header) else ext.header['RDNOISE']
-
-                crj = podi_cython.lacosmics(
-                    ext.data.astype(numpy.float64),
-                    gain=gain,
-                    readnoise=readnoise,
-                    niter=3,
-                    sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
-                    saturation_limit=saturation_limit,
-                    verbose=False
-                )
-                cell_cleaned, cell_mask, cell_saturated = crj
-                ext.data = cell_cleaned
+        # This is BEFORE mosaicing, therefore clean all amplifiers, several
+        # of them in parallel
+        crj_masks = lacosmics_amplifiers(
+            hdulist,
+            n_threads=crj_threads if multithread else 1,
+            niter=3,
+            sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
+            saturation_limit=saturation_limit,
+        )
+
+        if (crj_mask):
+            # keep the masks of all cleaned pixels; these are tiled into a
+            # CRJMASK extension of the mosaic just like VAR and BPM
+            for i in sorted(crj_masks):
+                hdulist[i].header['CRJEXT'] = len(hdulist)
+                hdulist.append(fits.ImageHDU(
+                    data=crj_masks[i].astype(numpy.uint8),
+                    name='CRJMASK'))
 
     logger.debug("done with cosmics")
 
+    branches = [hdulist] if raw_hdulist is None else [raw_hdulist, hdulist]
+
     #
     # Apply flat-field correction if requested
     #
@@ -506,10 +517,11 @@ def salt_prepdata(infile, badpixelimage=None, create_variance=False,
     if (not flatfield_frame is None and os.path.isfile(flatfield_frame)):
         logger.debug("Applying flatfield")
         flathdu = fits.open(flatfield_frame)
-        pysalt.saltred.saltflat.flat(
-            struct=hdulist,  # input
-            fstruct=flathdu,  # flatfield
-        )
+        for _hdulist in branches:
+            pysalt.saltred.saltflat.flat(
+                struct=_hdulist,  # input
+                fstruct=flathdu,  # flatfield
+            )
         # saltflat('xgbpP*fits', '', 'f', flatimage, minflat=500, clobber=True, logfile=logfile, verbose=True)
         flathdu.close()
         logger.debug("done with flatfield")
@@ -546,7 +558,8 @@ def salt_prepdata(infile, badpixelimage=None, create_variance=False,
             xshift = [0.0, +5.9, -2.1]
             yshift = [0.0, -2.6, 0.4]
             rotation = [0, 0, 0]
-            hdulist = tiledata(hdulist, (gap, xshift, yshift, rotation))
+            branches = [tiledata(_hdulist, (gap, xshift, yshift, rotation))
+                        for _hdulist in branches]
             # #return
 
             # create the mosaic
@@ -563,6 +576,16 @@ def salt_prepdata(infile, badpixelimage=None, create_variance=False,
             # hdulist.info()
             # logger.debug("done with mosaic")
 
+    hdulist = branches[0]
+    if (raw_hdulist is not None):
+        # add the cosmic-ray cleaned data (and masks) to the un-cleaned frame
+        for ext in branches[1]:
+            if (ext.name == 'SCI'):
+                ext.name = 'SCI.CRJ'
+                hdulist.append(ext)
+            elif (ext.name == 'CRJMASK'):
+                hdulist.append(ext)
+
     return hdulist
 
 
@@ -598,1438 +621,1824 @@ def save_sky_spec(wl, sky_spline, hi_res=None):
 
 
 
-#################################################################################
-#################################################################################
-#################################################################################
-
-def specred(rawdir, prodir, options,
-            imreduce=True, specreduce=True,
-            calfile=None, lamp='Ar',
-            automethod='Matchlines', skysection=[800, 1000],
-            cleanup=True):
-    #print rawdir
-    #print prodir
+@stagetiming.timed(frame_arg='filename')
+def reduce_arc_frame(filename, options, cachedir=None, cache_key=None):
+    """
 
-    logger = logging.getLogger("SPECRED")
+    Prepare, mosaic and wavelength-calibrate a single ARC frame. All output
+    files are written to the current directory. If cache_key is given, the
+    solution is added to the ARC cache in cachedir.
 
-    # get the name of the files
-    # if (type(infile) == list):
-    #     infile_list = infile
-    # elif (type(infile) == str and os.path.isdir(infile)):
-    infile_list = glob.glob(os.path.join(rawdir, "*.fits"))
+    Returns the filename of the calibrated ARC mosaic, or None if no
+    wavelength solution could be found.
 
-    # get the current date for the files
-    obsdate = os.path.basename(infile_list[0])[1:9]
-    #print obsdate
+    """
 
-    # set up some files that will be needed
-    logfile = 'spec' + obsdate + '.log'
-    flatimage = 'FLAT%s.fits' % (obsdate)
-    dbfile = 'spec%s.db' % obsdate
+    logger = logging.getLogger("SPECRED")
 
-    # create the observation log
-    # obs_dict=obslog(infile_list)
+    _, fb = os.path.split(filename)
+    hdulist = fits.open(filename)
+
+    arc_filename = "ARC_%s" % (fb)
+    arc_mosaic_filename = "ARC_m_%s" % (fb)
+    rect_filename = "ARC-RECT_%s" % (fb)
+
+    logger.info("Creating MEF  for frame %s --> %s" % (fb, arc_filename))
+    hdu = salt_prepdata(filename,
+                        badpixelimage=None,
+                        create_variance=True,
+                        clean_cosmics=False,
+                        mosaic=False,
+                        verbose=False)
+    pysalt.clobberfile(arc_filename)
+    hdu.writeto(arc_filename, clobber=True)
+
+    logger.info("Creating mosaic for frame %s --> %s" % (fb, arc_mosaic_filename))
+    hdu_mosaiced = salt_prepdata(filename,
+                                 badpixelimage=None,
+                                 create_variance=True,
+                                 clean_cosmics=False,
+                                 mosaic=True,
+                                 verbose=False)
 
-    # import pysalt.lib.saltsafeio as saltio
+    #
+    # Now we have a HDUList of the mosaiced ARC file, so 
+    # we can continue to the wavelength calibration
+    #
+    logger.info("Starting wavelength calibration")
+    binx, biny = pysalt.get_binning(hdulist)
 
-    #print infile_list
+    logger.info("Checking symmetry of ARC lines to tune the spectropgraph model")
+    symmetry_lines, best_midline, linewidth = \
+        findcentersymmetry.find_curvature_symmetry_line(
+            hdulist=hdu_mosaiced,
+            data_ext='SCI',
+            avg_width=10,
+            n_lines=10,
+    )
+    reference_row = int(best_midline[1])
+    logger.info("Using row %d as reference row" % (reference_row))
+    hdu_mosaiced[0].header['WLREFROW'] = (
+        reference_row, "symmetry row")
+    hdu_mosaiced[0].header['WLREFCOL'] = (
+        best_midline[0], "approx line position x")
+    hdu_mosaiced[0].header['LINEWDTH'] = (
+        linewidth, "linewidth in pixels")
+
+    wls_data = wlcal.find_wavelength_solution(
+        hdu_mosaiced,
+        line=reference_row,
+        #line=(2070/biny)
+    )
+    if (wls_data is None):
+        logger.error("Unable to compute WL map from %s" % (filename))
+        return None
 
     #
+    # Write wavelength solution to FITS header so we can access it 
+    # again if we need to at a later point
     #
-    # Now reduce all files, one by one
+    logger.info("Storing wavelength solution in ARC file (%s)" % (arc_mosaic_filename))
+    hdu_mosaiced[0].header['WLSFIT_N'] = len(wls_data['wl_fit_coeffs'])
+    for i in range(len(wls_data['wl_fit_coeffs'])):
+        hdu_mosaiced[0].header['WLSFIT_%d' % (i)] = wls_data['wl_fit_coeffs'][i]
+
     #
+    # Now add some plotting here just to make sure the user is happy :-)
     #
-    # work_dir = "working/"
-    # if (not os.path.isdir(work_dir)):
-    #     os.mkdir(work_dir)
-
-    # #
-    # # Make sure we have all directories 
-    # #
-    # for rs in reduction_steps:
-    #     dirname = "%s/%s" % (work_dir, rs)
-    #     if (not os.path.isdir(dirname)):
-    #         os.mkdir(dirname)
+    logger.info("Creating calibration plot for user")
+    plotfile = arc_mosaic_filename[:-5] + ".png"
+    wlcal.create_wl_calibration_plot(wls_data, hdu_mosaiced, plotfile)
 
     #
-    # Go through the list of files, find out what type of file they are
+    # Simulate the ARC spectrum by extracting a 2-D ARC spectrum just 
+    # like we would for the sky-subtraction in OBJECT frames
     #
-    logger.info("Identifying frames and sorting by type (object/flat/arc)")
-    obslog = {
-        'FLAT':   [],
-        'ARC':    [],
-        'OBJECT': [],
-    }
-
-    for idx, filename in enumerate(infile_list):
-        hdulist = fits.open(filename)
-        if (not hdulist[0].header['INSTRUME'] == "RSS"):
-            logger.info("Frame %s is not a valid RSS frame (instrument: %s)" % (
-                filename, hdulist[0].header['INSTRUME']))
-            continue
-
-        obstype = None
-        if ('OBSTYPE' in hdulist[0].header):
-            obstype = hdulist[0].header['OBSTYPE']
-            if (obstype not in ['OBJECT', 'ARC', 'FLAT']):
-                obstype = None
-        if (obstype is None or (obstype.strip() == "" and 'CCDTYPE' in hdulist[0].header)):
-            obstype = hdulist[0].header['CCDTYPE']
-        if (obstype in obslog):
-            obslog[obstype].append(filename)
-            logger.debug("Identifying %s as %s" % (filename, obstype))
-        else:
-            logger.info("No idea what to do with frame %s --> %s" % (filename, obstype))
+    logger.info("Computing a 2-D wavelength solution by tracing arc lines")
+    arc_region_file = "ARC_m_%s_traces.reg" % (fb[:-5])
+    wls_2darc = traceline.compute_2d_wavelength_solution(
+        arc_filename=hdu_mosaiced,
+        n_lines_to_trace=-15,  # -50, # trace all lines with S/N > 50
+        fit_order=wlmap_fitorder,
+        output_wavelength_image="wl+image.fits",
+        debug=options.debug,
+        arc_region_file=arc_region_file,
+        trace_every=0.05,
+        wls_data=wls_data,
+    )
+    wl_hdu = fits.ImageHDU(data=wls_2darc)
+    wl_hdu.name = "WAVELENGTH"
+    wl_hdu.header['OBJECT'] = ("wavelength map (ARC-trace)", "description")
+    hdu_mosaiced.append(wl_hdu)
 
-    for obstype in obslog:
-        if (len(obslog[obstype]) > 0):
-            logger.info("Found the following %ss:\n -- %s" % (
-                obstype, "\n -- ".join(obslog[obstype])))
-        else:
-            logger.info("No files of type %s found!" % (obstype))
+    #
+    # Compute a synthetic 2-D wavelength model
+    #
+    logger.info("Computing 2-D wavelength map from RSS spectrograph model")
+    model_wl = wlmodel.rssmodelwave(
+        header=hdu_mosaiced[0].header,
+        img=hdu_mosaiced['SCI'].data,
+        xbin=binx, ybin=biny,
+        y_center=reference_row*biny,
+    )
+    hdu_mosaiced.append(
+        fits.ImageHDU(
+            data=model_wl,
+            name="WL_MODEL_2D",
+            header=fits.Header(
+                {"OBJECT": "wavelength map from RSS model"}
+            )
+        )
+    )
+    debugartifacts.save_fits("arcwl", model_wl, stage="specred")
+    hdu_mosaiced[0].header['RSSYCNTR'] = (
+        reference_row*biny,
+        "reference line for spectrograph model"
+    )
 
-    if (options.check_only):
-        return
 
     #
-    # Go through the list of files, find all flat-fields, and create a master flat field
+    # Now go ahead and extract the full 2-d sky
     #
-    logger.info("Creating a master flat-field frame")
-    flatfield_filenames = []
-    flatfield_hdus = {}
-    first_flat = None
-    flatfield_list = {}
+    logger.info("Extracting a ARC-spectrum from the entire frame")
+    arc_regions = numpy.array([[0, hdu_mosaiced['SCI'].data.shape[0]]])
+    debugartifacts.save_hdulist("dummy", hdu_mosaiced, stage="specred")
+    arc2d = skysub2d.make_2d_skyspectrum(
+        hdu_mosaiced,
+        model_wl, #wls_2darc,
+        sky_regions=arc_regions,
+        oversample_factor=1.0,
+    )
+    simul_arc_hdu = fits.ImageHDU(data=arc2d)
+    simul_arc_hdu.name = "SIMULATION"
+    hdu_mosaiced.append(simul_arc_hdu)
+
+    logger.info("Writing calibrated ARC frame to file (%s)" % (arc_mosaic_filename))
+    pysalt.clobberfile(arc_mosaic_filename)
+    hdu_mosaiced.writeto(arc_mosaic_filename, clobber=True)
+
+    if (cache_key is not None):
+        arccache.store(
+            cachedir=cachedir,
+            key=cache_key,
+            arc_mosaic_filename=arc_mosaic_filename,
+        )
 
-    for idx, filename in enumerate(obslog['FLAT']):
-        hdulist = fits.open(filename)
-        obstype = None
-        if ('OBSTYPE' in hdulist[0].header):
-            obstype = hdulist[0].header['OBSTYPE']
-        if (obstype is None or (obstype.strip() == "" and 'CCDTYPE' in hdulist[0].header)):
-            obstype = hdulist[0].header['CCDTYPE']
-        if (obstype.find("FLAT") >= 0 and
-            hdulist[0].header['INSTRUME'] == "RSS" and
-            options.use_flats):
-            #
-            # This is a flat-field
-            #
+    # lamp=hdu[0].header['LAMPID'].strip().replace(' ', '')
+    # lampfile=pysalt.get_data_filename("pysalt$data/linelists/%s.txt" % lamp)
+    # automethod='Matchlines'
+    # skysection=[800,1000]
+    # logger.info("Searching for wavelength solution (lamp:%s, arc-image:%s)" % (
+    #     lamp, arc_filename))
+    # specidentify(arc_filename, lampfile, dbfile, guesstype='rss', 
+    #              guessfile='', automethod=automethod,  function='legendre',  order=5, 
+    #              rstep=100, rstart='middlerow', mdiff=10, thresh=3, niter=5, 
+    #              inter=False, clobber=True, logfile=logfile, verbose=True)
+    # logger.debug("Done with specidentify")
+
+    # logger.debug("Starting specrectify")
+    # specrectify(arc_filename, outimages=rect_filename, outpref='',
+    #             solfile=dbfile, caltype='line', 
+    #             function='legendre',  order=3, inttype='interp', 
+    #             w1=None, w2=None, dw=None, nw=None,
+    #             blank=0.0, clobber=True, logfile=logfile, verbose=True)
+
+    # logger.debug("Done with specrectify")
+
+    return arc_mosaic_filename
+
+def _reduce_arc_frame_worker(args):
+    """
 
-            #
-            # Get some parameters so we can create flatfields for each specific
-            # instrument configuration
-            #
-            grating = hdulist[0].header['GRATING']
-            grating_angle = hdulist[0].header['GR-ANGLE']
-            grating_tilt = hdulist[0].header['GRTILT']
-            binning = "x".join(hdulist[0].header['CCDSUM'].split())
+    Pool worker: reduce one ARC frame in its own working directory, to keep
+    the fixed-name scratch files of the different frames apart, then move
+    all ARC products back to the product directory and return the stage
+    timing records to the main process.
 
-            if (not grating in flatfield_list):
-                flatfield_list[grating] = {}
-            if (not binning in flatfield_list[grating]):
-                flatfield_list[grating][binning] = {}
-            if (not grating_tilt in flatfield_list[grating][binning]):
-                flatfield_list[grating][binning][grating_tilt] = {}
-            if (not grating_angle in flatfield_list[grating][binning][grating_tilt]):
-                flatfield_list[grating][binning][grating_tilt][grating_angle] = []
+    """
 
-            flatfield_list[grating][binning][grating_tilt][grating_angle].append(filename)
+    filename, options, cachedir, cache_key, prodir = args
 
-    for grating in flatfield_list:
-        for binning in flatfield_list[grating]:
-            for grating_tilt in flatfield_list[grating][binning]:
-                for grating_angle in flatfield_list[grating][binning][grating_tilt]:
+    _, fb = os.path.split(filename)
+    _fb, _ = os.path.splitext(fb)
+    logger = logging.getLogger("ARC(%s)" % _fb)
 
-                    filelist = flatfield_list[grating][binning][grating_tilt][grating_angle]
-                    flatfield_hdus = {}
+    work_dir = os.path.join(prodir, "work__%s" % (_fb))
+    if (not os.path.isdir(work_dir)):
+        os.mkdir(work_dir)
 
-                    logger.info("Creating master flatfield for %s (%.3f/%.3f), %s (%d frames)" % (
-                        grating, grating_angle, grating_tilt, binning, len(filelist)))
+    arc_mosaic_filename = None
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        arc_mosaic_filename = reduce_arc_frame(
+            filename=filename,
+            options=options,
+            cachedir=cachedir,
+            cache_key=cache_key,
+        )
+    except:
+        logger.critical("Error while reducing ARC %s" % (fb))
+        pysalt.mp_logging.log_exception()
+    finally:
+        os.chdir(cwd)
+        debugartifacts.flush()
 
-                    for filename in filelist:
-
-                        _, fb = os.path.split(filename)
-                        single_flat = "flat_%s" % (fb)
-
-                        hdu = salt_prepdata(filename,
-                                            badpixelimage=None,
-                                            create_variance=True,
-                                            clean_cosmics=False,
-                                            mosaic=False,
-                                            verbose=False)
-                        pysalt.clobberfile(single_flat)
-                        hdu.writeto(single_flat, clobber=True)
-                        logger.info("Wrote single flatfield to %s" % (single_flat))
-
-                        for extid, ext in enumerate(hdu):
-                            if (ext.name == "SCI"):
-                                # Only use the science extensions, leave everything else 
-                                # untouched: Apply a one-dimensional median filter to take 
-                                # out spectral slope. We can then divide the raw data by this 
-                                # median flat to isolate pixel-by-pixel variations
-                                filtered = scipy.ndimage.filters.median_filter(
-                                    input=ext.data,
-                                    size=(1, 25),
-                                    footprint=None,
-                                    output=None,
-                                    mode='reflect',
-                                    cval=0.0,
-                                    origin=0)
-                                ext.data /= filtered
-
-                                if (not extid in flatfield_hdus):
-                                    flatfield_hdus[extid] = []
-                                flatfield_hdus[extid].append(ext.data)
-
-                        single_flat = "norm" + single_flat
-                        pysalt.clobberfile(single_flat)
-                        hdu.writeto(single_flat, clobber=True)
-                        logger.info("Wrote normalized flatfield to %s" % (single_flat))
-
-                        if (first_flat is None):
-                            first_flat = hdulist
-
-                    print first_flat
+    # move all output products back to the product directory
+    for product in glob.glob(os.path.join(work_dir, "ARC*")):
+        _, product_fn = os.path.split(product)
+        target = os.path.join(prodir, product_fn)
+        pysalt.clobberfile(target)
+        shutil.move(product, target)
 
-                    if (len(filelist) <= 0):
-                        continue
+    if (not options.debug and not debugartifacts.any_enabled()):
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-                    # Combine all flat-fields into a single master-flat
-                    for extid in flatfield_hdus:
-                        flatstack = flatfield_hdus[extid]
-                        # print "EXT",extid,"-->",flatstack
-                        logger.info("Ext %d: %d flats" % (extid, len(flatstack)))
-                        flatstack = numpy.array(flatstack)
-                        print flatstack.shape
-                        avg_flat = numpy.mean(flatstack, axis=0)
-                        print "avg:", avg_flat.shape
+    return filename, arc_mosaic_filename, stagetiming.collect()
 
-                        first_flat[extid].data = avg_flat
 
-                    masterflat_filename = "flat__%s_%s_%.3f_%.3f.fits" % (
-                        grating, binning, grating_tilt, grating_angle)
-                    pysalt.clobberfile(masterflat_filename)
-                    first_flat.writeto(masterflat_filename, clobber=True)
+@stagetiming.timed()
+def reduce_arc_frames(filelist, options, prodir, cachedir=None, index=None):
+    """
 
-                    # # hdu = salt_prepdata(filename, badpixelimage=None, create_variance=False,
-                    # #                     verbose=False)
-                    # # flatfield_hdus.append(hdu)
+    Wavelength-calibrate all ARC frames in filelist. ARCs found in the ARC
+    cache (or, with --reusearcs, from a previous run) are re-used, all others
+    are solved in up to options.jobs parallel processes.
 
-    #############################################################################
-    #
-    # Determine a wavelength solution from ARC frames, where available
-    #
-    #############################################################################
+    Headers are taken from the headerindex.HeaderIndex index, if given.
 
-    logger.info("Searching for a wavelength calibration from the ARC files")
-    skip_wavelength_cal_search = False  # os.path.isfile(dbfile)
+    Returns the list of calibrated ARC mosaics, with None for all ARCs that
+    could not be calibrated.
 
-    # Keep track of when the ARCs were taken, so we can pick the one closest 
-    # in time to the science observation for data reduction
-    arc_obstimes = numpy.ones((len(obslog['ARC']))) * -999.9
-    arc_mosaic_list = [None] * len(obslog['ARC'])
-    arc_mef_list = [None] * len(obslog['ARC'])
-    if (not skip_wavelength_cal_search):
-        for idx, filename in enumerate(obslog['ARC']):
-            _, fb = os.path.split(filename)
-            hdulist = fits.open(filename)
+    """
+
+    logger = logging.getLogger("SPECRED")
 
-            # Use Julian Date for simple time indexing
-            arc_obstimes[idx] = hdulist[0].header['JD']
+    arc_mosaic_list = [None] * len(filelist)
+    to_solve = []
+    for idx, filename in enumerate(filelist):
+        _, fb = os.path.split(filename)
+        arc_mosaic_filename = "ARC_m_%s" % (fb)
 
-            arc_filename = "ARC_%s" % (fb)
-            arc_mosaic_filename = "ARC_m_%s" % (fb)
-            rect_filename = "ARC-RECT_%s" % (fb)
+        if (os.path.isfile(arc_mosaic_filename) and options.reusearcs):
+            logger.info("Re-using ARC %s from previous run" % (arc_mosaic_filename))
+            arc_mosaic_list[idx] = arc_mosaic_filename
+            continue
 
-            if (os.path.isfile(arc_mosaic_filename) and options.reusearcs):
+        cache_key = None
+        if (cachedir is not None):
+            header = index.header(filename) if index is not None else None
+            cache_key = arccache.cache_key(filename, header=header)
+            if (arccache.restore(cachedir, cache_key, arc_mosaic_filename)):
+                logger.info("Re-using cached solution for ARC %s (%s)" % (
+                    fb, cache_key))
                 arc_mosaic_list[idx] = arc_mosaic_filename
-                logger.info("Re-using ARC %s from previous run" % (arc_mosaic_filename))
                 continue
 
-            logger.info("Creating MEF  for frame %s --> %s" % (fb, arc_filename))
-            hdu = salt_prepdata(filename,
-                                badpixelimage=None,
-                                create_variance=True,
-                                clean_cosmics=False,
-                                mosaic=False,
-                                verbose=False)
-            pysalt.clobberfile(arc_filename)
-            hdu.writeto(arc_filename, clobber=True)
-            arc_mef_list[idx] = arc_filename
-
-            logger.info("Creating mosaic for frame %s --> %s" % (fb, arc_mosaic_filename))
-            hdu_mosaiced = salt_prepdata(filename,
-                                         badpixelimage=None,
-                                         create_variance=True,
-                                         clean_cosmics=False,
-                                         mosaic=True,
-                                         verbose=False)
+        to_solve.append((idx, filename, cache_key))
 
-            #
-            # Now we have a HDUList of the mosaiced ARC file, so 
-            # we can continue to the wavelength calibration
-            #
-            logger.info("Starting wavelength calibration")
-            binx, biny = pysalt.get_binning(hdulist)
-
-            logger.info("Checking symmetry of ARC lines to tune the spectropgraph model")
-            symmetry_lines, best_midline, linewidth = \
-                findcentersymmetry.find_curvature_symmetry_line(
-                    hdulist=hdu_mosaiced,
-                    data_ext='SCI',
-                    avg_width=10,
-                    n_lines=10,
-            )
-            reference_row = int(best_midline[1])
-            logger.info("Using row %d as reference row" % (reference_row))
-            hdu_mosaiced[0].header['WLREFROW'] = (
-                reference_row, "symmetry row")
-            hdu_mosaiced[0].header['WLREFCOL'] = (
-                best_midline[0], "approx line position x")
-            hdu_mosaiced[0].header['LINEWDTH'] = (
-                linewidth, "linewidth in pixels")
-
-            wls_data = wlcal.find_wavelength_solution(
-                hdu_mosaiced,
-                line=reference_row,
-                #line=(2070/biny)
+    logger.info("Re-using %d of %d ARCs, %d left to solve" % (
+        len(filelist) - len(to_solve), len(filelist), len(to_solve)))
+
+    if (options.jobs <= 1 or len(to_solve) <= 1):
+        for idx, filename, cache_key in to_solve:
+            arc_mosaic_list[idx] = reduce_arc_frame(
+                filename=filename,
+                options=options,
+                cachedir=cachedir,
+                cache_key=cache_key,
             )
-            if (wls_data is None):
-                logger.error("Unable to compute WL map from %s" % (filename))
-                continue
+        return arc_mosaic_list
+
+    # workers run in their own directories, so make all paths absolute
+    _prodir = os.path.abspath(prodir)
+    _cachedir = os.path.abspath(cachedir) if cachedir is not None else None
+    jobs = []
+    job_index = {}
+    for idx, filename, cache_key in to_solve:
+        _filename = os.path.abspath(filename)
+        jobs.append((_filename, options, _cachedir, cache_key, _prodir))
+        job_index[_filename] = idx
+
+    n_processes = min(options.jobs, len(jobs))
+    logger.info("Solving %d ARCs using %d parallel processes" % (
+        len(jobs), n_processes))
+
+    pool = multiprocessing.Pool(processes=n_processes, maxtasksperchild=1)
+    for filename, arc_mosaic_filename, timing in pool.imap_unordered(
+            _reduce_arc_frame_worker, jobs):
+        stagetiming.add(timing)
+        if (arc_mosaic_filename is None):
+            logger.error("Unable to calibrate ARC %s" % (filename))
+            continue
+        arc_mosaic_list[job_index[filename]] = arc_mosaic_filename
+    pool.close()
+    pool.join()
 
-            #
-            # Write wavelength solution to FITS header so we can access it 
-            # again if we need to at a later point
-            #
-            logger.info("Storing wavelength solution in ARC file (%s)" % (arc_mosaic_filename))
-            hdu_mosaiced[0].header['WLSFIT_N'] = len(wls_data['wl_fit_coeffs'])
-            for i in range(len(wls_data['wl_fit_coeffs'])):
-                hdu_mosaiced[0].header['WLSFIT_%d' % (i)] = wls_data['wl_fit_coeffs'][i]
+    return arc_mosaic_list
 
-            #
-            # Now add some plotting here just to make sure the user is happy :-)
-            #
-            logger.info("Creating calibration plot for user")
-            plotfile = arc_mosaic_filename[:-5] + ".png"
-            wlcal.create_wl_calibration_plot(wls_data, hdu_mosaiced, plotfile)
 
-            #
-            # Simulate the ARC spectrum by extracting a 2-D ARC spectrum just 
-            # like we would for the sky-subtraction in OBJECT frames
-            #
-            logger.info("Computing a 2-D wavelength solution by tracing arc lines")
-            arc_region_file = "ARC_m_%s_traces.reg" % (fb[:-5])
-            wls_2darc = traceline.compute_2d_wavelength_solution(
-                arc_filename=hdu_mosaiced,
-                n_lines_to_trace=-15,  # -50, # trace all lines with S/N > 50
-                fit_order=wlmap_fitorder,
-                output_wavelength_image="wl+image.fits",
-                debug=True,
-                arc_region_file=arc_region_file,
-                trace_every=0.05,
-                wls_data=wls_data,
-            )
-            wl_hdu = fits.ImageHDU(data=wls_2darc)
-            wl_hdu.name = "WAVELENGTH"
-            wl_hdu.header['OBJECT'] = ("wavelength map (ARC-trace)", "description")
-            hdu_mosaiced.append(wl_hdu)
+@stagetiming.timed(frame_arg='filename')
+def normalize_flat_frame(filename, normalized_filename):
+    """
 
-            #
-            # Compute a synthetic 2-D wavelength model
-            #
-            logger.info("Computing 2-D wavelength map from RSS spectrograph model")
-            model_wl = wlmodel.rssmodelwave(
-                header=hdu_mosaiced[0].header,
-                img=hdu_mosaiced['SCI'].data,
-                xbin=binx, ybin=biny,
-                y_center=reference_row*biny,
-            )
-            hdu_mosaiced.append(
-                fits.ImageHDU(
-                    data=model_wl,
-                    name="WL_MODEL_2D",
-                    header=fits.Header(
-                        {"OBJECT": "wavelength map from RSS model"}
-                    )
-                )
-            )
-            fits.PrimaryHDU(data=model_wl).writeto("arcwl.fits", clobber=True)
-            hdu_mosaiced[0].header['RSSYCNTR'] = (
-                reference_row*biny,
-                "reference line for spectrograph model"
-            )
+    Basic reduction of a single flat-field, followed by the normalization
+    of each amplifier. The result is written to normalized_filename.
 
+    """
+    logger = logging.getLogger("SPECRED")
 
-            #
-            # Now go ahead and extract the full 2-d sky
-            #
-            logger.info("Extracting a ARC-spectrum from the entire frame")
-            arc_regions = numpy.array([[0, hdu_mosaiced['SCI'].data.shape[0]]])
-            hdu_mosaiced.writeto("dummy.fits", clobber=True)
-            arc2d = skysub2d.make_2d_skyspectrum(
-                hdu_mosaiced,
-                model_wl, #wls_2darc,
-                sky_regions=arc_regions,
-                oversample_factor=1.0,
-            )
-            simul_arc_hdu = fits.ImageHDU(data=arc2d)
-            simul_arc_hdu.name = "SIMULATION"
-            hdu_mosaiced.append(simul_arc_hdu)
+    hdu = salt_prepdata(filename,
+                        badpixelimage=None,
+                        create_variance=True,
+                        clean_cosmics=False,
+                        mosaic=False,
+                        verbose=False)
+    for ext in hdu:
+        if (ext.name == "SCI"):
+            # Only use the science extensions, leave everything else
+            # untouched: Apply a one-dimensional median filter to take
+            # out spectral slope. We can then divide the raw data by this
+            # median flat to isolate pixel-by-pixel variations
+            ext.data = masterflat.normalize_amplifier(ext.data)
+
+    pysalt.clobberfile(normalized_filename)
+    hdu.writeto(normalized_filename, clobber=True)
+    logger.info("Wrote normalized flatfield to %s" % (normalized_filename))
+    return normalized_filename
+
+
+def _normalize_flat_worker(args):
+    """
 
-            logger.info("Writing calibrated ARC frame to file (%s)" % (arc_mosaic_filename))
-            pysalt.clobberfile(arc_mosaic_filename)
-            hdu_mosaiced.writeto(arc_mosaic_filename, clobber=True)
-            arc_mosaic_list[idx] = arc_mosaic_filename
+    Pool worker: normalize one flat-field, and return the stage timing
+    records to the main process.
+
+    """
+    filename, normalized_filename = args
+    try:
+        normalize_flat_frame(filename, normalized_filename)
+    except:
+        logging.getLogger("SPECRED").critical(
+            "Error while normalizing flat %s" % (filename))
+        pysalt.mp_logging.log_exception()
+        normalized_filename = None
+    return filename, normalized_filename, stagetiming.collect()
 
 
-            # lamp=hdu[0].header['LAMPID'].strip().replace(' ', '')
-            # lampfile=pysalt.get_data_filename("pysalt$data/linelists/%s.txt" % lamp)
-            # automethod='Matchlines'
-            # skysection=[800,1000]
-            # logger.info("Searching for wavelength solution (lamp:%s, arc-image:%s)" % (
-            #     lamp, arc_filename))
-            # specidentify(arc_filename, lampfile, dbfile, guesstype='rss', 
-            #              guessfile='', automethod=automethod,  function='legendre',  order=5, 
-            #              rstep=100, rstart='middlerow', mdiff=10, thresh=3, niter=5, 
-            #              inter=False, clobber=True, logfile=logfile, verbose=True)
-            # logger.debug("Done with specidentify")
+@stagetiming.timed()
+def create_master_flat(filelist, masterflat_filename, options,
+                       cachedir=None, index=None):
+    """
 
-            # logger.debug("Starting specrectify")
-            # specrectify(arc_filename, outimages=rect_filename, outpref='',
-            #             solfile=dbfile, caltype='line', 
-            #             function='legendre',  order=3, inttype='interp', 
-            #             w1=None, w2=None, dw=None, nw=None,
-            #             blank=0.0, clobber=True, logfile=logfile, verbose=True)
+    Create a master flat-field from all flats in filelist (all taken with
+    the same instrument setup), or restore it from the flat cache in
+    cachedir. Flats are normalized in up to options.jobs parallel
+    processes, and then combined block by block of rows.
 
-            # logger.debug("Done with specrectify")
+    Returns True if the master flat was created.
 
-    if (options.arc_only):
-        logger.info("Only ARCs were requested, all done!")
-        return
-    if (arc_mosaic_list is None or len(arc_mosaic_list) <= 0):
-        logger.error("NO VALID ARCs FOUND, aborting.")
-        return
+    """
+    logger = logging.getLogger("SPECRED")
 
-    # return
-    # os._exit(0)
+    cache_key = None
+    if (cachedir is not None):
+        header = index.header(filelist[0]) if index is not None else None
+        cache_key = masterflat.cache_key(filelist, header=header,
+                                         method=options.flat_combine)
+        if (masterflat.restore(cachedir, cache_key, masterflat_filename)):
+            logger.info("Re-using cached master flat-field %s (%s)" % (
+                masterflat_filename, cache_key))
+            return True
+
+    jobs = [(os.path.abspath(fn), os.path.abspath(
+        "normflat_%s" % (os.path.split(fn)[1]))) for fn in filelist]
+
+    normalized = []
+    if (options.jobs <= 1 or len(jobs) <= 1):
+        for filename, normalized_filename in jobs:
+            normalized.append(normalize_flat_frame(
+                filename, normalized_filename))
+    else:
+        n_processes = min(options.jobs, len(jobs))
+        logger.info("Normalizing %d flats using %d parallel processes" % (
+            len(jobs), n_processes))
+        pool = multiprocessing.Pool(processes=n_processes, maxtasksperchild=1)
+        for filename, normalized_filename, timing in pool.imap_unordered(
+                _normalize_flat_worker, jobs):
+            stagetiming.add(timing)
+            if (normalized_filename is None):
+                logger.error("Unable to normalize flat %s" % (filename))
+                continue
+            normalized.append(normalized_filename)
+        pool.close()
+        pool.join()
+
+    if (len(normalized) <= 0):
+        return False
+
+    # keep the order of the frames, independent of the order in which the
+    # workers finished
+    normalized = [fn for _, fn in jobs if fn in normalized]
+    masterflat.combine(
+        normalized_filenames=normalized,
+        template=fits.open(filelist[0]),
+        masterflat_filename=masterflat_filename,
+        method=options.flat_combine,
+        n_threads=1 if options.jobs > 1 else None,
+    )
 
-    # with open("flatlist", "w") as picklefile:
-    #    pickle.dump(flatfield_list, picklefile)
-    # print "\nPICKLE done"*10
+    if (not options.debug):
+        for fn in normalized:
+            os.remove(fn)
 
-    #############################################################################
-    #
-    # Now apply wavelength solution found above to your data frames
-    #
-    #############################################################################
-    logger.info("\n\n\nProcessing OBJECT frames")
-    arcinfos = {}
-    for idx, filename in enumerate(obslog['OBJECT']):
+    if (cache_key is not None):
+        masterflat.store(cachedir, cache_key, masterflat_filename)
+    return True
 
-        hdu_appends = []
 
-        _, fb = os.path.split(filename)
-        _fb, _ = os.path.splitext(fb)
-        hdulist = fits.open(filename)
-        logger = logging.getLogger("OBJ(%s)" % _fb)
-
-        binx, biny = pysalt.get_binning(hdulist)
-        logger.info("Using binning of %d x %d (spectral/spatial)" % (binx, biny))
-
-        mosaic_filename = "OBJ_raw__%s" % (fb)
-        output_basename = "OBJ_%s" % (fb[:-5])
-        out_filename =  "%s.fits" % (output_basename)
-
-        grating = hdulist[0].header['GRATING']
-        grating_angle = hdulist[0].header['GR-ANGLE']
-        grating_tilt = hdulist[0].header['GRTILT']
-        binning = "x".join(hdulist[0].header['CCDSUM'].split())
-
-        # Find the most appropriate flat-field
-        if (grating in flatfield_list):
-            if (binning in flatfield_list[grating]):
-                if (grating_tilt in flatfield_list[grating][binning]):
-                    _grating_tilt = grating_tilt
-                else:
-                    # We can handle flatfields with non-matching grating-tilts
-                    # make sure to pick the closest one
-                    grating_tilts = numpy.array(flatfield_list[grating][binning].keys())
-                    closest = numpy.argmin(numpy.fabs(grating_tilts - grating_tilt))
-                    _grating_tilt = grating_tilts[closest]
-
-                if (grating_angle in flatfield_list[grating][binning][_grating_tilt]):
-                    _grating_angle = grating_angle
-                else:
-                    grating_angles = numpy.array(flatfield_list[grating][binning][_grating_tilt].keys())
-                    closest = numpy.argmin(numpy.fabs(grating_angles - grating_angle))
-                    _grating_angle = grating_angles[closest]
-
-                masterflat_filename = "flat__%s_%s_%.3f_%.3f.fits" % (
-                    grating, binning, _grating_angle, _grating_tilt)
+@stagetiming.timed(frame_arg='filename')
+def reduce_object_frame(filename, options, flatfield_list, arc_mosaic_list,
+                        arcinfos=None, caldir="", arc_table=None):
+    """
+
+    Reduce a single OBJECT frame, using the master flat-fields and the ARC
+    mosaics (including their wavelength solutions) created earlier by
+    specred. All intermediate and output files are written to the current
+    directory, master flat-fields are looked up in caldir. arc_table
+    (headerindex.SetupTable) holds the ARC mosaics by instrument setup.
 
+    Returns True if the frame was reduced successfully.
+
+    """
+
+    if (arcinfos is None):
+        arcinfos = {}
+
+    hdu_appends = []
+
+    _, fb = os.path.split(filename)
+    _fb, _ = os.path.splitext(fb)
+    hdulist = fits.open(filename)
+    logger = logging.getLogger("OBJ(%s)" % _fb)
+
+    binx, biny = pysalt.get_binning(hdulist)
+    logger.info("Using binning of %d x %d (spectral/spatial)" % (binx, biny))
+
+    mosaic_filename = "OBJ_raw__%s" % (fb)
+    output_basename = "OBJ_%s" % (fb[:-5])
+    out_filename =  "%s.fits" % (output_basename)
+
+    grating = hdulist[0].header['GRATING']
+    grating_angle = hdulist[0].header['GR-ANGLE']
+    grating_tilt = hdulist[0].header['GRTILT']
+    binning = "x".join(hdulist[0].header['CCDSUM'].split())
+
+    # Find the most appropriate flat-field
+    if (grating in flatfield_list):
+        if (binning in flatfield_list[grating]):
+            if (grating_tilt in flatfield_list[grating][binning]):
+                _grating_tilt = grating_tilt
+            else:
+                # We can handle flatfields with non-matching grating-tilts
+                # make sure to pick the closest one
+                grating_tilts = numpy.array(flatfield_list[grating][binning].keys())
+                closest = numpy.argmin(numpy.fabs(grating_tilts - grating_tilt))
+                _grating_tilt = grating_tilts[closest]
+
+            if (grating_angle in flatfield_list[grating][binning][_grating_tilt]):
+                _grating_angle = grating_angle
             else:
-                masterflat_filename = None
+                grating_angles = numpy.array(flatfield_list[grating][binning][_grating_tilt].keys())
+                closest = numpy.argmin(numpy.fabs(grating_angles - grating_angle))
+                _grating_angle = grating_angles[closest]
+
+            masterflat_filename = os.path.join(
+                caldir, "flat__%s_%s_%.3f_%.3f.fits" % (
+                    grating, binning, _grating_angle, _grating_tilt))
+
         else:
             masterflat_filename = None
-
+    else:
         masterflat_filename = None
 
-        logger.info("FLATX: %s (%s, %f, %f, %s) = %s" % (
-            str(masterflat_filename),
-            grating, grating_angle, grating_tilt, binning,
-            filename)
-                    )
-        if (not masterflat_filename is None):
-            if (not os.path.isfile(masterflat_filename)):
-                masterflat_filename = None
+    masterflat_filename = None
 
-        #
-        # Find the ARC closest in time to this frame
-        #
-        # obj_jd = hdulist[0].header['JD']
-        # delta_jd = numpy.fabs(arc_obstimes - obj_jd)
-        # good_arc_idx = numpy.argmin(delta_jd)
-        # good_arc = arc_mosaic_list[good_arc_idx]
-        # logger.info("Using ARC %s for wavelength calibration" % (good_arc))
-        # good_arc_list = find_appropriate_arc(hdu, obslog['ARC'], arcinfos)
-        raw_hdu = fits.open(filename)
-        good_arc_list, exact_match = find_appropriate_arc(
-            raw_hdu, arc_mosaic_list,
-            arcinfos,
-            accept_closest=options.use_closest_arc,
-        )
-        logger.debug("Found these ARCs as appropriate:\n -- %s" % ("\n -- ".join(good_arc_list)))
+    logger.info("FLATX: %s (%s, %f, %f, %s) = %s" % (
+        str(masterflat_filename),
+        grating, grating_angle, grating_tilt, binning,
+        filename)
+                )
+    if (not masterflat_filename is None):
+        if (not os.path.isfile(masterflat_filename)):
+            masterflat_filename = None
 
-        if (len(good_arc_list) == 0):
-            logger.error("Could not find any appropriate ARCs")
-            continue
-        elif (not exact_match):
-            good_arc = good_arc_list[0]
-            logger.warning("Couldn't find exact matching ARC, using closest match")
+    #
+    # Find the ARC closest in time to this frame
+    #
+    # obj_jd = hdulist[0].header['JD']
+    # delta_jd = numpy.fabs(arc_obstimes - obj_jd)
+    # good_arc_idx = numpy.argmin(delta_jd)
+    # good_arc = arc_mosaic_list[good_arc_idx]
+    # logger.info("Using ARC %s for wavelength calibration" % (good_arc))
+    # good_arc_list = find_appropriate_arc(hdu, obslog['ARC'], arcinfos)
+    raw_hdu = fits.open(filename)
+    good_arc_list, exact_match = find_appropriate_arc(
+        raw_hdu, arc_mosaic_list,
+        arcinfos,
+        accept_closest=options.use_closest_arc,
+        arc_table=arc_table,
+    )
+    logger.debug("Found these ARCs as appropriate:\n -- %s" % ("\n -- ".join(good_arc_list)))
+
+    if (len(good_arc_list) == 0):
+        logger.error("Could not find any appropriate ARCs")
+        return False
+    elif (not exact_match):
+        good_arc = good_arc_list[0]
+        logger.warning("Couldn't find exact matching ARC, using closest match")
+    else:
+        good_arc = good_arc_list[0]
+        logger.info("Using ARC %s for wavelength calibration" % (good_arc))
+
+    # open the ARC frame
+    arc_hdu = fits.open(good_arc)
+
+    #
+    # Create the mosaic both without (SCI) and with (SCI.CRJ) cosmic ray
+    # rejection in a single pass
+    #
+    logger.info("Creating mosaic for frame %s --> %s" % (fb, mosaic_filename))
+    hdu = salt_prepdata(filename,
+                        flatfield_frame=masterflat_filename,
+                        badpixelimage=None,
+                        create_variance=True,
+                        clean_cosmics='both',
+                        mosaic=True,
+                        # frames already run in parallel processes
+                        crj_threads=1 if options.jobs > 1 else None,
+                        verbose=False,
+                        )
+    pysalt.clobberfile(mosaic_filename)
+    logger.info("Writing mosaiced OBJ file to %s" % (mosaic_filename))
+    fits.HDUList([ext for ext in hdu if ext.name != 'SCI.CRJ']).writeto(
+        mosaic_filename, clobber=True)
+
+    img_data = numpy.array(hdu['SCI'].data)
+
+    #
+    # Find bad rows that are not well exposed and likely contain no useful information
+    #
+    bad_rows = find_obscured_regions.find_obscured_regions(img_data)
+    img_data[bad_rows, :] = numpy.NaN
+
+    #
+    # Save the bad-column data as image extension in the output frame
+    #
+    bad_rows_img = numpy.zeros((img_data.shape[0]), dtype=numpy.int)
+    bad_rows_img[bad_rows] = 1
+    bad_rows_ext = fits.ImageHDU(data=bad_rows_img, name="BADROWS")
+    hdu_appends.append(bad_rows_ext)
+
+    #hdu_sci_nocrj = hdu_nocrj['SCI']
+    #hdu_sci_nocrj.name = 'SCI.NOCRJ'
+    #hdu.append(hdu_sci_nocrj)
+    hdu_crj = hdu['SCI.CRJ']
+    img_crjclean = hdu_crj.data
+
+
+    # Make backup of the image BEFORE sky subtraction
+    # make sure to copy the actual data, not just create a duplicate reference
+    # for source_ext in ['SCI', 'SCI.NOCRJ']:
+    #     presub_hdu = fits.ImageHDU(data=numpy.array(hdu['SCI'].data),
+    #                                header=hdu['SCI'].header)
+    #     presub_hdu.name = source_ext + '.RAW'
+    #     hdu.append(presub_hdu)
+
+    #
+    # Find symmetry from sky-lines
+    #
+    logger.info("Checking symmetry of SKY lines to tune the spectropgraph model")
+    symmetry_lines, best_midline, linewidth = \
+        findcentersymmetry.find_curvature_symmetry_line(
+            hdulist=hdu,
+            data_ext='SCI',
+            avg_width=10,
+            n_lines=10,
+    )
+    if (symmetry_lines is None):
+        # This means we could not find any valid linetraces
+        # assume the center from the corresponding arc
+        logger.warning("Adopting symmetry row from ARC")
+        reference_row = arc_hdu[0].header['WLREFROW']
+        linewidth = arc_hdu[0].header['LINEWDTH']
+    else:
+        reference_row = int(best_midline[1])
+        logger.info("Using row %d as reference row" % (reference_row))
+
+    #
+    # Find a global slit profile to identify obscured regions (i.e. behind guide and/or focus probe)
+    #
+    profile_raw_1d = numpy.mean(img_data, axis=1, dtype=numpy.float64)
+    # print profile_raw_1d
+
+    #
+    # Use ARC to trace lines and compute a 2-D wavelength solution
+    #
+    logger.info("Computing 2-D wavelength map")
+    arc_region_file = "OBJ_%s_traces.reg" % (fb[:-5])
+    # wls_2d, slitprofile = traceline.compute_2d_wavelength_solution(
+    #     arc_filename=good_arc, 
+    #     n_lines_to_trace=-50, # trace all lines with S/N > 50 
+    #     fit_order=wlmap_fitorder,
+    #     output_wavelength_image="wl+image.fits",
+    #     debug=False,
+    #     arc_region_file=arc_region_file,
+    #     return_slitprofile=True,
+    #     trace_every=0.05)
+    # print wls_2d
+    # wl_hdu = fits.ImageHDU(data=wls_2d)
+    # wl_hdu.name = "WAVELENGTH"
+    # hdu.append(wl_hdu)
+
+    # This uses the ARC tracing & polynomial fit WL solution
+    wls_2d = arc_hdu['WAVELENGTH'].data
+
+    # BETTER: Use the 2-D model fit as WL solution
+    # This would also be saved in the ARC reference frame as WL_MODEL_2D
+    model_wl = wlmodel.rssmodelwave(
+        header=arc_hdu[0].header,
+        img=arc_hdu['SCI'].data,
+        xbin=binx, ybin=biny,
+        y_center=reference_row * biny,
+    )
+    # wls_2d = arc_hdu['WL_MODEL_2D'].data
+    wls_2d = model_wl
+
+    debugartifacts.save_fits("specred.wl", wls_2d, stage="specred")
+    # os._exit(-1)
+
+    n_params = arc_hdu[0].header['WLSFIT_N']
+    # copy a couple of relevant keywords
+    for key in ['RSSYCNTR', 'WLSFIT_N', 'LINEWDTH']:
+        if (key in arc_hdu[0].header):
+            hdu[0].header[key] = arc_hdu[0].header[key]
         else:
-            good_arc = good_arc_list[0]
-            logger.info("Using ARC %s for wavelength calibration" % (good_arc))
-
-        # open the ARC frame
-        arc_hdu = fits.open(good_arc)
-
-        logger.info("Creating mosaic for frame %s --> %s" % (fb, mosaic_filename))
-        hdu = salt_prepdata(filename,
-                            flatfield_frame=masterflat_filename,
-                            badpixelimage=None,
-                            create_variance=True,
-                            clean_cosmics=False,  # True,
-                            mosaic=True,
-                            verbose=False,
-                            )
-        pysalt.clobberfile(mosaic_filename)
-        logger.info("Writing mosaiced OBJ file to %s" % (mosaic_filename))
-        hdu.writeto(mosaic_filename, clobber=True)
-
-        img_data = numpy.array(hdu['SCI'].data)
+            logger.warning("Unable to find FITS keywords %s in %s" % (key, good_arc))
+    # hdu[0].header["WLSFIT_N"] = arc_hdu[0].header["WLSFIT_N"]
+
+    wls_fit = numpy.zeros(n_params)
+    for i in range(n_params):
+        wls_fit[i] = arc_hdu[0].header['WLSFIT_%d' % (i)]
+        hdu[0].header['WLSFIT_%d' % (i)] = arc_hdu[0].header['WLSFIT_%d' % (i)]
+    hdu.append(fits.ImageHDU(data=wls_2d, name='WAVELENGTH.RAW'))
+
+    in_data = hdu['SCI.CRJ'].data if 'SCI.CRJ' in hdu else hdu['SCI'].data
+    skylines, skyline_list, skylines_ref_y = prep_science.find_nightsky_lines(
+        data=numpy.array(in_data),
+        linewidth=linewidth,
+    )
 
-        #
-        # Find bad rows that are not well exposed and likely contain no useful information
-        #
-        bad_rows = find_obscured_regions.find_obscured_regions(img_data)
-        img_data[bad_rows, :] = numpy.NaN
+    #
+    # TODO: CONVERT SKYLINE POSITION FROM PIXELS TO WAVELENGTHS
+    #
 
-        #
-        # Save the bad-column data as image extension in the output frame
-        #
-        bad_rows_img = numpy.zeros((img_data.shape[0]), dtype=numpy.int)
-        bad_rows_img[bad_rows] = 1
-        bad_rows_ext = fits.ImageHDU(data=bad_rows_img, name="BADROWS")
-        hdu_appends.append(bad_rows_ext)
+    #
+    # Fit and include the wavelength distortion (based on sky-lines) in the wavelength calibration
+    #
+    if (options.model_wl_distortions):
+        print "\n"*10
+        print "symmetry:", reference_row
+        print "spec ref row:", skylines_ref_y
+        print "from model:", hdu[0].header['RSSYCNTR']
+        print "binning x/y: ", binx, biny
+        print "\n"*10
+        distortion_2d, dist_quality = model_distortions.map_wavelength_distortions(
+            skyline_list=skyline_list,
+            wl_2d=wls_2d,
+            img_2d=img_crjclean,
+            diff_2d=None,
+            badrows=bad_rows_img,
+            linewidth=linewidth,
+            xbin=binx, ybin=biny,
+            ref_row=skylines_ref_y,
+            symmetry_row=hdu[0].header['RSSYCNTR'], #reference_row*biny,
+            primary_header=hdu[0].header,
+            debug=options.debug,
+        )
+        if (distortion_2d is not None):
+            debugartifacts.save_fits("specred.wl.dist", distortion_2d,
+                                     stage="specred")
+            max_dist = 1.5
+            # TODO: CHANGE TO BE DEPENDENT ON SPECTRAL RESOLUTION ETC.
+            distortion_2d[distortion_2d > max_dist] = max_dist
+            distortion_2d[distortion_2d < -1*max_dist] = -1*max_dist
+    else:
+        logger.info("Per user-request skipping WL distortion modeling")
+        distortion_2d = None
+
+    if (distortion_2d is not None):
+        wls_2d -= distortion_2d
+        hdu.append(fits.ImageHDU(data=precision.image(distortion_2d),
+                                 name='WAVELENGTH.DISTORTION'))
+        hdu.append(fits.ImageHDU(data=wls_2d, name='WAVELENGTH'))
+    else:
+        logger.warning("Skipping the wavelength distortion due to "
+                       "previous error")
 
-        #
-        # Also create the image without cosmic ray rejection, and add it to the 
-        # output file
-        #
-        logger.info("Creating mosaiced frame WITHOUT cosmic-ray rejection")
-        hdulist_crj = salt_prepdata(filename,
-                                    flatfield_frame=masterflat_filename,
-                                    create_variance=True,
-                                    badpixelimage=None,
-                                    clean_cosmics=True,
-                                    mosaic=True,
-                                    verbose=False,
-                                    )
-        #hdu_sci_nocrj = hdu_nocrj['SCI']
-        #hdu_sci_nocrj.name = 'SCI.NOCRJ'
-        #hdu.append(hdu_sci_nocrj)
-        hdu_crj = hdulist_crj['SCI']
-        hdu_crj.name = 'SCI.CRJ'
-        hdu.append(hdu_crj)
-        img_crjclean = hdu_crj.data
-
-
-        # Make backup of the image BEFORE sky subtraction
-        # make sure to copy the actual data, not just create a duplicate reference
-        # for source_ext in ['SCI', 'SCI.NOCRJ']:
-        #     presub_hdu = fits.ImageHDU(data=numpy.array(hdu['SCI'].data),
-        #                                header=hdu['SCI'].header)
-        #     presub_hdu.name = source_ext + '.RAW'
-        #     hdu.append(presub_hdu)
+    debugartifacts.save_hdulist("dummy", hdu, stage="specred")
+    #os._exit(0)
 
+    debugartifacts.save_fits("img0", img_data, stage="specred")
+
+    apply_skyline_intensity_flat = False
+    if (apply_skyline_intensity_flat):
+        # 
+        # Extract the sky-line intensity profile along the slit. Use this to 
+        # correct the data. This should also improve the quality of the extracted
+        # 2-D sky.
         #
-        # Find symmetry from sky-lines
-        #
-        logger.info("Checking symmetry of SKY lines to tune the spectropgraph model")
-        symmetry_lines, best_midline, linewidth = \
-            findcentersymmetry.find_curvature_symmetry_line(
+        plot_filename = "%s_slitprofile.png" % (fb)
+        skylines, skyline_list, intensity_profile = \
+            prep_science.extract_skyline_intensity_profile(
                 hdulist=hdu,
-                data_ext='SCI',
-                avg_width=10,
-                n_lines=10,
-        )
-        if (symmetry_lines is None):
-            # This means we could not find any valid linetraces
-            # assume the center from the corresponding arc
-            logger.warning("Adopting symmetry row from ARC")
-            reference_row = arc_hdu[0].header['WLREFROW']
-            linewidth = arc_hdu[0].header['LINEWDTH']
-        else:
-            reference_row = int(best_midline[1])
-            logger.info("Using row %d as reference row" % (reference_row))
+                data=numpy.array(hdu['SCI.RAW'].data),
+                wls=wls_fit,
+                plot_filename=plot_filename,
+            )
+        # Flatten the science frame using the line profile
+        # hdu.append(
+        #     fits.ImageHDU(
+        #         data=numpy.array(hdu['SCI'].data),
+        #         header=hdu['SCI'].header,
+        #         name="SCI.PREFLAT"
+        #     )
+        # )
+        # hdu.append(
+        #     fits.ImageHDU(
+        #         data=numpy.array(hdu['SCI'].data / intensity_profile.reshape((-1, 1))),
+        #         header=hdu['SCI'].header,
+        #         name="SCI.POSTFLAT"
+        #     )
+        # )
 
         #
-        # Find a global slit profile to identify obscured regions (i.e. behind guide and/or focus probe)
+        # Mask out all regions with relative intensities below 0.1x max 
         #
-        img_raw = img_data.copy()
-        profile_raw_1d = numpy.mean(img_raw, axis=1)
-        # print profile_raw_1d
+        stats = scipy.stats.scoreatpercentile(intensity_profile, [50, 16, 84, 2.5, 97.5])
+        one_sigma = (stats[4] - stats[3]) / 4.
+        median = stats[0]
+        bad_region = intensity_profile < median - 2 * one_sigma
+        hdu['SCI'].data[bad_region] = numpy.NaN
+        intensity_profile[bad_region] = numpy.NaN
 
-        #
-        # Use ARC to trace lines and compute a 2-D wavelength solution
-        #
-        logger.info("Computing 2-D wavelength map")
-        arc_region_file = "OBJ_%s_traces.reg" % (fb[:-5])
-        # wls_2d, slitprofile = traceline.compute_2d_wavelength_solution(
-        #     arc_filename=good_arc, 
-        #     n_lines_to_trace=-50, # trace all lines with S/N > 50 
-        #     fit_order=wlmap_fitorder,
-        #     output_wavelength_image="wl+image.fits",
-        #     debug=False,
-        #     arc_region_file=arc_region_file,
-        #     return_slitprofile=True,
-        #     trace_every=0.05)
-        # print wls_2d
-        # wl_hdu = fits.ImageHDU(data=wls_2d)
-        # wl_hdu.name = "WAVELENGTH"
-        # hdu.append(wl_hdu)
-
-        # This uses the ARC tracing & polynomial fit WL solution
-        wls_2d = arc_hdu['WAVELENGTH'].data
-
-        # BETTER: Use the 2-D model fit as WL solution
-        # This would also be saved in the ARC reference frame as WL_MODEL_2D
-        model_wl = wlmodel.rssmodelwave(
-            header=arc_hdu[0].header,
-            img=arc_hdu['SCI'].data,
-            xbin=binx, ybin=biny,
-            y_center=reference_row * biny,
+        hdu['SCI'].data /= intensity_profile.reshape((-1, 1))
+        logger.info("Slit-flattened SCI extension")
+
+        y = img_data / intensity_profile.reshape((-1, 1))
+        debugartifacts.save_fits("img1", lambda: y / img_data, stage="specred")
+
+        # img_data /= intensity_profile.reshape((-1,1))
+    else:
+        pass
+
+    if (options.debug):
+        # print "FOUND NIGHT-SKY LINES:"
+        # numpy.savetxt(sys.stdout, skyline_list, "%9.3f")
+        numpy.savetxt("nightsky_lines", skyline_list)
+
+    skyline_tbhdu = prep_science.add_skylines_as_tbhdu(skyline_list)
+    skyline_tbhdu.header['LINEREFY'] = skylines_ref_y
+    hdu_appends.append(skyline_tbhdu)
+
+    #
+    # Map wavelength distortions
+    #
+    # try:
+    #     print skyline_list.shape
+    #     distortions, distortions_binned = map_distortions.map_distortions(
+    #         wl_2d=wls_2d,
+    #         diff_2d=None,
+    #         img_2d = img_raw,
+    #         y=610,
+    #         x_list=skyline_list[:,0],
+    #     )
+    # except:
+    #     pass
+
+    # logger.info("Adding xxx extension")
+    # hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
+    #                          data=img_data,
+    #                          name="XXX"))
+
+    #
+    # Compute a full-frame 2-D flat-field.
+    # With this flat-field we can extract a better sky spectrum, and later improve the sky-subtraction
+    #
+    logger.info("Computing 2-D flatfield from night sky intensity profile")
+    vph_flatfield, vph_flat_interpol = \
+        fiddle_slitflat2.create_2d_flatfield_from_sky(
+            wl=wls_2d,
+            img=img_data,
+            bad_rows=bad_rows
+    )
+    flattened_img = img_data / vph_flatfield
+    logger.info("Flattened image: %s" % (str(flattened_img.shape)))
+
+
+
+    # #
+    # # Now go ahead and extract the full 2-d sky
+    # #
+    # logger.info("Extracting 2-D sky")
+    # sky_regions = numpy.array([[0, hdu['SCI'].data.shape[0]]])
+    # sky2d = skysub2d.make_2d_skyspectrum(
+    #     hdu,
+    #     wls_2d,
+    #     sky_regions=sky_regions,
+    #     oversample_factor=1.0,
+    #     slitprofile=None, #slitprofile,
+    #     )
+
+    # logger.info("Performing sky subtraction")
+    # sky_hdu = fits.ImageHDU(data=sky2d, name='SKY')
+    # hdu.append(sky_hdu)
+
+    # if (not slitprofile == None):
+    #     sky_hdux = fits.ImageHDU(data=sky2d*slitprofile.reshape((-1,1)))
+    #     sky_hdux.name = "SKY_X"
+    #     hdu.append(sky_hdux)
+
+    # # Don't forget to subtract the sky off the image
+    # for source_ext in ['SCI', 'SCI.NOCRJ']:
+    #     hdu[source_ext].data -= sky2d #(sky2d * slitprofile.reshape((-1,1)))
+
+    # numpy.savetxt("OBJ_%s_slit.asc" % (fb[:-5]), slitprofile)
+
+    #
+    # Compute the optimized sky, using better-chosen spline basepoints 
+    # to sample the sky-spectrum
+    #
+    sky_regions = numpy.array([[300, 500], [1400, 1700]])
+    logger.info("Preparing optimized sky-subtraction")
+    ia = None
+
+    # simple_spec = optimalskysub.optimal_sky_subtraction(hdu, 
+    #                                       sky_regions=sky_regions,
+    #                                       N_points=1000,
+    #                                       iterate=False,
+    #                                       skiplength=10, 
+    #                                       return_2d=False)
+    # numpy.savetxt("%s.simple_spec" % (_fb), simple_specs)
+
+    # simple_spec = hdu['VAR'].data[hdu['VAR'].data.shape[0]/2,:]
+    # numpy.savetxt("%s.simple_spec_2" % (_fb), simple_spec)
+
+    # logger.info("Searching for and analysing sky-lines")
+    # skyline_list = wlcal.find_list_of_lines(simple_spec, readnoise=1, avg_width=1)
+    # print skyline_list
+
+    # logger.info("Creating spatial flatfield from sky-line intensity profiles")
+    # i, ia, im = skyline_intensity.find_skyline_profiles(hdu, skyline_list)
+
+
+    if (apply_skyline_intensity_flat):
+        skyline_flat = intensity_profile.reshape((-1, 1))
+    else:
+        skyline_flat = None
+
+    # sky_2d, spline = optimalskysub.optimal_sky_subtraction(
+    #     hdu, 
+    #     sky_regions=sky_regions,
+    #     N_points=2000,
+    #     iterate=False,
+    #     skiplength=5,
+    #     skyline_flat=skyline_flat, #intensity_profile.reshape((-1,1)),
+    # )
+
+
+
+    sky_2d, spline, extra = optimalskysub.optimal_sky_subtraction(
+        hdu,
+        sky_regions=None,  # sky_regions,
+        N_points=600,
+        iterate=False,
+        skiplength=5,
+        skyline_flat=skyline_flat,  # intensity_profile.reshape((-1,1)),
+        # select_region=numpy.array([[900,950]])
+        # select_region=numpy.array([[600, 640], [660, 700]]),
+        wlmode=options.wlmode,
+        debug_prefix="%s__" % (fb[:-5]),
+        image_data=flattened_img,
+        obj_wl=wls_2d,
+        debug=options.debug,
+        noise_mode=options.sky_noise_mode,
+        spline_engine=options.sky_spline_engine,
+        iteration_mode=options.sky_iteration_mode,
+        spline_weights=options.sky_weights,
+    )
+    if (sky_2d is not None):
+        (x_eff, wl_map, medians, p_scale, p_skew, fm, good_sky_data) = extra
+
+        hdu.append(fits.ImageHDU(data=precision.mask(good_sky_data, numpy.int),
+                                 name="GOOD_SKY_DATA"))
+    else:
+        logger.critical("Error while computing sky spectrum")
+        good_sky_data = None
+
+    #
+    # Create a diagnostic plot showing the sky-spectrum and the
+    # sky-fit spline used for sky-subtraction
+    #
+    plot_high_res_sky_spec.plot_sky_spectrum(
+        wl=wls_2d,
+        flux=flattened_img,
+        good_sky_data=good_sky_data,
+        bad_rows=bad_rows,
+        output_filebase=output_basename+".skyspec",
+        sky_spline=spline,
+        ext_list=['png'],
+    )
+
+    #
+    # Save a high-res version of the sky-spectrum as 1-D fits for
+    # wavelength verification and other purposes
+    #
+    hdu.append(save_sky_spec(wl=wls_2d, sky_spline=spline))
+
+    # recompute sky-2d based on the full wavelength map and the spline interpolator
+    # sky_2d = spline(wls_2d)
+
+    # bs = 100
+    # maxbs = 10
+
+    # sky2d_full = numpy.zeros(img_data.shape)
+    # for nbs in range(maxbs):
+
+    #     sky_2d, spline, extra = optimalskysub.optimal_sky_subtraction(
+    #         hdu, 
+    #         sky_regions=None, #sky_regions,
+    #         N_points=2000,
+    #         iterate=False,
+    #         skiplength=5,
+    #         skyline_flat=skyline_flat, #intensity_profile.reshape((-1,1)),
+    #         #select_region=numpy.array([[900,950]])
+    #         select_region=numpy.array([[nbs*bs,(nbs+1)*bs]])
+    #     )
+    #     extra = 
+    #     if (sky_2d == None):
+    #         continue
+    #     sky2d_full[nbs*bs:(nbs+1)*bs, :] = sky_2d[nbs*bs:(nbs+1)*bs, :]
+
+    # sky_2d = sky2d_full
+
+    try:
+        if (skyline_flat is not None):
+            debugartifacts.save_fits(
+                "img_sky2d_input_skylineflat",
+                lambda: hdu['SCI.RAW'].data / skyline_flat, stage="specred")
+        debugartifacts.save_fits(
+            "img_sky2d_input_fm",
+            lambda: hdu['SCI.RAW'].data / fm.reshape((-1, 1)), stage="specred")
+
+        debugartifacts.save_fits("img_sky2d", sky_2d, stage="specred")
+
+        debugartifacts.save_fits(
+            "img_sky2d_x_vphflat",
+            lambda: sky_2d*vph_flatfield, stage="specred")
+
+        debugartifacts.save_fits(
+            "img_vphflat_skysub",
+            lambda: img_data - (sky_2d*vph_flatfield), stage="specred")
+    except:
+        pass
+    #
+    # Add here:
+    #
+    # Step 1:
+    # iteratively check the noise in and around sky-lines. Weight noise with
+    # the amplitude of the sky-spectrum. Then compute local (in ~ten bands 
+    # across the image) scaling factor that minimizes residuals. Take care 
+    # to mask out sources first. Then compute smooth scaling actor that yields
+    # the best overall sky subtraction.
+    #
+    logger.info("Minimizing sky residuals")
+    # scaling_data, opt_sky_scaling = optscale.minimize_sky_residuals(
+    #     img_data, sky_2d, vert_size=5, smooth=20, debug_out=True)
+    # # opt_sky_scaling = fm.reshape((-1,1))
+    # numpy.savetxt(out_filename[:-5]+".skyscaling", opt_sky_scaling)
+
+    skyscaling2d = 1.
+    opt_sky_scaling = 1.
+
+    debugartifacts.save_fits("debug_minimizeskyresiduals_img", img_data, stage="specred")
+    debugartifacts.save_fits("debug_minimizeskyresiduals_sky2d", sky_2d, stage="specred")
+    debugartifacts.save_fits("debug_minimizeskyresiduals_wlmap", wl_map, stage="specred")
+
+    # number of blocks in wavelength and spatial direction
+    n_scale_blocks_wl, n_scale_blocks_spatial = [
+        int(n) for n in options.sky_scaling_blocks.split(",")]
+
+    if (options.skyscaling == 'none'):
+
+        skyscaling2d = numpy.ones(img_data.shape)
+
+        pass
+
+    elif (options.skyscaling == 's2d'):
+
+        ret = optscale.minimize_sky_residuals2_spline(
+            img=img_data,
+            sky=sky_2d,
+            wl=wl_map,
+            bpm=hdu['BPM'].data,
+            vert_size=-n_scale_blocks_spatial,
+            dl=-n_scale_blocks_wl,
+            n_clip_iterations=options.sky_scaling_clip)
+        if (ret is not None):
+            full2d, data, pf2, data2, spline2d = ret
+            debugartifacts.save_array("new_scaling", data, stage="skyscaling")
+            skyscaling2d = spline2d
+        else:
+            logger.error("Unable to optimize sky subtraction, continuing without optimization")
+            skyscaling2d = numpy.ones(img_data.shape)
+
+        pass
+
+    elif (options.skyscaling == 'p2d'):
+        pass
+
+        ret = optscale.minimize_sky_residuals2(
+            img=img_data,
+            sky=sky_2d,
+            wl=wl_map,
+            bpm=hdu['BPM'].data,
+            vert_size=-n_scale_blocks_spatial,
+            dl=-n_scale_blocks_wl,
+            n_clip_iterations=options.sky_scaling_clip)
+        if (ret is not None):
+            full2d, data, pf2, data2 = ret
+            debugartifacts.save_array("new_scaling", data, stage="skyscaling")
+        else:
+            logger.error("Unable to optimize sky subtraction, continuing without optimization")
+            full2d = numpy.ones(img_data.shape)
+            data = None
+            pf2 = None
+            data2 = None
+
+        opt_sky_scaling = full2d
+        skyscaling2d = full2d
+
+    else:
+
+        skyscaling2d = vph_flatfield
+
+    if (sky_2d is not None):
+        sky_2d = precision.image(sky_2d)
+    skyscaling2d = precision.image(skyscaling2d)
+
+    # data, filtered, full2d = optscale.minimize_sky_residuals2(
+    #     img=img_data, 
+    #     sky=sky_2d, 
+    #     wl=wl_map, 
+    #     bpm=hdu['BPM'].data,
+    #     vert_size=-25, 
+    #     dl=-25)
+    # numpy.savetxt("new_scaling.dump", data)
+
+    #
+    # step 2: 
+    # Also consider small-scale gaussian smoothing to more closely match the
+    # sky-line profile along the slit.
+    #
+    pass
+
+    # skysub = obj_data - sky2d
+    # ss_hdu = fits.ImageHDU(header=obj_hdulist['SCI.RAW'].header,
+    #                          data=skysub)
+    # ss_hdu.name = "SKYSUB.OPT"
+    # obj_hdulist.append(ss_hdu)
+
+    ss_hdu2 = fits.ImageHDU(header=hdu['SCI'].header,
+                            data=(sky_2d * skyscaling2d),
+                            name="SKYSUB.IMG")
+    # ss_hdu2 = fits.ImageHDU(header=hdu['SCI'].header,
+    #                          data=(sky_2d * opt_sky_scaling))
+    #ss_hdu2.name = "SKYSUB.IMG"
+    hdu.append(ss_hdu2)
+
+    ss_hdu2 = fits.ImageHDU(header=hdu['SCI'].header,
+                            data=(sky_2d),
+                            name="SKY.RAW")
+    hdu.append(ss_hdu2)
+
+    # hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
+    #                          data=wl_map,
+    #                          name="WL_XXX")
+    #            )
+    hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
+                             data=skyscaling2d,
+                             name="SKY.SCALE")
+               )
+
+    skysub_img = (img_data) - (sky_2d * skyscaling2d)  # opt_sky_scaling)
+    # skysub_hdu = fits.ImageHDU(header=hdu['SCI'].header,
+    #                            data=numpy.array(skysub_img),
+    #                            name="SKYSUB.OPT")
+    # hdu.append(skysub_hdu)
+
+    #
+    # Run cosmic ray rejection on the sky-line subtracted frame
+    # Loop over all SCI extensions
+    #
+    # median_sky = numpy.median(sky_2d * opt_sky_scaling)
+    median_sky = bottleneck.nanmedian(sky_2d * opt_sky_scaling)
+    sigclip = 5.0
+    sigfrac = 0.6
+    objlim = 5.0
+    saturation_limit = 65000
+    try:
+        gain = 1.5 if (not 'GAIN' in hdu['SCI'].header) else hdu['SCI'].header['GAIN']
+        readnoise = 3 if (not 'RDNOISE' in hdu['SCI'].header) else hdu['SCI'].header['RDNOISE']
+    except:
+        gain, readnoise = 1.3, 5
+
+    with stagetiming.stage("lacosmics", skysub_img):
+        crj = podi_cython.lacosmics(
+            numpy.ascontiguousarray(skysub_img + median_sky, dtype=numpy.float64),
+            gain=gain,
+            readnoise=readnoise,
+            niter=3,
+            sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
+            saturation_limit=saturation_limit,
+            verbose=False
         )
-        # wls_2d = arc_hdu['WL_MODEL_2D'].data
-        wls_2d = model_wl
+    cell_cleaned, cell_mask, cell_saturated = crj
 
-        fits.PrimaryHDU(data=wls_2d).writeto("specred.wl.fits", clobber=True)
-        # os._exit(-1)
+    hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
+                             data=precision.image(skysub_img + median_sky - cell_cleaned),
+                             name="COSMICS"))
 
-        n_params = arc_hdu[0].header['WLSFIT_N']
-        # copy a couple of relevant keywords
-        for key in ['RSSYCNTR', 'WLSFIT_N', 'LINEWDTH']:
-            if (key in arc_hdu[0].header):
-                hdu[0].header[key] = arc_hdu[0].header[key]
-            else:
-                logger.warning("Unable to find FITS keywords %s in %s" % (key, good_arc))
-        # hdu[0].header["WLSFIT_N"] = arc_hdu[0].header["WLSFIT_N"]
-
-        wls_fit = numpy.zeros(n_params)
-        for i in range(n_params):
-            wls_fit[i] = arc_hdu[0].header['WLSFIT_%d' % (i)]
-            hdu[0].header['WLSFIT_%d' % (i)] = arc_hdu[0].header['WLSFIT_%d' % (i)]
-        hdu.append(fits.ImageHDU(data=wls_2d, name='WAVELENGTH.RAW'))
-
-        in_data = hdu['SCI.CRJ'].data if 'SCI.CRJ' in hdu else hdu['SCI'].data
-        skylines, skyline_list, skylines_ref_y = prep_science.find_nightsky_lines(
-            data=numpy.array(in_data),
-            linewidth=linewidth,
+    final_hdu = fits.ImageHDU(header=hdu['SCI'].header,
+                              data=precision.image(cell_cleaned - median_sky),
+                              name="SKYSUB.OPT")
+    del cell_cleaned, cell_mask, cell_saturated, crj
+    hdu.append(final_hdu)
+
+
+    #
+    # Add some more post-processing here:
+    # - source detection
+    # - optimal extraction of all detected sources
+    #
+
+    # compute a source list (includes source position, extent, and intensity)
+    extract1d = options.extract1d
+    still_good = True
+    if (extract1d or options.rectify):
+        prof, prof_var = find_sources.continuum_slit_profile(
+            data=hdu['SKYSUB.OPT'].data.copy(),
+            sky=hdu['SKYSUB.IMG'].data.copy(),
+            wl=wls_2d,
+            var=hdu['VAR'].data.copy(),
         )
+        if  (prof is None or prof_var is None):
+            logger.warning("Unable to extract 1-D spectra")
+            still_good = False
+        else:
+            debugartifacts.save_array("source_profile", prof,
+                                      stage="findsources")
+            src_profile_imghdu = find_sources.save_continuum_slit_profile(
+                prof=prof,
+                prof_var=prof_var)
+            hdu_appends.append(src_profile_imghdu)
 
-        #
-        # TODO: CONVERT SKYLINE POSITION FROM PIXELS TO WAVELENGTHS
-        #
+    if ((extract1d or options.rectify) and still_good):
+        sources = find_sources.identify_sources(prof, prof_var)
 
-        #
-        # Fit and include the wavelength distortion (based on sky-lines) in the wavelength calibration
-        #
-        if (options.model_wl_distortions):
-            print "\n"*10
-            print "symmetry:", reference_row
-            print "spec ref row:", skylines_ref_y
-            print "from model:", hdu[0].header['RSSYCNTR']
-            print "binning x/y: ", binx, biny
-            print "\n"*10
-            distortion_2d, dist_quality = model_distortions.map_wavelength_distortions(
-                skyline_list=skyline_list,
-                wl_2d=wls_2d,
-                img_2d=img_crjclean,
-                diff_2d=None,
-                badrows=bad_rows_img,
-                linewidth=linewidth,
-                xbin=binx, ybin=biny,
-                ref_row=skylines_ref_y,
-                symmetry_row=hdu[0].header['RSSYCNTR'], #reference_row*biny,
-                primary_header=hdu[0].header,
-                debug=options.debug,
-            )
-            fits.PrimaryHDU(data=distortion_2d).writeto(
-                "specred.wl.dist.fits", clobber=True)
-            if (distortion_2d is not None):
-                max_dist = 1.5
-                # TODO: CHANGE TO BE DEPENDENT ON SPECTRAL RESOLUTION ETC.
-                distortion_2d[distortion_2d > max_dist] = max_dist
-                distortion_2d[distortion_2d < -1*max_dist] = -1*max_dist
+        if (sources is None):
+            still_good = False
         else:
-            logger.info("Per user-request skipping WL distortion modeling")
-            distortion_2d = None
+            #
+            # Create a ds9-compatible region file to allow user-friendly
+            #  inspection of all detected source.
+            #
+            find_sources.write_source_region_file(
+                img_shape=hdu['SCI'].data.shape,
+                sources=sources,
+                outfile="OBJ_%s.sources.reg" % (fb[:-5]),
+            )
+
+            #
+            # Also prepare to save all source information as TableHDU in
+            #  the output file
+            #
+            source_tbhdu = find_sources.create_source_tbhdu(sources)
+            hdu_appends.append(source_tbhdu)
+
+    # if ((not extract1d) or
+    #     (extract1d and sources.shape[0]<= 0)):
+    #     logger.warning("No sources detected, skipping source extraction")
+    # else:
+    if (still_good and (extract1d or options.rectify) and
+        sources.shape[0]>0):
+        fullframe_background = zero_background.find_background_correction(
+            img_data=hdu['SKYSUB.OPT'].data.copy(),
+            sources=sources,
+            badrows=bad_rows,
+        )
+        if (fullframe_background is not None):
+            hdu['SKYSUB.OPT'].data -= fullframe_background
+            hdu.append(fits.ImageHDU(data=precision.image(fullframe_background),
+                                     name="SKY.RESIDUALS"))
+
+        # now pick the brightest of all sources
+        i_brightest = numpy.argmax(sources[:, 1])
+        print i_brightest
+        print sources[i_brightest]
+        brightest = sources[i_brightest]
+
+        # Now trace the line
+        logger.info("computing spectrum trace")
+        spec_data = hdu['SKYSUB.OPT'].data.copy()
+        center_x = spec_data.shape[1] / 2
+        spectrace_data = tracespec.compute_spectrum_trace(
+            data=spec_data,
+            start_x=center_x,
+            start_y=brightest[0],
+            xbin=5)
+
+        logger.info("finding trace slopes")
+        slopes, trace_offset = tracespec.compute_trace_slopes(
+            spectrace_data)
+        hdu_appends.append(tracespec.save_trace_offsets(trace_offset))
+
+        # print slopes
+        #hdu[0].header['TRACE0_0']
+        pass
+    else:
+        still_good = False
+
+    if (still_good and options.rectify):
+        logger.info("Starting to rectify the SCI and VAR planes")
+        rect_flux, rect_var = rectify_fullspec.rectify_full_spec(
+            data=hdu['SKYSUB.OPT'].data.copy(),
+            var=hdu['VAR'].data.copy(),
+            wavelength=wls_2d,
+            traceoffset=trace_offset,
+            n_threads=1 if options.jobs > 1 else None,
+        )
+        logger.debug("done rectifying")
+        rect_flux.data = precision.image(rect_flux.data)
+        rect_var.data = precision.image(rect_var.data)
+        logger.debug("appending SCI.RECT extension")
+        hdu.append(rect_flux)
+        logger.debug("appending VAR.RECT extension")
+        hdu.append(rect_var)
 
-        if (distortion_2d is not None):
-            wls_2d -= distortion_2d
-            hdu.append(fits.ImageHDU(data=distortion_2d, name='WAVELENGTH.DISTORTION'))
-            hdu.append(fits.ImageHDU(data=wls_2d, name='WAVELENGTH'))
-        else:
-            logger.warning("Skipping the wavelength distortion due to "
-                           "previous error")
 
-        hdu.writeto("dummy.fits", clobber=True)
-        #os._exit(0)
+    if (still_good and extract1d):
 
-        fits.PrimaryHDU(data=img_data).writeto("img0.fits", clobber=True)
+        for source_id, source in enumerate(sources):
 
-        apply_skyline_intensity_flat = False
-        if (apply_skyline_intensity_flat):
-            # 
-            # Extract the sky-line intensity profile along the slit. Use this to 
-            # correct the data. This should also improve the quality of the extracted
-            # 2-D sky.
-            #
-            plot_filename = "%s_slitprofile.png" % (fb)
-            skylines, skyline_list, intensity_profile = \
-                prep_science.extract_skyline_intensity_profile(
-                    hdulist=hdu,
-                    data=numpy.array(hdu['SCI.RAW'].data),
-                    wls=wls_fit,
-                    plot_filename=plot_filename,
-                )
-            # Flatten the science frame using the line profile
-            # hdu.append(
-            #     fits.ImageHDU(
-            #         data=numpy.array(hdu['SCI'].data),
-            #         header=hdu['SCI'].header,
-            #         name="SCI.PREFLAT"
-            #     )
-            # )
-            # hdu.append(
-            #     fits.ImageHDU(
-            #         data=numpy.array(hdu['SCI'].data / intensity_profile.reshape((-1, 1))),
-            #         header=hdu['SCI'].header,
-            #         name="SCI.POSTFLAT"
-            #     )
-            # )
+            logger.info("generating source profile in prep for optimal "
+                        "extraction - source %d" % (source_id + 1))
+            width = 2 * (source[3] - source[2])
+            source_profile_2d = optimal_extraction.generate_source_profile(
+                data=hdu['SKYSUB.OPT'].data,
+                variance=hdu['VAR'].data,
+                wavelength=wls_2d,
+                trace_offset=trace_offset,
+                position=[center_x, source[0]],
+                width=width,
+            )
+            #print "source profile 2d", source_profile_2d.shape, \
+            #    "\n", source_profile_2d
+
+            logger.info("computing optimal extraction weights")
+            supersample = 2
+            optimal_weight = optimal_extraction.integrate_source_profile(
+                width=width,
+                supersample=supersample,
+                profile2d=source_profile_2d,
+                wl_resolution=-5,
+            )
+            logger.info("done with weights, ready for extraction!")
 
             #
-            # Mask out all regions with relative intensities below 0.1x max 
+            # Extract the 1-d spectrum, applying weights, and
+            # re-drizzling all flux to a simple wavelength grid using
+            # twice the mean dispersion (in A/px) of the input data
             #
-            stats = scipy.stats.scoreatpercentile(intensity_profile, [50, 16, 84, 2.5, 97.5])
-            one_sigma = (stats[4] - stats[3]) / 4.
-            median = stats[0]
-            bad_region = intensity_profile < median - 2 * one_sigma
-            hdu['SCI'].data[bad_region] = numpy.NaN
-            intensity_profile[bad_region] = numpy.NaN
+            min_wl, max_wl = numpy.min(wls_2d), numpy.max(wls_2d)
+            mean_dispersion = (max_wl - min_wl) / wls_2d.shape[1]
+            output_dispersion = numpy.round(0.5*mean_dispersion, 2)
+            d_width = source[2:4] - source[0]
+            y_ranges = [d_width]
+            results = optimal_extraction.optimal_extract(
+                img_data=hdu['SKYSUB.OPT'].data,
+                wl_data=wls_2d,
+                variance_data=hdu['VAR'].data,
+                trace_offset=trace_offset,
+                optimal_weight=optimal_weight,
+                opt_weight_center_y=source[0],
+                reference_x=center_x,
+                reference_y=source[0],
+                y_ranges=y_ranges,
+                dwl=0.5*mean_dispersion,
+                debug_filebase=fb[:-5]+"__" if options.debug else None,
+            )
 
-            hdu['SCI'].data /= intensity_profile.reshape((-1, 1))
-            logger.info("Slit-flattened SCI extension")
+            #
+            # extract individual data from return data
+            #
+            spectra_1d = results['spectra']
+            variance_1d = results['variance']
+            wl0 = results['wl0']
+            dwl = results['dwl']
+            out_wl = results['wl_base']
 
-            y = img_data / intensity_profile.reshape((-1, 1))
-            fits.PrimaryHDU(data=(y / img_data)).writeto("img1.fits", clobber=True)
+            #
+            # Finally, merge wavelength data and flux and write output to file
+            #
+            output_format = ["ascii", "fits"]
+            # out_fn = "opt_extract"
+            if ("fits" in output_format or True):
+                # out_fn_fits = out_fn + ".fits"
+                # logger.info("Writing FITS output to %s" % (out_fn))
+                #
+                # extlist = [fits.PrimaryHDU()]
 
-            # img_data /= intensity_profile.reshape((-1,1))
-        else:
-            pass
+                spec1d_hdus = []
+                for i, part in enumerate(['BEST', 'WEIGHTED', 'SUM']):
+                    spec1d_hdus.append(
+                        fits.ImageHDU(data=spectra_1d[:, :, i].T,
+                                      name="SCI.%s.%d" % (part, source_id+1), )
+                    )
+                    spec1d_hdus.append(
+                        fits.ImageHDU(data=variance_1d[:, :, i].T,
+                                      name="VAR.%s.%d" % (part, source_id+1), )
+                    )
 
-        if (options.debug):
-            # print "FOUND NIGHT-SKY LINES:"
-            # numpy.savetxt(sys.stdout, skyline_list, "%9.3f")
-            numpy.savetxt("nightsky_lines", skyline_list)
+                # add headers for the wavelength solution
+                for ext in spec1d_hdus:  # ['SCI', 'VAR']:
+                    ext.header['WCSNAME'] = "calibrated wavelength"
+                    ext.header['CRPIX1'] = 1.
+                    ext.header['CRVAL1'] = wl0
+                    ext.header['CD1_1'] = dwl
+                    ext.header['CTYPE1'] = "AWAV"
+                    ext.header['CUNIT1'] = "Angstrom"
+                    for i, yr in enumerate(y_ranges):
+                        keyname = "YR_%03d" % (i + 1)
+                        value = "%04d:%04d" % (yr[0], yr[1])
+                        ext.header[keyname] = (
+                        value, "y-range for aperture %d" % (i + 1))
+                #hdulist.writeto(out_fn_fits, clobber=True)
+
+                hdu_appends.extend(spec1d_hdus)
+                #logger.info("done writing results (%s)" % (out_fn_fits))
+
+            if ("ascii" in output_format):
+                out_fn_ascii = "OBJ_%s.%d.dat" % (fb[:-5], source_id+1)
+                out_fn_asciivar = "OBJ_%s.%d.var" % (fb[:-5], source_id+1)
+                logger.info("Writing output as ASCII to %s / %s" % (out_fn_ascii,
+                                                                    out_fn_asciivar))
+
+                with open(out_fn_ascii, "w") as of:
+                    for aper, yr in enumerate(y_ranges):
+                        print >> of, "# APERTURE: ", yr
+                        numpy.savetxt(of, numpy.append(out_wl.reshape((-1, 1)),
+                                                       spectra_1d[:, aper, :],
+                                                       axis=1
+                                                       )
+                                      )
+                        print >> of, "\n" * 5
+
+                with open(out_fn_asciivar, "w") as of:
+                    for aper, yr in enumerate(y_ranges):
+                        print >> of, "# APERTURE: ", yr
+                        numpy.savetxt(of, numpy.append(out_wl.reshape((-1, 1)),
+                                                       variance_1d[:, aper, :],
+                                                       axis=1
+                                                       )
+                                      )
+                        print >> of, "\n" * 5
+                # numpy.savetxt(out_fn + ".var",
+                #               numpy.append(out_wl.reshape((-1, 1)),
+                #                            variance_1d, axis=1))
+                logger.info("done writing ASCII results")
+
+    hdu.extend(hdu_appends)
+    if (stagetiming.is_enabled()):
+        hdu.append(stagetiming.table_hdu(frame=fb))
 
-        skyline_tbhdu = prep_science.add_skylines_as_tbhdu(skyline_list)
-        skyline_tbhdu.header['LINEREFY'] = skylines_ref_y
-        hdu_appends.append(skyline_tbhdu)
+    #
+    # And finally write reduced frame back to disk
+    #
+    out_filename = "OBJ_%s" % (fb)
+    logger.info("Saving output to %s" % (out_filename))
+    pysalt.clobberfile(out_filename)
+    hdu.writeto(out_filename, clobber=True)
+    logger.info("Peak memory usage so far: %.1f MB (%s image planes)" % (
+        precision.peak_memory(), precision.mode))
 
-        #
-        # Map wavelength distortions
-        #
-        # try:
-        #     print skyline_list.shape
-        #     distortions, distortions_binned = map_distortions.map_distortions(
-        #         wl_2d=wls_2d,
-        #         diff_2d=None,
-        #         img_2d = img_raw,
-        #         y=610,
-        #         x_list=skyline_list[:,0],
-        #     )
-        # except:
-        #     pass
 
-        # logger.info("Adding xxx extension")
-        # hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
-        #                          data=img_data,
-        #                          name="XXX"))
 
-        #
-        # Compute a full-frame 2-D flat-field.
-        # With this flat-field we can extract a better sky spectrum, and later improve the sky-subtraction
-        #
-        logger.info("Computing 2-D flatfield from night sky intensity profile")
-        vph_flatfield, vph_flat_interpol = \
-            fiddle_slitflat2.create_2d_flatfield_from_sky(
-                wl=wls_2d,
-                img=img_data,
-                bad_rows=bad_rows
-        )
-        flattened_img = img_data / vph_flatfield
-        logger.info("Flattened image: %s" % (str(flattened_img.shape)))
 
 
 
-        # #
-        # # Now go ahead and extract the full 2-d sky
-        # #
-        # logger.info("Extracting 2-D sky")
-        # sky_regions = numpy.array([[0, hdu['SCI'].data.shape[0]]])
-        # sky2d = skysub2d.make_2d_skyspectrum(
-        #     hdu,
-        #     wls_2d,
-        #     sky_regions=sky_regions,
-        #     oversample_factor=1.0,
-        #     slitprofile=None, #slitprofile,
-        #     )
 
-        # logger.info("Performing sky subtraction")
-        # sky_hdu = fits.ImageHDU(data=sky2d, name='SKY')
-        # hdu.append(sky_hdu)
 
-        # if (not slitprofile == None):
-        #     sky_hdux = fits.ImageHDU(data=sky2d*slitprofile.reshape((-1,1)))
-        #     sky_hdux.name = "SKY_X"
-        #     hdu.append(sky_hdux)
 
-        # # Don't forget to subtract the sky off the image
-        # for source_ext in ['SCI', 'SCI.NOCRJ']:
-        #     hdu[source_ext].data -= sky2d #(sky2d * slitprofile.reshape((-1,1)))
+    # #
+    # # Trial: replace all 0 value pixels with NaNs
+    # #
+    # bpm = hdu[3].data
+    # hdu[1].data[bpm == 1] = numpy.NaN
 
-        # numpy.savetxt("OBJ_%s_slit.asc" % (fb[:-5]), slitprofile)
+    # # for ext in hdu[1:]:
+    # #     ext.data[ext.data <= 0] = numpy.NaN
 
-        #
-        # Compute the optimized sky, using better-chosen spline basepoints 
-        # to sample the sky-spectrum
-        #
-        sky_regions = numpy.array([[300, 500], [1400, 1700]])
-        logger.info("Preparing optimized sky-subtraction")
-        ia = None
 
-        # simple_spec = optimalskysub.optimal_sky_subtraction(hdu, 
-        #                                       sky_regions=sky_regions,
-        #                                       N_points=1000,
-        #                                       iterate=False,
-        #                                       skiplength=10, 
-        #                                       return_2d=False)
-        # numpy.savetxt("%s.simple_spec" % (_fb), simple_specs)
+    # spectrectify writes to disk, no need to do so here
+    # specrectify(mosaic_filename, outimages=out_filename, outpref='', 
+    #             solfile=dbfile, caltype='line', 
+    #             function='legendre',  order=3, inttype='interp', 
+    #             w1=None, w2=None, dw=None, nw=None,
+    #             blank=0.0, clobber=True, logfile=logfile, verbose=True)
 
-        # simple_spec = hdu['VAR'].data[hdu['VAR'].data.shape[0]/2,:]
-        # numpy.savetxt("%s.simple_spec_2" % (_fb), simple_spec)
+    # #
+    # # Now we have a full 2-d spectrum, but still with emission lines
+    # #
 
-        # logger.info("Searching for and analysing sky-lines")
-        # skyline_list = wlcal.find_list_of_lines(simple_spec, readnoise=1, avg_width=1)
-        # print skyline_list
+    # #
+    # # Next, find good regions with no source contamation
+    # #
+    # hdu_rect = pyfits.open(out_filename)
+    # hdu_rect.info()
 
-        # logger.info("Creating spatial flatfield from sky-line intensity profiles")
-        # i, ia, im = skyline_intensity.find_skyline_profiles(hdu, skyline_list)
+    # src_region = [1500,2400] # Jay
+    # src_region = [1850,2050] # Greg
 
+    # #intspec = get_integrated_spectrum(hdu_rect, out_filename)
+    # #slitprof, skymask = find_slit_profile(hdu_rect, out_filename) # Jay
+    # slitprof, skymask = find_slit_profile(hdu_rect, out_filename, src_region)  # Greg
+    # print skymask.shape[0]
 
-        if (apply_skyline_intensity_flat):
-            skyline_flat = intensity_profile.reshape((-1, 1))
-        else:
-            skyline_flat = None
-
-        # sky_2d, spline = optimalskysub.optimal_sky_subtraction(
-        #     hdu, 
-        #     sky_regions=sky_regions,
-        #     N_points=2000,
-        #     iterate=False,
-        #     skiplength=5,
-        #     skyline_flat=skyline_flat, #intensity_profile.reshape((-1,1)),
-        # )
+    # hdu_rect['SCI'].data /= slitprof
 
+    # rectflat_filename = "OBJ_flat_%s" % (fb)
+    # pysalt.clobberfile(rectflat_filename)
+    # hdu_rect.writeto(rectflat_filename, clobber=True)
 
+    # #
+    # # Block out the central region of the chip as object
+    # #
+    # skymask[src_region[0]/biny:src_region[1]/biny] = False
+    # sky_lines = bottleneck.nanmedian(
+    #     hdu_rect['SCI'].data[skymask].astype(numpy.float64),
+    #     axis=0)
+    # print sky_lines.shape
 
-        sky_2d, spline, extra = optimalskysub.optimal_sky_subtraction(
-            hdu,
-            sky_regions=None,  # sky_regions,
-            N_points=600,
-            iterate=False,
-            skiplength=5,
-            skyline_flat=skyline_flat,  # intensity_profile.reshape((-1,1)),
-            # select_region=numpy.array([[900,950]])
-            # select_region=numpy.array([[600, 640], [660, 700]]),
-            wlmode=options.wlmode,
-            debug_prefix="%s__" % (fb[:-5]),
-            image_data=flattened_img,
-            obj_wl=wls_2d,
-            debug=options.debug,
-            noise_mode=options.sky_noise_mode,
-        )
-        if (sky_2d is not None):
-            (x_eff, wl_map, medians, p_scale, p_skew, fm, good_sky_data) = extra
+    # #
+    # # Now subtract skylines
+    # #
+    # hdu_rect['SCI'].data -= sky_lines
+    # skysub_filename = "OBJ_skysub_%s" % (fb)
+    # pysalt.clobberfile(skysub_filename)
+    # hdu_rect.writeto(skysub_filename, clobber=True)
 
-            hdu.append(fits.ImageHDU(data=good_sky_data.astype(numpy.int),
-                                     name="GOOD_SKY_DATA"))
-        else:
-            logger.critical("Error while computing sky spectrum")
-            good_sky_data = None
+    return True
 
-        #
-        # Create a diagnostic plot showing the sky-spectrum and the
-        # sky-fit spline used for sky-subtraction
-        #
-        plot_high_res_sky_spec.plot_sky_spectrum(
-            wl=wls_2d,
-            flux=flattened_img,
-            good_sky_data=good_sky_data,
-            bad_rows=bad_rows,
-            output_filebase=output_basename+".skyspec",
-            sky_spline=spline,
-            ext_list=['png'],
-        )
 
-        #
-        # Save a high-res version of the sky-spectrum as 1-D fits for
-        # wavelength verification and other purposes
-        #
-        hdu.append(save_sky_spec(wl=wls_2d, sky_spline=spline))
-
-        # recompute sky-2d based on the full wavelength map and the spline interpolator
-        # sky_2d = spline(wls_2d)
-
-        # bs = 100
-        # maxbs = 10
-
-        # sky2d_full = numpy.zeros(img_data.shape)
-        # for nbs in range(maxbs):
-
-        #     sky_2d, spline, extra = optimalskysub.optimal_sky_subtraction(
-        #         hdu, 
-        #         sky_regions=None, #sky_regions,
-        #         N_points=2000,
-        #         iterate=False,
-        #         skiplength=5,
-        #         skyline_flat=skyline_flat, #intensity_profile.reshape((-1,1)),
-        #         #select_region=numpy.array([[900,950]])
-        #         select_region=numpy.array([[nbs*bs,(nbs+1)*bs]])
-        #     )
-        #     extra = 
-        #     if (sky_2d == None):
-        #         continue
-        #     sky2d_full[nbs*bs:(nbs+1)*bs, :] = sky_2d[nbs*bs:(nbs+1)*bs, :]
+def _reduce_object_frame_worker(args):
+    """
 
-        # sky_2d = sky2d_full
+    Pool worker: reduce one OBJECT frame in its own working directory, so
+    that the many fixed-name scratch files (dummy.fits, img0.fits, ...)
+    written by the individual steps do not collide between frames. All
+    OBJ_* output products are moved back to the product directory, and the
+    stage timing records are returned to the main process.
 
-        try:
-            if (skyline_flat is not None):
-                fits.PrimaryHDU(data=hdu['SCI.RAW'].data / skyline_flat).writeto("img_sky2d_input_skylineflat.fits",
-                                                                             clobber=True)
-            fits.PrimaryHDU(data=hdu['SCI.RAW'].data / fm.reshape((-1, 1))).writeto("img_sky2d_input_fm.fits", clobber=True)
+    """
 
-            fits.PrimaryHDU(data=sky_2d).writeto("img_sky2d.fits", clobber=True)
+    filename, options, flatfield_list, arc_mosaic_list, arcinfos, \
+        arc_table, prodir = args
 
-            fits.PrimaryHDU(data=(sky_2d*vph_flatfield)).writeto("img_sky2d_x_vphflat.fits", clobber=True)
+    _, fb = os.path.split(filename)
+    _fb, _ = os.path.splitext(fb)
+    logger = logging.getLogger("OBJ(%s)" % _fb)
 
-            fits.PrimaryHDU(data=(img_data - (sky_2d*vph_flatfield))).writeto("img_vphflat_skysub.fits", clobber=True)
-        except:
-            pass
-        #
-        # Add here:
-        #
-        # Step 1:
-        # iteratively check the noise in and around sky-lines. Weight noise with
-        # the amplitude of the sky-spectrum. Then compute local (in ~ten bands 
-        # across the image) scaling factor that minimizes residuals. Take care 
-        # to mask out sources first. Then compute smooth scaling actor that yields
-        # the best overall sky subtraction.
-        #
-        logger.info("Minimizing sky residuals")
-        # scaling_data, opt_sky_scaling = optscale.minimize_sky_residuals(
-        #     img_data, sky_2d, vert_size=5, smooth=20, debug_out=True)
-        # # opt_sky_scaling = fm.reshape((-1,1))
-        # numpy.savetxt(out_filename[:-5]+".skyscaling", opt_sky_scaling)
+    work_dir = os.path.join(prodir, "work__%s" % (_fb))
+    if (not os.path.isdir(work_dir)):
+        os.mkdir(work_dir)
+    logger.info("Reducing frame %s in working directory %s" % (fb, work_dir))
 
-        skyscaling2d = 1.
-        opt_sky_scaling = 1.
+    success = False
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        success = reduce_object_frame(
+            filename=filename,
+            options=options,
+            flatfield_list=flatfield_list,
+            arc_mosaic_list=arc_mosaic_list,
+            arcinfos=arcinfos,
+            caldir=prodir,
+            arc_table=arc_table,
+        )
+    except:
+        logger.critical("Error while reducing %s" % (fb))
+        pysalt.mp_logging.log_exception()
+    finally:
+        os.chdir(cwd)
+        debugartifacts.flush()
 
-        fits.PrimaryHDU(data=img_data).writeto("debug_minimizeskyresiduals_img.fits", clobber=True)
-        fits.PrimaryHDU(data=sky_2d).writeto("debug_minimizeskyresiduals_sky2d.fits", clobber=True)
-        fits.PrimaryHDU(data=wl_map).writeto("debug_minimizeskyresiduals_wlmap.fits", clobber=True)
+    # move all output products back to the product directory
+    for product in glob.glob(os.path.join(work_dir, "OBJ_*")):
+        _, product_fn = os.path.split(product)
+        target = os.path.join(prodir, product_fn)
+        pysalt.clobberfile(target)
+        shutil.move(product, target)
 
-        if (options.skyscaling == 'none'):
+    if (not options.debug and not debugartifacts.any_enabled()):
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-            skyscaling2d = numpy.ones(img_data.shape)
+    return filename, success, stagetiming.collect()
 
-            pass
 
-        elif (options.skyscaling == 's2d'):
+@stagetiming.timed()
+def reduce_object_frames_parallel(filelist, options, flatfield_list,
+                                  arc_mosaic_list, arcinfos, prodir,
+                                  arc_table=None):
+    """
 
-            full2d, data, pf2, data2, spline2d = optscale.minimize_sky_residuals2_spline(
-                img=img_data,
-                sky=sky_2d,
-                wl=wl_map,
-                bpm=hdu['BPM'].data,
-                vert_size=-25,
-                dl=-25)
-            numpy.savetxt("new_scaling.dump", data)
-            skyscaling2d = spline2d
+    Reduce all OBJECT frames in filelist using a pool of options.jobs worker
+    processes. Requires that all master flats and ARC solutions exist.
 
-            pass
-
-        elif (options.skyscaling == 'p2d'):
-            pass
-
-            ret = optscale.minimize_sky_residuals2(
-                img=img_data,
-                sky=sky_2d,
-                wl=wl_map,
-                bpm=hdu['BPM'].data,
-                vert_size=-25,
-                dl=-25)
-            if (ret is not None):
-                full2d, data, pf2, data2 = ret
-                numpy.savetxt("new_scaling.dump", data)
-            else:
-                logger.error("Unable to optimize sky subtraction, continuing without optimization")
-                full2d = numpy.ones(img_data.shape)
-                data = None
-                pf2 = None
-                data2 = None
+    """
 
-            opt_sky_scaling = full2d
-            skyscaling2d = full2d
+    logger = logging.getLogger("SPECRED")
 
+    prodir = os.path.abspath(prodir)
+
+    # workers run in their own directories, so make all paths absolute
+    arc_mosaic_list = [os.path.abspath(fn) if fn is not None else None
+                       for fn in arc_mosaic_list]
+    _arcinfos = {}
+    for arcfile in arcinfos:
+        _arcinfos[os.path.abspath(arcfile)] = arcinfos[arcfile]
+    if (arc_table is not None):
+        arc_table = arc_table.map(os.path.abspath)
+
+    jobs = [(os.path.abspath(fn), options, flatfield_list, arc_mosaic_list,
+             _arcinfos, arc_table, prodir) for fn in filelist]
+
+    n_processes = min(options.jobs, len(jobs))
+    logger.info("Reducing %d OBJECT frames using %d parallel processes" % (
+        len(jobs), n_processes))
+
+    pool = multiprocessing.Pool(processes=n_processes, maxtasksperchild=1)
+    n_failed = 0
+    for filename, success, timing in pool.imap_unordered(
+            _reduce_object_frame_worker, jobs):
+        stagetiming.add(timing)
+        if (success):
+            logger.info("Finished reducing %s" % (filename))
         else:
+            logger.error("Reducing %s failed" % (filename))
+            n_failed += 1
+    pool.close()
+    pool.join()
 
-            skyscaling2d = vph_flatfield
-
-        # data, filtered, full2d = optscale.minimize_sky_residuals2(
-        #     img=img_data, 
-        #     sky=sky_2d, 
-        #     wl=wl_map, 
-        #     bpm=hdu['BPM'].data,
-        #     vert_size=-25, 
-        #     dl=-25)
-        # numpy.savetxt("new_scaling.dump", data)
-
-        #
-        # step 2: 
-        # Also consider small-scale gaussian smoothing to more closely match the
-        # sky-line profile along the slit.
-        #
-        pass
+    logger.info("Done with all %d OBJECT frames (%d failed)" % (
+        len(jobs), n_failed))
 
-        # skysub = obj_data - sky2d
-        # ss_hdu = fits.ImageHDU(header=obj_hdulist['SCI.RAW'].header,
-        #                          data=skysub)
-        # ss_hdu.name = "SKYSUB.OPT"
-        # obj_hdulist.append(ss_hdu)
-
-        ss_hdu2 = fits.ImageHDU(header=hdu['SCI'].header,
-                                data=(sky_2d * skyscaling2d),
-                                name="SKYSUB.IMG")
-        # ss_hdu2 = fits.ImageHDU(header=hdu['SCI'].header,
-        #                          data=(sky_2d * opt_sky_scaling))
-        #ss_hdu2.name = "SKYSUB.IMG"
-        hdu.append(ss_hdu2)
-
-        ss_hdu2 = fits.ImageHDU(header=hdu['SCI'].header,
-                                data=(sky_2d),
-                                name="SKY.RAW")
-        hdu.append(ss_hdu2)
-
-        # hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
-        #                          data=wl_map,
-        #                          name="WL_XXX")
-        #            )
-        hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
-                                 data=skyscaling2d,
-                                 name="SKY.SCALE")
-                   )
-
-        skysub_img = (img_data) - (sky_2d * skyscaling2d)  # opt_sky_scaling)
-        # skysub_hdu = fits.ImageHDU(header=hdu['SCI'].header,
-        #                            data=numpy.array(skysub_img),
-        #                            name="SKYSUB.OPT")
-        # hdu.append(skysub_hdu)
+    return
 
-        #
-        # Run cosmic ray rejection on the sky-line subtracted frame
-        # Loop over all SCI extensions
-        #
-        # median_sky = numpy.median(sky_2d * opt_sky_scaling)
-        median_sky = bottleneck.nanmedian(sky_2d * opt_sky_scaling)
-        sigclip = 5.0
-        sigfrac = 0.6
-        objlim = 5.0
-        saturation_limit = 65000
-        try:
-            gain = 1.5 if (not 'GAIN' in hdu['SCI'].header) else hdu['SCI'].header['GAIN']
-            readnoise = 3 if (not 'RDNOISE' in hdu['SCI'].header) else hdu['SCI'].header['RDNOISE']
-        except:
-            gain, readnoise = 1.3, 5
 
-        crj = podi_cython.lacosmics(
-            numpy.array(skysub_img + median_sky),  # .astype(numpy.float64),
-            gain=gain,
-            readnoise=readnoise,
-            niter=3,
-            sigclip=sigclip, sigfrac=sigfrac, objlim=objlim,
-            saturation_limit=saturation_limit,
-            verbose=False
-        )
-        cell_cleaned, cell_mask, cell_saturated = crj
+def write_timing_rollup(obsdate):
+    """
 
-        hdu.append(fits.ImageHDU(header=hdu['SCI'].header,
-                                 data=skysub_img + median_sky - cell_cleaned,
-                                 name="COSMICS"))
+    Write the time and memory used by all stages (of the main process and all
+    workers) during this night to timing_<obsdate>.json.
 
-        final_hdu = fits.ImageHDU(header=hdu['SCI'].header,
-                                  data=(cell_cleaned - median_sky),
-                                  name="SKYSUB.OPT")
-        hdu.append(final_hdu)
+    """
+    if (not stagetiming.is_enabled()):
+        return
+    logger = logging.getLogger("SPECRED")
+    rollup_filename = "timing_%s.json" % (obsdate)
+    logger.info("Writing stage timing summary to %s" % (rollup_filename))
+    stagetiming.write_rollup(rollup_filename)
 
 
-        #
-        # Add some more post-processing here:
-        # - source detection
-        # - optimal extraction of all detected sources
-        #
+#################################################################################
+#################################################################################
+#################################################################################
 
-        # compute a source list (includes source position, extent, and intensity)
-        extract1d = options.extract1d
-        still_good = True
-        if (extract1d or options.rectify):
-            prof, prof_var = find_sources.continuum_slit_profile(
-                data=hdu['SKYSUB.OPT'].data.copy(),
-                sky=hdu['SKYSUB.IMG'].data.copy(),
-                wl=wls_2d,
-                var=hdu['VAR'].data.copy(),
-            )
-            if  (prof is None or prof_var is None):
-                logger.warning("Unable to extract 1-D spectra")
-                still_good = False
-            else:
-                numpy.savetxt("source_profile", prof)
-                src_profile_imghdu = find_sources.save_continuum_slit_profile(
-                    prof=prof,
-                    prof_var=prof_var)
-                hdu_appends.append(src_profile_imghdu)
+def specred(rawdir, prodir, options,
+            imreduce=True, specreduce=True,
+            calfile=None, lamp='Ar',
+            automethod='Matchlines', skysection=[800, 1000],
+            cleanup=True):
+    #print rawdir
+    #print prodir
 
-        if ((extract1d or options.rectify) and still_good):
-            sources = find_sources.identify_sources(prof, prof_var)
+    logger = logging.getLogger("SPECRED")
 
-            if (sources is None):
-                still_good = False
-            else:
-                #
-                # Create a ds9-compatible region file to allow user-friendly
-                #  inspection of all detected source.
-                #
-                find_sources.write_source_region_file(
-                    img_shape=hdu['SCI'].data.shape,
-                    sources=sources,
-                    outfile="OBJ_%s.sources.reg" % (fb[:-5]),
-                )
+    # get the name of the files
+    # if (type(infile) == list):
+    #     infile_list = infile
+    # elif (type(infile) == str and os.path.isdir(infile)):
+    infile_list = glob.glob(os.path.join(rawdir, "*.fits"))
 
-                #
-                # Also prepare to save all source information as TableHDU in
-                #  the output file
-                #
-                source_tbhdu = find_sources.create_source_tbhdu(sources)
-                hdu_appends.append(source_tbhdu)
+    # get the current date for the files
+    obsdate = os.path.basename(infile_list[0])[1:9]
+    #print obsdate
 
-        # if ((not extract1d) or
-        #     (extract1d and sources.shape[0]<= 0)):
-        #     logger.warning("No sources detected, skipping source extraction")
-        # else:
-        if (still_good and (extract1d or options.rectify) and
-            sources.shape[0]>0):
-            fullframe_background = zero_background.find_background_correction(
-                img_data=hdu['SKYSUB.OPT'].data.copy(),
-                sources=sources,
-                badrows=bad_rows,
-            )
-            if (fullframe_background is not None):
-                hdu['SKYSUB.OPT'].data -= fullframe_background
-                hdu.append(fits.ImageHDU(data=fullframe_background,
-                                         name="SKY.RESIDUALS"))
-
-            # now pick the brightest of all sources
-            i_brightest = numpy.argmax(sources[:, 1])
-            print i_brightest
-            print sources[i_brightest]
-            brightest = sources[i_brightest]
-
-            # Now trace the line
-            logger.info("computing spectrum trace")
-            spec_data = hdu['SKYSUB.OPT'].data.copy()
-            center_x = spec_data.shape[1] / 2
-            spectrace_data = tracespec.compute_spectrum_trace(
-                data=spec_data,
-                start_x=center_x,
-                start_y=brightest[0],
-                xbin=5)
-
-            logger.info("finding trace slopes")
-            slopes, trace_offset = tracespec.compute_trace_slopes(
-                spectrace_data)
-            hdu_appends.append(tracespec.save_trace_offsets(trace_offset))
-
-            # print slopes
-            #hdu[0].header['TRACE0_0']
-            pass
-        else:
-            still_good = False
+    # set up some files that will be needed
+    logfile = 'spec' + obsdate + '.log'
+    flatimage = 'FLAT%s.fits' % (obsdate)
+    dbfile = 'spec%s.db' % obsdate
 
-        if (still_good and options.rectify):
-            logger.info("Starting to rectify the SCI and VAR planes")
-            rect_flux, rect_var = rectify_fullspec.rectify_full_spec(
-                data=hdu['SKYSUB.OPT'].data.copy(),
-                var=hdu['VAR'].data.copy(),
-                wavelength=wls_2d,
-                traceoffset=trace_offset,
-            )
-            logger.debug("done rectifying")
-            logger.debug("appending SCI.RECT extension")
-            hdu.append(rect_flux)
-            logger.debug("appending VAR.RECT extension")
-            hdu.append(rect_var)
-
-
-        if (still_good and extract1d):
-
-            for source_id, source in enumerate(sources):
-
-                logger.info("generating source profile in prep for optimal "
-                            "extraction - source %d" % (source_id + 1))
-                width = 2 * (source[3] - source[2])
-                source_profile_2d = optimal_extraction.generate_source_profile(
-                    data=hdu['SKYSUB.OPT'].data,
-                    variance=hdu['VAR'].data,
-                    wavelength=wls_2d,
-                    trace_offset=trace_offset,
-                    position=[center_x, source[0]],
-                    width=width,
-                )
-                #print "source profile 2d", source_profile_2d.shape, \
-                #    "\n", source_profile_2d
-
-                logger.info("computing optimal extraction weights")
-                supersample = 2
-                optimal_weight = optimal_extraction.integrate_source_profile(
-                    width=width,
-                    supersample=supersample,
-                    profile2d=source_profile_2d,
-                    wl_resolution=-5,
-                )
-                logger.info("done with weights, ready for extraction!")
+    # create the observation log
+    # obs_dict=obslog(infile_list)
 
-                #
-                # Extract the 1-d spectrum, applying weights, and
-                # re-drizzling all flux to a simple wavelength grid using
-                # twice the mean dispersion (in A/px) of the input data
-                #
-                min_wl, max_wl = numpy.min(wls_2d), numpy.max(wls_2d)
-                mean_dispersion = (max_wl - min_wl) / wls_2d.shape[1]
-                output_dispersion = numpy.round(0.5*mean_dispersion, 2)
-                d_width = source[2:4] - source[0]
-                y_ranges = [d_width]
-                results = optimal_extraction.optimal_extract(
-                    img_data=hdu['SKYSUB.OPT'].data,
-                    wl_data=wls_2d,
-                    variance_data=hdu['VAR'].data,
-                    trace_offset=trace_offset,
-                    optimal_weight=optimal_weight,
-                    opt_weight_center_y=source[0],
-                    reference_x=center_x,
-                    reference_y=source[0],
-                    y_ranges=y_ranges,
-                    dwl=0.5*mean_dispersion,
-                    debug_filebase=fb[:-5]+"__" if options.debug else None,
-                )
+    # import pysalt.lib.saltsafeio as saltio
 
-                #
-                # extract individual data from return data
-                #
-                spectra_1d = results['spectra']
-                variance_1d = results['variance']
-                wl0 = results['wl0']
-                dwl = results['dwl']
-                out_wl = results['wl_base']
+    #print infile_list
 
-                #
-                # Finally, merge wavelength data and flux and write output to file
-                #
-                output_format = ["ascii", "fits"]
-                # out_fn = "opt_extract"
-                if ("fits" in output_format or True):
-                    # out_fn_fits = out_fn + ".fits"
-                    # logger.info("Writing FITS output to %s" % (out_fn))
-                    #
-                    # extlist = [fits.PrimaryHDU()]
-
-                    spec1d_hdus = []
-                    for i, part in enumerate(['BEST', 'WEIGHTED', 'SUM']):
-                        spec1d_hdus.append(
-                            fits.ImageHDU(data=spectra_1d[:, :, i].T,
-                                          name="SCI.%s.%d" % (part, source_id+1), )
-                        )
-                        spec1d_hdus.append(
-                            fits.ImageHDU(data=variance_1d[:, :, i].T,
-                                          name="VAR.%s.%d" % (part, source_id+1), )
-                        )
+    #
+    #
+    # Now reduce all files, one by one
+    #
+    #
+    # work_dir = "working/"
+    # if (not os.path.isdir(work_dir)):
+    #     os.mkdir(work_dir)
 
-                    # add headers for the wavelength solution
-                    for ext in spec1d_hdus:  # ['SCI', 'VAR']:
-                        ext.header['WCSNAME'] = "calibrated wavelength"
-                        ext.header['CRPIX1'] = 1.
-                        ext.header['CRVAL1'] = wl0
-                        ext.header['CD1_1'] = dwl
-                        ext.header['CTYPE1'] = "AWAV"
-                        ext.header['CUNIT1'] = "Angstrom"
-                        for i, yr in enumerate(y_ranges):
-                            keyname = "YR_%03d" % (i + 1)
-                            value = "%04d:%04d" % (yr[0], yr[1])
-                            ext.header[keyname] = (
-                            value, "y-range for aperture %d" % (i + 1))
-                    #hdulist.writeto(out_fn_fits, clobber=True)
-
-                    hdu_appends.extend(spec1d_hdus)
-                    #logger.info("done writing results (%s)" % (out_fn_fits))
-
-                if ("ascii" in output_format):
-                    out_fn_ascii = "OBJ_%s.%d.dat" % (fb[:-5], source_id+1)
-                    out_fn_asciivar = "OBJ_%s.%d.var" % (fb[:-5], source_id+1)
-                    logger.info("Writing output as ASCII to %s / %s" % (out_fn_ascii,
-                                                                        out_fn_asciivar))
-
-                    with open(out_fn_ascii, "w") as of:
-                        for aper, yr in enumerate(y_ranges):
-                            print >> of, "# APERTURE: ", yr
-                            numpy.savetxt(of, numpy.append(out_wl.reshape((-1, 1)),
-                                                           spectra_1d[:, aper, :],
-                                                           axis=1
-                                                           )
-                                          )
-                            print >> of, "\n" * 5
-
-                    with open(out_fn_asciivar, "w") as of:
-                        for aper, yr in enumerate(y_ranges):
-                            print >> of, "# APERTURE: ", yr
-                            numpy.savetxt(of, numpy.append(out_wl.reshape((-1, 1)),
-                                                           variance_1d[:, aper, :],
-                                                           axis=1
-                                                           )
-                                          )
-                            print >> of, "\n" * 5
-                    # numpy.savetxt(out_fn + ".var",
-                    #               numpy.append(out_wl.reshape((-1, 1)),
-                    #                            variance_1d, axis=1))
-                    logger.info("done writing ASCII results")
-
-        hdu.extend(hdu_appends)
+    # #
+    # # Make sure we have all directories 
+    # #
+    # for rs in reduction_steps:
+    #     dirname = "%s/%s" % (work_dir, rs)
+    #     if (not os.path.isdir(dirname)):
+    #         os.mkdir(dirname)
 
-        #
-        # And finally write reduced frame back to disk
-        #
-        out_filename = "OBJ_%s" % (fb)
-        logger.info("Saving output to %s" % (out_filename))
-        pysalt.clobberfile(out_filename)
-        hdu.writeto(out_filename, clobber=True)
+    #
+    # Go through the list of files, find out what type of file they are
+    #
+    logger.info("Identifying frames and sorting by type (object/flat/arc)")
+    with stagetiming.stage("classify_frames"):
+        index = headerindex.build_index(
+            infile_list, catalog=options.header_index)
+        obslog = index.classify(infile_list)
 
+    for obstype in obslog:
+        if (len(obslog[obstype]) > 0):
+            logger.info("Found the following %ss:\n -- %s" % (
+                obstype, "\n -- ".join(obslog[obstype])))
+        else:
+            logger.info("No files of type %s found!" % (obstype))
 
+    if (options.check_only):
+        return
 
+    #
+    # Go through the list of files, find all flat-fields, and create a master flat field
+    #
+    logger.info("Creating a master flat-field frame")
+    flatfield_list = {}
 
+    for idx, filename in enumerate(obslog['FLAT']):
+        header = index.header(filename)
+        obstype = header.get('OBSTYPE', None)
+        if (obstype is None or (obstype.strip() == "" and 'CCDTYPE' in header)):
+            obstype = header['CCDTYPE']
+        if (obstype.find("FLAT") >= 0 and
+            header['INSTRUME'] == "RSS" and
+            options.use_flats):
+            #
+            # This is a flat-field
+            #
 
+            #
+            # Get some parameters so we can create flatfields for each specific
+            # instrument configuration
+            #
+            grating = header['GRATING']
+            grating_angle = header['GR-ANGLE']
+            grating_tilt = header['GRTILT']
+            binning = "x".join(header['CCDSUM'].split())
 
+            if (not grating in flatfield_list):
+                flatfield_list[grating] = {}
+            if (not binning in flatfield_list[grating]):
+                flatfield_list[grating][binning] = {}
+            if (not grating_tilt in flatfield_list[grating][binning]):
+                flatfield_list[grating][binning][grating_tilt] = {}
+            if (not grating_angle in flatfield_list[grating][binning][grating_tilt]):
+                flatfield_list[grating][binning][grating_tilt][grating_angle] = []
 
+            flatfield_list[grating][binning][grating_tilt][grating_angle].append(filename)
 
+    for grating in flatfield_list:
+        for binning in flatfield_list[grating]:
+            for grating_tilt in flatfield_list[grating][binning]:
+                for grating_angle in flatfield_list[grating][binning][grating_tilt]:
 
-        # #
-        # # Trial: replace all 0 value pixels with NaNs
-        # #
-        # bpm = hdu[3].data
-        # hdu[1].data[bpm == 1] = numpy.NaN
+                    filelist = flatfield_list[grating][binning][grating_tilt][grating_angle]
+                    if (len(filelist) <= 0):
+                        continue
 
-        # # for ext in hdu[1:]:
-        # #     ext.data[ext.data <= 0] = numpy.NaN
+                    logger.info("Creating master flatfield for %s (%.3f/%.3f), %s (%d frames)" % (
+                        grating, grating_angle, grating_tilt, binning, len(filelist)))
 
+                    masterflat_filename = "flat__%s_%s_%.3f_%.3f.fits" % (
+                        grating, binning, grating_tilt, grating_angle)
+                    create_master_flat(
+                        filelist=filelist,
+                        masterflat_filename=masterflat_filename,
+                        options=options,
+                        cachedir=options.flat_cache,
+                        index=index,
+                    )
 
-        # spectrectify writes to disk, no need to do so here
-        # specrectify(mosaic_filename, outimages=out_filename, outpref='', 
-        #             solfile=dbfile, caltype='line', 
-        #             function='legendre',  order=3, inttype='interp', 
-        #             w1=None, w2=None, dw=None, nw=None,
-        #             blank=0.0, clobber=True, logfile=logfile, verbose=True)
+                    # # hdu = salt_prepdata(filename, badpixelimage=None, create_variance=False,
+                    # #                     verbose=False)
+                    # # flatfield_hdus.append(hdu)
 
-        # #
-        # # Now we have a full 2-d spectrum, but still with emission lines
-        # #
+    #############################################################################
+    #
+    # Determine a wavelength solution from ARC frames, where available
+    #
+    #############################################################################
 
-        # #
-        # # Next, find good regions with no source contamation
-        # #
-        # hdu_rect = pyfits.open(out_filename)
-        # hdu_rect.info()
+    logger.info("Searching for a wavelength calibration from the ARC files")
+    skip_wavelength_cal_search = False  # os.path.isfile(dbfile)
 
-        # src_region = [1500,2400] # Jay
-        # src_region = [1850,2050] # Greg
+    arc_mosaic_list = [None] * len(obslog['ARC'])
+    if (not skip_wavelength_cal_search):
+        arc_mosaic_list = reduce_arc_frames(
+            filelist=obslog['ARC'],
+            options=options,
+            prodir=prodir,
+            cachedir=options.arc_cache,
+            index=index,
+        )
 
-        # #intspec = get_integrated_spectrum(hdu_rect, out_filename)
-        # #slitprof, skymask = find_slit_profile(hdu_rect, out_filename) # Jay
-        # slitprof, skymask = find_slit_profile(hdu_rect, out_filename, src_region)  # Greg
-        # print skymask.shape[0]
+    if (options.arc_only):
+        logger.info("Only ARCs were requested, all done!")
+        write_timing_rollup(obsdate)
+        return
+    if (arc_mosaic_list is None or len(arc_mosaic_list) <= 0):
+        logger.error("NO VALID ARCs FOUND, aborting.")
+        return
 
-        # hdu_rect['SCI'].data /= slitprof
+    # return
+    # os._exit(0)
 
-        # rectflat_filename = "OBJ_flat_%s" % (fb)
-        # pysalt.clobberfile(rectflat_filename)
-        # hdu_rect.writeto(rectflat_filename, clobber=True)
+    # with open("flatlist", "w") as picklefile:
+    #    pickle.dump(flatfield_list, picklefile)
+    # print "\nPICKLE done"*10
 
-        # #
-        # # Block out the central region of the chip as object
-        # #
-        # skymask[src_region[0]/biny:src_region[1]/biny] = False
-        # sky_lines = bottleneck.nanmedian(
-        #     hdu_rect['SCI'].data[skymask].astype(numpy.float64),
-        #     axis=0)
-        # print sky_lines.shape
+    #############################################################################
+    #
+    # Now apply wavelength solution found above to your data frames
+    #
+    #############################################################################
+    logger.info("\n\n\nProcessing OBJECT frames")
+    arcinfos = {}
 
-        # #
-        # # Now subtract skylines
-        # #
-        # hdu_rect['SCI'].data -= sky_lines
-        # skysub_filename = "OBJ_skysub_%s" % (fb)
-        # pysalt.clobberfile(skysub_filename)
-        # hdu_rect.writeto(skysub_filename, clobber=True)
+    # ARC mosaics share the primary header of their raw frame
+    arc_table = headerindex.SetupTable()
+    for filename, arc_mosaic in zip(obslog['ARC'], arc_mosaic_list):
+        if (arc_mosaic is not None):
+            arc_table.add(index.header(filename), arc_mosaic,
+                          setup=index.setup(filename))
+
+    if (options.jobs <= 1 or len(obslog['OBJECT']) <= 1):
+        for idx, filename in enumerate(obslog['OBJECT']):
+            reduce_object_frame(
+                filename=filename,
+                options=options,
+                flatfield_list=flatfield_list,
+                arc_mosaic_list=arc_mosaic_list,
+                arcinfos=arcinfos,
+                arc_table=arc_table,
+            )
+    else:
+        reduce_object_frames_parallel(
+            filelist=obslog['OBJECT'],
+            options=options,
+            flatfield_list=flatfield_list,
+            arc_mosaic_list=arc_mosaic_list,
+            arcinfos=arcinfos,
+            prodir=prodir,
+            arc_table=arc_table,
+        )
 
+    write_timing_rollup(obsdate)
     return
 
     verbose = False
@@ -2456,14 +2865,41 @@ if __name__ == '__main__':
     parser.add_option("-s", "--scale", dest="skyscaling",
                       help="How to scale the sky spectrum (none,s2d,p2d)",
                       default="xxx")
+    parser.add_option("", "--scaleblocks", dest="sky_scaling_blocks",
+                      help="number of wavelength and spatial blocks for "
+                           "s2d/p2d sky scaling (default: 100,50)",
+                      default="100,50")
+    parser.add_option("", "--scaleclip", dest="sky_scaling_clip",
+                      help="outlier rejection iterations for s2d/p2d sky "
+                           "scaling",
+                      default=3, type=int)
     parser.add_option("-d", "--debug", dest="debug",
                        action="store_true", default=False)
+    parser.add_option("", "--debugfiles", dest="debug_artifacts",
+                      help="write debug files for these stages/files "
+                           "(comma-separated, or 'all')",
+                      default=None)
     parser.add_option("", "--reusearcs", dest="reusearcs",
                       action="store_true", default=False)
     parser.add_option("", "--nowldist", dest="model_wl_distortions",
                       action="store_false", default=True)
     parser.add_option("", "--noisemode", dest='sky_noise_mode',
                       default="local1")
+    parser.add_option("", "--skyspline", dest='sky_spline_engine',
+                      help="spline engine for sky-fitting (fitpack/banded)",
+                      default="fitpack")
+    parser.add_option("", "--skyiterations", dest='sky_iteration_mode',
+                      help="sky-spline iterations (full/incremental; "
+                           "incremental requires --skyspline banded)",
+                      choices=['full', 'incremental'],
+                      default="full")
+    parser.add_option("", "--skyweights", dest='sky_weights',
+                      help="weight sky pixels (none/variance)",
+                      default=None)
+    parser.add_option("", "--precision", dest='precision',
+                      help="storage precision of image planes "
+                           "(float64/float32)",
+                      default="float64")
     parser.add_option("", "--noextract", dest='extract1d',
                       action='store_false', default=True)
     parser.add_option("", "--noflats", dest='use_flats',
@@ -2476,8 +2912,42 @@ if __name__ == '__main__':
                       action="store_true", default=False)
     parser.add_option("", "--check", dest="check_only",
                       action="store_true", default=False)
+    parser.add_option("", "--arccache", dest="arc_cache",
+                      help="directory with cached ARC wavelength solutions, "
+                           "can be shared between nights (default: no cache)",
+                      default=None)
+    parser.add_option("", "--flatcache", dest="flat_cache",
+                      help="directory with cached master flat-fields, "
+                           "can be shared between nights (default: no cache)",
+                      default=None)
+    parser.add_option("", "--flatcombine", dest="flat_combine",
+                      help="sigma-clipped combination of flats (mean/median)",
+                      choices=sorted(masterflat.combine_methods.keys()),
+                      default="mean")
+    parser.add_option("", "--headerindex", dest="header_index",
+                      help="catalog of the raw frame headers, re-used as "
+                           "long as the raw frames do not change "
+                           "(default: no catalog)",
+                      default=None)
+    parser.add_option("", "--timing", dest="timing",
+                      help="record time and memory used by each stage "
+                           "(TIMING table in OBJ files, timing_<date>.json)",
+                      action="store_true", default=False)
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      help="number of OBJECT frames to reduce in parallel",
+                      type="int", default=1)
 
     (options, cmdline_args) = parser.parse_args()
+    if (options.sky_iteration_mode == 'incremental' and
+            options.sky_spline_engine != 'banded'):
+        parser.error("--skyiterations incremental requires --skyspline banded")
+
+    debugartifacts.enable(options.debug_artifacts)
+    precision.set_mode(options.precision)
+    if (options.timing):
+        stagetiming.enable()
+    if (options.debug):
+        debugartifacts.enable('all')
 
     # print options
     # print cmdline_args
@@ -1,21 +1,24 @@
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Build import cythonize
-from Cython.Distutils import build_ext
 
 import numpy
 
+# podi_cython.c is not kept in the repository; cythonize generates it from
+# podi_cython.pyx (and regenerates it whenever the .pyx changes), so the
+# extension is never built from a stale C file
 setup(
-    cmdclass = {'build_ext': build_ext},
-    ext_modules = [
+    ext_modules = cythonize([
         Extension("podi_cython", 
                   sources=['cython_src/podi_cython.pyx', 
                            "cython_src/sigma_clip_mean.c",
                            "cython_src/sigma_clip_median.c",
                            "cython_src/lacosmics.c",
+                           "cython_src/drizzle.c",
+                           "cython_src/tracearcs.c",
                        ],
                   include_dirs=["cython_src", numpy.get_include()],
                   libraries=['gsl', 'gslcblas',  "m"]
                   )
-    ]
+    ])
 )
@@ -7,6 +7,8 @@ import logging
 
 from wlcal import lineinfo_colidx
 import traceline
+import stagetiming
+import debugartifacts
 import scipy, scipy.stats
 
 
@@ -33,6 +35,7 @@ def compute_local_median_std(tracedata, intensity, window=5):
     return med_std
 
 
+@stagetiming.timed()
 def find_skyline_profiles(hdulist, skyline_list, data=None, 
                           write_debug_data=False, 
                           tracewidth=10,
@@ -145,7 +148,8 @@ def find_skyline_profiles(hdulist, skyline_list, data=None,
         combined[:,tracedata.shape[1]+2] = bottleneck.nanmax(linedata, axis=1)
         combined[:,-2:] = medstd[:]
         
-        numpy.savetxt("sky_trace_comb.%d" % (idx+1), combined)    
+        debugartifacts.save_array("sky_trace_comb.%d" % (idx+1), combined,
+                                  stage="skylineflat")
 
         #
         # Now reject all intensities that exceed the local variance by 
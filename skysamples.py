@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+
+Compact store of all sky samples (i.e. all pixels) of a frame, used for
+fitting the sky spectrum.
+
+All samples are kept in wavelength order, with wavelength, flux, variance
+and spatial position as separate contiguous columns. The sort permutation
+(and its inverse) is stored, so results can be mapped back to the detector
+layout at any time without re-sorting.
+
+Each sample has a set of flags, one bit for each reason to exclude it from
+the sky fit; a sample is good only if none of its flags are set.
+
+Columns are allocated with NaN padding on both ends, so that splitting a
+column into blocks of blocksize consecutive samples (as done for the noise
+estimate) is a zero-copy view.
+
+"""
+
+import numpy
+
+
+# flags, one bit each
+INVALID = 1     # not finite or marked in the bad pixel mask
+MASKED = 2      # excluded region, e.g. rows contaminated by sources
+NOISY = 4       # rejected from the binned noise estimate
+OUTLIER = 8     # rejected as outlier from the sky fit
+
+
+class SkySamples(object):
+
+    def __init__(self, wl, flux, var, spatial, blocksize=250):
+
+        self.shape = wl.shape
+        self.size = wl.size
+        self.blocksize = blocksize
+
+        # sorted position -> detector position, and the inverse
+        self.order = numpy.argsort(wl, axis=None)
+        self.inverse = numpy.empty_like(self.order)
+        self.inverse[self.order] = numpy.arange(self.size)
+
+        n_blocks = int(numpy.ceil(self.size / float(blocksize)))
+        n_to_add = n_blocks * blocksize - self.size
+        self.pad_front = n_to_add // 2
+        self.pad_back = n_to_add - self.pad_front
+
+        self.wl = self._column(wl)
+        self.flux = self._column(flux)
+        self.var = self._column(var)
+        self.spatial = self._column(spatial)
+
+        self.flags = numpy.zeros((self.size), dtype=numpy.uint8)
+
+    def _column(self, data):
+        buffer = numpy.empty((self.size + self.pad_front + self.pad_back))
+        buffer[:self.pad_front] = numpy.NaN
+        buffer[self.pad_front+self.size:] = numpy.NaN
+        column = buffer[self.pad_front:self.pad_front+self.size]
+        column[:] = numpy.ravel(data)[self.order]
+        return column
+
+    def to_sorted(self, data):
+        """
+
+        Convert data in detector layout to wavelength order.
+
+        """
+        return numpy.ravel(data)[self.order]
+
+    def to_detector(self, data):
+        """
+
+        Convert data in wavelength order back to detector layout.
+
+        """
+        return data[self.inverse].reshape(self.shape)
+
+    def blocks(self, column):
+        """
+
+        View of column (one of wl, flux, var, spatial) as array of shape
+        (n_blocks, blocksize), including the NaN padding on both ends.
+
+        """
+        return column.base.reshape((-1, self.blocksize))
+
+    def flag(self, bit, select):
+        """
+
+        Set flag bit for all samples in select (given in wavelength order).
+
+        """
+        self.flags[select] |= bit
+
+    def flag_detector(self, bit, select):
+        """
+
+        Set flag bit for all samples in select (given in detector layout).
+
+        """
+        self.flags[self.to_sorted(select)] |= bit
+
+    def good(self, ignore=0):
+        """
+
+        Boolean mask (in wavelength order) of all samples without any flags,
+        except those in ignore.
+
+        """
+        return (self.flags & ~numpy.uint8(ignore)) == 0
+
+    def unblock(self, block_data):
+        """
+
+        Inverse of blocks(): convert data of shape (n_blocks, blocksize) back
+        to one value per sample, dropping the padding.
+
+        """
+        return block_data.reshape((-1))[
+            self.pad_front:self.pad_front+self.size]
@@ -10,6 +10,8 @@ import logging
 import numpy
 import scipy, scipy.interpolate
 import math
+import stagetiming
+import debugartifacts
 
 import matplotlib.pyplot as pl
 
@@ -97,10 +99,11 @@ def compute_spline_sky_spectrum(all_skies,
     neighbor_count = numpy.sum( numpy.isfinite(nearest_neighbor), axis=1)
     #print neighbor_count.shape
     
-    numpy.savetxt("neighbor_count", 
-                  numpy.append(basepoints.reshape((-1,1)),
-                               neighbor_count.reshape((-1,1)), axis=1)
-                  )
+    debugartifacts.save_array(
+        "neighbor_count",
+        lambda: numpy.append(basepoints.reshape((-1,1)),
+                             neighbor_count.reshape((-1,1)), axis=1),
+        stage="skysub")
 
     #
     # Now eliminate all basepoints with not enough data points for proper fitting
@@ -127,9 +130,13 @@ def compute_spline_sky_spectrum(all_skies,
         ss = numpy.append(basepoints.reshape((-1,1)),
                           sky_spectrum_spline(basepoints).reshape((-1,1)),
                           axis=1)
-        numpy.savetxt("skyspectrum.knots", sky_spectrum_spline.get_knots())
-        numpy.savetxt("skyspectrum.coeffs", sky_spectrum_spline.get_coeffs())
-        numpy.savetxt("skyspectrum.txt", ss)
+        debugartifacts.save_array("skyspectrum.knots",
+                                  sky_spectrum_spline.get_knots(),
+                                  stage="skysub")
+        debugartifacts.save_array("skyspectrum.coeffs",
+                                  sky_spectrum_spline.get_coeffs(),
+                                  stage="skysub")
+        debugartifacts.save_array("skyspectrum.txt", ss, stage="skysub")
     except:
         logger.critical("Error with spline-fitting the sky-spectrum")
         pysalt.mp_logging.log_exception()
@@ -157,6 +164,7 @@ def compute_spline_sky_spectrum(all_skies,
     return sky_spectrum_spline
 
 
+@stagetiming.timed()
 def make_2d_skyspectrum(hdulist, 
                         wls_2d,
                         sky_regions=None, 
@@ -249,8 +257,8 @@ def make_2d_skyspectrum(hdulist,
     # XXXXXXXX
     # Change this to add masked region as separate extension
     #
-    fits.HDUList([fits.PrimaryHDU(header=hdulist['SCI'].header,
-                                      data=obj_masked)]).writeto("obj_masked.fits", clobber=True)
+    debugartifacts.save_fits("obj_masked", obj_masked, stage="skysub",
+                             header=hdulist['SCI'].header)
 
     #
     # Exclude all points with NaNs in either wavelength or flux
@@ -267,7 +275,7 @@ def make_2d_skyspectrum(hdulist,
     wl_sort = numpy.argsort(all_skies[:,0])
     all_skies = all_skies[wl_sort]
 
-    numpy.savetxt("allskies", all_skies[::10])
+    debugartifacts.save_array("allskies", all_skies[::10], stage="skysub")
 
     ############################################################################
     #
@@ -303,7 +311,7 @@ def make_2d_skyspectrum(hdulist,
     sky_2d = sky_2d.reshape(wls_2d.shape)
     
     # For now, write the sky spectrum to FITS so we can have a look at it in ds9
-    fits.HDUList([fits.PrimaryHDU(data=sky_2d)]).writeto("sky_2d.fits", clobber=True)
+    debugartifacts.save_fits("sky_2d", sky_2d, stage="skysub")
 
     return sky_2d
 
@@ -11,15 +11,12 @@ import wlcal
 import bottleneck
 import traceline
 import logging
+import movingstats
+import debugartifacts
 
 def filter_with_padding(data, w, fct):
 
-    padded = numpy.empty((data.shape[0]+2*w))
-    padded[:] = numpy.NaN
-    padded[w:-w] = data
-
-    fm = numpy.array([fct(padded[i-w:i+w+1]) for i in range(w,data.shape[0]+w)])
-    return fm
+    return movingstats.move_filter(data, w, w, fct)
 
 def trace_full_line(imgdata, x_start, y_start, window=5):
 
@@ -133,16 +130,16 @@ def create_wlmap_from_skylines(hdulist):
 
     logger.info("Isolating sky lines and continuum")
     skylines, continuum = prep_science.filter_isolate_skylines(data=imgdata)
-    fits.PrimaryHDU(data=skylines).writeto("skytrace_sky.fits", clobber=True)
-    fits.PrimaryHDU(data=continuum).writeto("skytrace_continuum.fits", clobber=True)
+    debugartifacts.save_fits("skytrace_sky", skylines, stage="skytrace")
+    debugartifacts.save_fits("skytrace_continuum", continuum, stage="skytrace")
 
     # pick a region close to the center, extract block of image rows, and get 
     # line list
     sky1d = bottleneck.nanmean(imgdata[550:575, :].astype(numpy.float32), axis=0)
     print sky1d.shape
     sky_linelist = wlcal.find_list_of_lines(sky1d, avg_width=25, pre_smooth=None)
-    numpy.savetxt("sky1d", sky1d)
-    numpy.savetxt("skylines.all", sky_linelist)
+    debugartifacts.save_array("sky1d", sky1d, stage="skytrace")
+    debugartifacts.save_array("skylines.all", sky_linelist, stage="skytrace")
 
     # select lines with good spacing
     good_lines = traceline.pick_line_every_separation(
@@ -152,7 +149,8 @@ def create_wlmap_from_skylines(hdulist):
         n_pixels=imgdata.shape[1],
         min_signal_to_noise=7,
         )
-    numpy.savetxt("skylines.good", sky_linelist[good_lines])
+    debugartifacts.save_array("skylines.good", sky_linelist[good_lines],
+                              stage="skytrace")
 
     print "X",skylines.shape, sky_linelist.shape, good_lines.shape
     selected_lines = sky_linelist[good_lines]
@@ -161,16 +159,15 @@ def create_wlmap_from_skylines(hdulist):
     all_traces = []
 
     logger.info("Tracing %d lines" % (selected_lines.shape[0]))
-    linetraces = open("skylines.traces", "w")
     for idx, pick_line in enumerate(selected_lines):
         #print pick_line
 
         wp = trace_full_line(skylines, x_start=pick_line[0], y_start=562, window=5)
-        numpy.savetxt(linetraces, wp)
-        print >>linetraces, "\n"*5
         all_traces.append(wp)
+    debugartifacts.save_array("skylines.traces", all_traces, stage="skytrace")
 
-    numpy.savetxt("skylines.picked", selected_lines)
+    debugartifacts.save_array("skylines.picked", selected_lines,
+                              stage="skytrace")
     for idx in range(selected_lines.shape[0]):
         pick_line = selected_lines[idx,:]
         #print pick_line
@@ -178,7 +175,7 @@ def create_wlmap_from_skylines(hdulist):
     all_traces = numpy.array(all_traces)
     print all_traces.shape
 
-    fits.PrimaryHDU(data=all_traces).writeto("alltraces.fits", clobber=True)
+    debugartifacts.save_fits("alltraces", all_traces, stage="skytrace")
 
     ##########################################################################
     #
@@ -192,7 +189,8 @@ def create_wlmap_from_skylines(hdulist):
     logger.info("Rejecting outliers along the spatial profile")
     _cl, _cr = int(0.4*all_traces.shape[1]), int(0.6*all_traces.shape[1])
     central_position = numpy.median(all_traces[:,_cl:_cr,:], axis=1)
-    numpy.savetxt("skytrace_median", central_position)
+    debugartifacts.save_array("skytrace_median", central_position,
+                              stage="skytrace")
     print central_position
 
     # subtract central position
@@ -202,10 +200,8 @@ def create_wlmap_from_skylines(hdulist):
     # scale intensity by median flux
     all_traces[:,:,3] /= central_position[:,3:]
 
-    with open("skylines.traces.norm", "w") as lt2:
-        for line in range(all_traces.shape[0]):
-            numpy.savetxt(lt2, all_traces[line,:,:])
-            print >>lt2, "\n"*5
+    debugartifacts.save_array("skylines.traces.norm", all_traces,
+                              stage="skytrace")
 
     #
     # Now eliminate all lines that have negative median fluxes
@@ -253,19 +249,18 @@ def create_wlmap_from_skylines(hdulist):
         profiles[outlier] = numpy.NaN
         all_traces[:,:,3][outlier] = numpy.NaN
 
-    
-    with open("skylines.traces.clean", "w") as lt2:
-        for line in range(all_traces.shape[0]):
-            numpy.savetxt(lt2, all_traces[line,:,:])
-            print >>lt2, "\n"*5
+
+    debugartifacts.save_array("skylines.traces.clean", all_traces,
+                              stage="skytrace")
 
     medians = bottleneck.nanmedian(all_traces, axis=0)
-    numpy.savetxt("skylines.traces.median", medians)
+    debugartifacts.save_array("skylines.traces.median", medians,
+                              stage="skytrace")
     print medians.shape
 
     stds = bottleneck.nanstd(all_traces, axis=0)
     stds[:,0] = medians[:,0]
-    numpy.savetxt("skylines.traces.std", stds)
+    debugartifacts.save_array("skylines.traces.std", stds, stage="skytrace")
 
     #
     # Now reconstruct the final line traces, filling in gaps with values 
@@ -285,15 +280,10 @@ def create_wlmap_from_skylines(hdulist):
         all_traces[:,:,1] += central_position[:,1:2]
 
 
-        with open("skylines.traces.corrected", "w") as lt2:
-            for line in range(all_traces.shape[0]):
-                numpy.savetxt(lt2, all_traces[line,:,:])
-                print >>lt2, "\n"*5
-
-        with open("skylines.traces.corrected2", "w") as lt2:
-            for line in range(all_traces.shape[0]):
-                numpy.savetxt(lt2, all_median[:,:])
-                print >>lt2, "\n"*5
+        debugartifacts.save_array("skylines.traces.corrected", all_traces,
+                                  stage="skytrace")
+        debugartifacts.save_array("skylines.traces.corrected2", all_median,
+                                  stage="skytrace")
 
 
     # compute average intensity profile, weighting each line profile by its 
@@ -312,11 +302,13 @@ def create_wlmap_from_skylines(hdulist):
     i_count = bottleneck.nansum(strong_line_traces[:,:,3] / strong_line_traces[:,:,3] * strong_line_fluxes.reshape((-1,1)), axis=0)
     i_avg = i_sum / i_count
     print i_sum.shape
-    numpy.savetxt("skylines.traces.meanflux", i_avg)
+    debugartifacts.save_array("skylines.traces.meanflux", i_avg,
+                              stage="skytrace")
 
     fm = filter_with_padding(i_avg, w=50, fct=bottleneck.nanmedian)
     print fm.shape
-    numpy.savetxt("skylines.traces.meanflux2", fm)
+    debugartifacts.save_array("skylines.traces.meanflux2", fm,
+                              stage="skytrace")
 
 
     #
@@ -372,9 +364,10 @@ def create_wlmap_from_skylines(hdulist):
 
         comb[:,5] = arc_model(p_bestfit, medians[:,1])
 
-        numpy.savetxt("ARC_%04d.delete" % (ypos), comb)
+        debugartifacts.save_array("ARC_%04d.delete" % (ypos), comb,
+                                  stage="skytrace")
 
-    numpy.savetxt("all_scalings", numpy.array(scalings))
+    debugartifacts.save_array("all_scalings", scalings, stage="skytrace")
 
     def model_linear(p, x):
         model = p[0]*x+p[1]
@@ -391,7 +384,8 @@ def create_wlmap_from_skylines(hdulist):
                                [0.,1.],
                                )
     fit_scalings[:,1] = model_linear(p_scale, fit_scalings[:,0])
-    numpy.savetxt("all_scalings_scale", numpy.array(fit_scalings))
+    debugartifacts.save_array("all_scalings_scale", fit_scalings,
+                              stage="skytrace")
 
     fit_skew = numpy.array(scalings)
     p_skew = fit_with_rejection(fit_scalings[:,0], fit_scalings[:,4],
@@ -399,7 +393,7 @@ def create_wlmap_from_skylines(hdulist):
                                     [0.,0.],
                                 )
     fit_skew[:,2] = model_linear(p_skew, fit_scalings[:,0])
-    numpy.savetxt("all_scalings_skew", numpy.array(fit_skew))
+    debugartifacts.save_array("all_scalings_skew", fit_skew, stage="skytrace")
 
     #
     # Now compute spline function for the median curvature profile
@@ -426,7 +420,8 @@ def create_wlmap_from_skylines(hdulist):
     x_eff = x
     for iteration in range(3):
         x_eff = x - ((p_scale[0]*x_eff+p_scale[1])*mc_spline(y) + (p_skew[0]*x_eff+p_skew[1])*(y-imgdata.shape[0]/2))
-        fits.PrimaryHDU(data=x_eff).writeto("x_eff_%d.fits" % (iteration+1), clobber=True)
+        debugartifacts.save_fits("x_eff_%d" % (iteration+1), x_eff,
+                                 stage="skytrace")
 
 
     #
@@ -441,7 +436,7 @@ def create_wlmap_from_skylines(hdulist):
     for order in range(hdulist[0].header['WLSFIT_N']):
         a = hdulist[0].header['WLSFIT_%d' % (order)]
         wl_map += a * numpy.power(x_eff,order)
-    fits.PrimaryHDU(data=wl_map).writeto("wl_map.fits", clobber=True)
+    debugartifacts.save_fits("wl_map", wl_map, stage="skytrace")
 
 
     return x_eff, wl_map, medians, p_scale, p_skew, fm
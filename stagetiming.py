@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+"""
+
+Timing and memory instrumentation of the reduction stages.
+
+Each stage records its wall-clock time, CPU time (user + system, summed over
+all threads of the process), the increase of the peak resident memory of
+the process during the stage, and the sizes of the arrays it works on.
+Stages can be nested; each record carries the path of all enclosing stages
+and the frame that was being reduced.
+
+Instrumentation is off by default, and then costs just one check per stage.
+It can be switched on with enable(), or via the environment variable
+RSS_TIMING=1.
+
+Usage:
+
+    @stagetiming.timed()
+    def optimal_sky_subtraction(...):
+
+    @stagetiming.timed(frame_arg="filename")
+    def reduce_object_frame(filename, ...):
+
+    with stagetiming.stage("combine_flats", flatstack):
+        ...
+
+Records are kept per process. Worker processes hand their records to the
+main process with collect(), where they are merged with add(); this works
+with forked workers (e.g. those of multiprocessing.Pool) as well as in the
+main process.
+
+"""
+
+import os
+import time
+import json
+import socket
+import resource
+import threading
+import functools
+import inspect
+import numpy
+from astropy.io import fits
+
+import precision
+
+
+_enabled = False
+
+_records = []
+_records_pid = os.getpid()
+_local = threading.local()
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = bool(on)
+
+
+def is_enabled():
+    return _enabled
+
+
+def _stack():
+    if (not hasattr(_local, 'stack')):
+        _local.stack = []
+        _local.frame = None
+    return _local.stack
+
+
+def _current_frame():
+    _stack()
+    return _local.frame
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _describe_arrays(arrays):
+    shapes, nbytes = [], 0
+    for a in arrays:
+        if (isinstance(a, numpy.ndarray)):
+            shapes.append("%s:%s" % ("x".join(["%d" % s for s in a.shape]),
+                                     a.dtype.name))
+            nbytes += a.nbytes
+    return ",".join(shapes), nbytes
+
+
+def _append(record):
+    global _records_pid
+    # records inherited from the parent of a forked process belong to the
+    # parent, so start with an empty list
+    if (_records_pid != os.getpid()):
+        del _records[:]
+        _records_pid = os.getpid()
+    _records.append(record)
+
+
+class _Stage(object):
+
+    def __init__(self, name, arrays, frame=None):
+        self.name = name
+        self.arrays = arrays
+        self.frame = frame
+
+    def __enter__(self):
+        stack = _stack()
+        self.outer_frame = _local.frame
+        if (self.frame is not None):
+            _local.frame = self.frame
+        stack.append(self.name)
+        self.path = "/".join(stack)
+        self.peak_start = precision.peak_memory()
+        self.start = time.time()
+        self.cpu_start = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = time.time() - self.start
+        cpu = _cpu_time() - self.cpu_start
+        peak = precision.peak_memory()
+        arrays, nbytes = _describe_arrays(self.arrays)
+        _append({
+            'stage': self.name,
+            'path': self.path,
+            'frame': _local.frame,
+            'pid': os.getpid(),
+            'start': self.start,
+            'wall': wall,
+            'cpu': cpu,
+            'peak_rss_mb': peak,
+            'peak_rss_delta_mb': peak - self.peak_start,
+            'arrays': arrays,
+            'nbytes': nbytes,
+            'failed': exc_type is not None,
+        })
+        _stack().pop()
+        _local.frame = self.outer_frame
+        return False
+
+
+class _NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_no_stage = _NoStage()
+
+
+def stage(name, *arrays, **kwargs):
+    """
+
+    Context manager timing the enclosed block as stage name. Pass all arrays
+    the stage works on to record their sizes, and frame=... to attribute the
+    stage (and all stages within) to a frame.
+
+    """
+    if (not _enabled):
+        return _no_stage
+    return _Stage(name, arrays, frame=kwargs.get('frame', None))
+
+
+def timed(name=None, frame_arg=None):
+    """
+
+    Decorator timing each call of a function as stage name (default: the
+    name of the function), recording the sizes of all array arguments. With
+    frame_arg, the (file-)name passed as this argument names the frame.
+
+    """
+    def decorator(fct):
+        stage_name = fct.__name__ if name is None else name
+
+        @functools.wraps(fct)
+        def wrapper(*args, **kwargs):
+            if (not _enabled):
+                return fct(*args, **kwargs)
+            frame = None
+            if (frame_arg is not None):
+                frame = inspect.getcallargs(fct, *args, **kwargs)[frame_arg]
+                if (isinstance(frame, str)):
+                    frame = os.path.basename(frame)
+            arrays = list(args) + list(kwargs.values())
+            with _Stage(stage_name, arrays, frame=frame):
+                return fct(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def records(frame=None):
+    """
+
+    All records of this process so far, or only those of frame.
+
+    """
+    if (_records_pid != os.getpid()):
+        return []
+    if (frame is None):
+        return list(_records)
+    return [r for r in _records if r['frame'] == frame]
+
+
+def collect():
+    """
+
+    Return and clear all records of this process, e.g. to return them from a
+    worker process to the main process.
+
+    """
+    result = records()
+    del _records[:]
+    return result
+
+
+def add(new_records):
+    """
+
+    Merge records collected in another process.
+
+    """
+    if (new_records is None):
+        return
+    for record in new_records:
+        _append(record)
+
+
+def table_hdu(frame=None):
+    """
+
+    FITS table (extension TIMING) with all records of frame, in the order
+    the stages finished.
+
+    """
+    data = records(frame)
+    columns = [
+        fits.Column(name='STAGE', format='64A',
+                    array=[r['stage'] for r in data]),
+        fits.Column(name='PATH', format='256A',
+                    array=[r['path'] for r in data]),
+        fits.Column(name='WALL', format='D', unit='s',
+                    array=[r['wall'] for r in data]),
+        fits.Column(name='CPU', format='D', unit='s',
+                    array=[r['cpu'] for r in data]),
+        fits.Column(name='PEAKRSS', format='D', unit='MB',
+                    array=[r['peak_rss_mb'] for r in data]),
+        fits.Column(name='DPEAKRSS', format='D', unit='MB',
+                    array=[r['peak_rss_delta_mb'] for r in data]),
+        fits.Column(name='NBYTES', format='K',
+                    array=[r['nbytes'] for r in data]),
+        fits.Column(name='ARRAYS', format='128A',
+                    array=[r['arrays'] for r in data]),
+    ]
+    tbhdu = fits.BinTableHDU.from_columns(columns)
+    tbhdu.name = "TIMING"
+    return tbhdu
+
+
+def summarize(all_records):
+    """
+
+    Total and maximum time and memory of each stage, over all frames.
+
+    """
+    summary = {}
+    for r in all_records:
+        if (r['path'] not in summary):
+            summary[r['path']] = {'count': 0, 'wall_total': 0., 'wall_max': 0.,
+                                  'cpu_total': 0., 'peak_rss_delta_max_mb': 0.}
+        s = summary[r['path']]
+        s['count'] += 1
+        s['wall_total'] += r['wall']
+        s['wall_max'] = max(s['wall_max'], r['wall'])
+        s['cpu_total'] += r['cpu']
+        s['peak_rss_delta_max_mb'] = max(s['peak_rss_delta_max_mb'],
+                                         r['peak_rss_delta_mb'])
+    return summary
+
+
+def write_rollup(filename, all_records=None):
+    """
+
+    Write all records (default: those of this process), grouped by frame,
+    and a summary by stage as JSON file.
+
+    """
+    if (all_records is None):
+        all_records = records()
+    frames = {}
+    for r in all_records:
+        frame = str(r['frame'])
+        if (frame not in frames):
+            frames[frame] = []
+        frames[frame].append(r)
+
+    rollup = {
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'hostname': socket.gethostname(),
+        'stages': summarize(all_records),
+        'frames': frames,
+    }
+    with open(filename, "w") as f:
+        json.dump(rollup, f, indent=1, sort_keys=True)
+
+
+enable(os.environ.get("RSS_TIMING", "0") not in ("", "0"))
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+
+Evaluation of smooth 2-D models (distortion maps, flat-field and sky
+scaling fits, wavelength solutions) for each pixel of a frame.
+
+Instead of evaluating the model at every pixel, it is evaluated on a coarse
+grid of pixels only, and the full frame is filled in, block of rows by block
+of rows, with a bicubic spline through the grid; this interpolation is
+separable in rows and columns and much cheaper than evaluating most models.
+The interpolation is checked against the model on a grid four times finer
+(i.e. at 16 points per grid cell); cells (and their neighbors) where it does
+not reproduce the model to within the given tolerance, e.g. close to kinks
+of a spline model at the edges of its data, are evaluated exactly, and the
+grid is refined if this applies to too many cells. As the error is only
+checked at these points, the tolerance is not a strict bound for all other
+pixels. If the model is not finite everywhere on the
+grid, it is evaluated at every pixel instead.
+
+Models are passed as functions of the (integer) row and column indices,
+given as column and row vector, e.g. for a model depending on wavelength and
+spatial position:
+
+    def distortion(rows, cols):
+        _wl, _y = numpy.broadcast_arrays(wlmap[rows, cols], rows)
+        return interpol(x=_wl, y=_y, grid=False)
+
+    distortion_2d = surface.evaluate(distortion, wlmap.shape, tolerance=5e-4)
+
+"""
+
+import logging
+import numpy
+import scipy.interpolate
+import scipy.ndimage
+
+import precision
+import stagetiming
+
+
+def _grid(n, step):
+    # grid points every step pixels, always including the last pixel
+    nodes = numpy.arange(0, n, step)
+    if (nodes[-1] != n-1):
+        nodes = numpy.append(nodes, n-1)
+    return nodes
+
+
+def _check_points(nodes, n):
+    # n points per interval between the grid nodes, starting at the nodes,
+    # and the index of each node among these points
+    frac = numpy.arange(n) / float(n)
+    points = nodes[:-1].reshape((-1,1)) + frac * numpy.diff(nodes).reshape((-1,1))
+    points = numpy.unique(numpy.append(points.astype(numpy.int), nodes[-1]))
+    return points, numpy.searchsorted(points, nodes)
+
+
+def _cell_max(error, node_index, axis):
+    # largest error between each pair of neighboring grid nodes (inclusive);
+    # NaNs are propagated
+    return numpy.maximum(
+        numpy.maximum.reduceat(error, node_index[:-1], axis=axis),
+        error.take(node_index[1:], axis=axis))
+
+
+def evaluate_exact(fct, shape, dtype=None, tile_rows=256):
+    """
+
+    Evaluate fct at every pixel of a frame of the given shape, tile_rows
+    rows at a time.
+
+    """
+    if (dtype is None):
+        dtype = precision.image_dtype
+    out = numpy.empty(shape, dtype=dtype)
+    cols = numpy.arange(shape[1]).reshape((1,-1))
+    for y0 in range(0, shape[0], tile_rows):
+        y1 = min(y0 + tile_rows, shape[0])
+        out[y0:y1] = fct(numpy.arange(y0, y1).reshape((-1,1)), cols)
+    return out
+
+
+@stagetiming.timed()
+def evaluate(fct, shape, tolerance, step=64, min_step=8, tile_rows=256,
+             check_points=4, max_bad_fraction=0.1, dtype=None):
+    """
+
+    Evaluate the smooth model fct(rows, cols) for every pixel of a frame of
+    the given shape, interpolating between a grid of at most step pixels
+    spacing. Grid cells where the interpolation error (checked at
+    check_points x check_points points per cell) exceeds tolerance (in the
+    units of the model), and their neighbors, are evaluated exactly; the
+    grid is refined as long as this applies to more than max_bad_fraction
+    of all cells. Returns an image of type dtype (default: image planes as
+    set in the precision module).
+
+    """
+    logger = logging.getLogger("Surface")
+    if (dtype is None):
+        dtype = precision.image_dtype
+
+    spline = None
+    while (step >= min_step):
+        rows = _grid(shape[0], step)
+        cols = _grid(shape[1], step)
+        if (rows.shape[0] < 4 or cols.shape[0] < 4):
+            # too few grid points for a cubic spline
+            break
+
+        coarse = fct(rows.reshape((-1,1)), cols.reshape((1,-1)))
+        if (not numpy.all(numpy.isfinite(coarse))):
+            logger.debug("Model is not finite everywhere on the grid")
+            break
+        spline = scipy.interpolate.RectBivariateSpline(
+            rows, cols, coarse, kx=3, ky=3, s=0)
+
+        # check the interpolation on a finer grid, with check_points points
+        # per cell and axis, and find the largest error in each cell
+        check_rows, row_nodes = _check_points(rows, check_points)
+        check_cols, col_nodes = _check_points(cols, check_points)
+        error = numpy.fabs(spline(check_rows, check_cols) - fct(
+            check_rows.reshape((-1,1)), check_cols.reshape((1,-1))))
+        error = _cell_max(_cell_max(error, row_nodes, axis=0),
+                          col_nodes, axis=1)
+        bad_cells = ~(error <= tolerance)
+        logger.debug("Grid step %d: max. error %g, %d of %d cells above %g" % (
+            step, numpy.nanmax(error), numpy.sum(bad_cells), bad_cells.size,
+            tolerance))
+        if (numpy.mean(bad_cells) <= max_bad_fraction or step//2 < min_step):
+            break
+        step //= 2
+        spline = None
+
+    if (spline is None):
+        logger.debug("Evaluating model at every pixel")
+        return evaluate_exact(fct, shape, dtype=dtype, tile_rows=tile_rows)
+
+    out = numpy.empty(shape, dtype=dtype)
+    all_cols = numpy.arange(shape[1])
+    for y0 in range(0, shape[0], tile_rows):
+        y1 = min(y0 + tile_rows, shape[0])
+        out[y0:y1] = spline(numpy.arange(y0, y1), all_cols)
+
+    # the interpolation error of a cell also affects its neighbors
+    bad_cells = scipy.ndimage.binary_dilation(
+        bad_cells, structure=numpy.ones((3,3), dtype=numpy.bool))
+    for i, j in zip(*numpy.nonzero(bad_cells)):
+        out[rows[i]:rows[i+1]+1, cols[j]:cols[j+1]+1] = fct(
+            numpy.arange(rows[i], rows[i+1]+1).reshape((-1,1)),
+            numpy.arange(cols[j], cols[j+1]+1).reshape((1,-1)))
+    return out
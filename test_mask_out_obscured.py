@@ -8,8 +8,10 @@ import scipy
 import scipy.ndimage
 
 import logging
+import stagetiming
 
 
+@stagetiming.timed()
 def find_obscured_regions(img, threshold=0.35,
                           debug=False):
 
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+
+Compare the running-window filters in movingstats against applying the same
+reduction to each window in turn, for regular profiles as well as profiles
+shorter than the window.
+
+"""
+
+import sys
+import numpy
+import bottleneck
+
+import movingstats
+
+
+def reference(data, before, after, fct):
+    # data[i-before:i+after+1], truncated at the edges; windows without any
+    # valid data are NaN
+    result = numpy.empty(data.shape)
+    for i in range(data.shape[0]):
+        window = data[max(0, i-before):i+after+1]
+        valid = numpy.isfinite(window)
+        result[i] = fct(window) if numpy.any(valid) else numpy.NaN
+    return result
+
+
+def check(n_points, before, after):
+    data = numpy.random.normal(size=n_points)
+    data[::7] = numpy.NaN
+
+    ok = True
+    for name, move_fct, fct in [
+            ('median', movingstats.move_median, bottleneck.nanmedian),
+            ('mean', movingstats.move_mean, bottleneck.nanmean),
+            ('sum', movingstats.move_sum, bottleneck.nansum),
+            ('std', movingstats.move_std, bottleneck.nanstd)]:
+        result = move_fct(data, before, after)
+        expected = reference(data, before, after, fct)
+        match = (result.shape == expected.shape and
+                 numpy.allclose(result, expected, equal_nan=True))
+        print "%-6s n=%4d before=%3d after=%3d: %s" % (
+            name, n_points, before, after, "ok" if match else "MISMATCH")
+        ok &= match
+    return ok
+
+
+if __name__ == "__main__":
+
+    numpy.random.seed(1)
+
+    ok = True
+    # regular profiles, window much smaller than the data
+    ok &= check(1000, 50, 50)
+    ok &= check(1000, 50, 49)
+    ok &= check(1000, 0, 10)
+
+    # short profiles, window longer than the data
+    ok &= check(30, 49, 49)
+    ok &= check(30, 50, 10)
+    ok &= check(5, 3, 40)
+    ok &= check(1, 10, 10)
+
+    sys.exit(0 if ok else 1)
@@ -28,13 +28,20 @@ import time
 import math
 
 import wlcal
+import surface
 import pickle
+import podi_cython
+import debugartifacts
+import stagetiming
 
 from helpers import *
 # from rk_specred import find_slit_profile
 
 createdebugfiles = False
 
+# use the compiled line tracer in podi_cython instead of trace_arc
+use_compiled_tracer = True
+
 linetrace_cols = ["Y",
                   "X",
                   "---",
@@ -277,13 +284,43 @@ def trace_arc(data,
     #                         arc_center.reshape((-1,1)), axis=1)
     combined = numpy.append(numpy.arange(data.shape[0]).reshape((-1,1)),
                             arc_center, axis=1)
-    numpy.savetxt("arcshape_%d" % (direction), combined)
+    debugartifacts.save_array("arcshape_%d" % (direction), combined,
+                              stage="traceline")
 
     return combined
 
 
 
 
+def trace_arcs(data, starts, directions,
+               max_window_x=5,
+               max_corner_angle=60,
+               ):
+    """
+
+    Compiled version of trace_arc, tracing many lines in one go. starts is
+    a list of (x,y) starting positions and directions a matching list of
+    directions (-1: downwards, +1: upwards).
+
+    Returns a list with one array for each line, in the same layout as the
+    combined array returned by trace_arc.
+
+    """
+
+    starts = numpy.array(starts, dtype=numpy.float).reshape((-1,2))
+    arc_center = podi_cython.trace_arcs(
+        data,
+        start_x=starts[:,0].astype(numpy.int),
+        start_y=starts[:,1].astype(numpy.int),
+        direction=numpy.array(directions).astype(numpy.int),
+        max_window_x=int(max_window_x),
+        max_corner_angle=max_corner_angle,
+    )
+
+    row_index = numpy.arange(data.shape[0]).reshape((-1,1))
+    return [numpy.append(row_index, ac, axis=1) for ac in arc_center]
+
+
 def subpixel_centroid_trace(data, tracedata, width=5, dumpfile=None, return_all=False):
 
     logger = logging.getLogger("SubpixelCentroid")
@@ -378,7 +415,8 @@ def subpixel_centroid_trace(data, tracedata, width=5, dumpfile=None, return_all=
 def trace_single_line(fitsdata, wls_data, line_idx, ds9_region_file=None,
                       fine_centroiding=False, fine_centroiding_width=10,
                       centroiding_width=5,
-                      linetrace_hdulist=None):
+                      linetrace_hdulist=None,
+                      traces=None):
 
     logger = logging.getLogger("TraceSlgLine")
 
@@ -402,14 +440,25 @@ def trace_single_line(fitsdata, wls_data, line_idx, ds9_region_file=None,
     # Now, going downwards, follow the line
     all_row_data = None
 
-    for direction_y in [-1,+1]:
+    if (traces is None and use_compiled_tracer):
+        traces = trace_arcs(data=fitsdata,
+                            starts=[(arcpos_x, wls_data['line'])]*2,
+                            directions=[-1,+1],
+                            max_window_x=5,
+                            )
+
+    for i_dir, direction_y in enumerate([-1,+1]):
         #direction_y = -1
         # print arcpos_x, wls_data['line']
-        lt = trace_arc(data=fitsdata,
-                       start=(arcpos_x, wls_data['line']),
-                       direction=direction_y,
-                       max_window_x=5,
-                       )
+        if (traces is not None):
+            # use the line-trace computed by trace_arcs
+            lt = traces[i_dir]
+        else:
+            lt = trace_arc(data=fitsdata,
+                           start=(arcpos_x, wls_data['line']),
+                           direction=direction_y,
+                           max_window_x=5,
+                           )
         
         valid = numpy.isfinite(lt[:,1])
         lt = lt[valid]
@@ -734,6 +783,7 @@ def pick_line_every_separation(
     return final_indices.astype(numpy.int)
 
 
+@stagetiming.timed()
 def compute_2d_wavelength_solution(arc_filename, 
                                    n_lines_to_trace=15, 
                                    fit_order=[3,2],
@@ -840,7 +890,8 @@ def compute_2d_wavelength_solution(arc_filename,
     
     if (trace_every is not None):
 
-        pickle.dump(wls_data['linelist_arc'], open("arclist", "wb"))
+        debugartifacts.save_array("arclist", wls_data['linelist_arc'],
+                                  stage="traceline")
         # print "exiting"
         # sys.exit(0)
         trace_line_indices = pick_line_every_separation(
@@ -876,14 +927,32 @@ def compute_2d_wavelength_solution(arc_filename,
     #print trace_line_indices
     #print "XXX"
 
-    linetrace_hdulist = [fits.PrimaryHDU()]
-
-    for i in trace_line_indices: #range(n_lines_to_trace):
+    # only collect the line traces if we are going to save them
+    linetrace_hdulist = None
+    if (debugartifacts.is_enabled("linetraces", stage="traceline")):
+        linetrace_hdulist = [fits.PrimaryHDU()]
+
+    all_traces = None
+    if (use_compiled_tracer):
+        # trace all lines, in both directions, in one go
+        logger.debug("Tracing all lines with compiled tracer")
+        _line_x = wls_data['linelist_arc'][trace_line_indices,
+                                           wlcal.lineinfo_colidx['PIXELPOS']]
+        starts = [(x, wls_data['line']) for x in _line_x for d in [-1,+1]]
+        directions = [-1,+1] * len(_line_x)
+        _traces = trace_arcs(data=fitsdata_gf,
+                             starts=starts,
+                             directions=directions,
+                             max_window_x=5)
+        all_traces = [_traces[2*i:2*i+2] for i in range(len(_line_x))]
+
+    for i_line, i in enumerate(trace_line_indices): #range(n_lines_to_trace):
         linetrace = trace_single_line(fitsdata_gf, wls_data, i,
                                       ds9_region_file=arc_region_file,
                                       fine_centroiding=True,
                                       centroiding_width=10,
-                                      linetrace_hdulist=linetrace_hdulist)
+                                      linetrace_hdulist=linetrace_hdulist,
+                                      traces=None if all_traces is None else all_traces[i_line])
         # linetrace = trace_single_line(fitsdata_gf, wls_data, sort_sn[i],
         #                    ds9_region_file=arc_region_file)
         # print linetrace.shape
@@ -894,10 +963,9 @@ def compute_2d_wavelength_solution(arc_filename,
                  numpy.append(traces, linetrace, axis=0)
         #traces.append(linetrace)
 
-    linetrace_fitsfile = "linetraces.fits"
-    linetrace_hdulist = fits.HDUList(linetrace_hdulist)
-    #clobberfile(linetrace_fitsfile)
-    linetrace_hdulist.writeto(linetrace_fitsfile, clobber=True)
+    if (linetrace_hdulist is not None):
+        debugartifacts.save_hdulist(
+            "linetraces", fits.HDUList(linetrace_hdulist), stage="traceline")
 
 
     traces_2d = numpy.array(traces)
@@ -942,12 +1010,15 @@ def compute_2d_wavelength_solution(arc_filename,
     #
 
     logger.info("Computing full 2-D wavelength map for frame")
-    arc_x, arc_y = numpy.indices(fitsdata.shape)
-
     line = wls_data['line']
     #print line
 
-    wl_data = polyval2d(arc_x.astype(numpy.float32), arc_y.astype(numpy.float32), m)
+    def wavelength(arc_x, arc_y):
+        arc_x, arc_y = numpy.broadcast_arrays(arc_x.astype(numpy.float),
+                                              arc_y.astype(numpy.float))
+        return polyval2d(arc_x, arc_y, m)
+    wl_data = surface.evaluate(wavelength, fitsdata.shape, tolerance=1e-3,
+                               dtype=numpy.float32)
 
     if (debug):
         fits.PrimaryHDU(data=wl_data.T).writeto(
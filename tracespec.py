@@ -7,7 +7,10 @@ import logging
 import pysalt
 import traceline
 import prep_science
+import stagetiming
+import debugartifacts
 
+@stagetiming.timed()
 def compute_spectrum_trace(data, start_x, start_y, xbin=1,
                         debug=False):
 
@@ -95,6 +98,7 @@ def compute_spectrum_trace(data, start_x, start_y, xbin=1,
 
 
 
+@stagetiming.timed()
 def compute_trace_slopes(tracedata, n_iter=3, polyorder=1):
 
     logger = logging.getLogger("ComputeTraceSlopes")
@@ -145,7 +149,8 @@ def compute_trace_slopes(tracedata, n_iter=3, polyorder=1):
         poly_fits[detector] = poly
 
         logger.debug("Detector %d: %s" % (detector+1, str(poly)))
-        numpy.savetxt("det_trace.%d" % (detector + 1), detector_trace)
+        debugartifacts.save_array("det_trace.%d" % (detector + 1),
+                                  detector_trace, stage="tracespec")
 
     # Now compensate all slopes to be offsets relative to the trace at the center of the detector
     poly_fits = numpy.array(poly_fits)
@@ -164,7 +169,8 @@ def compute_trace_slopes(tracedata, n_iter=3, polyorder=1):
         tracepos = numpy.polyval(poly_fits[detector], numpy.arange(npixels))
         trace_offset[x_start:x_end] = tracepos[x_start:x_end] - center_y
 
-    numpy.savetxt("tracespec.offset", trace_offset)
+    debugartifacts.save_array("tracespec.offset", trace_offset,
+                              stage="tracespec")
     return poly_fits, trace_offset
 
 def save_trace_offsets(trace_offset):
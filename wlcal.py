@@ -29,6 +29,9 @@ import scipy.spatial
 import pysalt.mp_logging
 import logging
 
+import debugartifacts
+import stagetiming
+import movingstats
 
 import matplotlib.pyplot as pl
 
@@ -128,6 +131,11 @@ def rssmodelwave(grating, grang, artic, xbin, cols):
     T0 = lam0 + T2 
     T1 = 3162.*disp + 3*T3
     X = (numpy.array(range(cols))+1-cols/2) * xbin / 3162.
+
+    # grang and artic may also be arrays (of the same shape), in which case
+    # the result has one row of column wavelengths for each angle pair
+    T0, T1, T2, T3 = [numpy.asarray(t)[..., numpy.newaxis]
+                      for t in (T0, T1, T2, T3)]
     lam_X = T0+T1*X+T2*(2*X**2-1)+T3*(4*X**3-3*X)
     return lam_X
 
@@ -178,8 +186,8 @@ def match_line_catalogs(arc, ref, matching_radius, verbose=False,
     matched[:,arc.shape[1]:] = ref[i]
     #print "XXXXXXXXXXXX\n"*3,ref.shape, ref[i].shape, i.shape, bad_matches.shape
     #print bad_matches
-    numpy.savetxt("matched_raw", matched)
-    numpy.savetxt("matched_bad", bad_matches)
+    debugartifacts.save_array("matched_raw", matched, stage="wlcal")
+    debugartifacts.save_array("matched_bad", bad_matches, stage="wlcal")
     #sys.exit(0)
 
     #print "XXXX\n"*3
@@ -236,7 +244,7 @@ def extract_arc_spectrum(hdulist, line=None, avg_width=20):
     #print avg_spec.shape
 
     logger.debug("done here!")
-    numpy.savetxt("arcspec.dat", avg_spec)
+    debugartifacts.save_array("arcspec", avg_spec, stage="wlcal")
     return avg_spec
 
 
@@ -308,12 +316,8 @@ def find_list_of_lines(spec, readnoise=2, gain=1, avg_width=1,
     if (debug):
         numpy.savetxt("spec_nolines", spec_nolines)
 
-    # add some padding to avoid querying non-existant data
-    padded = numpy.empty((spec_nolines.shape[0]+2*fw))
-    padded[:] = numpy.NaN
-    padded[fw:-fw] = spec_nolines
-    continuum = numpy.array([
-        bottleneck.nanmedian(padded[i-fw:i+fw]) for i in range(fw, spec_nolines.shape[0]+fw)])
+    # running median over spec_nolines[i-fw:i+fw]
+    continuum = movingstats.move_median(spec_nolines, fw, fw-1)
 
     # continuum = numpy.array([
     #     bottleneck.nanmedian(spec_nolines[i-fw:i+fw]) for i in range(spec_nolines.shape[0])])
@@ -407,7 +411,7 @@ def compute_wavelength_solution(matched, max_order=3):
     #
 
     logger.debug("Running a polynomial fit to %4d data points" % (matched.shape[0]))
-    numpy.savetxt("matched.for_final_fit", matched)
+    debugartifacts.save_array("matched.for_final_fit", matched, stage="wlcal")
     ret = numpy.polynomial.polynomial.polyfit(
         x=matched[:,0],
         y=matched[:,6],
@@ -504,7 +508,7 @@ def find_matching_lines(ref_lines, lineinfo,
     # to the next.
     #
     differences = ref_lines[:,0].reshape((-1,1)).T - wl.reshape((-1,1))
-    numpy.savetxt("diffs", differences.flatten())
+    debugartifacts.save_array("diffs", differences, stage="wlcal")
 
     #
     # Now find the most frequently found offset
@@ -525,7 +529,8 @@ def find_matching_lines(ref_lines, lineinfo,
     hist[:,0] = bins[:-1]
     hist[:,1] = bins[1:]
     hist[:,2] = count[:]
-    numpy.savetxt("histogram__%.4f" % (dispersion), hist)
+    debugartifacts.save_array("histogram__%.4f" % (dispersion), hist,
+                              stage="wlcal")
 
     # Now find the offset that allows to match the most lines
     hist_max = numpy.argmax(count)
@@ -540,7 +545,8 @@ def find_matching_lines(ref_lines, lineinfo,
     # applying the shift we just found
     #
     my_lineinfo[:,lineinfo_colidx['WAVELENGTH']] += avg_shift
-    numpy.savetxt("lineinfo__dispersion=%.3f" % (dispersion), my_lineinfo)
+    debugartifacts.save_array("lineinfo__dispersion=%.3f" % (dispersion),
+                              my_lineinfo, stage="wlcal")
 
     #lineinfo[:,-1] += avg_shift
 
@@ -552,7 +558,8 @@ def find_matching_lines(ref_lines, lineinfo,
     matched = match_line_catalogs(my_lineinfo, ref_lines, matching_radius,
                                   col_arc=lineinfo_colidx['WAVELENGTH'],
                                   col_ref=0)
-    numpy.savetxt("matched.lines.%.4f" % (dispersion), matched)
+    debugartifacts.save_array("matched.lines.%.4f" % (dispersion), matched,
+                              stage="wlcal")
 
     logger.info("Trying dispersion %8.4f A/px   ===>   shift: %8.2fA, #matches: %3d" % (
             dispersion, avg_shift, matched.shape[0]))
@@ -640,7 +647,86 @@ class  KenRSSModel( object ):
         return self.all_wavelength
 
 
-def find_wavelength_solution(filename, line, debug=False):
+def interpolate_line_wavelengths(all_wavelength, colpos):
+    """
+
+    Linearly interpolate the wavelengths at (fractional) column positions
+    colpos from a table of wavelengths for each column. all_wavelength may
+    also be 2-d, with one row for each spectrograph setup, in which case
+    the interpolation is done for all rows at once.
+
+    """
+    ncols = all_wavelength.shape[-1]
+    i0 = numpy.clip(numpy.floor(colpos).astype(numpy.int), 0, ncols-2)
+    frac = colpos - i0
+    return all_wavelength[..., i0] * (1.-frac) + \
+        all_wavelength[..., i0+1] * frac
+
+
+def count_line_matches(wl_lines, ref_sorted, matching_radius):
+    """
+
+    For each row of wl_lines (wavelengths of all lines found in the ARC, for
+    one spectrograph setup per row), count the number of lines with a
+    reference line within matching_radius. ref_sorted has to be sorted.
+
+    Returns the number of matches and the sum of the wavelength differences
+    of all matched lines for each row.
+
+    """
+    idx = numpy.searchsorted(ref_sorted, wl_lines)
+    left = ref_sorted[numpy.clip(idx-1, 0, ref_sorted.shape[0]-1)]
+    right = ref_sorted[numpy.clip(idx, 0, ref_sorted.shape[0]-1)]
+    distance = numpy.minimum(numpy.fabs(wl_lines - left),
+                             numpy.fabs(right - wl_lines))
+    good_match = distance < matching_radius
+    n_matches = numpy.sum(good_match, axis=-1)
+    residuals = numpy.sum(numpy.where(good_match, distance, 0.), axis=-1)
+    return n_matches, residuals
+
+
+def grid_search_angles(kens_model, line_pos, ref_sorted,
+                       try_camangles, try_gratingangles, matching_radius):
+    """
+
+    Evaluate the RSS model for all combinations of camera and grating
+    angles in one go and count the number of ARC lines matching a reference
+    line for each combination.
+
+    Returns arrays of matches and summed wavelength residuals, both of shape
+    (n_camangles, n_gratingangles).
+
+    """
+    camangles, gratingangles = numpy.meshgrid(
+        try_camangles, try_gratingangles, indexing='ij')
+
+    all_wavelength = rssmodelwave(
+        kens_model.grating, gratingangles.ravel(), camangles.ravel(),
+        kens_model.xbin, kens_model.ncols)
+    wl_lines = interpolate_line_wavelengths(all_wavelength, line_pos)
+
+    n_matches, residuals = count_line_matches(
+        wl_lines, ref_sorted, matching_radius)
+    return n_matches.reshape(camangles.shape), \
+        residuals.reshape(camangles.shape)
+
+
+@stagetiming.timed()
+def find_wavelength_solution(filename, line, debug=False,
+                             grid_search='batch', n_refine=0):
+    """
+
+    Find the wavelength solution for the ARC spectrum extracted around line.
+
+    The camera and grating angles of the RSS model are first optimized by
+    searching a grid of angles around the nominal values for the best match
+    between ARC lines and the lamp line list. grid_search='batch' evaluates
+    the full grid at once, 'loop' does one angle pair at a time. With
+    n_refine > 0, the search is repeated n_refine times on a 5x finer grid
+    around the best match; there, ties in the number of matches are broken
+    by the smallest total residual.
+
+    """
 
     logger = logging.getLogger("FindWLS")
 
@@ -823,40 +909,46 @@ def find_wavelength_solution(filename, line, debug=False):
     
     ref_kdtree = scipy.spatial.cKDTree(ref_lines[:,0].reshape((-1,1)))
     matching_radius=5.0
-    for idx_camangle, idx_gratingangle in \
-        itertools.product(range(n_steps_camangle), range(n_steps_gratingangle)):
+    ref_sorted = numpy.sort(ref_lines[:,0])
+    if (grid_search == 'batch'):
+        results, _ = grid_search_angles(
+            kens_model, lineinfo[:,0], ref_sorted,
+            try_camangles, try_gratingangles, matching_radius)
+    else:
+        for idx_camangle, idx_gratingangle in \
+            itertools.product(range(n_steps_camangle), range(n_steps_gratingangle)):
 
-        camangle = try_camangles[idx_camangle]
-        gratingangle = try_gratingangles[idx_gratingangle]
+            camangle = try_camangles[idx_camangle]
+            gratingangle = try_gratingangles[idx_gratingangle]
 
-        #print camangle, gratingangle
+            #print camangle, gratingangle
 
 
-        #match_line_catalogs(arc, ref, matching_radius, verbose=False,
-        #                col_ref=0, col_arc=-1, dumpfile=None):
+            #match_line_catalogs(arc, ref, matching_radius, verbose=False,
+            #                col_ref=0, col_arc=-1, dumpfile=None):
 
 
-        # compute the wavelength position for all lines using the
-        # spectrograph parameters of this iteration
-        wl_lines = kens_model.compute(grang=gratingangle,
-                                      artic=camangle,
-                                      colpos=lineinfo[:,0])
+            # compute the wavelength position for all lines using the
+            # spectrograph parameters of this iteration
+            wl_lines = kens_model.compute(grang=gratingangle,
+                                          artic=camangle,
+                                          colpos=lineinfo[:,0])
 
-        #print wl_lines, ref_lines.shape
+            #print wl_lines, ref_lines.shape
                                       
-        nearest_neighbor, i = ref_kdtree.query(
-            x=wl_lines.reshape((-1,1)), 
-            k=1, # only find 1 nearest neighbor
-            p=1, # use linear distance
-            distance_upper_bound=matching_radius)
+            nearest_neighbor, i = ref_kdtree.query(
+                x=wl_lines.reshape((-1,1)), 
+                k=1, # only find 1 nearest neighbor
+                p=1, # use linear distance
+                distance_upper_bound=matching_radius)
 
-        # i is the index with the closest match
-        # good matches have i within legal range
-        good_match = i < ref_lines.shape[0]
+            # i is the index with the closest match
+            # good matches have i within legal range
+            good_match = i < ref_lines.shape[0]
 
-        results[idx_camangle, idx_gratingangle] = numpy.sum(good_match)
+            results[idx_camangle, idx_gratingangle] = numpy.sum(good_match)
 
-    numpy.savetxt("results", results)
+    debugartifacts.save_array("results", results, stage="wlcal")
 
     # fig=matplotlib.pyplot.figure()
     # ax=fig.add_subplot(111)
@@ -874,6 +966,26 @@ def find_wavelength_solution(filename, line, debug=False):
     best_camangle = try_camangles[most_matches[0]]
     best_gratingangle = try_gratingangles[most_matches[1]]
 
+    for refine in range(n_refine):
+        # search a finer grid around the best match so far
+        step_camangle /= 5.
+        step_gratingangle /= 5.
+        try_camangles = best_camangle + \
+            numpy.arange(-10, 11) * step_camangle
+        try_gratingangles = best_gratingangle + \
+            numpy.arange(-10, 11) * step_gratingangle
+        results, residuals = grid_search_angles(
+            kens_model, lineinfo[:,0], ref_sorted,
+            try_camangles, try_gratingangles, matching_radius)
+
+        best = numpy.max(results)
+        residuals[results < best] = numpy.Inf
+        most_matches = numpy.unravel_index(numpy.argmin(residuals), results.shape)
+        best_camangle = try_camangles[most_matches[0]]
+        best_gratingangle = try_gratingangles[most_matches[1]]
+        logger.info("refinement %d: %d matches for camangle=%.4f, gratingangle=%.4f" % (
+            refine+1, results[most_matches], best_camangle, best_gratingangle))
+
     #
     # Now write the complete spectrum with the wavelength calibration
     #
@@ -881,8 +993,10 @@ def find_wavelength_solution(filename, line, debug=False):
 
     kens_model.compute(artic=best_camangle, grang=best_gratingangle, ncols=spec.shape[0])
     spec_wl = kens_model.get_wavelength_list()
-    numpy.savetxt("spec_precalib", numpy.append(spec_wl.reshape((-1,1)),
-                                                spec.reshape((-1,1)), axis=1))
+    debugartifacts.save_array(
+        "spec_precalib", lambda: numpy.append(spec_wl.reshape((-1,1)),
+                                              spec.reshape((-1,1)), axis=1),
+        stage="wlcal")
 
     #
     # Now cross-identify all lines, and do a least-sq fit to further optimize 
@@ -895,7 +1009,7 @@ def find_wavelength_solution(filename, line, debug=False):
         colpos = lineinfo[:,0],
         )
     
-    numpy.savetxt("linelist.calib", lineinfo)
+    debugartifacts.save_array("linelist.calib", lineinfo, stage="wlcal")
 
     # one last time, match the two line lists, using the same matching radius 
     # as above
@@ -929,7 +1043,7 @@ def find_wavelength_solution(filename, line, debug=False):
     matched_catalog[:,:lineinfo.shape[1]] = lineinfo[good_matches]
     matched_catalog[:,lineinfo.shape[1]:] = ref_lines[i[good_matches]]
 
-    numpy.savetxt("matched_lines.dat", matched_catalog)
+    debugartifacts.save_array("matched_lines", matched_catalog, stage="wlcal")
 
     # print "xxxxxxxxxxxxx"
 
@@ -966,7 +1080,8 @@ def find_wavelength_solution(filename, line, debug=False):
     matched_catalog[:, lineinfo_colidx['WAVELENGTH']] = fit__wavelength(
         p_final, matched_catalog[:, lineinfo_colidx["PIXELPOS"]], kens_model)
 
-    numpy.savetxt("matched_lines_afterfit.dat", matched_catalog)
+    debugartifacts.save_array("matched_lines_afterfit", matched_catalog,
+                              stage="wlcal")
 
     # 
     # compute rms
@@ -1190,10 +1305,11 @@ def find_wavelength_solution(filename, line, debug=False):
     # numpy.savetxt("matched.cat.final", final_match)
 
 
-    # Also save the original spectrum as text file
-    spec_x = numpy.polynomial.polynomial.polyval(numpy.arange(spec.shape[0]), wls).reshape((-1,1))
-    spec_combined = numpy.append(spec_x, spec.reshape((-1,1)), axis=1)
-    numpy.savetxt("spec.calib", spec_combined)
+    # Also save the original spectrum
+    if (debugartifacts.is_enabled("spec.calib", stage="wlcal")):
+        spec_x = numpy.polynomial.polynomial.polyval(numpy.arange(spec.shape[0]), wls).reshape((-1,1))
+        spec_combined = numpy.append(spec_x, spec.reshape((-1,1)), axis=1)
+        debugartifacts.save_array("spec.calib", spec_combined, stage="wlcal")
     
 
     # print lines
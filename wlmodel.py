@@ -2,12 +2,14 @@
 
 import os
 import sys
+import collections
 from astropy.io import fits
 import numpy
 import scipy
 
 import pysalt
 import logging
+import stagetiming
 from optparse import OptionParser
 
 datadir=os.path.dirname(os.path.realpath(__file__))
@@ -31,152 +33,216 @@ def rotate_detector(ndet=0,
 
 
 
-def rssmodelwave(#grating,grang,artic,cbin,refimg,
-        header, img,
-        xbin=1, ybin=1,
-        y_center=None, x_center=None,
-        debug=False,
-        x=None, y=None,
-):
-#   compute wavelengths from model (this can probably be done using pyraf spectrograph model)
+_tables = None
 
-    logger = logging.getLogger("RSS-2Dmodel")
-    # ncols = img.shape[0]
-    # nrows = img.shape[1]
+_models = {}
 
-    # compute X/Y position for each pixel
+# full-frame wavelength maps of the most recently used setups, limited to a
+# total of wlmap_cache_mb megabytes
+wlmap_cache_mb = 512.
+_wlmap_cache = collections.OrderedDict()
 
-    if (x is None or y is None):
-        y,x = numpy.indices(img.shape)
 
-    # also account for binning
-    y *= ybin
-    x *= xbin
+def instrument_tables():
+    """
 
-    #
-    #
-    # Load spectrograph parameters
-    #
-    logger.debug("Loading spectrograph parameters")
-    spec=numpy.loadtxt(datadir+"/spec.txt",usecols=(1,))
-    grating_rotation_home_error = spec[0]
+    Spectrograph parameters (spec.txt) and grating data (gratings.txt),
+    read only once per process.
 
-    Grat0,Home0,ArtErr,T2Con,T3Con=spec[0:5]
-    FCampoly=spec[5:11]
+    """
+    global _tables
+    if (_tables is None):
+        logger = logging.getLogger("RSS-2Dmodel")
+        logger.debug("Loading spectrograph parameters")
+        spec = numpy.loadtxt(datadir+"/spec.txt", usecols=(1,))
+        grating_names = numpy.loadtxt(datadir+"/gratings.txt", dtype=str,
+                                      usecols=(0,))
+        grlmm, grgam0, y0 = numpy.loadtxt(datadir+"/gratings.txt",
+                                          usecols=(1,2,3), unpack=True)
+        _tables = {
+            'spec': spec,
+            'grating_names': grating_names,
+            'lines_per_mm': grlmm,
+            'gamma0': grgam0,
+            'y0': y0,
+        }
+    return _tables
 
-    grating_names=numpy.loadtxt(datadir+"/gratings.txt",dtype=str,usecols=(0,))
-    #grname=numpy.loadtxt(datadir+"gratings.txt",dtype=str,usecols=(0,))
-    grlmm,grgam0,y0=numpy.loadtxt(datadir+"/gratings.txt",usecols=(1,2,3),
-                               unpack=True)
 
+class RSSModel(object):
+    """
 
-#
-    # Load all necessary information from FITS header
-    #
-    grating_angle = header['GR-ANGLE'] # alpha_C
-    articulation_angle = header['CAMANG'] #GRTILT'] # A_C
-    grating_name = header['GRATING']
+    Spectrograph model for one setup (grating, grating angle and camera
+    articulation angle), giving the wavelength for any position in the focal
+    plane.
 
-    logger.debug("grating-angle: %f" % (grating_angle))
-    logger.debug("articulation angle: %f" % (articulation_angle))
-    logger.debug("grating name: %s" % (grating_name))
+    The wavelength only depends on the position through _x/fcam and
+    _y/fcam (positions in mm relative to the center), and on _y only via
+    cos(_y/fcam). The camera focal length fcam in turn depends on the
+    wavelength, and is refined iteratively.
 
-    
-    # get grating data: lines per mm
-    #grnum = numpy.where(grname==grating)[0][0]
-    #lmm = grlmm[grnum]
-    grnum = numpy.where(grating_names==grating_name)[0][0]
-    grating_lines_per_mm = grlmm[grating_name == grating_names][0]
-    logger.debug("grating lines/mm: %f" % (grating_lines_per_mm))
+    """
 
+    def __init__(self, grating_name, grating_angle, articulation_angle):
+        logger = logging.getLogger("RSS-2Dmodel")
+        tables = instrument_tables()
 
-    if (y_center is None):
-        y_center = y0[grating_name==grating_names]
-    if (x_center is None):
-        x_center = img.shape[1] / 2. * xbin
-    logger.info("Using (un-binned) center coordinates of x=%.2f, y=%.2f" % (
-        x_center, y_center))
+        spec = tables['spec']
+        Grat0,Home0,ArtErr,T2Con,T3Con=spec[0:5]
+        self.FCampoly=spec[5:11]
 
+        logger.debug("grating-angle: %f" % (grating_angle))
+        logger.debug("articulation angle: %f" % (articulation_angle))
+        logger.debug("grating name: %s" % (grating_name))
 
+        # get grating data: lines per mm
+        grnum = numpy.where(tables['grating_names'] == grating_name)[0][0]
+        self.grating_lines_per_mm = tables['lines_per_mm'][grnum]
+        self.y0 = tables['y0'][grnum]
+        logger.debug("grating lines/mm: %f" % (self.grating_lines_per_mm))
 
-    #alpha_r = numpy.radians(grang+Grat0)
-    alpha_r = numpy.radians(grating_angle+Grat0)
-    #beta0_r = numpy.radians(artic*(1+ArtErr)+Home0)-alpha_r
-    beta0_r = numpy.radians(articulation_angle*(1+ArtErr)+Home0)-alpha_r
-    gam0_r = numpy.radians(grgam0[grnum])
+        self.alpha_r = numpy.radians(grating_angle+Grat0)
+        self.beta0_r = numpy.radians(articulation_angle*(1+ArtErr)+Home0)-self.alpha_r
+        gam0_r = numpy.radians(tables['gamma0'][grnum])
 
-    logger.debug("alpha-r: %f" % (alpha_r))
-    logger.debug("beta_r : %f" % (beta0_r))
-    logger.debug("gamma_r: %f" % (gam0_r))
+        logger.debug("alpha-r: %f" % (self.alpha_r))
+        logger.debug("beta_r : %f" % (self.beta0_r))
+        logger.debug("gamma_r: %f" % (gam0_r))
 
-    # compute reference wavelength at center of focal plane
-    #lam0 = 1e7*numpy.cos(gam0_r)*(numpy.sin(alpha_r) + numpy.sin(beta0_r))/lmm
-    lam0 = 1e7*numpy.cos(gam0_r)*(numpy.sin(alpha_r) + numpy.sin(beta0_r))/grating_lines_per_mm
-    logger.debug("reference wavelength: %f" % (lam0))
+        # compute reference wavelength at center of focal plane
+        lam0 = 1e7*numpy.cos(gam0_r)*(numpy.sin(self.alpha_r) + numpy.sin(self.beta0_r))/self.grating_lines_per_mm
+        logger.debug("reference wavelength: %f" % (lam0))
 
-    # compute camera focal length
-    ww = (lam0-4000.)/1000.
-    fcam = numpy.polyval(FCampoly,ww)
-    logger.debug("camera focal length @ 4000A: %f mm" %(fcam))
+        # compute camera focal length
+        ww = (lam0-4000.)/1000.
+        self.fcam0 = numpy.polyval(self.FCampoly,ww)
+        logger.debug("camera focal length @ 4000A: %f mm" %(self.fcam0))
 
-    # compute dispersion per pixel
-    disp = (1e7*numpy.cos(gam0_r)*numpy.cos(beta0_r)/grating_lines_per_mm) / (fcam/.015)
-    #disp = (1e7*numpy.cos(gam0_r)*numpy.cos(beta0_r)/lmm)/(fcam/.015)
-    logger.debug("dispersion: %f angstroems/pixel [unbinned]" % (disp))
+        # compute dispersion per pixel
+        disp = (1e7*numpy.cos(gam0_r)*numpy.cos(self.beta0_r)/self.grating_lines_per_mm) / (self.fcam0/.015)
+        logger.debug("dispersion: %f angstroems/pixel [unbinned]" % (disp))
 
+    def wavelength(self, _x, _y, n_iterations=4):
+        """
 
-    # 
-    # Iteratively compute a lambda for each pixel, refine the focal length as 
-    # fct of lambda, and recompute lambda
-    # 
-    _x = (x - x_center) * 0.015 #/ 3162.
-    _y = (y - y_center) * 0.015 # / 2048.
-    logger.debug("min/max X: %f / %f" % (numpy.min(x), numpy.max(x)))
-    logger.debug("min/max Y: %f / %f" % (numpy.min(y), numpy.max(y)))
+        Wavelength at focal plane positions _x, _y (in mm relative to the
+        center, any shapes that can be broadcast against each other).
 
-    logger.debug("min/max _X [mm]: %f / %f" % (numpy.min(_x), numpy.max(_x)))
-    logger.debug("min/max _Y [mm]: %f / %f" % (numpy.min(_y), numpy.max(_y)))
+        """
+        # the first iteration uses the same focal length everywhere, so it
+        # can be computed separately for _x and _y
+        fcam = self.fcam0
+        for iteration in range(n_iterations):
+            beta = _x/fcam + self.beta0_r
+            gamma = _y/fcam #+ gam0_r
+
+            # compute lambda (1e7 = angstroem/mm)
+            _lambda = 1e7 * numpy.cos(gamma) * (numpy.sin(beta) + numpy.sin(self.alpha_r)) / self.grating_lines_per_mm
+
+            if (iteration < n_iterations-1):
+                L = (_lambda - 4000.) / 1000.
+                fcam = numpy.polyval(self.FCampoly,L)
+
+        return _lambda
+
+    def wavelength_map(self, shape, xbin=1, ybin=1,
+                       y_center=None, x_center=None):
+        """
+
+        Wavelength of each pixel of a frame of the given shape and binning,
+        with center coordinates given in un-binned pixels.
+
+        Since the wavelength only depends on the absolute distance from
+        y_center, it is only computed once for each pair of rows on either
+        side of the center.
+
+        """
+        if (y_center is None):
+            y_center = self.y0
+        if (x_center is None):
+            x_center = shape[1] / 2. * xbin
 
-    alpha = numpy.ones(x.shape) * alpha_r
-    for iteration in range(4):
-        logger.debug("working on iterative correction for fcam(lambda) - iteration %d" % (iteration+1))
-        beta = _x/fcam + beta0_r 
-        gamma = _y/fcam #+ gam0_r
-        #print beta.shape, gamma.shape
+        _x = (numpy.arange(shape[1]) * xbin - x_center) * 0.015
+        _y = (numpy.arange(shape[0]) * ybin - y_center) * 0.015
+        abs_y, row_index = numpy.unique(numpy.fabs(_y), return_inverse=True)
 
-        # compute lambda (1e7 = angstroem/mm)
-        _lambda = 1e7 * numpy.cos(gamma) * (numpy.sin(beta) + numpy.sin(alpha)) / grating_lines_per_mm
+        _lambda = self.wavelength(_x.reshape((1,-1)), abs_y.reshape((-1,1)))
+        return _lambda[row_index]
 
-        L = (_lambda - 4000.) / 1000.
-        fcam = numpy.polyval(FCampoly,L)
-        #print "ITER", iteration, fcam.shape
 
-        if (debug):
-            fits.PrimaryHDU(data=_lambda).writeto("lambda_%d.fits" % (iteration+1), clobber=True)
+def get_model(header):
+    """
+
+    Return the (memoized) spectrograph model for the setup in header.
+
+    """
+    key = (header['GRATING'], header['GR-ANGLE'], header['CAMANG'])
+    if (key not in _models):
+        _models[key] = RSSModel(
+            grating_name=header['GRATING'],
+            grating_angle=header['GR-ANGLE'],  # alpha_C
+            articulation_angle=header['CAMANG'],  # A_C
+        )
+    return _models[key]
 
-        
-    return _lambda
 
-        
-    # now compute F_cam as function of lambda_0
-    # use polynomial fit from ZEMAX camera model (that's step from Ken's docu)
-    dfcam = 3.162*disp*numpy.polyval([FCampoly[x]*(5-x) for x in range(5)],ww)
+def _cache_wlmap(key, wlmap):
+    _wlmap_cache[key] = wlmap
+    total_mb = sum([m.nbytes for m in _wlmap_cache.values()]) / 2.**20
+    while (total_mb > wlmap_cache_mb and len(_wlmap_cache) > 1):
+        _, dropped = _wlmap_cache.popitem(last=False)
+        total_mb -= dropped.nbytes / 2.**20
 
 
-    #T2 = -0.25*(1e7*numpy.cos(gam0_r)*numpy.sin(beta0_r)/lmm)/(fcam/47.43)**2 + T2Con*disp*dfcam
-    T2 = -0.25*(1e7*numpy.cos(gam0_r)*numpy.sin(beta0_r)/grating_lines_per_mm)/(fcam/47.43)**2 + T2Con*disp*dfcam
-    T3 = (-1./24.)*3162.*disp/(fcam/47.43)**2 + T3Con*disp
-    T0 = lam0 + T2 
-    T1 = 3162.*disp + 3*T3
+@stagetiming.timed()
+def rssmodelwave(#grating,grang,artic,cbin,refimg,
+        header, img,
+        xbin=1, ybin=1,
+        y_center=None, x_center=None,
+        debug=False,
+        x=None, y=None,
+):
+    """
+
+    Compute wavelengths from the RSS spectrograph model, either for each
+    pixel of img, or for the (binned) pixel positions x, y. Full-frame
+    wavelength maps are cached for each setup, binning, center and shape.
+
+    """
 
-    return
+    logger = logging.getLogger("RSS-2Dmodel")
 
+    model = get_model(header)
 
-    # compute normalized X-position (range [-1,1], X=0 is center of middle chip)
-    X = (numpy.array(range(cols))+1-cols/2)*cbin/3162.
+    if (y_center is None):
+        y_center = model.y0
+    if (x_center is None):
+        x_center = img.shape[1] / 2. * xbin
+    logger.info("Using (un-binned) center coordinates of x=%.2f, y=%.2f" % (
+        x_center, y_center))
+
+    if (x is None or y is None):
+        key = (header['GRATING'], header['GR-ANGLE'], header['CAMANG'],
+               xbin, ybin, float(y_center), float(x_center), img.shape)
+        if (key in _wlmap_cache):
+            logger.debug("Re-using wavelength map for this setup")
+            _wlmap_cache[key] = _wlmap_cache.pop(key)
+        else:
+            _cache_wlmap(key, model.wavelength_map(
+                img.shape, xbin=xbin, ybin=ybin,
+                y_center=y_center, x_center=x_center))
+        # return a copy, so callers can not change the cached map
+        _lambda = _wlmap_cache[key].copy()
+    else:
+        # also account for binning
+        _x = (x * xbin - x_center) * 0.015
+        _y = (y * ybin - y_center) * 0.015
+        _lambda = model.wavelength(_x, _y)
+
+    if (debug):
+        fits.PrimaryHDU(data=_lambda).writeto("lambda.fits", clobber=True)
 
-    lam_X = T0+T1*X+T2*(2*X**2-1)+T3*(4*X**3-3*X)
-    return lam_X
+    return _lambda
 
 
 if __name__ == "__main__":
@@ -12,10 +12,14 @@ import scipy.interpolate
 
 import find_sources
 import tracespec
+import debugartifacts
+import stagetiming
+import precision
 
 import pysalt.mp_logging
 
 
+@stagetiming.timed()
 def find_background_correction(hdulist=None,
                                img_data=None,
                                badrows=None,
@@ -25,7 +29,7 @@ def find_background_correction(hdulist=None,
     if (sources is None):
         # compute a source list (includes source position, extent, and intensity)
         prof, prof_var = find_sources.continuum_slit_profile(hdulist)
-        numpy.savetxt("source_profile", prof)
+        debugartifacts.save_array("source_profile", prof, stage="zeroback")
         sources = find_sources.identify_sources(prof, prof_var)
 
         print "="*50,"\n List of sources: \n","="*50
@@ -55,22 +59,25 @@ def find_background_correction(hdulist=None,
         img_data[int(src[0]-2*(src[0]-src[2])):
                  int(src[0]+2*(src[3]-src[0]))] = numpy.NaN
 
-    fits.PrimaryHDU(data=img_data).writeto("zeroback.fits", clobber=True)
+    debugartifacts.save_fits("zeroback", img_data, stage="zeroback")
 
     bg_level = numpy.nanmedian(img_data)
     print bg_level
 
     bg_slit = numpy.nanmedian(img_data, axis=1)
     print bg_slit.shape
-    numpy.savetxt("zeroslit", bg_slit)
+    debugartifacts.save_array("zeroslit", bg_slit, stage="zeroback")
 
     iy = numpy.arange(bg_slit.shape[0])
 
     good_data = numpy.isfinite(bg_slit)
     spline_in_y = iy[good_data]
     spline_in_bg = bg_slit[good_data]
-    numpy.savetxt("zerobg.spline.in", numpy.append(spline_in_y.reshape((-1,1)),
-                                                   spline_in_bg.reshape((-1,1)), axis=1))
+    debugartifacts.save_array(
+        "zerobg.spline.in",
+        lambda: numpy.append(spline_in_y.reshape((-1,1)),
+                             spline_in_bg.reshape((-1,1)), axis=1),
+        stage="zeroback")
 
 
     valid = numpy.isfinite(spline_in_bg)
@@ -104,13 +111,15 @@ def find_background_correction(hdulist=None,
         [iy, bg_slit,fit]
     ).T
     print combined.shape
-    numpy.savetxt("zerobg.fit", combined)
+    debugartifacts.save_array("zerobg.fit", combined, stage="zeroback")
 
     #
     # Compute a full 2-d model for the frame background
     #
-    _y, _x = numpy.indices(img_data.shape)
-    fullframe_bg = numpy.polyval(poly, _y)
+    # the background only depends on the row, so evaluate it once per row
+    fullframe_bg = numpy.empty(img_data.shape, dtype=precision.image_dtype)
+    fullframe_bg[:,:] = numpy.polyval(
+        poly, numpy.arange(img_data.shape[0])).reshape((-1,1))
 
     return fullframe_bg
 